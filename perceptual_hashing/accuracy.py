@@ -1,10 +1,22 @@
 #!/usr/bin/env python
-from .data_manager import VideoDataManager
+import multiprocessing
+
+import numpy as np
+
+from .catalog import VideoCatalog
+from .cpu_budget import current_budget
+from .data_manager import VideoDataManager, VideoDistance, VideoSet
+from .snapshot import parse_hash
+from .util import ints_to_words, popcount_words
 from .video_hashing import VideoHasher
 
 
 ################################################################################
 class CalculateAccuracy:
+    ############################################################################
+    # distances written between commits by calculate_distances
+    commit_every = 1 << 20
+
     ############################################################################
     def __init__(self, method, manager=None, verbose=True):
         self.verbose = verbose
@@ -15,25 +27,54 @@ class CalculateAccuracy:
             self._manager = VideoDataManager()
         self._methodid = self._manager.hash_dao.get_hash_method_by_name(method)
         self._memoized_distances = {}
+        self._video_sets = None
         return
 
+    ############################################################################
+    @property
+    def video_sets(self):
+        if self._video_sets is None:
+            vsdao = self._manager.videoset_dao
+            self._video_sets = vsdao.get_video_all_sets([self._method])
+        return self._video_sets
+
     ############################################################################
     def calculate_distances(self):
-        videos = self._manager.video_dao.all_videos()
-        for idx, a in enumerate(videos):
-            for b in videos[idx+1:]:
-                vd = self._methodcls.calculate_distance(a, b)
-                self._manager.distance_dao.add_distance(vd)
+        '''
+        store the distance of every pair of hashed videos, a row at a time:
+        the hash of a video against those of all videos after it
+        '''
+        videos = self._manager.video_dao.all_videos([self._method])
+        words = ints_to_words(
+            [parse_hash(v.hash_values[self._method].value,
+                        self._methodcls.hash_encoding) for v in videos],
+            self._methodcls.hash_bits())
+        ddao = self._manager.distance_dao
+        pending = 0
+        for idx in range(len(videos) - 1):
+            distances = popcount_words(words[idx] ^ words[idx + 1:])
+            pending += len(distances)
+            commit = (pending >= self.commit_every
+                      or idx == len(videos) - 2)
+            ddao.add_row(self._methodid, videos[idx], videos[idx + 1:],
+                         distances, commit)
+            if commit:
+                pending = 0
         return
 
     ############################################################################
-    def run(self):
+    def run(self, calculate=True):
+        '''
+        evaluate and store the accuracy; without calculate the distances
+        must be stored already
+        '''
         accuracy = self._manager.hash_dao.get_method_accuracy(self._methodid)
         if accuracy is not None and accuracy['accuracy'] is not None:
             print("{} Accuracy: {}".format(self._method, accuracy))
             return accuracy
 
-        self.calculate_distances()
+        if calculate:
+            self.calculate_distances()
         accuracy = self.best_accuracy()
         print("{} Accuracy: {}".format(self._method, accuracy))
         self._manager.hash_dao.set_method_accuracy(self._methodid, accuracy)
@@ -94,11 +135,11 @@ class CalculateAccuracy:
 
     ############################################################################
     def get_distance(self, methodid, a, b):
-        v = self._memoized_distances.get((methodid, a, b))
+        v = self._memoized_distances.get((a.id, b.id))
         if v is None:
             ddao = self._manager.distance_dao
             vd = ddao.get_distance(self._methodid, a, b)
-            self._memoized_distances[(methodid, a, b)] = vd
+            self._memoized_distances[(a.id, b.id)] = vd
             v = vd
         return v
 
@@ -116,7 +157,7 @@ class CalculateAccuracy:
         count = 0
         positive = 0
         negative = 0
-        for s in self._manager.videoset_dao.get_video_all_sets():
+        for s in self.video_sets:
             for idx, a in enumerate(s.videos):
                 for b in list(s.videos)[idx+1:]:
                     count += 1
@@ -128,11 +169,10 @@ class CalculateAccuracy:
 
     ############################################################################
     def _true_negatives(self, threshold):
-        vsdao = self._manager.videoset_dao
         count = 0
         positive = 0
         negative = 0
-        video_sets = vsdao.get_video_all_sets()
+        video_sets = self.video_sets
         for n, s1 in enumerate(video_sets):
             for a in s1.videos:
                 for s2 in video_sets[n+1:]:
@@ -143,3 +183,244 @@ class CalculateAccuracy:
                                                            threshold)
 
         return (count, positive, negative)
+
+
+################################################################################
+class CatalogAccuracy(CalculateAccuracy):
+    '''
+    accuracy of a single hash method over a catalog that has already been
+    loaded; never touches the database, so it can run on a worker process
+    '''
+
+    ############################################################################
+    def __init__(self, methodcls, videos, video_sets, verbose=False):
+        self.verbose = verbose
+        self._methodcls = methodcls
+        self._method = methodcls.hash_type()
+        self._manager = None
+        self._methodid = None
+        self._memoized_distances = {}
+        self._videos = [v for v in videos if self._method in v.hash_values]
+        hashed = set(v.id for v in self._videos)
+        self._video_sets = [VideoSet(s.id, set(v for v in s.videos
+                                               if v.id in hashed))
+                            for s in video_sets]
+        self.distances = []
+        return
+
+    ############################################################################
+    def calculate_distances(self):
+        for idx, a in enumerate(self._videos):
+            for b in self._videos[idx+1:]:
+                vd = self._methodcls.calculate_distance(a, b)
+                self._memoized_distances[(a.id, b.id)] = vd
+                self.distances.append(vd)
+        return
+
+    ############################################################################
+    def get_distance(self, methodid, a, b):
+        v = self._memoized_distances.get((a.id, b.id))
+        if v is None:
+            v = self._memoized_distances.get((b.id, a.id))
+        return v
+
+
+################################################################################
+class VectorAccuracy(CalculateAccuracy):
+    '''
+    accuracy of a single hash method over a catalog.VideoCatalog
+
+    the distances of every pair of set members are computed in blocks of at
+    most block_words words and only kept as two histograms, of the pairs
+    within a set and of the pairs across sets, so the count for any
+    threshold is a lookup in their cumulative sums
+    '''
+
+    ############################################################################
+    block_words = 1 << 22
+
+    ############################################################################
+    def __init__(self, methodcls, catalog, verbose=False):
+        self.verbose = verbose
+        self._methodcls = methodcls
+        self._method = methodcls.hash_type()
+        self._manager = None
+        self._methodid = None
+        self._catalog = catalog
+        self._positives = None
+        self._negatives = None
+        return
+
+    ############################################################################
+    def histograms(self):
+        '''
+        histograms of the distances within and across sets
+        '''
+        if self._positives is not None:
+            return (self._positives, self._negatives)
+        catalog = self._catalog
+        members = catalog.set_members
+        members = members[catalog.hashed(self._method)[members]]
+        labels = catalog.set_labels[members]
+        words = catalog.words(self._method)[members]
+
+        n_bins = catalog.bits(self._method) + 1
+        positives = np.zeros(n_bins, dtype=np.int64)
+        negatives = np.zeros(n_bins, dtype=np.int64)
+        n = len(members)
+        block = max(1, self.block_words // max(1, n * words.shape[1]))
+        for s in range(0, n - 1, block):
+            rows = slice(s, min(s + block, n - 1))
+            d = popcount_words(words[rows, None, :] ^ words[None, s + 1:, :])
+            # column j of row i is member s + 1 + j; keep j >= i only
+            upper = np.triu(np.ones(d.shape, dtype=bool))
+            same = labels[rows, None] == labels[None, s + 1:]
+            positives += np.bincount(d[upper & same], minlength=n_bins)
+            negatives += np.bincount(d[upper & ~same], minlength=n_bins)
+        self._positives = np.cumsum(positives)
+        self._negatives = np.cumsum(negatives)
+        return (self._positives, self._negatives)
+
+    ############################################################################
+    def accuracy(self, threshold):
+        positives, negatives = self.histograms()
+        true_positives = int(positives[threshold - 1])
+        false_negatives = int(positives[-1]) - true_positives
+        false_positives = int(negatives[threshold - 1])
+        true_negatives = int(negatives[-1]) - false_positives
+        if self.verbose:
+            print('Threshold: {}, TP: {}, TN: {}, FP: {}, FN: {}'.format(
+                                                      threshold,
+                                                      true_positives,
+                                                      true_negatives,
+                                                      false_positives,
+                                                      false_negatives))
+
+        return ((true_positives + true_negatives) /
+                (int(positives[-1]) + int(negatives[-1])),
+                true_positives,
+                true_negatives,
+                false_positives,
+                false_negatives)
+
+
+################################################################################
+_worker_catalog = None
+
+
+################################################################################
+def _init_worker(videos, video_sets):
+    global _worker_catalog
+    _worker_catalog = (videos, video_sets)
+    return
+
+
+################################################################################
+def _evaluate_method(job):
+    methodcls, verbose = job
+    videos, video_sets = _worker_catalog
+    calc = CatalogAccuracy(methodcls, videos, video_sets, verbose)
+    calc.calculate_distances()
+    distances = [(d.a.id, d.b.id, d.method, d.distance)
+                 for d in calc.distances]
+    return (calc._method, calc.best_accuracy(), distances)
+
+
+################################################################################
+class MultiMethodAccuracy:
+    '''
+    evaluate several hash methods at once: the video and set catalog is read
+    from the database a single time, every method is evaluated on its own
+    worker process and all results are written back in one transaction.
+    without store_distances the pairwise distances are not kept and the
+    methods are evaluated on a VideoCatalog by VectorAccuracy instead
+    '''
+
+    ############################################################################
+    def __init__(self, methods, manager=None, processes=None, verbose=False,
+                 store_distances=True):
+        self.verbose = verbose
+        self.processes = processes
+        self.store_distances = store_distances
+        self._methods = list(methods)
+        self._manager = manager
+        if self._manager is None:
+            self._manager = VideoDataManager()
+        return
+
+    ############################################################################
+    def _evaluate(self, methods, videos, video_sets):
+        jobs = [(VideoHasher.get_hashmethod_class(m), self.verbose)
+                for m in methods]
+        processes = self.processes or current_budget().cores
+        processes = min(processes, len(jobs))
+
+        if processes <= 1:
+            _init_worker(videos, video_sets)
+            return [_evaluate_method(job) for job in jobs]
+
+        with multiprocessing.Pool(processes, _init_worker,
+                                  (videos, video_sets)) as pool:
+            return pool.map(_evaluate_method, jobs)
+
+    ############################################################################
+    def run(self):
+        hdao = self._manager.hash_dao
+        results = {}
+        method_ids = {}
+        pending = []
+        for method in self._methods:
+            method_ids[method] = hdao.get_hash_method_by_name(method)
+            accuracy = hdao.get_method_accuracy(method_ids[method])
+            if accuracy is not None and accuracy['accuracy'] is not None:
+                print("{} Accuracy: {}".format(method, accuracy))
+                results[method] = accuracy['accuracy']
+            else:
+                pending.append(method)
+
+        if len(pending) == 0:
+            return results
+
+        if not self.store_distances:
+            return self._run_vectorized(pending, method_ids, results)
+
+        videos = self._manager.video_dao.all_videos(pending)
+        video_sets = self._manager.videoset_dao.get_video_all_sets(pending)
+        evaluated = self._evaluate(pending, videos, video_sets)
+
+        by_id = {v.id: v for v in videos}
+        ddao = self._manager.distance_dao
+        try:
+            for method, accuracy, distances in evaluated:
+                print("{} Accuracy: {}".format(method, accuracy))
+                ddao.add_distances([VideoDistance(by_id[a], by_id[b],
+                                                  methodid, distance)
+                                    for a, b, methodid, distance
+                                    in distances], commit=False)
+                hdao.set_method_accuracy(method_ids[method], accuracy,
+                                         commit=False)
+                results[method] = accuracy['accuracy']
+            self._manager.conn.commit()
+        except Exception:
+            self._manager.conn.rollback()
+            raise
+        return results
+
+    ############################################################################
+    def _run_vectorized(self, methods, method_ids, results):
+        catalog = VideoCatalog.from_manager(self._manager, methods)
+        hdao = self._manager.hash_dao
+        try:
+            for method in methods:
+                accuracy = VectorAccuracy(
+                    VideoHasher.get_hashmethod_class(method), catalog,
+                    self.verbose).best_accuracy()
+                print("{} Accuracy: {}".format(method, accuracy))
+                hdao.set_method_accuracy(method_ids[method], accuracy,
+                                         commit=False)
+                results[method] = accuracy['accuracy']
+            self._manager.conn.commit()
+        except Exception:
+            self._manager.conn.rollback()
+            raise
+        return results
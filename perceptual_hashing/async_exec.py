@@ -0,0 +1,185 @@
+#!/usr/bin/env python
+import asyncio
+import json
+import time
+
+
+################################################################################
+class ProcessResult:
+    ############################################################################
+    def __init__(self, argv, returncode, stdout, stderr, elapsed):
+        self.argv = argv
+        self.returncode = returncode
+        self.stdout = stdout
+        self.stderr = stderr
+        self.elapsed = elapsed
+        return
+
+    ############################################################################
+    def __repr__(self):
+        return 'ProcessResult({}, {})'.format(self.argv[0], self.returncode)
+
+
+################################################################################
+class AsyncRunner:
+    '''
+    runs external processes from an asyncio event loop, at most limit at
+    once; a process that runs past its timeout, or whose task is cancelled,
+    is killed and reaped before the error is raised
+    '''
+
+    ############################################################################
+    def __init__(self, limit=32, timeout=None):
+        self.limit = limit
+        self.timeout = timeout
+        self._semaphore = None
+        return
+
+    ############################################################################
+    @property
+    def semaphore(self):
+        # created on first use, inside the running loop
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.limit)
+        return self._semaphore
+
+    ############################################################################
+    @staticmethod
+    async def _kill(proc):
+        if proc.returncode is None:
+            try:
+                proc.kill()
+            except ProcessLookupError:
+                pass
+        # drain the pipes so the transport is closed on this loop
+        await proc.communicate()
+        return
+
+    ############################################################################
+    async def run(self, argv, timeout=None, stdin=None):
+        '''
+        run argv to completion and return its ProcessResult
+        '''
+        if timeout is None:
+            timeout = self.timeout
+        async with self.semaphore:
+            start = time.perf_counter()
+            proc = await asyncio.create_subprocess_exec(
+                *argv,
+                stdin=asyncio.subprocess.PIPE if stdin is not None else None,
+                stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.PIPE)
+            try:
+                stdout, stderr = await asyncio.wait_for(
+                    proc.communicate(stdin), timeout)
+            except asyncio.TimeoutError:
+                await self._kill(proc)
+                raise RuntimeError('Timed out after {}s: {}'.format(
+                    timeout, ' '.join(argv)))
+            except BaseException:
+                # cancelled
+                await self._kill(proc)
+                raise
+            return ProcessResult(argv, proc.returncode, stdout, stderr,
+                                 time.perf_counter() - start)
+
+    ############################################################################
+    async def records(self, argv, read, timeout=None):
+        '''
+        yield the records the coroutine function read(stream) parses from the
+        stdout of argv, until it returns None; the timeout is per record.
+        aclose() the generator to stop the process early
+        '''
+        if timeout is None:
+            timeout = self.timeout
+        async with self.semaphore:
+            proc = await asyncio.create_subprocess_exec(
+                *argv, stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.DEVNULL)
+            try:
+                while True:
+                    try:
+                        record = await asyncio.wait_for(read(proc.stdout),
+                                                        timeout)
+                    except asyncio.TimeoutError:
+                        raise RuntimeError('Timed out after {}s: {}'.format(
+                            timeout, ' '.join(argv)))
+                    if record is None:
+                        break
+                    yield record
+                await proc.wait()
+                if proc.returncode != 0:
+                    raise RuntimeError('{} exited with {}'.format(
+                        argv[0], proc.returncode))
+            finally:
+                await self._kill(proc)
+        return
+
+    ############################################################################
+    async def lines(self, argv, timeout=None):
+        '''
+        yield the stdout lines of argv as they are written; the timeout is
+        per line. aclose() the generator to stop the process early
+        '''
+        async def readline(stream):
+            line = await stream.readline()
+            if not line:
+                return None
+            return line.decode('utf-8', 'replace').rstrip('\n')
+
+        records = self.records(argv, readline, timeout)
+        try:
+            async for line in records:
+                yield line
+        finally:
+            await records.aclose()
+        return
+
+
+################################################################################
+def run_all(jobs, limit=32, timeout=None):
+    '''
+    run job(runner) for every coroutine function in jobs on one event loop
+    sharing an AsyncRunner; returns their results in order, with the
+    exception a job raised in place of its result
+    '''
+    async def main():
+        runner = AsyncRunner(limit, timeout)
+        return await asyncio.gather(*[job(runner) for job in jobs],
+                                    return_exceptions=True)
+
+    if len(jobs) == 0:
+        return []
+    return asyncio.run(main())
+
+
+################################################################################
+async def probe(runner, filepath, timeout=None, count_frames=False):
+    '''
+    ffprobe information of the first video stream of filepath; with
+    count_frames its frames are decoded and counted into nb_read_frames
+    '''
+    argv = ['ffprobe', '-v', 'error', '-print_format', 'json',
+            '-show_streams', '-select_streams', 'v:0']
+    if count_frames:
+        argv.append('-count_frames')
+    result = await runner.run(argv + [filepath], timeout)
+    if result.returncode != 0:
+        raise RuntimeError('ffprobe failed on {}: {}'.format(
+            filepath, result.stderr.decode('utf-8', 'replace').strip()))
+    streams = json.loads(result.stdout.decode('utf-8')).get('streams', [])
+    if len(streams) == 0:
+        raise RuntimeError('No video stream: {}'.format(filepath))
+    return streams[0]
+
+
+################################################################################
+def probe_all(filepaths, limit=32, timeout=None):
+    '''
+    {filepath: video stream information} of the files that could be probed
+    '''
+    filepaths = list(filepaths)
+    jobs = [lambda runner, f=f: probe(runner, f, timeout) for f in filepaths]
+    results = run_all(jobs, limit, timeout)
+    return {f: info for f, info in zip(filepaths, results)
+            if not isinstance(info, BaseException)}
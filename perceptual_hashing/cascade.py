@@ -0,0 +1,253 @@
+#!/usr/bin/env python
+import math
+import sys
+from optparse import OptionParser
+
+import numpy as np
+
+from .data_manager import VideoDataManager
+from .util import ints_to_words, popcount_words, threshold_radius
+
+
+################################################################################
+class CascadeSearch:
+    '''
+    two-tier lookup for the LLE hashes
+
+    every LLE hash is stored with a 64-bit block-mean hash of the same
+    frames (HashDAO.get_coarse_hashes). a query first compares the coarse
+    hashes of the whole catalog, which is one word per video, and only the
+    videos within coarse_radius get the full 480-bit distance
+
+    the coarse radius is calibrated on the video sets with an even id and
+    the recall reported on the others, so the report does not measure the
+    radius on the pairs it was fitted to
+    '''
+
+    ############################################################################
+    def __init__(self, methodcls, manager=None, radius=None,
+                 coarse_radius=None):
+        self._methodcls = methodcls
+        self._manager = manager
+        if self._manager is None:
+            self._manager = VideoDataManager()
+        self.method = methodcls.hash_type()
+        self._radius = radius
+        self.coarse_radius = coarse_radius
+        # whether coarse_radius came from calibrate()
+        self.calibrated = False
+        self.ids = None
+        self._fine = None
+        self._coarse = None
+        return
+
+    ############################################################################
+    @property
+    def radius(self):
+        if self._radius is None:
+            hdao = self._manager.hash_dao
+            details = hdao.get_method_accuracy(
+                hdao.get_hash_method_by_name(self.method))
+            if details is None or details['threshold'] is None:
+                raise RuntimeError('No radius given and no threshold learned '
+                                   'for {}'.format(self.method))
+            max_distance = self._methodcls.max_threshold()
+            self._radius = threshold_radius(details['threshold'],
+                                            max_distance)
+        return self._radius
+
+    ############################################################################
+    def load(self):
+        '''
+        read the videos having both hashes
+        '''
+        hdao = self._manager.hash_dao
+        hashes = hdao.get_all_video_hashes([self.method])
+        coarse = hdao.get_coarse_hashes(self.method)
+        self.ids = np.array(sorted(n for n in hashes if n in coarse),
+                            dtype=np.int64)
+        ids = self.ids.tolist()
+        self._fine = ints_to_words(
+            [self._methodcls.hash_to_int(hashes[n][self.method])
+             for n in ids], self._methodcls.hash_bits())
+        self._coarse = ints_to_words([int(coarse[n]) for n in ids],
+                                     self._methodcls.coarse_bits)
+        return len(ids)
+
+    ############################################################################
+    def _fine_words(self, value):
+        if self.ids is None:
+            self.load()
+        return ints_to_words([self._methodcls.hash_to_int(value)],
+                             self._methodcls.hash_bits())
+
+    ############################################################################
+    def survivors(self, coarse_value):
+        '''
+        positions of the videos that pass the coarse filter
+        '''
+        if self.ids is None:
+            self.load()
+        coarse = ints_to_words([int(coarse_value)],
+                               self._methodcls.coarse_bits)
+        distances = popcount_words(self._coarse ^ coarse)
+        return np.flatnonzero(distances <= self.coarse_radius)
+
+    ############################################################################
+    def search(self, value, coarse_value):
+        '''
+        (video_id, distance) of the videos within radius that pass the coarse
+        filter, closest first
+        '''
+        fine = self._fine_words(value)
+        candidates = self.survivors(coarse_value)
+        distances = popcount_words(self._fine[candidates] ^ fine)
+        keep = distances <= self.radius
+        return self._ranked(candidates[keep], distances[keep])
+
+    ############################################################################
+    def exhaustive(self, value):
+        fine = self._fine_words(value)
+        distances = popcount_words(self._fine ^ fine)
+        found = np.flatnonzero(distances <= self.radius)
+        return self._ranked(found, distances[found])
+
+    ############################################################################
+    def _ranked(self, positions, distances):
+        order = np.lexsort((self.ids[positions], distances))
+        return list(zip(self.ids[positions][order].tolist(),
+                        distances[order].tolist()))
+
+    ############################################################################
+    def _set_pairs(self, calibration=None):
+        '''
+        (coarse distance, fine distance) of every pair of videos that share
+        a video set, and the video set members that have both hashes; only
+        the calibration sets (even ids) if calibration, only the others if
+        it is False
+        '''
+        if self.ids is None:
+            self.load()
+        position = {n: p for p, n in enumerate(self.ids.tolist())}
+        video_sets = self._manager.videoset_dao.get_video_all_sets(
+            [self.method])
+        a, b, members = [], [], []
+        for video_set in video_sets:
+            if (calibration is not None
+                    and (video_set.id % 2 == 0) != calibration):
+                continue
+            found = sorted(position[v.id] for v in video_set.videos
+                           if v.id in position)
+            members.extend(found)
+            for n, p in enumerate(found):
+                a.extend([p] * (len(found) - n - 1))
+                b.extend(found[n + 1:])
+        a = np.array(a, dtype=np.int64)
+        b = np.array(b, dtype=np.int64)
+        coarse = popcount_words(self._coarse[a] ^ self._coarse[b])
+        fine = popcount_words(self._fine[a] ^ self._fine[b])
+        return coarse, fine, members
+
+    ############################################################################
+    def calibrate(self, target_recall=0.99):
+        '''
+        smallest coarse radius that keeps target_recall of the pairs of the
+        calibration sets the exhaustive search finds
+        '''
+        coarse, fine, members = self._set_pairs(True)
+        found = np.sort(coarse[fine <= self.radius])
+        if len(found) == 0:
+            self.coarse_radius = 0
+        else:
+            n = max(1, math.ceil(target_recall * len(found)))
+            self.coarse_radius = int(found[n - 1])
+        self.calibrated = True
+        return self.coarse_radius
+
+    ############################################################################
+    def recall_report(self):
+        '''
+        recall loss of the cascade against the exhaustive search, over the
+        pairs of videos that share a video set, and the fraction of the
+        catalog that reaches the full comparison. a calibrated coarse
+        radius is only measured on the sets calibrate() did not use
+        '''
+        if self.coarse_radius is None:
+            self.calibrate()
+        held_out = None
+        if self.calibrated:
+            held_out = False
+        coarse, fine, members = self._set_pairs(held_out)
+        exhaustive = int(np.count_nonzero(fine <= self.radius))
+        cascade = int(np.count_nonzero((fine <= self.radius) &
+                                       (coarse <= self.coarse_radius)))
+
+        survivors = 0
+        for p in members:
+            survivors += int(np.count_nonzero(
+                popcount_words(self._coarse ^ self._coarse[p]) <=
+                self.coarse_radius))
+        candidate_fraction = 0.0
+        if members:
+            candidate_fraction = survivors / (len(members) * len(self.ids))
+
+        recall = 1.0
+        if exhaustive > 0:
+            recall = cascade / exhaustive
+        return {
+            'radius': self.radius,
+            'coarse_radius': self.coarse_radius,
+            'held_out': self.calibrated,
+            'set_pairs': len(fine),
+            'exhaustive_pairs': exhaustive,
+            'cascade_pairs': cascade,
+            'recall': recall,
+            'recall_loss': 1.0 - recall,
+            'candidate_fraction': candidate_fraction,
+        }
+
+
+################################################################################
+def main(argv):
+    from . import llehash  # noqa: F401
+    from .video_hashing import VideoHasher
+
+    parser = OptionParser(usage='%prog [options] method [method ...]')
+    parser.add_option('--db',
+                      action='store',
+                      dest='db',
+                      default='videohash.db',
+                      help='Database holding the catalog')
+    parser.add_option('-r', '--radius',
+                      action='store',
+                      type='int',
+                      dest='radius',
+                      default=None,
+                      help="LLE distance to match on (default: the method's "
+                           "learned threshold)")
+    parser.add_option('-c', '--coarse-radius',
+                      action='store',
+                      type='int',
+                      dest='coarse_radius',
+                      default=None,
+                      help='Coarse distance to prune on (default: calibrated '
+                           'on the video sets)')
+    parser.add_option('--target-recall',
+                      action='store',
+                      type='float',
+                      dest='target_recall',
+                      default=0.99,
+                      help='Recall the calibrated coarse radius keeps')
+    (opts, args) = parser.parse_args(argv[1:])
+    if len(args) < 1:
+        sys.stderr.write("Must specify at least one hash method\n")
+        sys.exit(1)
+
+    manager = VideoDataManager(opts.db)
+    for method in args:
+        cascade = CascadeSearch(VideoHasher.get_hashmethod_class(method),
+                                manager, opts.radius, opts.coarse_radius)
+        if opts.coarse_radius is None:
+            cascade.calibrate(opts.target_recall)
+        print('{}: {}'.format(method, cascade.recall_report()))
+    return
@@ -0,0 +1,172 @@
+#!/usr/bin/env python
+import numpy as np
+
+from .data_manager import Video
+from .snapshot import method_format, parse_hash
+from .util import ints_to_words, popcount_words, words_per_hash
+
+
+################################################################################
+class VideoCatalog:
+    '''
+    columnar, read-only view of the videos, video sets and hashes
+
+    every video gets a dense ordinal (its position in ids, which is sorted).
+    per video there is a set label (the video set id, -1 for none), and per
+    method a mask of the videos having a hash and an (n, words) uint64 matrix
+    of the hashes packed by util.ints_to_words. set membership is also kept
+    as a CSR index: the ordinals of the n-th of set_ids are
+    set_members[set_indptr[n]:set_indptr[n + 1]]. nothing here builds a
+    Video per row, so accuracy, search and clustering code can work on the
+    arrays directly
+    '''
+
+    ############################################################################
+    def __init__(self, ids, names, formats, set_labels):
+        self.ids = np.asarray(ids, dtype=np.int64)
+        if np.any(self.ids[1:] <= self.ids[:-1]):
+            raise RuntimeError('Catalog video ids must be sorted and unique')
+        self.names = list(names)
+        self.formats = list(formats)
+        self.set_labels = np.asarray(set_labels, dtype=np.int64)
+        self._hashes = {}
+
+        order = np.argsort(self.set_labels, kind='stable')
+        order = order[self.set_labels[order] >= 0]
+        labels = self.set_labels[order]
+        self.set_ids, starts = np.unique(labels, return_index=True)
+        self.set_indptr = np.append(starts, len(order)).astype(np.int64)
+        self.set_members = order.astype(np.int64)
+        return
+
+    ############################################################################
+    @classmethod
+    def from_manager(cls, manager, methods=()):
+        table = manager.video_dao.video_table()
+        catalog = cls([r[0] for r in table], [r[1] for r in table],
+                      [r[2] for r in table],
+                      [-1 if r[3] is None else r[3] for r in table])
+        hdao = manager.hash_dao
+        for method in methods:
+            bits, encoding = method_format(method)
+            hashes = hdao.get_all_video_hashes([method])
+            ids = sorted(hashes)
+            catalog.add_method(method, bits, ids, ints_to_words(
+                [parse_hash(hashes[n][method].value, encoding) for n in ids],
+                bits))
+        return catalog
+
+    ############################################################################
+    @classmethod
+    def from_snapshot(cls, snapshot, methods=None):
+        '''
+        catalog of a snapshot.HashSnapshot; the hash matrices are copied out
+        of the memory map only where a method misses some videos
+        '''
+        if methods is None:
+            methods = snapshot.methods
+        n = len(snapshot)
+        names = [snapshot.video_name(k) for k in range(n)]
+        catalog = cls(snapshot.video_ids, [v[0] for v in names],
+                      [v[1] for v in names], snapshot.set_ids)
+        for method in methods:
+            catalog.add_method(method, snapshot.method(method)['bits'],
+                               snapshot.ids(method), snapshot.words(method))
+        return catalog
+
+    ############################################################################
+    def add_method(self, method, bits, video_ids, words):
+        ordinals = self.ordinals(video_ids)
+        hashed = np.zeros(len(self), dtype=bool)
+        hashed[ordinals] = True
+        if np.array_equal(ordinals, np.arange(len(self))):
+            matrix = words
+        elif len(ordinals) == len(self):
+            matrix = np.asarray(words)[np.argsort(ordinals)]
+        else:
+            matrix = np.zeros((len(self), words_per_hash(bits)),
+                              dtype=np.uint64)
+            matrix[ordinals] = words
+        self._hashes[method] = (bits, hashed, matrix)
+        return
+
+    ############################################################################
+    def __len__(self):
+        return len(self.ids)
+
+    ############################################################################
+    @property
+    def methods(self):
+        return list(self._hashes)
+
+    ############################################################################
+    def ordinals(self, video_ids):
+        video_ids = np.asarray(video_ids, dtype=np.int64)
+        ordinals = np.searchsorted(self.ids, video_ids)
+        if len(video_ids) == 0:
+            return ordinals
+        if (np.any(ordinals >= len(self.ids))
+                or np.any(self.ids[np.minimum(ordinals, len(self) - 1)]
+                          != video_ids)):
+            raise RuntimeError('Video id not in catalog')
+        return ordinals
+
+    ############################################################################
+    def _method(self, method):
+        if method not in self._hashes:
+            raise RuntimeError('Method not in catalog: {}'.format(method))
+        return self._hashes[method]
+
+    ############################################################################
+    def bits(self, method):
+        return self._method(method)[0]
+
+    ############################################################################
+    def hashed(self, method):
+        '''
+        mask of the videos having a hash of method
+        '''
+        return self._method(method)[1]
+
+    ############################################################################
+    def words(self, method):
+        '''
+        (n, words) hash matrix of method by ordinal; rows of videos without
+        a hash are zero
+        '''
+        return self._method(method)[2]
+
+    ############################################################################
+    @property
+    def n_sets(self):
+        return len(self.set_ids)
+
+    ############################################################################
+    def members(self, n):
+        '''
+        ordinals of the n-th video set
+        '''
+        return self.set_members[self.set_indptr[n]:self.set_indptr[n + 1]]
+
+    ############################################################################
+    def distances(self, method, a, b):
+        '''
+        hamming distances between the videos at ordinals a and b
+        '''
+        words = self.words(method)
+        return popcount_words(words[a] ^ words[b])
+
+    ############################################################################
+    def distances_from(self, method, h):
+        '''
+        distance from the integer hash h to every video; videos without a
+        hash get -1
+        '''
+        bits, hashed, words = self._method(method)
+        d = popcount_words(words ^ ints_to_words([h], bits))
+        d[~hashed] = -1
+        return d
+
+    ############################################################################
+    def video(self, n):
+        return Video(self.names[n], self.formats[n], video_id=int(self.ids[n]))
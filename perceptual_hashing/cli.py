@@ -14,9 +14,12 @@ from .llehash import (LLE16x16PointHash,
                       LLE16x16in256x256OneDimensionLuminHash,
                       LLE16x16in256x256LowGauss1d,
                       )
-from .video_preprocessing import VideoTranscoder
+from .video_preprocessing import VideoTranscoder, StreamingTranscoder
 from .data_manager import VideoDataManager
-from .accuracy import CalculateAccuracy
+from .accuracy import MultiMethodAccuracy
+from .work_queue import WorkQueue, QueueWorker
+from .pipeline import PipelineRunner
+from .cpu_budget import CpuBudget, warn_if_uncapped
 
 
 ################################################################################
@@ -58,7 +61,90 @@ class CLI:
                           dest='experiments',
                           default='all',
                           help='Comma separted list of experiments | "all"')
-
+        parser.add_option('--processes',
+                          action='store',
+                          dest='processes',
+                          default=None,
+                          help='Number of worker processes for accuracy ' +
+                               'evaluation (default: number of cores)')
+        parser.add_option('--cores',
+                          action='store',
+                          dest='cores',
+                          default=None,
+                          help='Cores shared by the --n_parts workers; ' +
+                               'this part gets its share for BLAS, sklearn, ' +
+                               'ffmpeg and process pools ' +
+                               '(default: all available)')
+        parser.add_option('--pin',
+                          action='store_true',
+                          dest='pin',
+                          default=False,
+                          help='Restrict this worker to the cpus of its ' +
+                               'share of the cores')
+        parser.add_option('--transcode-jobs',
+                          action='store',
+                          dest='transcode_jobs',
+                          default=None,
+                          help='Number of ffmpeg transcodes run at once; ' +
+                               'the cores are shared out between them ' +
+                               '(default: number of cores)')
+        parser.add_option('--subprocesses',
+                          action='store',
+                          dest='subprocesses',
+                          default=None,
+                          help='Number of phash and ffprobe processes run ' +
+                               'at once while hashing (default: 1)')
+        parser.add_option('--stream',
+                          action='store_true',
+                          dest='stream',
+                          default=False,
+                          help='Hash the transcoded variants straight from ' +
+                               'an ffmpeg pipe instead of writing them to ' +
+                               'disk (only for hashers that take frames)')
+        parser.add_option('--pipeline',
+                          action='store_true',
+                          dest='pipeline',
+                          default=False,
+                          help='Transcode, hash and compute distances as ' +
+                               'concurrent stages instead of one phase ' +
+                               'after the other')
+        parser.add_option('--distance-store',
+                          action='store',
+                          dest='distance_store',
+                          default='sqlite',
+                          help='Where pairwise distances are kept: ' +
+                               '"sqlite" | "matrix"')
+        parser.add_option('--no-distances',
+                          action='store_false',
+                          dest='store_distances',
+                          default=True,
+                          help='Evaluate accuracy without storing the ' +
+                               'pairwise distances')
+        parser.add_option('--db',
+                          action='store',
+                          dest='db',
+                          default='videohash.db',
+                          help='Database to write to, e.g. a shard of ' +
+                               'this worker for merge_shards')
+        parser.add_option('--queue',
+                          action='store_true',
+                          dest='queue',
+                          default=False,
+                          help='Pull (video, method) hashing tasks from the ' +
+                               'shared task queue instead of hashing a ' +
+                               '--part of the methods')
+        parser.add_option('--lease',
+                          action='store',
+                          dest='lease',
+                          default=300,
+                          help='Seconds a queued task is leased for before ' +
+                               'other workers may reclaim it')
+        parser.add_option('--worker-id',
+                          action='store',
+                          dest='worker_id',
+                          default=None,
+                          help='Name of this queue worker ' +
+                               '(default: host:pid)')
 
         (opts, args) = parser.parse_args()
         if len(args) < 1 or not os.path.isdir(args[0]):
@@ -71,15 +157,54 @@ class CLI:
         if opts.experiments != 'all':
             self.experiments = set(opts.experiments.split(','))
 
-        self.parts = self.get_partition_list(int(opts.part),
-                                             int(opts.n_parts),
-                                             self.experiments)
+        self.queue = None
+        if opts.queue:
+            # every worker takes tasks of all the experiments
+            self.parts = self.get_partition_list(1, 1, self.experiments)
+        else:
+            self.parts = self.get_partition_list(int(opts.part),
+                                                 int(opts.n_parts),
+                                                 self.experiments)
         self.force = opts.force
+        cores = None
+        if opts.cores is not None:
+            cores = int(opts.cores)
+        budget = CpuBudget(cores)
+        if not opts.queue:
+            budget = budget.share(int(opts.part), int(opts.n_parts))
+        self.budget = budget.apply(pin=opts.pin)
+        warn_if_uncapped()
+        self.processes = None
+        if opts.processes is not None:
+            self.processes = int(opts.processes)
+        self.transcode_jobs = None
+        if opts.transcode_jobs is not None:
+            self.transcode_jobs = int(opts.transcode_jobs)
+        self.subprocesses = None
+        if opts.subprocesses is not None:
+            self.subprocesses = int(opts.subprocesses)
+        self.store_distances = opts.store_distances
+        self.stream = opts.stream
+        self.pipeline = opts.pipeline
+        if self.pipeline and (opts.queue or opts.stream
+                              or not opts.store_distances):
+            sys.stderr.write("--pipeline cannot be combined with --queue, " +
+                             "--stream or --no-distances\n")
+            sys.exit(1)
         self.path = args[0]
-        self.manager = VideoDataManager()
+        self.manager = VideoDataManager(
+            opts.db, distance_store=opts.distance_store)
+        if opts.queue:
+            self.queue = WorkQueue(self.manager, worker=opts.worker_id,
+                                   lease_seconds=float(opts.lease))
 
     ############################################################################
     def run(self):
+        if self.pipeline:
+            PipelineRunner(self.path, self.parts, self.manager,
+                           force=self.force,
+                           transcode_jobs=self.transcode_jobs).run()
+            return
         self.runSetupSteps()
         self.runHashingSteps()
         self.runAccuracySteps()
@@ -87,7 +212,20 @@ class CLI:
 
     ############################################################################
     def runSetupSteps(self):
-        steps = [VideoTranscoder(self.path, self.manager, force=self.force)]
+        if self.stream:
+            hashers = [cl(self.path, self.manager, force=self.force)
+                       for cl in self.parts if cl.supports_frames]
+            skipped = [cl.__name__ for cl in self.parts
+                       if not cl.supports_frames]
+            if skipped:
+                print('Not streamed, only the sources are hashed: {}'.format(
+                    ', '.join(skipped)))
+            StreamingTranscoder(self.path, self.manager, hashers,
+                                force=self.force).run()
+            return
+
+        steps = [VideoTranscoder(self.path, self.manager, force=self.force,
+                                 processes=self.transcode_jobs)]
 
         for step in steps:
             step.run()
@@ -95,20 +233,39 @@ class CLI:
 
     ############################################################################
     def runHashingSteps(self):
+        if self.queue is not None:
+            return self.runQueuedHashing()
         steps = [cl(self.path, self.manager, force=self.force)
                  for cl in self.parts]
 
         for step in steps:
+            if self.subprocesses is not None:
+                step.concurrency = self.subprocesses
             step.run()
         return
 
     ############################################################################
-    def runAccuracySteps(self):
-        steps = [CalculateAccuracy(cl.hash_type(), self.manager)
-                 for cl in self.parts]
-
-        for step in steps:
-            print('Running accuracy for {}'.format(step._method))
-            step.run()
+    def runQueuedHashing(self):
+        hashers = {cl.hash_type(): cl(self.path, self.manager,
+                                      force=self.force)
+                   for cl in self.parts}
+        self.queue.enqueue(list(hashers), force=self.force)
+        done, failed = QueueWorker(self.queue, self.path, hashers).run()
+        print('{}: hashed {} tasks, {} failed'.format(self.queue.worker,
+                                                      done, failed))
+        return
 
+    ############################################################################
+    def runAccuracySteps(self):
+        if self.queue is not None and not self.queue.is_finished():
+            # accuracy is left to the worker that finishes the queue
+            for method, counts in sorted(self.queue.progress().items()):
+                print('{}: {} of {} tasks done'.format(
+                    method, counts['done'], sum(counts.values())))
+            return
+        methods = [cl.hash_type() for cl in self.parts]
+        print('Running accuracy for {}'.format(', '.join(methods)))
+        MultiMethodAccuracy(methods, self.manager,
+                            processes=self.processes,
+                            store_distances=self.store_distances).run()
         return
@@ -0,0 +1,201 @@
+#!/usr/bin/env python
+import sqlite3
+import threading
+import time
+
+# applied, in order, to every connection that is opened
+DEFAULT_PRAGMAS = (
+    ('journal_mode', 'WAL'),
+    ('synchronous', 'NORMAL'),
+    ('cache_size', -65536),
+    ('mmap_size', 268435456),
+    ('temp_store', 'MEMORY'),
+    ('foreign_keys', 'ON'),
+)
+
+
+################################################################################
+def is_busy_error(err):
+    msg = str(err).lower()
+    return 'locked' in msg or 'busy' in msg
+
+
+################################################################################
+class RetryingCursor:
+    '''
+    sqlite3 cursor whose statements are retried while the database is
+    locked by another connection
+    '''
+
+    ############################################################################
+    def __init__(self, cursor, manager):
+        self._cursor = cursor
+        self._manager = manager
+        return
+
+    ############################################################################
+    def execute(self, sql, params=()):
+        self._manager.retry(self._cursor.execute, sql, params)
+        return self
+
+    ############################################################################
+    def executemany(self, sql, params):
+        self._manager.retry(self._cursor.executemany, sql, params)
+        return self
+
+    ############################################################################
+    def __iter__(self):
+        return iter(self._cursor)
+
+    ############################################################################
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+
+################################################################################
+class ConnectionManager:
+    '''
+    one sqlite3 connection per thread to the same database file
+
+    every connection gets the configured pragmas, a busy timeout and
+    "BEGIN IMMEDIATE" write transactions, so concurrent writers queue on the
+    lock instead of failing on a read-to-write upgrade. the manager exposes
+    the parts of the sqlite3.Connection API the DAOs use, each call going to
+    the connection of the calling thread.
+    '''
+
+    ############################################################################
+    def __init__(self, path, pragmas=DEFAULT_PRAGMAS, timeout=30.0,
+                 retries=5, retry_delay=0.05, isolation_level='IMMEDIATE'):
+        self.path = path
+        self.pragmas = list(pragmas)
+        self.timeout = timeout
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self.isolation_level = isolation_level
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._connections = []
+        # called after every rollback, on the thread that rolled back
+        self.on_rollback = []
+        return
+
+    ############################################################################
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=self.timeout,
+                               isolation_level=self.isolation_level,
+                               check_same_thread=False)
+        for name, value in self.pragmas:
+            self._retry(conn, False, conn.execute,
+                        'PRAGMA {} = {}'.format(name, value))
+        with self._lock:
+            self._connections.append(conn)
+        return conn
+
+    ############################################################################
+    @property
+    def connection(self):
+        conn = getattr(self._local, 'connection', None)
+        if conn is None:
+            conn = self._connect()
+            self._local.connection = conn
+        return conn
+
+    ############################################################################
+    def _retry(self, conn, always, fn, *args):
+        delay = self.retry_delay
+        for attempt in range(self.retries + 1):
+            try:
+                return fn(*args)
+            except sqlite3.OperationalError as err:
+                # a statement that failed inside a transaction cannot be
+                # replayed on its own; let the caller roll back
+                if (not is_busy_error(err) or attempt == self.retries
+                        or (conn.in_transaction and not always)):
+                    raise
+            time.sleep(delay)
+            delay *= 2
+        return None
+
+    ############################################################################
+    def retry(self, fn, *args):
+        return self._retry(self.connection, False, fn, *args)
+
+    ############################################################################
+    def cursor(self):
+        return RetryingCursor(self.connection.cursor(), self)
+
+    ############################################################################
+    def execute(self, sql, params=()):
+        return self.cursor().execute(sql, params)
+
+    ############################################################################
+    def executemany(self, sql, params):
+        return self.cursor().executemany(sql, params)
+
+    ############################################################################
+    def commit(self):
+        conn = self.connection
+        return self._retry(conn, True, conn.commit)
+
+    ############################################################################
+    def rollback(self):
+        result = self.connection.rollback()
+        for callback in self.on_rollback:
+            callback()
+        return result
+
+    ############################################################################
+    @property
+    def in_transaction(self):
+        return self.connection.in_transaction
+
+    ############################################################################
+    def set_trace_callback(self, callback):
+        return self.connection.set_trace_callback(callback)
+
+    ############################################################################
+    def pragma(self, name):
+        return self.connection.execute('PRAGMA {}'.format(name)).fetchone()[0]
+
+    ############################################################################
+    def migrate(self, migrations):
+        '''
+        bring the schema up to len(migrations); migrations[n] is the list of
+        statements that upgrades PRAGMA user_version n to n + 1
+        '''
+        if self.pragma('user_version') >= len(migrations):
+            return self.pragma('user_version')
+
+        conn = self.connection
+        self.retry(conn.execute, 'BEGIN IMMEDIATE')
+        try:
+            version = self.pragma('user_version')
+            for n, statements in enumerate(migrations[version:], version):
+                for sql in statements:
+                    conn.execute(sql)
+                conn.execute('PRAGMA user_version = {}'.format(n + 1))
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        return self.pragma('user_version')
+
+    ############################################################################
+    def close(self):
+        conn = getattr(self._local, 'connection', None)
+        if conn is not None:
+            self._local.connection = None
+            with self._lock:
+                self._connections.remove(conn)
+            conn.close()
+        return
+
+    ############################################################################
+    def close_all(self):
+        with self._lock:
+            connections, self._connections = self._connections, []
+        for conn in connections:
+            conn.close()
+        self._local = threading.local()
+        return
@@ -0,0 +1,219 @@
+#!/usr/bin/env python
+import multiprocessing
+import os
+import sys
+import time
+from optparse import OptionParser
+
+import numpy as np
+
+try:
+    from threadpoolctl import threadpool_limits
+except ImportError:
+    threadpool_limits = None
+
+# thread pool sizes read by BLAS/OpenMP libraries, and inherited by the
+# processes started after them
+THREAD_ENV_VARS = ['OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS',
+                   'MKL_NUM_THREADS', 'BLIS_NUM_THREADS',
+                   'VECLIB_MAXIMUM_THREADS', 'NUMEXPR_NUM_THREADS']
+
+_current = None
+
+
+################################################################################
+def available_cpus():
+    '''
+    ids of the cpus this process may run on
+    '''
+    if hasattr(os, 'sched_getaffinity'):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(multiprocessing.cpu_count()))
+
+
+################################################################################
+class CpuBudget:
+    '''
+    the cores one worker may keep busy
+
+    everything that starts threads or processes of its own sizes them from
+    the budget in force (current_budget()): the BLAS thread pools, the
+    n_jobs of sklearn, the ffmpeg -threads and the number of transcodes run
+    at once, and the default size of the accuracy and similarity join
+    process pools. workers run side by side (--part) each take a share(),
+    so together they do not ask for more cores than the machine has
+    '''
+
+    ############################################################################
+    def __init__(self, cores=None, cpus=None):
+        if cpus is None:
+            cpus = available_cpus()
+        self.cpus = list(cpus)
+        self.cores = cores or len(self.cpus)
+        if self.cores < 1:
+            raise RuntimeError('A cpu budget needs at least one core')
+        # the threadpoolctl limiter of apply(), which can restore the pools
+        self.thread_limits = None
+        return
+
+    ############################################################################
+    def __repr__(self):
+        return 'CpuBudget({}, {})'.format(self.cores, self.cpus)
+
+    ############################################################################
+    def share(self, n, n_parts):
+        '''
+        the budget of part n (1 based) of n_parts workers dividing this one;
+        the first parts take the cores left over by an uneven division
+        '''
+        if n < 1 or n > n_parts:
+            raise RuntimeError('Invalid partitioning')
+        if n_parts > self.cores:
+            # more workers than cores: one core each, taking turns
+            start, cores = n - 1, 1
+        else:
+            size, extra = divmod(self.cores, n_parts)
+            start = (n - 1) * size + min(n - 1, extra)
+            cores = size + (1 if n <= extra else 0)
+        cpus = sorted(set(self.cpus[i % len(self.cpus)]
+                          for i in range(start, start + cores)))
+        return CpuBudget(cores, cpus)
+
+    ############################################################################
+    def threads_for(self, jobs):
+        '''
+        threads each of jobs concurrent jobs may use
+        '''
+        return max(1, self.cores // max(1, jobs))
+
+    ############################################################################
+    def apply(self, pin=False):
+        '''
+        make this the budget in force: cap the BLAS thread pools, already
+        loaded ones through threadpoolctl when it is installed, and with
+        pin restrict the process to the cpus of the budget
+        '''
+        global _current
+        for var in THREAD_ENV_VARS:
+            os.environ[var] = str(self.cores)
+        if threadpool_limits is not None:
+            self.thread_limits = threadpool_limits(limits=self.cores)
+        if pin and hasattr(os, 'sched_setaffinity'):
+            os.sched_setaffinity(0, self.cpus)
+        _current = self
+        return self
+
+
+################################################################################
+def current_budget():
+    '''
+    the budget applied last, or all the cpus of the process
+    '''
+    if _current is None:
+        return CpuBudget()
+    return _current
+
+
+################################################################################
+def warn_if_uncapped(stream=None):
+    '''
+    warn on stream (stderr) when threadpoolctl is missing: the BLAS pools
+    numpy started on import then keep all their threads whatever the
+    budget. True if it warned
+    '''
+    if threadpool_limits is not None:
+        return False
+    (stream or sys.stderr).write('threadpoolctl is not installed: BLAS '
+                                 'pools already started are not capped\n')
+    return True
+
+
+################################################################################
+def splits(cores):
+    '''
+    the (workers, threads) pairs that use exactly cores
+    '''
+    return [(w, cores // w) for w in range(1, cores + 1) if cores % w == 0]
+
+
+################################################################################
+def _benchmark_task(job):
+    # the same kind of work as LLE hashing: a dense locally linear
+    # embedding of one video's worth of points
+    from sklearn.manifold import locally_linear_embedding
+    threads, points, seed = job
+    data = np.random.RandomState(seed).rand(points, 64)
+    locally_linear_embedding(data, n_neighbors=8, n_components=2,
+                             eigen_solver='dense', n_jobs=threads)
+    return
+
+
+################################################################################
+def _init_benchmark_worker(threads):
+    CpuBudget(threads).apply()
+    return
+
+
+################################################################################
+def benchmark(budget=None, tasks=None, points=400, candidates=None):
+    '''
+    time the same tasks under every workers x threads split of the budget;
+    returns [(workers, threads, seconds)], fastest first
+    '''
+    if budget is None:
+        budget = current_budget()
+    if candidates is None:
+        candidates = splits(budget.cores)
+    if tasks is None:
+        tasks = 2 * budget.cores
+
+    results = []
+    for workers, threads in candidates:
+        jobs = [(threads, points, seed) for seed in range(tasks)]
+        start = time.perf_counter()
+        # a pool even for one worker, so every split starts its BLAS afresh
+        with multiprocessing.Pool(workers, _init_benchmark_worker,
+                                  (threads,)) as pool:
+            pool.map(_benchmark_task, jobs)
+        results.append((workers, threads, time.perf_counter() - start))
+    return sorted(results, key=lambda r: r[2])
+
+
+################################################################################
+def main(argv):
+    parser = OptionParser(usage='%prog [options]')
+    parser.add_option('--cores',
+                      action='store',
+                      dest='cores',
+                      default=None,
+                      help='Cores to divide (default: all available)')
+    parser.add_option('--tasks',
+                      action='store',
+                      dest='tasks',
+                      default=None,
+                      help='Tasks timed per split (default: 2 per core)')
+    parser.add_option('--points',
+                      action='store',
+                      dest='points',
+                      default=400,
+                      help='Points embedded per task')
+    (opts, args) = parser.parse_args(argv[1:])
+    if len(args) > 0:
+        sys.stderr.write("Unexpected arguments: {}\n".format(' '.join(args)))
+        sys.exit(1)
+
+    cores = None
+    if opts.cores is not None:
+        cores = int(opts.cores)
+    tasks = None
+    if opts.tasks is not None:
+        tasks = int(opts.tasks)
+    warn_if_uncapped()
+
+    results = benchmark(CpuBudget(cores), tasks, int(opts.points))
+    for workers, threads, seconds in results:
+        print('{:3d} workers x {:3d} threads: {:.3f}s'.format(
+            workers, threads, seconds))
+    workers, threads, _ = results[0]
+    print('best: --n_parts {} with {} threads each'.format(workers, threads))
+    return
@@ -1,5 +1,189 @@
 #!/usr/bin/env python
-import sqlite3
+import os
+import threading
+
+from .connection import ConnectionManager, DEFAULT_PRAGMAS
+from .distance_matrix import DistanceMatrix
+
+DISTANCE_STORES = ('sqlite', 'matrix')
+
+# secondary indexes and later schema changes; SCHEMA_MIGRATIONS[n] upgrades
+# a database at PRAGMA user_version n to n + 1
+SCHEMA_MIGRATIONS = [
+    [
+        # the UNIQUE(video_id, hash_method_id) index already covers lookups
+        # by video, loading a single method needs the reverse order
+        '''
+        CREATE INDEX IF NOT EXISTS computed_hashes_method_video
+        ON computed_hashes (hash_method_id, video_id)
+        ''',
+        '''
+        CREATE INDEX IF NOT EXISTS video_set_memberships_video
+        ON video_set_memberships (video_id)
+        ''',
+        '''
+        CREATE INDEX IF NOT EXISTS video_distances_method
+        ON video_distances (method, a, b)
+        ''',
+        '''
+        CREATE INDEX IF NOT EXISTS video_distances_b
+        ON video_distances (b)
+        ''',
+    ],
+    [
+        # multi-index hashing tables, see mih.MultiIndexHash
+        '''
+        CREATE TABLE IF NOT EXISTS mih_substrings
+        (
+            method INTEGER NOT NULL,
+            chunk INTEGER NOT NULL,
+            key INTEGER NOT NULL,
+            video_id INTEGER(8) NOT NULL,
+            PRIMARY KEY (method, chunk, key, video_id),
+            FOREIGN KEY(video_id) REFERENCES video_info(id) ON DELETE CASCADE,
+            FOREIGN KEY (method) REFERENCES hash_methods(id)
+                ON DELETE CASCADE
+        ) WITHOUT ROWID
+        ''',
+        '''
+        CREATE INDEX IF NOT EXISTS mih_substrings_video
+        ON mih_substrings (video_id)
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS computed_hashes_mih_delete
+        AFTER DELETE ON computed_hashes
+        BEGIN
+            DELETE FROM mih_substrings
+            WHERE method = OLD.hash_method_id AND video_id = OLD.video_id;
+        END
+        ''',
+    ],
+    [
+        # near-duplicate clusters found by similarity_join.SimilarityJoin
+        '''
+        CREATE TABLE IF NOT EXISTS clusters
+        (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            method INTEGER NOT NULL,
+            radius INTEGER NOT NULL,
+            number_of_videos INTEGER NOT NULL,
+            date_added DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (method) REFERENCES hash_methods(id)
+                ON DELETE CASCADE
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS cluster_memberships
+        (
+            cluster_id INTEGER(8) NOT NULL,
+            video_id INTEGER(8) NOT NULL,
+            PRIMARY KEY(cluster_id, video_id),
+            FOREIGN KEY(video_id) REFERENCES video_info(id) ON DELETE CASCADE,
+            FOREIGN KEY(cluster_id) REFERENCES clusters(id) ON DELETE CASCADE
+        )
+        ''',
+        '''
+        CREATE INDEX IF NOT EXISTS clusters_method
+        ON clusters (method)
+        ''',
+        '''
+        CREATE INDEX IF NOT EXISTS cluster_memberships_video
+        ON cluster_memberships (video_id)
+        ''',
+    ],
+    [
+        # (video, method) hashing tasks, see work_queue.WorkQueue
+        '''
+        CREATE TABLE IF NOT EXISTS hash_tasks
+        (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            video_id INTEGER(8) NOT NULL,
+            method INTEGER NOT NULL,
+            state TEXT NOT NULL DEFAULT 'pending',
+            worker TEXT,
+            lease_expires REAL,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            error TEXT,
+            date_added DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP,
+            date_updated DATETIME,
+            UNIQUE(video_id, method),
+            FOREIGN KEY(video_id) REFERENCES video_info(id) ON DELETE CASCADE,
+            FOREIGN KEY (method) REFERENCES hash_methods(id)
+                ON DELETE CASCADE
+        )
+        ''',
+        '''
+        CREATE INDEX IF NOT EXISTS hash_tasks_state
+        ON hash_tasks (state, lease_expires)
+        ''',
+    ],
+    [
+        # sampled content digest, see util.content_digest
+        '''
+        ALTER TABLE video_info ADD COLUMN digest TEXT
+        ''',
+        '''
+        CREATE INDEX IF NOT EXISTS video_info_digest
+        ON video_info (digest)
+        ''',
+    ],
+    [
+        # block-mean hashes computed with the hash of their parent method,
+        # see cascade.CascadeSearch; they used to be stored as the hashes
+        # of a '<method>-coarse' method
+        '''
+        CREATE TABLE IF NOT EXISTS coarse_hashes
+        (
+            method INTEGER NOT NULL,
+            video_id INTEGER(8) NOT NULL,
+            hash_value TEXT NOT NULL,
+            PRIMARY KEY (method, video_id),
+            FOREIGN KEY(video_id) REFERENCES video_info(id) ON DELETE CASCADE,
+            FOREIGN KEY (method) REFERENCES hash_methods(id)
+                ON DELETE CASCADE
+        ) WITHOUT ROWID
+        ''',
+        '''
+        INSERT INTO coarse_hashes (method, video_id, hash_value)
+        SELECT p.id, ch.video_id, ch.hash_value
+        FROM computed_hashes ch
+        INNER JOIN hash_methods h
+        ON h.id = ch.hash_method_id
+        INNER JOIN hash_methods p
+        ON h.name = p.name || '-coarse'
+        WHERE ch.hash_value IS NOT NULL
+        ''',
+        '''
+        DELETE FROM hash_methods
+        WHERE name IN (SELECT name || '-coarse' FROM hash_methods)
+        ''',
+    ],
+    [
+        # the per-frame hash sequence a hash summarizes, e.g. the keyframe
+        # hashes of pHash, see video_hashing.PHash
+        '''
+        CREATE TABLE IF NOT EXISTS hash_sequences
+        (
+            method INTEGER NOT NULL,
+            video_id INTEGER(8) NOT NULL,
+            hash_value TEXT NOT NULL,
+            PRIMARY KEY (method, video_id),
+            FOREIGN KEY(video_id) REFERENCES video_info(id) ON DELETE CASCADE,
+            FOREIGN KEY (method) REFERENCES hash_methods(id)
+                ON DELETE CASCADE
+        ) WITHOUT ROWID
+        ''',
+        # 'phash-video' held the output of ./phash, or the bitwise majority
+        # of the keyframe hashes, which is not ph_dct_videohash and is now
+        # 'phash-summary'. the two cannot be told apart, so the hashes, with
+        # their distances, clusters and accuracy, are dropped to be hashed
+        # again
+        '''
+        DELETE FROM hash_methods
+        WHERE name IN ('phash-video', 'phash-video-sequence')
+        ''',
+    ],
+]
 
 
 ################################################################################
@@ -31,10 +215,15 @@ class VideoDistance:
 ################################################################################
 class Hash:
     ############################################################################
-    def __init__(self, method, value, method_id=None):
+    def __init__(self, method, value, method_id=None, coarse=None,
+                 sequence=None):
         self._id = method_id
         self._name = method
         self._value = value
+        # the coarse hash computed with value, and the hash sequence value
+        # summarizes, if the method has them
+        self._coarse = coarse
+        self._sequence = sequence
         return
 
     ############################################################################
@@ -52,6 +241,16 @@ class Hash:
     def value(self):
         return self._value
 
+    ############################################################################
+    @property
+    def coarse(self):
+        return self._coarse
+
+    ############################################################################
+    @property
+    def sequence(self):
+        return self._sequence
+
     ############################################################################
     def __repr__(self):
         return 'Hash(\'{}\', \'{}\', {})'.format(self._name, self._value,
@@ -77,6 +276,7 @@ class Video:
         self._name = name
         self._fmt = fmt
         self._hash_values = hash_values
+        self._hash = None
         return
 
     ############################################################################
@@ -103,8 +303,11 @@ class Video:
 
     ############################################################################
     def __hash__(self):
-        return hash((self._id, self._name, self._fmt,
-                    hash(tuple(self._hash_values.keys()))))
+        # id, name and format never change; hash_values are mutated in
+        # place, so they must not take part
+        if self._hash is None:
+            self._hash = hash((self._id, self._name, self._fmt))
+        return self._hash
 
     ############################################################################
     def __repr__(self):
@@ -133,13 +336,13 @@ class VideoSet:
     ############################################################################
     def __init__(self, set_id=None, videos=None):
         self._id = set_id
-        self._videos = videos
+        self._videos = frozenset(videos or ())
         return
 
     ############################################################################
     @property
     def videos(self):
-        return set(self._videos)
+        return self._videos
 
     ############################################################################
     @property
@@ -159,11 +362,123 @@ class VideoSet:
         return repr(self)
 
 
+################################################################################
+class Session:
+    '''
+    identity map shared by the DAOs of one VideoDataManager
+
+    every video, video set and hash method id read from the database is kept
+    here and handed out again instead of re-reading its rows; writes made
+    through the DAOs update or expire the affected entries. alongside each
+    video the hashes last written to/read from the database are kept, so a
+    caller mutating a video's hash_values can still be diffed against what
+    is stored.
+    '''
+
+    ############################################################################
+    def __init__(self):
+        self.clear()
+        return
+
+    ############################################################################
+    def clear(self):
+        self._videos = {}
+        self._video_keys = {}
+        self._stored_hashes = {}
+        self._video_sets = {}
+        self._video_set_ids = {}
+        self._hash_methods = {}
+        return
+
+    ############################################################################
+    def video(self, video_id):
+        return self._videos.get(video_id)
+
+    ############################################################################
+    def video_by_key(self, name, fmt):
+        return self._videos.get(self._video_keys.get((name, fmt)))
+
+    ############################################################################
+    def add_video(self, video):
+        known = self._videos.get(video.id)
+        if known is not None:
+            return known
+        self._videos[video.id] = video
+        self._video_keys[(video.name, video.format)] = video.id
+        self._stored_hashes[video.id] = dict(video.hash_values)
+        return video
+
+    ############################################################################
+    def stored_video(self, video_id):
+        video = self._videos.get(video_id)
+        if video is None:
+            return None
+        return Video(video.name, video.format, video_id=video_id,
+                     hash_values=dict(self._stored_hashes[video_id]))
+
+    ############################################################################
+    def hashes_stored(self, video, hash_values):
+        known = self._videos.get(video.id)
+        if known is None:
+            return None
+        self._stored_hashes[video.id].update(hash_values)
+        known.hash_values.update(hash_values)
+        return known
+
+    ############################################################################
+    def expire_video(self, video_id):
+        video = self._videos.pop(video_id, None)
+        if video is not None:
+            self._video_keys.pop((video.name, video.format), None)
+        self._stored_hashes.pop(video_id, None)
+        self.expire_video_set(self._video_set_ids.get(video_id))
+        return
+
+    ############################################################################
+    def video_set(self, set_id):
+        return self._video_sets.get(set_id)
+
+    ############################################################################
+    def video_set_id(self, video_id):
+        return self._video_set_ids.get(video_id)
+
+    ############################################################################
+    def add_video_set(self, video_set):
+        self._video_sets[video_set.id] = video_set
+        for video in video_set.videos:
+            self._video_set_ids[video.id] = video_set.id
+        return video_set
+
+    ############################################################################
+    def expire_video_set(self, set_id):
+        video_set = self._video_sets.pop(set_id, None)
+        if video_set is not None:
+            for video in video_set.videos:
+                self._video_set_ids.pop(video.id, None)
+        return
+
+    ############################################################################
+    def hash_method(self, name):
+        return self._hash_methods.get(name)
+
+    ############################################################################
+    def add_hash_method(self, name, method_id):
+        self._hash_methods[name] = method_id
+        return method_id
+
+
 ################################################################################
 class DAO:
     ############################################################################
-    def __init__(self, connection):
+    def __init__(self, connection, session=None, hash_index=None):
         self._c = connection
+        self._session = session
+        if self._session is None:
+            self._session = Session()
+        # method name -> the index to keep up to date with its hashes, or None
+        self._hash_index = hash_index
+        if self._hash_index is None:
+            self._hash_index = lambda method: None
         return
 
 
@@ -171,6 +486,10 @@ class DAO:
 class HashDAO(DAO):
     ############################################################################
     def get_hash_method_by_name(self, hash_method_name, commit=True):
+        hash_method_id = self._session.hash_method(hash_method_name)
+        if hash_method_id is not None:
+            return hash_method_id
+
         c = self._c.cursor()
         c.execute('''
             SELECT id
@@ -183,16 +502,11 @@ class HashDAO(DAO):
                 INSERT INTO hash_methods (name)
                 VALUES (?)
                 ''', [hash_method_name])
-            c.execute('''
-                SELECT id
-                FROM hash_methods
-                ORDER BY id DESC
-                LIMIT 1
-                ''')
-            hash_method_id = c.fetchone()
+            hash_method_id = (c.lastrowid,)
             if commit:
                 self._c.commit()
-        return hash_method_id[0]
+        return self._session.add_hash_method(hash_method_name,
+                                             hash_method_id[0])
 
     ############################################################################
     def get_video_hashes(self, video_id):
@@ -209,6 +523,71 @@ class HashDAO(DAO):
         c.execute(get_hashes_sql, [video_id])
         return {v[0]: Hash(*v) for v in c.fetchall()}
 
+    ############################################################################
+    def get_all_video_hashes(self, methods=None):
+        get_hashes_sql = '''
+            SELECT ch.video_id, h.name, ch.hash_value, h.id
+            FROM computed_hashes ch
+            INNER JOIN hash_methods h
+            ON ch.hash_method_id = h.id
+            '''
+        params = []
+        if methods is not None:
+            params = list(methods)
+            get_hashes_sql += '''
+            WHERE h.name IN ({})
+            '''.format(','.join('?' * len(params)))
+
+        c = self._c.cursor()
+        c.execute(get_hashes_sql, params)
+        hashes = {}
+        for video_id, name, value, method_id in c.fetchall():
+            hashes.setdefault(video_id, {})[name] = Hash(name, value,
+                                                         method_id)
+        return hashes
+
+    ############################################################################
+    def get_coarse_hashes(self, method):
+        '''
+        {video_id: coarse hash value} stored with the hashes of method
+        '''
+        c = self._c.cursor()
+        c.execute('''
+            SELECT ch.video_id, ch.hash_value
+            FROM coarse_hashes ch
+            INNER JOIN hash_methods h
+            ON ch.method = h.id
+            WHERE h.name = ?
+            ''', [method])
+        return dict(c.fetchall())
+
+    ############################################################################
+    def get_sequences(self, method, video_ids=None):
+        '''
+        {video_id: hash sequence text} stored with the hashes of method, of
+        the videos of video_ids (default: all)
+        '''
+        sql = '''
+            SELECT s.video_id, s.hash_value
+            FROM hash_sequences s
+            INNER JOIN hash_methods h
+            ON s.method = h.id
+            WHERE h.name = ?
+            '''
+        c = self._c.cursor()
+        if video_ids is None:
+            c.execute(sql, [method])
+            return dict(c.fetchall())
+        sequences = {}
+        video_ids = list(video_ids)
+        for n in range(0, len(video_ids), 500):
+            chunk = video_ids[n:n+500]
+            c.execute(sql + '''
+            AND s.video_id IN ({})
+            '''.format(','.join('?' * len(chunk))), [method] + chunk)
+            sequences.update(c.fetchall())
+        return sequences
+
     ############################################################################
     def get_method_accuracy(self, method_id):
         getsql = '''
@@ -232,7 +611,8 @@ class HashDAO(DAO):
         return None
 
     ############################################################################
-    def set_method_accuracy(self, method_id, details, force=False):
+    def set_method_accuracy(self, method_id, details, force=False,
+                            commit=True):
         best = self.get_method_accuracy(method_id)
         if (best is not None and best['accuracy'] is not None
                 and best['accuracy'] > details['accuracy']
@@ -257,7 +637,8 @@ class HashDAO(DAO):
                               details['false_positives'],
                               details['false_negatives'],
                               method_id])
-        self._c.commit()
+        if commit:
+            self._c.commit()
         return
 
     ############################################################################
@@ -270,7 +651,7 @@ class HashDAO(DAO):
         update_video_hash_sql = '''
             UPDATE computed_hashes
             SET hash_value = ?
-            WHERE hash_method_id = ? AND video_id = ?
+            WHERE video_id = ? AND hash_method_id = ?
             '''
 
         if video.id is None:
@@ -284,16 +665,39 @@ class HashDAO(DAO):
             if hash_method not in old_video.hash_values:
                 new_hash_upserts.append((insert_video_hash_sql,
                                          hash_method, hash_value))
-            elif hash_value != old_video.hash_values[hash_method]:
+            elif (hash_value != old_video.hash_values[hash_method]
+                  or hash_value.coarse is not None
+                  or hash_value.sequence is not None):
                 new_hash_upserts.append((update_video_hash_sql,
                                          hash_method, hash_value))
 
         c = self._c.cursor()
+        stored = {}
         for q, hash_method, hash_value in new_hash_upserts:
             hash_id = hash_value.id
             if hash_id is None:
                 hash_id = self.get_hash_method_by_name(hash_method, False)
-            c.execute(q, [video.id, hash_id, str(hash_value.value)])
+            params = [video.id, hash_id, str(hash_value.value)]
+            if q is update_video_hash_sql:
+                params = params[2:] + params[:2]
+            c.execute(q, params)
+            extras = []
+            for table, extra in [('coarse_hashes', hash_value.coarse),
+                                 ('hash_sequences', hash_value.sequence)]:
+                if extra is not None:
+                    extra = str(extra)
+                    c.execute('''
+                        INSERT INTO {} (method, video_id, hash_value)
+                        VALUES (?,?,?)
+                        ON CONFLICT (method, video_id)
+                        DO UPDATE SET hash_value = excluded.hash_value
+                        '''.format(table), [hash_id, video.id, extra])
+                extras.append(extra)
+            stored[hash_method] = Hash(hash_method, str(hash_value.value),
+                                       hash_id, *extras)
+            index = self._hash_index(hash_method)
+            if index is not None:
+                index.add(c, video.id, hash_value.value, hash_id)
 
         if commit:
             self._c.commit()
@@ -301,6 +705,9 @@ class HashDAO(DAO):
         hash_values.update(old_video.hash_values)
         hash_values.update(video.hash_values)
 
+        known = self._session.hashes_stored(video, stored)
+        if known is not None:
+            return known
         return Video(video.name, video.format,
                      video_id=video.id, hash_values=hash_values)
 
@@ -308,18 +715,47 @@ class HashDAO(DAO):
 ################################################################################
 class VideoDAO(DAO):
     ############################################################################
-    def __init__(self, connection, hashdao):
-        super().__init__(connection)
+    def __init__(self, connection, hashdao, session=None):
+        super().__init__(connection, session)
         self._hashdao = hashdao
         return
 
     ############################################################################
-    def _video(self, row):
-        if row is not None:
-            video_id, video_name, fmt = row
-            hashes = self._hashdao.get_video_hashes(video_id)
-            return Video(video_name, fmt, video_id=video_id, hash_values=hashes)
-        return None
+    def _load_videos(self, where='', params=(), methods=None):
+        '''
+        load videos together with their hashes in a single query; methods
+        restricts which hash columns are loaded
+        '''
+        method_filter = ''
+        method_params = []
+        if methods is not None:
+            method_params = list(methods)
+            method_filter = 'AND h.name IN ({})'.format(
+                ','.join('?' * len(method_params)))
+
+        load_videos_sql = '''
+            SELECT v.id, v.video_name, v.format, h.name, ch.hash_value, h.id
+            FROM video_info v
+            LEFT JOIN (computed_hashes ch
+                       INNER JOIN hash_methods h
+                       ON ch.hash_method_id = h.id {})
+            ON ch.video_id = v.id
+            {}
+            ORDER BY v.id
+            '''.format(method_filter, where)
+
+        c = self._c.cursor()
+        c.execute(load_videos_sql, method_params + list(params))
+        videos = []
+        for video_id, video_name, fmt, name, value, method_id in c.fetchall():
+            if len(videos) == 0 or videos[-1].id != video_id:
+                videos.append(Video(video_name, fmt, video_id=video_id,
+                                    hash_values={}))
+            if name is not None:
+                videos[-1].hash_values[name] = Hash(name, value, method_id)
+        if methods is None:
+            videos = [self._session.add_video(v) for v in videos]
+        return videos
 
     ############################################################################
     def _video_id(self, video):
@@ -335,44 +771,73 @@ class VideoDAO(DAO):
     def video_by_id(self, video_id):
         if video_id is None:
             return None
-        get_video_by_id_sql = '''
-            SELECT v.id, v.video_name, v.format
-            FROM video_info v
-            WHERE v.id = ?
-            '''
-        c = self._c.cursor()
-        c.execute(get_video_by_id_sql, [video_id])
-        return self._video(c.fetchone())
+        video = self._session.video(video_id)
+        if video is not None:
+            return video
+        videos = self._load_videos('WHERE v.id = ?', [video_id])
+        if len(videos) > 0:
+            return videos[0]
+        return None
 
     ############################################################################
-    def all_videos(self):
-        sql = '''
-        SELECT id
-        FROM video_info
+    def all_videos(self, methods=None):
+        return self._load_videos(methods=methods)
+
+    ############################################################################
+    def video_table(self):
+        '''
+        (id, name, format, set id) of every video ordered by id, without
+        building Video objects; the set id is the lowest of the video's
+        sets, or None
         '''
         c = self._c.cursor()
-        c.execute(sql)
+        c.execute('''
+        SELECT v.id, v.video_name, v.format, MIN(sm.set_id)
+        FROM video_info v
+        LEFT JOIN video_set_memberships sm
+        ON sm.video_id = v.id
+        GROUP BY v.id
+        ORDER BY v.id
+        ''')
+        return c.fetchall()
 
-        return [self.video_by_id(v[0]) for v in c.fetchall()]
+    ############################################################################
+    def videos_by_ids(self, video_ids, methods=None):
+        video_ids = list(video_ids)
+        videos = []
+        # stay below SQLITE_MAX_VARIABLE_NUMBER on older sqlite builds
+        for n in range(0, len(video_ids), 500):
+            chunk = video_ids[n:n+500]
+            videos.extend(self._load_videos(
+                'WHERE v.id IN ({})'.format(','.join('?' * len(chunk))),
+                chunk, methods))
+        return videos
+
+    ############################################################################
+    def videos_in_sets(self, set_id=None, methods=None):
+        if set_id is None:
+            return self._load_videos('''
+                WHERE v.id IN (SELECT video_id FROM video_set_memberships)
+                ''', methods=methods)
+        return self._load_videos('''
+            WHERE v.id IN (SELECT video_id
+                           FROM video_set_memberships
+                           WHERE set_id = ?)
+            ''', [set_id], methods)
 
     ############################################################################
     def videos_by_name(self, video_name, fmt=None):
         search = [video_name]
-        get_video_by_name_sql = '''
-            SELECT v.id, v.video_name, v.format
-            FROM video_info v
-            WHERE v.video_name = ?
-            '''
+        where = 'WHERE v.video_name = ?'
 
         if fmt is not None:
-            get_video_by_name_sql += '''
-            AND v.format = ?
-            '''
+            video = self._session.video_by_key(video_name, fmt)
+            if video is not None:
+                return [video]
+            where += ' AND v.format = ?'
             search.append(fmt)
 
-        c = self._c.cursor()
-        c.execute(get_video_by_name_sql, search)
-        return [self._video(v) for v in c.fetchall()]
+        return self._load_videos(where, search)
 
     ############################################################################
     def video_by_name_and_format(self, video_name, fmt):
@@ -381,11 +846,74 @@ class VideoDAO(DAO):
             return videos[0]
         return None
 
+    ############################################################################
+    def set_digest(self, video, digest, commit=True):
+        c = self._c.cursor()
+        c.execute('''
+            UPDATE video_info
+            SET digest = ?
+            WHERE id = ?
+            ''', [digest, self._video_id(video)])
+        if commit:
+            self._c.commit()
+        return
+
+    ############################################################################
+    def get_digest(self, video):
+        c = self._c.cursor()
+        c.execute('''
+            SELECT digest
+            FROM video_info
+            WHERE id = ?
+            ''', [self._video_id(video)])
+        row = c.fetchone()
+        if row is None:
+            return None
+        return row[0]
+
+    ############################################################################
+    def hashes_by_digest(self, digest, methods):
+        '''
+        {method: Hash} of the first video with content digest that has a
+        hash of every one of methods, or None; the hashes carry their coarse
+        hash and hash sequence, if any
+        '''
+        methods = list(methods)
+        c = self._c.cursor()
+        c.execute('''
+            SELECT v.id, h.name, ch.hash_value, h.id, co.hash_value,
+                   s.hash_value
+            FROM video_info v
+            INNER JOIN computed_hashes ch
+            ON ch.video_id = v.id
+            INNER JOIN hash_methods h
+            ON h.id = ch.hash_method_id
+            LEFT JOIN coarse_hashes co
+            ON co.method = h.id AND co.video_id = v.id
+            LEFT JOIN hash_sequences s
+            ON s.method = h.id AND s.video_id = v.id
+            WHERE v.digest = ?
+            AND h.name IN ({})
+            ORDER BY v.id
+            '''.format(','.join('?' * len(methods))), [digest] + methods)
+        found = {}
+        for video_id, method, value, method_id, coarse, sequence \
+                in c.fetchall():
+            found.setdefault(video_id, {})[method] = Hash(
+                method, value, method_id, coarse, sequence)
+        for hashes in found.values():
+            if len(hashes) == len(methods):
+                return hashes
+        return None
+
     ############################################################################
     def add_video_hashes(self, video, commit=True):
         if video.id is None:
             return self.add_video(video, commit)
-        old_video = self.video_by_id(video.id)
+        old_video = self._session.stored_video(video.id)
+        if old_video is None:
+            self.video_by_id(video.id)
+            old_video = self._session.stored_video(video.id)
         return self._hashdao.add_video_hashes(video, old_video, commit)
 
     ############################################################################
@@ -397,6 +925,23 @@ class VideoDAO(DAO):
             return v
         return self.add_video(video, commit)
 
+    ############################################################################
+    def delete_video(self, video, commit=True):
+        '''
+        remove a video; its hashes, set memberships, distances and index
+        entries go with it
+        '''
+        video_id = self._video_id(video)
+        c = self._c.cursor()
+        c.execute('''
+            DELETE FROM video_info
+            WHERE id = ?
+            ''', [video_id])
+        if commit:
+            self._c.commit()
+        self._session.expire_video(video_id)
+        return
+
     ############################################################################
     def add_video(self, video, commit=True):
         add_video_info_sql = '''
@@ -405,20 +950,22 @@ class VideoDAO(DAO):
             '''
         c = self._c.cursor()
         c.execute(add_video_info_sql, [video.name, video.format])
-        v = self.videos_by_name(video.name, video.format)[0]
-        old_video = self.video_by_id(video.id)
-        self._hashdao.add_video_hashes(v, old_video, commit=False)
+        v = self._session.add_video(Video(video.name, video.format,
+                                          video_id=c.lastrowid,
+                                          hash_values={}))
+        v.hash_values.update(video.hash_values)
+        self._hashdao.add_video_hashes(v, None, commit=False)
 
         if commit:
             self._c.commit()
-        return self.video_by_id(v.id)
+        return v
 
 
 ################################################################################
 class VideoSetDAO(DAO):
     ############################################################################
-    def __init__(self, connection, video_dao):
-        super().__init__(connection)
+    def __init__(self, connection, video_dao, session=None):
+        super().__init__(connection, session)
         self._video_dao = video_dao
         return
 
@@ -427,6 +974,10 @@ class VideoSetDAO(DAO):
         if video.id is None:
             return None
 
+        set_id = self._session.video_set_id(video.id)
+        if set_id is not None:
+            return self.get_video_set_by_id(set_id)
+
         video_set_from_video_name_sql = '''
             SELECT set_id
             FROM video_set_memberships s
@@ -442,15 +993,29 @@ class VideoSetDAO(DAO):
         return None
 
     ############################################################################
-    def get_video_all_sets(self):
+    def get_video_all_sets(self, methods=None):
+        videos = {v.id: v
+                  for v in self._video_dao.videos_in_sets(methods=methods)}
         sql = '''
-        SELECT id
-        FROM video_sets
+        SELECT s.id, sm.video_id
+        FROM video_sets s
+        LEFT JOIN video_set_memberships sm
+        ON sm.set_id = s.id
+        ORDER BY s.id
         '''
         c = self._c.cursor()
         c.execute(sql)
 
-        return [self.get_video_set_by_id(v[0]) for v in c.fetchall()]
+        members = {}
+        for set_id, video_id in c.fetchall():
+            members.setdefault(set_id, set())
+            if video_id is not None:
+                members[set_id].add(videos[video_id])
+        video_sets = [VideoSet(set_id, m) for set_id, m in members.items()]
+        if methods is None:
+            for video_set in video_sets:
+                self._session.add_video_set(video_set)
+        return video_sets
 
     ############################################################################
     def get_video_set(self, video):
@@ -463,7 +1028,7 @@ class VideoSetDAO(DAO):
             INNER JOIN video_info v
             ON v.id = s.video_id
             WHERE v.video_name = ?
-            AND v.video_fmt = ?
+            AND v.format = ?
             '''
         cur = self._c.cursor()
         cur.execute(video_set_from_video_name_sql, [video.name, video.format])
@@ -473,20 +1038,16 @@ class VideoSetDAO(DAO):
         return None
 
     ############################################################################
-    def get_video_set_by_id(self, set_id):
-        video_set_sql = '''
-            SELECT v.id
-            FROM video_set_memberships sm
-            LEFT JOIN video_info v
-            ON v.id = sm.video_id
-            INNER JOIN video_sets s
-            ON s.id = sm.set_id
-            WHERE s.id = ?
-            '''
-        cur = self._c.cursor()
-        cur.execute(video_set_sql, [set_id])
-        videos = [self._video_dao.video_by_id(r[0]) for r in cur.fetchall()]
-        return VideoSet(set_id, set(videos))
+    def get_video_set_by_id(self, set_id, methods=None):
+        if methods is None:
+            video_set = self._session.video_set(set_id)
+            if video_set is not None:
+                return video_set
+        videos = self._video_dao.videos_in_sets(set_id, methods)
+        video_set = VideoSet(set_id, set(videos))
+        if methods is None:
+            self._session.add_video_set(video_set)
+        return video_set
 
     ############################################################################
     def create_video_set(self, commit=True):
@@ -495,18 +1056,11 @@ class VideoSetDAO(DAO):
         INSERT INTO video_sets (number_of_videos)
         VALUES (0)
         ''')
-        c.execute('''
-        SELECT id
-        FROM video_sets
-        ORDER BY id DESC
-        LIMIT 1
-        ''')
-
-        set_id = c.fetchone()[0]
+        set_id = c.lastrowid
         v = VideoSet(set_id=set_id, videos=set([]))
         if commit:
             self._c.commit()
-        return v
+        return self._session.add_video_set(v)
 
     ############################################################################
     def add_video_to_set(self, video, video_set=None, commit=True):
@@ -519,7 +1073,7 @@ class VideoSetDAO(DAO):
         if video_set is None:
             video_set = self.create_video_set(False)
 
-        if video in video_set.videos:
+        if video.id in set(v.id for v in video_set.videos):
             return video_set
 
         c = self._c.cursor()
@@ -529,7 +1083,101 @@ class VideoSetDAO(DAO):
 
         if commit:
             self._c.commit()
-        return VideoSet(video_set.id, video_set.videos.union(set([video])))
+        video_set = VideoSet(video_set.id,
+                             video_set.videos.union(set([video])))
+        return self._session.add_video_set(video_set)
+
+
+################################################################################
+class ClusterDAO(DAO):
+    '''
+    groupings of near-duplicate videos per hash method; clusters look like
+    video sets but are recomputed as a whole by every similarity join
+    '''
+
+    ############################################################################
+    def __init__(self, connection, video_dao, session=None):
+        super().__init__(connection, session)
+        self._video_dao = video_dao
+        return
+
+    ############################################################################
+    def replace_clusters(self, method_id, radius, clusters, commit=True):
+        '''
+        replace every cluster of method_id with clusters, an iterable of
+        video id collections; singletons are not stored
+        '''
+        c = self._c.cursor()
+        c.execute('''
+        DELETE FROM clusters
+        WHERE method = ?
+        ''', [method_id])
+        n_clusters = 0
+        for video_ids in clusters:
+            video_ids = sorted(set(video_ids))
+            if len(video_ids) < 2:
+                continue
+            c.execute('''
+            INSERT INTO clusters (method, radius, number_of_videos)
+            VALUES (?,?,?)
+            ''', [method_id, radius, len(video_ids)])
+            cluster_id = c.lastrowid
+            c.executemany('''
+            INSERT INTO cluster_memberships (cluster_id, video_id)
+            VALUES (?,?)
+            ''', [(cluster_id, video_id) for video_id in video_ids])
+            n_clusters += 1
+        if commit:
+            self._c.commit()
+        return n_clusters
+
+    ############################################################################
+    def get_cluster_members(self, method_id):
+        '''
+        {cluster_id: set(video_id)} of every cluster of method_id
+        '''
+        c = self._c.cursor()
+        c.execute('''
+        SELECT cm.cluster_id, cm.video_id
+        FROM clusters cl
+        INNER JOIN cluster_memberships cm
+        ON cm.cluster_id = cl.id
+        WHERE cl.method = ?
+        ''', [method_id])
+        members = {}
+        for cluster_id, video_id in c.fetchall():
+            members.setdefault(cluster_id, set()).add(video_id)
+        return members
+
+    ############################################################################
+    def get_clusters(self, method_id, methods=None):
+        members = self.get_cluster_members(method_id)
+        videos = {v.id: v for v in self._video_dao.videos_by_ids(
+            set(video_id for m in members.values() for video_id in m),
+            methods)}
+        return [VideoSet(cluster_id, set(videos[video_id] for video_id in m))
+                for cluster_id, m in sorted(members.items())]
+
+    ############################################################################
+    def get_cluster_by_video_id(self, method_id, video):
+        c = self._c.cursor()
+        c.execute('''
+        SELECT cm.cluster_id
+        FROM cluster_memberships cm
+        INNER JOIN clusters cl
+        ON cl.id = cm.cluster_id
+        WHERE cl.method = ? AND cm.video_id = ?
+        ''', [method_id, video.id])
+        cluster_id = c.fetchone()
+        if cluster_id is None:
+            return None
+        c.execute('''
+        SELECT video_id
+        FROM cluster_memberships
+        WHERE cluster_id = ?
+        ''', [cluster_id[0]])
+        videos = self._video_dao.videos_by_ids([r[0] for r in c.fetchall()])
+        return VideoSet(cluster_id[0], set(videos))
 
 
 ################################################################################
@@ -552,6 +1200,35 @@ class VideoDistanceDAO(DAO):
             self._c.commit()
         return
 
+    ############################################################################
+    def add_distances(self, distances, commit=True):
+        sql = '''
+        INSERT OR REPLACE INTO video_distances (a, b, method, distance)
+        VALUES (?,?,?,?)
+        '''
+        c = self._c.cursor()
+        c.executemany(sql, [(d.a.id, d.b.id, d.method, d.distance)
+                            for d in distances])
+        if commit:
+            self._c.commit()
+        return
+
+    ############################################################################
+    def add_row(self, method, video, others, distances, commit=True):
+        '''
+        store the distances from video to each video of others
+        '''
+        sql = '''
+        INSERT OR REPLACE INTO video_distances (a, b, method, distance)
+        VALUES (?,?,?,?)
+        '''
+        c = self._c.cursor()
+        c.executemany(sql, [(video.id, b.id, method, int(d))
+                            for b, d in zip(others, distances)])
+        if commit:
+            self._c.commit()
+        return
+
     ############################################################################
     def get_distance(self, method, video1, video2):
         sql = '''
@@ -571,34 +1248,582 @@ class VideoDistanceDAO(DAO):
         return None
 
 
+################################################################################
+class MatrixDistanceDAO(DAO):
+    '''
+    distances kept in one memory-mapped DistanceMatrix file per hash method;
+    sqlite only records the dense ordinal of every video and where each
+    method's matrix lives. the cached ordinals and matrices are shared by
+    the DAOs of every thread, under lock
+    '''
+
+    ############################################################################
+    def __init__(self, connection, directory, matrices, ordinals, lock,
+                 session=None):
+        super().__init__(connection, session)
+        self._directory = directory
+        self._matrices = matrices
+        self._ordinals = ordinals
+        self._lock = lock
+        return
+
+    ############################################################################
+    def ordinal(self, video, create=True):
+        with self._lock:
+            ordinal = self._ordinals.get(video.id)
+        if ordinal is not None:
+            return ordinal
+
+        c = self._c.cursor()
+        c.execute('''
+        SELECT ordinal
+        FROM video_ordinals
+        WHERE video_id = ?
+        ''', [video.id])
+        row = c.fetchone()
+        if row is None:
+            if not create:
+                return None
+            if video.id is None:
+                raise RuntimeError('video must be in db')
+            # another thread may have numbered the video meanwhile
+            c.execute('''
+            INSERT INTO video_ordinals (ordinal, video_id)
+            SELECT COALESCE(MAX(ordinal) + 1, 0), ?
+            FROM video_ordinals
+            WHERE true
+            ON CONFLICT (video_id) DO NOTHING
+            ''', [video.id])
+            c.execute('''
+            SELECT ordinal
+            FROM video_ordinals
+            WHERE video_id = ?
+            ''', [video.id])
+            row = c.fetchone()
+        with self._lock:
+            self._ordinals[video.id] = row[0]
+        return row[0]
+
+    ############################################################################
+    def matrix(self, method, create=True):
+        with self._lock:
+            matrix = self._matrices.get(method)
+        if matrix is not None:
+            return matrix
+
+        c = self._c.cursor()
+        if create:
+            if not os.path.isdir(self._directory):
+                os.makedirs(self._directory, exist_ok=True)
+            path = os.path.join(self._directory,
+                                'method_{}.u16'.format(method))
+            c.execute('''
+            INSERT OR IGNORE INTO distance_matrices (method, path)
+            VALUES (?,?)
+            ''', [method, path])
+        else:
+            c.execute('''
+            SELECT path
+            FROM distance_matrices
+            WHERE method = ?
+            ''', [method])
+            row = c.fetchone()
+            if row is None or not os.path.exists(row[0]):
+                return None
+            path = row[0]
+        # no statement runs under the lock, which a thread holding the
+        # database write lock may be waiting for
+        with self._lock:
+            if method not in self._matrices:
+                self._matrices[method] = DistanceMatrix(path)
+            return self._matrices[method]
+
+    ############################################################################
+    def _update_metadata(self, method, matrix):
+        c = self._c.cursor()
+        c.execute('''
+        UPDATE distance_matrices
+        SET n_videos = ?, date_updated = CURRENT_TIMESTAMP
+        WHERE method = ?
+        ''', [matrix.capacity, method])
+        return
+
+    ############################################################################
+    def add_distance(self, distance, commit=True):
+        self.add_distances([distance], commit)
+        return
+
+    ############################################################################
+    def add_distances(self, distances, commit=True):
+        matrices = {}
+        for d in distances:
+            ordinals = (self.ordinal(d.a), self.ordinal(d.b))
+            matrix = self.matrix(d.method)
+            # a write may grow, and so remap, the file
+            with self._lock:
+                matrix[ordinals] = d.distance
+            matrices[d.method] = matrix
+
+        for method, matrix in matrices.items():
+            self._update_metadata(method, matrix)
+            matrix.flush()
+
+        if commit:
+            self._c.commit()
+        return
+
+    ############################################################################
+    def add_row(self, method, video, others, distances, commit=True):
+        '''
+        store the distances from video to each video of others; the matrix
+        file is only flushed when committing
+        '''
+        i = self.ordinal(video)
+        ordinals = [self.ordinal(b) for b in others]
+        matrix = self.matrix(method)
+        with self._lock:
+            matrix.set_row(i, ordinals, distances)
+        if commit:
+            self._update_metadata(method, matrix)
+            matrix.flush()
+            self._c.commit()
+        return
+
+    ############################################################################
+    def get_distance(self, method, video1, video2):
+        a = self.ordinal(video1, create=False)
+        b = self.ordinal(video2, create=False)
+        if a is None or b is None:
+            return None
+        matrix = self.matrix(method, create=False)
+        if matrix is None:
+            return None
+        distance = matrix[a, b]
+        if distance is None:
+            return None
+        return VideoDistance(video1, video2, method, distance)
+
+    ############################################################################
+    def row(self, method, video):
+        '''
+        zero-copy view of the distances from video to every video with a
+        lower ordinal; unknown distances are DistanceMatrix.unknown
+        '''
+        return self.matrix(method).row(self.ordinal(video))
+
+
+################################################################################
+class WriteBatch:
+    '''
+    unit of work for bulk ingest
+
+    videos, hashes, content digests and set memberships are buffered and
+    written with INSERT ... ON CONFLICT statements in a single transaction
+    when the batch is flushed: every flush_every buffered writes, on flush()
+    and when the with-block that opened it ends. videos are identified by
+    (name, format) so they do not need to be in the database when they are
+    buffered.
+    '''
+
+    ############################################################################
+    def __init__(self, manager, flush_every=None):
+        self._manager = manager
+        self.flush_every = flush_every
+        self._depth = 0
+        self._clear()
+        return
+
+    ############################################################################
+    def _clear(self):
+        self._videos = {}
+        self._hashes = {}
+        self._coarse = {}
+        self._sequences = {}
+        self._digests = {}
+        self._memberships = []
+        return
+
+    ############################################################################
+    def __len__(self):
+        return (len(self._videos) + len(self._hashes) + len(self._coarse)
+                + len(self._sequences) + len(self._digests)
+                + len(self._memberships))
+
+    ############################################################################
+    def __enter__(self):
+        self._depth += 1
+        if self._depth == 1:
+            self._manager._begin_batch(self)
+        return self
+
+    ############################################################################
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._depth -= 1
+        if self._depth == 0:
+            self._manager._end_batch(self)
+            self.flush()
+        return False
+
+    ############################################################################
+    @staticmethod
+    def _key(video):
+        return (video.name, video.format)
+
+    ############################################################################
+    def contains(self, name, fmt):
+        return (name, fmt) in self._videos
+
+    ############################################################################
+    def _buffered(self):
+        if self.flush_every is not None and len(self) >= self.flush_every:
+            self.flush()
+        return
+
+    ############################################################################
+    def add_video(self, video):
+        self._videos[self._key(video)] = video.id
+        self._buffered()
+        return
+
+    ############################################################################
+    def add_hash(self, video, method, value, coarse=None, sequence=None):
+        self._videos.setdefault(self._key(video), video.id)
+        self._hashes[self._key(video) + (method,)] = str(value)
+        if coarse is not None:
+            self._coarse[self._key(video) + (method,)] = str(coarse)
+        if sequence is not None:
+            self._sequences[self._key(video) + (method,)] = str(sequence)
+        self._buffered()
+        return
+
+    ############################################################################
+    def add_coarse_hash(self, video, method, value):
+        self._videos.setdefault(self._key(video), video.id)
+        self._coarse[self._key(video) + (method,)] = str(value)
+        self._buffered()
+        return
+
+    ############################################################################
+    def add_sequence(self, video, method, value):
+        self._videos.setdefault(self._key(video), video.id)
+        self._sequences[self._key(video) + (method,)] = str(value)
+        self._buffered()
+        return
+
+    ############################################################################
+    def add_digest(self, video, digest):
+        self._videos.setdefault(self._key(video), video.id)
+        self._digests[self._key(video)] = digest
+        self._buffered()
+        return
+
+    ############################################################################
+    def add_to_set(self, video, anchor):
+        '''
+        video joins the set of anchor; anchor gets a new set if it has none
+        '''
+        self._videos.setdefault(self._key(anchor), anchor.id)
+        self._videos.setdefault(self._key(video), video.id)
+        self._memberships.append((self._key(video), self._key(anchor)))
+        self._buffered()
+        return
+
+    ############################################################################
+    def _video_ids(self, c):
+        ids = {k: v for k, v in self._videos.items() if v is not None}
+        missing = [k for k, v in self._videos.items() if v is None]
+        c.executemany('''
+            INSERT INTO video_info (video_name, format)
+            VALUES (?,?)
+            ON CONFLICT (video_name, format) DO NOTHING
+            ''', missing)
+        for n in range(0, len(missing), 400):
+            chunk = missing[n:n+400]
+            c.execute('''
+                SELECT id, video_name, format
+                FROM video_info
+                WHERE (video_name, format) IN (VALUES {})
+                '''.format(','.join(['(?,?)'] * len(chunk))),
+                [x for k in chunk for x in k])
+            for video_id, name, fmt in c.fetchall():
+                ids[(name, fmt)] = video_id
+        return ids
+
+    ############################################################################
+    def _write_memberships(self, c, ids):
+        if len(self._memberships) == 0:
+            return set()
+        video_ids = list(set(ids[k] for m in self._memberships for k in m))
+        set_of = {}
+        for n in range(0, len(video_ids), 500):
+            chunk = video_ids[n:n+500]
+            c.execute('''
+                SELECT video_id, MIN(set_id)
+                FROM video_set_memberships
+                WHERE video_id IN ({})
+                GROUP BY video_id
+                '''.format(','.join('?' * len(chunk))), chunk)
+            set_of.update(c.fetchall())
+
+        rows = []
+        for video, anchor in self._memberships:
+            anchor_id = ids[anchor]
+            if anchor_id not in set_of:
+                c.execute('''
+                    INSERT INTO video_sets (number_of_videos)
+                    VALUES (0)
+                    ''')
+                set_of[anchor_id] = c.lastrowid
+                rows.append((set_of[anchor_id], anchor_id))
+            rows.append((set_of[anchor_id], ids[video]))
+            set_of.setdefault(ids[video], set_of[anchor_id])
+
+        c.executemany('''
+            INSERT INTO video_set_memberships (set_id, video_id)
+            VALUES (?,?)
+            ON CONFLICT (set_id, video_id) DO NOTHING
+            ''', rows)
+        return set(r[0] for r in rows)
+
+    ############################################################################
+    def flush(self):
+        if len(self) == 0:
+            return
+        conn = self._manager.conn
+        hdao = self._manager.hash_dao
+        c = conn.cursor()
+        try:
+            ids = self._video_ids(c)
+            methods = {}
+            hash_rows = []
+            indexed = {}
+            for (name, fmt, method), value in self._hashes.items():
+                if method not in methods:
+                    methods[method] = hdao.get_hash_method_by_name(method,
+                                                                   False)
+                hash_rows.append((ids[(name, fmt)], methods[method], value))
+                if self._manager.hash_index(method) is not None:
+                    indexed.setdefault(method, []).append(
+                        (ids[(name, fmt)], value))
+            c.executemany('''
+                INSERT INTO computed_hashes (video_id, hash_method_id,
+                                             hash_value)
+                VALUES (?,?,?)
+                ON CONFLICT (video_id, hash_method_id)
+                DO UPDATE SET hash_value = excluded.hash_value
+                ''', hash_rows)
+            for table, extras in [('coarse_hashes', self._coarse),
+                                  ('hash_sequences', self._sequences)]:
+                rows = []
+                for (name, fmt, method), value in extras.items():
+                    if method not in methods:
+                        methods[method] = hdao.get_hash_method_by_name(
+                            method, False)
+                    rows.append((methods[method], ids[(name, fmt)], value))
+                c.executemany('''
+                    INSERT INTO {} (method, video_id, hash_value)
+                    VALUES (?,?,?)
+                    ON CONFLICT (method, video_id)
+                    DO UPDATE SET hash_value = excluded.hash_value
+                    '''.format(table), rows)
+            c.executemany('''
+                UPDATE video_info
+                SET digest = ?
+                WHERE id = ?
+                ''', [(digest, ids[key])
+                      for key, digest in self._digests.items()])
+            for method, hashes in indexed.items():
+                self._manager.hash_index(method).add_many(c, hashes,
+                                                          methods[method])
+            set_ids = self._write_memberships(c, ids)
+            conn.commit()
+        except Exception:
+            # which also expires the session, that may hold ids of rows the
+            # rollback took back, e.g. hash methods first inserted here
+            conn.rollback()
+            raise
+
+        session = self._manager.session
+        for video_id in ids.values():
+            session.expire_video(video_id)
+        for set_id in set_ids:
+            session.expire_video_set(set_id)
+        self._clear()
+        return
+
+
 ################################################################################
 class VideoDataManager:
     ############################################################################
-    def __init__(self, path='videohash.db'):
+    def __init__(self, path='videohash.db', distance_store='sqlite',
+                 pragmas=DEFAULT_PRAGMAS, timeout=30.0, retries=5):
+        if distance_store not in DISTANCE_STORES:
+            raise RuntimeError('Unknown distance store: {}'.format(
+                distance_store))
         self.path = path
-        self.conn = sqlite3.connect(path)
+        self.distance_store = distance_store
+        self.conn = ConnectionManager(path, pragmas=pragmas, timeout=timeout,
+                                      retries=retries)
+        self._matrices = {}
+        self._ordinals = {}
+        self._matrix_lock = threading.RLock()
+        self.hash_indexes = {}
+        self._unindexed = set()
+        self._index_lock = threading.Lock()
+        self._local = threading.local()
+        self.conn.on_rollback.append(self._rolled_back)
         self._create_schema()
         return
 
+    ############################################################################
+    def _rolled_back(self):
+        # the ordinals, matrices and hash method ids the transaction
+        # registered are gone
+        with self._matrix_lock:
+            self._ordinals.clear()
+            self._matrices.clear()
+        self.session.clear()
+        return
+
+    ############################################################################
+    def _daos(self):
+        # DAOs and their session are per thread, like the connections
+        daos = getattr(self._local, 'daos', None)
+        if daos is None:
+            session = Session()
+            hash_dao = HashDAO(self.conn, session, self.hash_index)
+            video_dao = VideoDAO(self.conn, hash_dao, session)
+            videoset_dao = VideoSetDAO(self.conn, video_dao, session)
+            cluster_dao = ClusterDAO(self.conn, video_dao, session)
+            if self.distance_store == 'matrix':
+                distance_dao = MatrixDistanceDAO(
+                    self.conn, self.path + '.distances', self._matrices,
+                    self._ordinals, self._matrix_lock, session)
+            else:
+                distance_dao = VideoDistanceDAO(self.conn, session)
+            daos = {
+                'session': session,
+                'hash': hash_dao,
+                'video': video_dao,
+                'videoset': videoset_dao,
+                'cluster': cluster_dao,
+                'distance': distance_dao,
+            }
+            self._local.daos = daos
+        return daos
+
+    ############################################################################
+    @property
+    def session(self):
+        return self._daos()['session']
+
     ############################################################################
     @property
     def hash_dao(self):
-        return HashDAO(self.conn)
+        return self._daos()['hash']
 
     ############################################################################
     @property
     def video_dao(self):
-        return VideoDAO(self.conn, self.hash_dao)
+        return self._daos()['video']
 
     ############################################################################
     @property
     def videoset_dao(self):
-        return VideoSetDAO(self.conn, self.video_dao)
+        return self._daos()['videoset']
+
+    ############################################################################
+    @property
+    def cluster_dao(self):
+        return self._daos()['cluster']
 
     ############################################################################
     @property
     def distance_dao(self):
-        return VideoDistanceDAO(self.conn)
+        return self._daos()['distance']
+
+    ############################################################################
+    def register_hash_index(self, index):
+        '''
+        keep index (e.g. a mih.MultiIndexHash) up to date with every hash
+        of index.method written through this manager
+        '''
+        with self._index_lock:
+            self.hash_indexes[index.method] = index
+        return index
+
+    ############################################################################
+    def hash_index(self, method):
+        '''
+        the index kept up to date with the hashes of method, or None; the
+        methods whose hasher has maintain_index get a MultiIndexHash the
+        first time they are written, whichever path writes them
+        '''
+        with self._index_lock:
+            if (method not in self.hash_indexes
+                    and method not in self._unindexed):
+                index = self._default_index(method)
+                if index is None:
+                    self._unindexed.add(method)
+                else:
+                    self.hash_indexes[method] = index
+            return self.hash_indexes.get(method)
+
+    ############################################################################
+    def _default_index(self, method):
+        # the hashers and the index import this module
+        from . import llehash  # noqa: F401
+        from .video_hashing import VideoHasher
+        from .mih import MultiIndexHash
+        try:
+            cls = VideoHasher.get_hashmethod_class(method)
+        except KeyError:
+            return None
+        if not cls.maintain_index:
+            return None
+        return MultiIndexHash(self, cls)
+
+    ############################################################################
+    @property
+    def current_batch(self):
+        return getattr(self._local, 'batch', None)
+
+    ############################################################################
+    def batch(self, flush_every=None):
+        '''
+        WriteBatch for use in a with-block; nested calls on the same thread
+        share the outer batch
+        '''
+        batch = self.current_batch
+        if batch is None:
+            batch = WriteBatch(self, flush_every)
+        return batch
+
+    ############################################################################
+    def _begin_batch(self, batch):
+        self._local.batch = batch
+        return
+
+    ############################################################################
+    def _end_batch(self, batch):
+        if self.current_batch is batch:
+            self._local.batch = None
+        return
+
+    ############################################################################
+    def close(self):
+        self.conn.close_all()
+        self._local = threading.local()
+        return
+
+    ############################################################################
+    def expire_all(self):
+        '''
+        forget every cached row, e.g. after another process wrote to the
+        same database
+        '''
+        self.session.clear()
+        return
 
     ############################################################################
     def _create_schema(self):
@@ -681,5 +1906,26 @@ class VideoDataManager:
         )
         ''')
 
+        c.execute('''
+        CREATE TABLE IF NOT EXISTS video_ordinals
+        (
+            ordinal INTEGER PRIMARY KEY,
+            video_id INTEGER(8) NOT NULL UNIQUE,
+            FOREIGN KEY(video_id) REFERENCES video_info(id) ON DELETE CASCADE
+        )
+        ''')
+
+        c.execute('''
+        CREATE TABLE IF NOT EXISTS distance_matrices
+        (
+            method INTEGER PRIMARY KEY,
+            path TEXT NOT NULL,
+            n_videos INTEGER NOT NULL DEFAULT 0,
+            date_updated DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (method) REFERENCES hash_methods(id) ON DELETE CASCADE
+        )
+        ''')
+
         c.commit()
+        c.migrate(SCHEMA_MIGRATIONS)
         return
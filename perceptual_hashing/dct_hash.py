@@ -0,0 +1,355 @@
+#!/usr/bin/env python
+'''
+the pHash DCT video hash (ph_dct_videohash) in numpy
+
+every step-th frame of a video, two a second, is decoded to 8 bit
+grayscale, and the samples are cut into shots where the 64 bin histogram
+of a sample differs from the one before by more than both a global and a
+local threshold. the sample of each shot that differs least from its
+predecessor is its keyframe; a keyframe is decoded again at 32x32, blurred,
+transformed with a 32x32 DCT, and the 8x8 lowest non-constant frequencies
+are thresholded at their median into a 64 bit hash. a video hash is the
+sequence of its keyframe hashes
+
+the arithmetic is that of pHash and CImg: float32 distances and
+thresholds, CImg's Deriche blur truncated back to uint8, and float32 DCT
+products summed in double
+'''
+import numpy as np
+from skimage.transform import resize
+
+SIZE = 32
+HISTOGRAM_BINS = 64
+BLUR_SIGMA = 1.0
+
+# shot boundary detection parameters of ph_getKeyframesFromVideo
+SHORT_WINDOW = 10
+LONG_WINDOW = 50
+ALPHA_GLOBAL = 3
+ALPHA_LOCAL = 2
+
+# keyframe hashes at most this far apart match in sequence_similarity
+MATCH_THRESHOLD = 21
+
+_BIT_VALUES = np.left_shift(np.uint64(1), np.arange(64, dtype=np.uint64))
+
+
+################################################################################
+def dct_matrix(n=SIZE):
+    '''
+    the orthonormal n x n DCT-II matrix, in float32 as ph_dct_matrix
+    '''
+    k = np.arange(1, n).reshape(-1, 1)
+    x = np.arange(n).reshape(1, -1)
+    c = np.empty((n, n), dtype=np.float32)
+    c[0, :] = np.float32(1) / np.sqrt(np.float32(n))
+    c[1:, :] = np.float32(np.sqrt(2.0 / n)) * np.cos(
+        np.pi / 2 / n * k * (2 * x + 1))
+    return c
+
+
+_DCT = dct_matrix()
+
+
+################################################################################
+def frame_step(fps):
+    '''
+    the step between the frames sampled from a video of fps frames a
+    second, for two a second
+    '''
+    return max(1, int(0.5 * fps + 0.5))
+
+
+################################################################################
+def to_gray(frame):
+    '''
+    uint8 grayscale of an rgb or grayscale frame
+    '''
+    frame = np.asarray(frame)
+    if frame.ndim == 3:
+        frame = frame[..., :3].dot([0.299, 0.587, 0.114])
+    if frame.dtype != np.uint8:
+        frame = np.clip(np.rint(frame), 0, 255).astype(np.uint8)
+    return frame
+
+
+################################################################################
+def shrink(frame):
+    '''
+    a uint8 grayscale frame scaled bicubically to 32x32; close to, not the
+    same as, the scaler of ffmpeg
+    '''
+    if frame.shape == (SIZE, SIZE):
+        return frame
+    small = resize(frame, (SIZE, SIZE), order=3, mode='edge',
+                   anti_aliasing=True, preserve_range=True)
+    return np.clip(np.rint(small), 0, 255).astype(np.uint8)
+
+
+################################################################################
+def histogram(frame):
+    '''
+    64 bin histogram of a uint8 grayscale frame, binned as CImg
+    get_histogram(64, 0, 255): value * 64 / 255, with 255 in the top bin
+    '''
+    levels = np.asarray(frame, dtype=np.uint8).ravel().astype(np.int32)
+    bins = np.minimum(levels * HISTOGRAM_BINS // 255, HISTOGRAM_BINS - 1)
+    return np.bincount(bins, minlength=HISTOGRAM_BINS)
+
+
+################################################################################
+def histogram_distances(histograms):
+    '''
+    float32 L1 distance of every histogram to the one before it; the first
+    is compared with an empty histogram
+    '''
+    distances = []
+    previous = np.zeros(HISTOGRAM_BINS, dtype=np.int64)
+    for h in histograms:
+        distances.append(np.abs(h - previous).sum())
+        previous = h
+    return np.array(distances, dtype=np.float32)
+
+
+################################################################################
+def _float32_sum(values):
+    # a float32 sum added up in order, as a C loop does
+    return np.cumsum(values, dtype=np.float32)[-1]
+
+
+################################################################################
+def keyframes(dist):
+    '''
+    indexes of the keyframes among the samples of a video, from their
+    histogram_distances; none for fewer than two samples
+    '''
+    dist = np.asarray(dist, dtype=np.float32)
+    n = len(dist)
+    if n < 2:
+        return []
+
+    bounds = np.zeros(n, dtype=np.uint8)
+    bounds[0] = 1
+    for k in range(1, n - 1):
+        s_begin, s_end = max(k - SHORT_WINDOW, 0), min(k + SHORT_WINDOW, n - 1)
+        l_begin, l_end = max(k - LONG_WINDOW, 0), min(k + LONG_WINDOW, n - 1)
+        window = dist[l_begin:l_end + 1]
+        count = np.float32(len(window))
+        average = _float32_sum(window) / count
+        deviation = _float32_sum(np.abs(average - window)) / count
+        t_global = average + ALPHA_GLOBAL * deviation
+
+        local = dist[s_begin:s_end + 1]
+        localmax = int(np.argmax(local))
+        # pHash looks for the second maximum above zero, and falls back to
+        # the start of the window, even when that is the maximum
+        others = local.copy()
+        others[localmax] = 0
+        second = others.max()
+        if second <= 0:
+            second = local[0]
+        t_local = ALPHA_LOCAL * second
+
+        if dist[k] == local[localmax] and dist[k] > max(t_global, t_local):
+            bounds[k] = 1
+    bounds[n - 1] = 1
+
+    # the calmest frame between two boundaries is the keyframe of the shot
+    selected = []
+    start = 0
+    while start < n - 1:
+        end = start + 1
+        while end < n - 1 and bounds[end] != 1:
+            end += 1
+        if end - start > 1:
+            selected.append(start + 1 + int(np.argmin(dist[start + 1:end])))
+        else:
+            selected.append(start + 1)
+        start = end
+    return selected
+
+
+################################################################################
+def _deriche_coefficients(sigma):
+    # CImg's order 0 Deriche recursive filter, in float32
+    alpha = np.float32(1.695) / np.float32(sigma)
+    ema = np.exp(-alpha)
+    ema2 = np.exp(-2 * alpha)
+    b1, b2 = -2 * ema, ema2
+    k = (1 - ema) * (1 - ema) / (1 + 2 * alpha * ema - ema2)
+    a0, a1, a2, a3 = k, k * (alpha - 1) * ema, k * (alpha + 1) * ema, -k * ema2
+    coefp = (a0 + a1) / (1 + b1 + b2)
+    coefn = (a2 + a3) / (1 + b1 + b2)
+    return a0, a1, a2, a3, b1, b2, coefp, coefn
+
+
+_DERICHE = _deriche_coefficients(BLUR_SIGMA)
+
+
+################################################################################
+def _to_uint8(values):
+    # a C cast of float to uint8: truncated, wrapping out of range
+    return (values.astype(np.int32) & 0xFF).astype(np.uint8)
+
+
+################################################################################
+def _deriche(frames, axis):
+    # CImg deriche(sigma, 0, axis) of uint8 frames, in place
+    a0, a1, a2, a3, b1, b2, coefp, coefn = _DERICHE
+    x = np.moveaxis(frames, axis, -1)
+    n = x.shape[-1]
+    y = np.empty(x.shape, dtype=np.float32)
+    xp = x[..., 0].astype(np.float32)
+    yb = yp = coefp * xp
+    for m in range(n):
+        xc = x[..., m].astype(np.float32)
+        yc = y[..., m] = a0 * xc + a1 * xp - b1 * yp - b2 * yb
+        xp, yb, yp = xc, yp, yc
+    xn = xa = x[..., n - 1].astype(np.float32)
+    yn = ya = coefn * xn
+    for m in range(n - 1, -1, -1):
+        xc = x[..., m].astype(np.float32)
+        yc = a2 * xn + a3 * xa - b1 * yn - b2 * ya
+        xa, xn, ya, yn = xn, xc, yn, yc
+        x[..., m] = _to_uint8(y[..., m] + yc)
+    return frames
+
+
+################################################################################
+def blur(frames):
+    '''
+    (n, height, width) uint8 frames blurred as CImg blur(1.0) does, along
+    their rows and then their columns
+    '''
+    frames = np.array(frames, dtype=np.uint8)
+    return _deriche(_deriche(frames, -1), -2)
+
+
+################################################################################
+def _matmul(a, b):
+    # a @ b as CImg multiplies: float32 products added up in double
+    products = a[..., :, :, None] * b[..., None, :, :]
+    return products.sum(axis=-2, dtype=np.float64).astype(np.float32)
+
+
+################################################################################
+def frame_hashes(frames):
+    '''
+    64 bit DCT hashes of (n, 32, 32) uint8 grayscale frames, as python ints
+    '''
+    if len(frames) == 0:
+        return []
+    dct = _matmul(_matmul(_DCT, blur(frames)), _DCT.T)
+    sub = dct[:, 1:9, 1:9].reshape(len(dct), 64)
+    # the median of an even count is the mean of the middle two
+    middle = np.sort(sub, axis=1)[:, 31:33]
+    median = (middle[:, 0] + middle[:, 1]) / np.float32(2)
+    bits = sub > median[:, None]
+    return [int(_BIT_VALUES[row].sum()) for row in bits]
+
+
+################################################################################
+def video_hash(frames):
+    '''
+    keyframe hash sequence of the sampled rgb or grayscale frames of a
+    video, read once
+    '''
+    histograms = []
+    small = []
+    for frame in frames:
+        gray = to_gray(frame)
+        histograms.append(histogram(gray))
+        small.append(shrink(gray))
+    selected = keyframes(histogram_distances(histograms))
+    return frame_hashes([small[k] for k in selected])
+
+
+################################################################################
+def summary_hash(sequence):
+    '''
+    one 64 bit hash of a keyframe sequence: the majority of every bit
+    '''
+    if len(sequence) == 0:
+        raise RuntimeError('Empty keyframe hash sequence')
+    bits = unpack(sequence)
+    majority = bits.sum(axis=0) * 2 > len(sequence)
+    return int(_BIT_VALUES[majority].sum())
+
+
+################################################################################
+def unpack(sequence):
+    '''
+    (n, 64) bool array of the bits of n 64 bit hashes
+    '''
+    values = np.array([int(h) for h in sequence], dtype=np.uint64)
+    return ((values[:, None] >> np.arange(64, dtype=np.uint64)) & 1) == 1
+
+
+################################################################################
+def hamming_matrix(a, b):
+    '''
+    hamming distances between every hash of sequence a and of sequence b
+    '''
+    return (unpack(a)[:, None, :] != unpack(b)[None, :, :]).sum(axis=2)
+
+
+################################################################################
+def _common_length(matches):
+    # longest common subsequence of keyframes over a boolean match matrix
+    n1, n2 = matches.shape
+    row = np.zeros(n2 + 1, dtype=int)
+    for i in range(n1):
+        new = np.zeros(n2 + 1, dtype=int)
+        for j in range(n2):
+            if matches[i, j]:
+                new[j + 1] = row[j] + 1
+            else:
+                new[j + 1] = max(row[j + 1], new[j])
+        row = new
+    return int(row[n2])
+
+
+################################################################################
+def sequence_similarity(a, b, threshold=MATCH_THRESHOLD):
+    '''
+    ph_dct_videohash_dist: the share of the keyframes of the shorter
+    sequence matched, in order, by keyframes of the other within
+    threshold bits; 1.0 for the same video
+    '''
+    if len(a) == 0 or len(b) == 0:
+        return 0.0
+    matches = hamming_matrix(a, b) <= threshold
+    return _common_length(matches) / min(len(a), len(b))
+
+
+################################################################################
+def match_sequences(query, candidates, threshold=MATCH_THRESHOLD):
+    '''
+    sequence_similarity of query to every sequence of candidates, with
+    the keyframe distances of all of them computed in one pass
+    '''
+    candidates = [list(c) for c in candidates]
+    if len(query) == 0 or sum(len(c) for c in candidates) == 0:
+        return [0.0] * len(candidates)
+    matches = hamming_matrix(query, [h for c in candidates for h in c])
+    matches = matches <= threshold
+    results = []
+    start = 0
+    for c in candidates:
+        if len(c) == 0:
+            results.append(0.0)
+            continue
+        block = matches[:, start:start + len(c)]
+        results.append(_common_length(block) / min(len(query), len(c)))
+        start += len(c)
+    return results
+
+
+################################################################################
+def format_sequence(sequence):
+    return ','.join(str(h) for h in sequence)
+
+
+################################################################################
+def parse_sequence(text):
+    return [int(h) for h in str(text).split(',') if h]
@@ -0,0 +1,150 @@
+#!/usr/bin/env python
+import math
+import os
+
+import numpy as np
+
+
+################################################################################
+class DistanceMatrix:
+    '''
+    condensed matrix of uint16 distances in a memory-mapped file
+
+    the lower triangle is stored row by row: the distance between ordinals
+    i > j lives at i * (i - 1) / 2 + j, so adding videos only ever appends
+    to the file and row i (distances to every ordinal below i) is one
+    contiguous slice
+    '''
+
+    ############################################################################
+    dtype = np.uint16
+    unknown = 0xffff
+    min_capacity = 64
+    # the file grows with the square of the capacity, so growing the
+    # capacity by sqrt(2) doubles the file
+    growth = math.sqrt(2)
+
+    ############################################################################
+    def __init__(self, path, n_videos=0):
+        self.path = path
+        self._mm = None
+        self._capacity = 0
+        if os.path.exists(path):
+            entries = os.path.getsize(path) // self.dtype().itemsize
+            self._capacity = self.capacity_for(entries)
+            self._open()
+        self.reserve(n_videos)
+        return
+
+    ############################################################################
+    @staticmethod
+    def offset(i, j):
+        if i < j:
+            i, j = j, i
+        return i * (i - 1) // 2 + j
+
+    ############################################################################
+    @staticmethod
+    def entries(n_videos):
+        return n_videos * (n_videos - 1) // 2
+
+    ############################################################################
+    @classmethod
+    def capacity_for(cls, entries):
+        n = (1 + math.isqrt(1 + 8 * entries)) // 2
+        while cls.entries(n) > entries:
+            n -= 1
+        return n
+
+    ############################################################################
+    @property
+    def capacity(self):
+        return self._capacity
+
+    ############################################################################
+    def _open(self):
+        self._mm = None
+        if self.entries(self._capacity) > 0:
+            self._mm = np.memmap(self.path, dtype=self.dtype, mode='r+',
+                                 shape=(self.entries(self._capacity),))
+        return
+
+    ############################################################################
+    def reserve(self, n_videos):
+        if n_videos <= self._capacity:
+            return
+        capacity = max(n_videos, int(self.growth * self._capacity),
+                       self.min_capacity)
+        missing = self.entries(capacity) - self.entries(self._capacity)
+        if self._mm is not None:
+            self._mm.flush()
+            self._mm = None
+
+        chunk = b'\xff' * (1 << 20)
+        remaining = missing * self.dtype().itemsize
+        with open(self.path, 'ab') as fd:
+            while remaining > 0:
+                fd.write(chunk[:remaining])
+                remaining -= len(chunk)
+
+        self._capacity = capacity
+        self._open()
+        return
+
+    ############################################################################
+    def __getitem__(self, key):
+        i, j = key
+        if i == j:
+            return 0
+        if max(i, j) >= self._capacity:
+            return None
+        v = int(self._mm[self.offset(i, j)])
+        if v == self.unknown:
+            return None
+        return v
+
+    ############################################################################
+    def __setitem__(self, key, distance):
+        i, j = key
+        if i == j:
+            raise RuntimeError('cannot store a distance to itself')
+        if distance < 0 or distance >= self.unknown:
+            raise RuntimeError('distance out of range: {}'.format(distance))
+        self.reserve(max(i, j) + 1)
+        self._mm[self.offset(i, j)] = distance
+        return
+
+    ############################################################################
+    def set_row(self, i, others, distances):
+        '''
+        store the distances from ordinal i to each ordinal of others
+        '''
+        others = np.asarray(others, dtype=np.int64)
+        distances = np.asarray(distances)
+        if len(others) == 0:
+            return
+        if np.any(others == i):
+            raise RuntimeError('cannot store a distance to itself')
+        if np.any(distances < 0) or np.any(distances >= self.unknown):
+            raise RuntimeError('distance out of range')
+        high = np.maximum(others, i)
+        low = np.minimum(others, i)
+        self.reserve(int(high.max()) + 1)
+        self._mm[high * (high - 1) // 2 + low] = distances
+        return
+
+    ############################################################################
+    def row(self, i):
+        '''
+        distances from ordinal i to ordinals 0..i-1, as a view on the file
+        '''
+        if i >= self._capacity:
+            return np.full((i,), self.unknown, dtype=self.dtype)
+        start = self.offset(i, 0)
+        return self._mm[start:start + i]
+
+    ############################################################################
+    def flush(self):
+        if self._mm is not None:
+            self._mm.flush()
+        return
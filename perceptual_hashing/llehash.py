@@ -11,9 +11,12 @@ from BitVector import BitVector
 import warnings
 
 from .video_hashing import VideoHasher
-from .data_manager import VideoDistance
+from .data_manager import VideoDistance, Hash
 from .video_hamming_distance import hamming_distance
-from .util import convert_to_hash
+from .util import convert_to_hash, block_mean_hash
+from .async_exec import probe_all
+from .cpu_budget import current_budget
+from .video_preprocessing import decode_bytes, probe_bytes
 
 
 ################################################################################
@@ -28,6 +31,21 @@ class LLE16x16PointHash(VideoHasher):
     knn = 8
     n_dimensions_per_pixel = 3
 
+    # block-mean pre-filter hash stored next to every LLE hash
+    coarse_bits = 64
+
+    # hash_video_frames hashes frames decoded by the caller
+    supports_frames = True
+
+    hash_encoding = 'bitstring'
+
+    ############################################################################
+    def __init__(self, path, manager=None, force=False):
+        super().__init__(path, manager, force)
+        # filepath -> ffprobe video stream information, fetched by prepare
+        self._probes = {}
+        return
+
     ############################################################################
     @classmethod
     def pixels_per_point(cls):
@@ -68,6 +86,22 @@ class LLE16x16PointHash(VideoHasher):
     def max_threshold(cls):
         return 480
 
+
+    ############################################################################
+    @classmethod
+    def coarse_hash(cls, frames):
+        return block_mean_hash(frames, math.isqrt(cls.coarse_bits))
+
+    ############################################################################
+    @classmethod
+    def hash_to_int(cls, value):
+        # stored as the BitVector bit string
+        if isinstance(value, Hash):
+            value = value.value
+        if isinstance(value, int):
+            return value
+        return int(str(value), 2)
+
     ############################################################################
     def _horizontal_bar(self, frame, blacklvl=16):
         x = 0
@@ -105,49 +139,84 @@ class LLE16x16PointHash(VideoHasher):
             new_frames[idx] = frame[t:b, l:r]
         return new_frames
 
+    ############################################################################
+    def save_image(self, filename, n, step, image):
+        '''
+        write step of the processing of frame n next to filename; nothing is
+        written for frames hashed from memory, which have no filename
+        '''
+        if filename is None:
+            return
+        misc.imsave('{}_{}_{}_{}.jpg'.format(filename, n, self.hash_type(),
+                                             step), image)
+        return
+
     ############################################################################
     def process_frame(self, n, filename, frame):
-        misc.imsave('{}_{}_{}_0.jpg'.format(filename, n, self.hash_type()),
-                    frame)
+        self.save_image(filename, n, '0', frame)
         frame = resize(frame, (self.height, self.width), mode='constant')
-        misc.imsave('{}_{}_{}_1.jpg'.format(filename, n, self.hash_type()),
-                    frame)
+        self.save_image(filename, n, '1', frame)
         frame = gaussian(frame, sigma=3.0, multichannel=True)
-        misc.imsave('{}_{}_{}_2.jpg'.format(filename, n, self.hash_type()),
-                    frame)
+        self.save_image(filename, n, '2', frame)
         xyz = color.convert_colorspace(frame, 'YUV', 'XYZ')
-        misc.imsave('{}_{}_{}_3.jpg'.format(filename, n, self.hash_type()),
-                    xyz)
+        self.save_image(filename, n, '3', xyz)
         lab = color.xyz2lab(xyz)
-        misc.imsave('{}_{}_{}_4.jpg'.format(filename, n, self.hash_type()),
-                    lab)
+        self.save_image(filename, n, '4', lab)
         return lab
 
     ############################################################################
-    def wanted(self, filename):
-        info = ffprobe(filename)
-        vinfo = info['video']
+    def prepare(self, filepaths):
+        '''
+        probe all the files at once rather than one before each decode
+        '''
+        if self.concurrency > 1:
+            self._probes = probe_all(filepaths, self.concurrency,
+                                     self.subprocess_timeout)
+        return
 
-        avg = vinfo['@r_frame_rate']
+    ############################################################################
+    def wanted(self, filename):
+        vinfo = self._probes.get(filename)
+        if vinfo is None:
+            # skvideo prefixes the stream attributes with @
+            vinfo = {key.lstrip('@'): value
+                     for key, value in ffprobe(filename)['video'].items()}
+        return self.wanted_from_info(vinfo)
+
+    ############################################################################
+    def wanted_from_info(self, vinfo):
+        '''
+        wanted frames of a video with the ffprobe stream information vinfo
+        '''
+        avg = vinfo['r_frame_rate']
         num = float(avg.split('/')[0])
         den = float(avg.split('/')[1])
         fps = float(num/den)
+        return self.wanted_frames(float(vinfo['duration']) * fps)
 
-        duration = float(vinfo['@duration']) * 0.90
-        n_frames = int(fps * duration)
-        start = int(math.floor(float(vinfo['@duration']) * fps * 0.05))
+    ############################################################################
+    def wanted_frames(self, total):
+        '''
+        grab_n_frames frame numbers spread over the middle 90% of a video
+        of total frames
+        '''
+        n_frames = int(total * 0.90)
+        start = int(math.floor(total * 0.05))
         step = int(math.floor(n_frames / self.grab_n_frames))
+        if step < 1:
+            raise RuntimeError('Video too short: {} frames'.format(total))
 
         wanted = [n for n in range(start, n_frames, step)]
         return set(wanted[:self.grab_n_frames])
 
     ############################################################################
-    def get_frames(self, filename, wanted):
-        v = FFmpegReader(filename)  # , outputdict={'-pix_fmt': 'yuv444p'})
-
-        frames = None
+    def select_frames(self, frames, wanted, filename):
+        '''
+        the wanted frames, by frame number, of an iterator over decoded frames
+        '''
+        selected = None
         n_frames = 0
-        for n, frame in enumerate(v.nextFrame()):
+        for n, frame in enumerate(frames):
             # the FFmpegReader API actually renders every frame; so it's rather
             # slow; but it ensures that every frame is rendered, not just
             # i-frames... getting i-frames would be faster, but might increase
@@ -155,23 +224,36 @@ class LLE16x16PointHash(VideoHasher):
             # different encodings
             if n not in wanted:
                 continue
-            if frames is None:
-                frames = np.ndarray(shape=(self.grab_n_frames,) + frame.shape,
-                                    dtype=np.float64)
+            if selected is None:
+                selected = np.ndarray(
+                    shape=(self.grab_n_frames,) + frame.shape,
+                    dtype=np.float64)
 
-            frames[n_frames] = frame
+            selected[n_frames] = frame
             n_frames += 1
             if n_frames == self.grab_n_frames:
                 break
-        v.close()
 
         if n_frames != self.grab_n_frames:
             raise RuntimeError(
                 'Video has invalid number of frames: {}: {}'.format(
-                    filename, len(frames)
+                    filename, n_frames
                 )
             )
-        frames = self._crop_bars(frames)
+        return selected
+
+    ############################################################################
+    def decode_frames(self, filename, wanted):
+        v = FFmpegReader(filename)  # , outputdict={'-pix_fmt': 'yuv444p'})
+        try:
+            frames = self.select_frames(v.nextFrame(), wanted, filename)
+        finally:
+            v.close()
+        return self._crop_bars(frames)
+
+    ############################################################################
+    def get_frames(self, filename, wanted):
+        frames = self.decode_frames(filename, wanted)
         return [self.process_frame(n, filename, frame)
                 for n, frame in enumerate(frames)]
 
@@ -202,18 +284,19 @@ class LLE16x16PointHash(VideoHasher):
     ############################################################################
     def get_embedding(self, points):
         n = self.wanted_dimensions
+        n_jobs = current_budget().cores
         try:
             embedding, errors = locally_linear_embedding(points,
                                                          n_neighbors=self.knn,
                                                          n_components=n,
                                                          eigen_solver='dense',
-                                                         n_jobs=-1)
+                                                         n_jobs=n_jobs)
         except Exception:
             embedding, errors = locally_linear_embedding(points,
                                                          n_neighbors=self.knn,
                                                          n_components=n,
                                                          eigen_solver='dense',
-                                                         n_jobs=-1)
+                                                         n_jobs=n_jobs)
         return (embedding, errors)
 
     ############################################################################
@@ -247,16 +330,80 @@ class LLE16x16PointHash(VideoHasher):
         pass
 
     ############################################################################
-    def hash_video(self, filepath, video):
+    def _lle_hash_decoded(self, filepath, decoded, n_wanted):
+        frames = [self.process_frame(n, filepath, frame)
+                  for n, frame in enumerate(decoded)]
+        points = self.frames_to_points(frames, n_wanted)
+        self.output_points_as_images(points, filepath)
+        return self.lle_hash(points)
+
+    ############################################################################
+    def _hash_decoded(self, filepath, decoded, n_wanted):
+        coarse = self.coarse_hash(decoded)
+        hash_value = self._lle_hash_decoded(filepath, decoded, n_wanted)
+        print(hash_value)
+        return (hash_value, coarse)
+
+    ############################################################################
+    def _hash_file(self, filepath):
         print('{}: {}: file: {}'.format(datetime.datetime.now(),
                                         self.hash_type(), filepath))
         wanted = self.wanted(filepath)
-        frames = self.get_frames(filepath, wanted)
-        points = self.frames_to_points(frames, len(wanted))
-        self.output_points_as_images(points, filepath)
-        hash_value = self.lle_hash(points)
-        print(hash_value)
-        self.store_hash(video, hash_value)
+        decoded = self.decode_frames(filepath, wanted)
+        return self._hash_decoded(filepath, decoded, len(wanted))
+
+    ############################################################################
+    def hash_file(self, filepath):
+        return self._hash_file(filepath)[0]
+
+    ############################################################################
+    def _compute_selected(self, frames, n_wanted):
+        # no coarse hash: nothing is stored
+        decoded = self._crop_bars(frames)
+        return self.hash_to_int(self._lle_hash_decoded(None, decoded,
+                                                       n_wanted))
+
+    ############################################################################
+    def compute(self, frames, total=None):
+        '''
+        only the wanted frames are kept, and frames is not read past the
+        last of them; an iterator of frames needs total
+        '''
+        if total is None:
+            if not hasattr(frames, '__len__'):
+                raise RuntimeError('Hashing a stream of frames needs the '
+                                   'number of frames of the video')
+            total = len(frames)
+        wanted = self.wanted_frames(total)
+        selected = self.select_frames(iter(frames), wanted, '<frames>')
+        return self._compute_selected(selected, len(wanted))
+
+    ############################################################################
+    def compute_from_bytes(self, buf):
+        wanted = self.wanted_from_info(probe_bytes(buf))
+        frames = decode_bytes(buf)
+        try:
+            selected = self.select_frames(frames, wanted, '<buffer>')
+        finally:
+            frames.close()
+        return self._compute_selected(selected, len(wanted))
+
+    ############################################################################
+    def hash_video(self, filepath, video):
+        # the coarse hash comes from the frames decoded for the LLE hash
+        hash_value, coarse = self._hash_file(filepath)
+        self.store_hash(video, hash_value, coarse=coarse)
+        return
+
+    ############################################################################
+    def hash_video_frames(self, filepath, frames, video):
+        print('{}: {}: stream: {}'.format(datetime.datetime.now(),
+                                          self.hash_type(), filepath))
+        decoded = self._crop_bars(np.asarray(frames, dtype=np.float64))
+        # filepath only names the stream: no debug images are written
+        hash_value, coarse = self._hash_decoded(None, decoded, len(frames))
+        self.store_hash(video, hash_value, coarse=coarse)
+        return
 
 
 ################################################################################
@@ -266,16 +413,13 @@ class LLE16x16LuminosityPointHash(LLE16x16PointHash):
     ############################################################################
     def process_frame(self, n, filename, frame):
         frame = resize(frame, (self.height, self.width), mode='constant')
-        misc.imsave('{}_{}_{}_0.jpg'
-                    .format(filename, n, self.hash_type()), frame)
+        self.save_image(filename, n, '0', frame)
         frame = gaussian(frame, sigma=3.0, multichannel=True)
-        misc.imsave('{}_{}_{}_1.jpg'
-                    .format(filename, n, self.hash_type()), frame)
+        self.save_image(filename, n, '1', frame)
         with warnings.catch_warnings():
             warnings.simplefilter('ignore')
             frame = img_as_float(color.rgb2gray(color.yuv2rgb(frame)))
-        misc.imsave('{}_{}_{}_2.jpg'
-                    .format(filename, n, self.hash_type()), frame)
+        self.save_image(filename, n, '2', frame)
         return frame
 
 
@@ -340,16 +484,13 @@ class LLE16x16in256x256LowGauss1d(LLE16x16in256x256OneDimensionLuminHash):
     ############################################################################
     def process_frame(self, n, filename, frame):
         frame = resize(frame, (self.height, self.width), mode='constant')
-        misc.imsave('{}_{}_{}_0.jpg'
-                    .format(filename, n, self.hash_type()), frame)
+        self.save_image(filename, n, '0', frame)
         frame = gaussian(frame, sigma=5.0, multichannel=True)
-        misc.imsave('{}_{}_{}_1.jpg'
-                    .format(filename, n, self.hash_type()), frame)
+        self.save_image(filename, n, '1', frame)
         with warnings.catch_warnings():
             warnings.simplefilter('ignore')
             frame = img_as_float(color.rgb2gray(color.yuv2rgb(frame)))
-        misc.imsave('{}_{}_{}_2.jpg'
-                    .format(filename, n, self.hash_type()), frame)
+        self.save_image(filename, n, '2', frame)
         return frame
 
 
@@ -373,8 +514,7 @@ class LLEMosaicHash(LLE16x16PointHash):
             warnings.simplefilter('ignore')
             frame = img_as_float(resize(frame, (self.height, self.width),
                                         mode='constant'))
-        misc.imsave('{}_{}_{}_0.jpg'
-                    .format(filename, n, self.hash_type()), frame)
+        self.save_image(filename, n, '0', frame)
         return frame
 
     ############################################################################
@@ -403,8 +543,7 @@ class LLEMosaicHash(LLE16x16PointHash):
                     block = block.reshape(self.point_y, self.point_x)
                 img[h:h+self.point_y, w:w+self.point_x] = block
 
-        misc.imsave('{}_{}_{}_9_mosaic.jpg'
-                    .format(filepath, n, self.hash_type()), img)
+        self.save_image(filepath, n, '9_mosaic', img)
         return
 
     ############################################################################
@@ -446,8 +585,7 @@ class LLEMosaicHashGrayScale(LLEMosaicHash):
                                         mode='constant'))
             frame = img_as_float(color.rgb2gray(color.yuv2rgb(frame)))
 
-        misc.imsave('{}_{}_{}_0.jpg'
-                    .format(filename, n, self.hash_type()), frame)
+        self.save_image(filename, n, '0', frame)
         return frame
 
 
@@ -462,11 +600,9 @@ class LLEDCTHash(LLE16x16PointHash):
             warnings.simplefilter('ignore')
             frame = img_as_float(resize(frame, (self.height, self.width),
                                         mode='constant'))
-            misc.imsave('{}_{}_{}_0.jpg'
-                        .format(filename, n, self.hash_type()), frame)
+            self.save_image(filename, n, '0', frame)
             frame = gaussian(frame, sigma=1.0, multichannel=True)
-            misc.imsave('{}_{}_{}_1.jpg'.format(filename, n, self.hash_type()),
-                        frame)
+            self.save_image(filename, n, '1', frame)
         return frame
 
     ############################################################################
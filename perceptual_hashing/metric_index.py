@@ -0,0 +1,359 @@
+#!/usr/bin/env python
+import heapq
+
+import numpy as np
+
+from .util import ints_to_words, words_to_ints, popcount_words
+from .video_hamming_distance import popcount
+
+
+################################################################################
+class MetricIndex:
+    '''
+    in-memory index over the integer hashes of one method, answering k-NN
+    and radius queries under the Hamming distance without touching the
+    database; subclasses prune with the triangle inequality
+    '''
+
+    ############################################################################
+    kind = None
+
+    ############################################################################
+    def __init__(self, bits, ids=None, hashes=None):
+        self.bits = bits
+        self.ids = list(ids or [])
+        self.hashes = list(hashes or [])
+        # identical hashes are indexed once: representative -> the others
+        self._duplicates = {}
+        return
+
+    ############################################################################
+    def __len__(self):
+        return len(self.ids)
+
+    ############################################################################
+    @staticmethod
+    def distance(a, b):
+        return popcount(a ^ b)
+
+    ############################################################################
+    def _found(self, found, n, d):
+        found(n, d)
+        for m in self._duplicates.get(n, ()):
+            found(m, d)
+        return
+
+    ############################################################################
+    def radius(self, h, r):
+        '''
+        (video_id, distance) of every hash within distance r of h, closest
+        first
+        '''
+        found = []
+        self._search(h, lambda: r,
+                     lambda n, d: found.append((d, int(self.ids[n]))))
+        return [(video_id, d) for d, video_id in sorted(found)]
+
+    ############################################################################
+    def knn(self, h, k):
+        '''
+        the k (video_id, distance) pairs closest to h, closest first; ties
+        go to the lower video id
+        '''
+        heap = []
+
+        def tau():
+            if len(heap) < k:
+                return float('inf')
+            return -heap[0][0]
+
+        def found(n, d):
+            item = (-d, -int(self.ids[n]))
+            if len(heap) < k:
+                heapq.heappush(heap, item)
+            elif item > heap[0]:
+                heapq.heapreplace(heap, item)
+
+        if k > 0:
+            self._search(h, tau, found)
+        return [(-video_id, -d)
+                for d, video_id in sorted(heap, reverse=True)]
+
+    ############################################################################
+    def _search(self, h, tau, found):
+        raise NotImplementedError('_search')
+
+    ############################################################################
+    def _arrays(self):
+        raise NotImplementedError('_arrays')
+
+    ############################################################################
+    def save(self, path):
+        with open(path, 'wb') as fd:
+            np.savez(fd, kind=np.array(self.kind), bits=np.array(self.bits),
+                     ids=np.asarray(self.ids, dtype=np.int64),
+                     **self._arrays())
+        return
+
+    ############################################################################
+    @classmethod
+    def load(cls, path):
+        data = np.load(path)
+        kind = str(data['kind'])
+        for sc in MetricIndex.__subclasses__():
+            if sc.kind == kind:
+                index = sc(int(data['bits']))
+                index._load_arrays(data)
+                return index
+        raise RuntimeError('Unknown index kind: {}'.format(kind))
+
+
+################################################################################
+class BKTree(MetricIndex):
+    '''
+    Burkhard-Keller tree; suits short hashes (e.g. the 64-bit pHash) where
+    the Hamming distance takes few distinct values
+    '''
+
+    ############################################################################
+    kind = 'bk'
+
+    ############################################################################
+    def __init__(self, bits, ids=None, hashes=None):
+        super().__init__(bits)
+        self._parent = []
+        self._edge = []
+        self._children = []
+        for video_id, h in zip(ids or [], hashes or []):
+            self.add(video_id, h)
+        return
+
+    ############################################################################
+    def add(self, video_id, h):
+        n = len(self.ids)
+        self.ids.append(video_id)
+        self.hashes.append(h)
+        self._children.append({})
+        if n == 0:
+            self._parent.append(-1)
+            self._edge.append(0)
+            return
+
+        node = 0
+        while True:
+            d = self.distance(h, self.hashes[node])
+            if d == 0:
+                self._duplicates.setdefault(node, []).append(n)
+                self._parent.append(-1)
+                self._edge.append(0)
+                return
+            child = self._children[node].get(d)
+            if child is None:
+                self._children[node][d] = n
+                self._parent.append(node)
+                self._edge.append(d)
+                return
+            node = child
+
+    ############################################################################
+    def _search(self, h, tau, found):
+        if len(self.ids) == 0:
+            return
+        stack = [0]
+        while stack:
+            node = stack.pop()
+            d = self.distance(h, self.hashes[node])
+            if d <= tau():
+                self._found(found, node, d)
+            r = tau()
+            for edge, child in self._children[node].items():
+                if d - r <= edge <= d + r:
+                    stack.append(child)
+        return
+
+    ############################################################################
+    def _arrays(self):
+        dup_of = np.full((len(self.ids),), -1, dtype=np.int64)
+        for n, duplicates in self._duplicates.items():
+            dup_of[duplicates] = n
+        return {'words': ints_to_words(self.hashes, self.bits),
+                'dup_of': dup_of,
+                'parent': np.array(self._parent, dtype=np.int64),
+                'edge': np.array(self._edge, dtype=np.int64)}
+
+    ############################################################################
+    def _load_arrays(self, data):
+        self.ids = data['ids'].tolist()
+        self.hashes = words_to_ints(data['words'])
+        for n, first in enumerate(data['dup_of'].tolist()):
+            if first >= 0:
+                self._duplicates.setdefault(first, []).append(n)
+        self._parent = data['parent'].tolist()
+        self._edge = data['edge'].tolist()
+        self._children = [{} for n in self._parent]
+        for n, (parent, edge) in enumerate(zip(self._parent, self._edge)):
+            if parent >= 0:
+                self._children[parent][edge] = n
+        return
+
+
+################################################################################
+class VPTree(MetricIndex):
+    '''
+    vantage-point tree; suits long hashes (the 480-bit LLE hashes) whose
+    distances spread too widely for a BK-tree to prune well
+
+    the tree lives in flat arrays: ids and the packed hash words are
+    reordered so that every node covers the slice [lo, hi) of them, its
+    vantage point first, then the hashes closer than mu to it, then the
+    rest. subtrees of at most leaf_size hashes, or of identical hashes, are
+    leaves scanned in one popcount. a saved tree loads without rebuilding
+    anything. where the distances concentrate, as between unrelated long
+    hashes, little is pruned and a query costs about as much as scanning
+    every hash
+    '''
+
+    ############################################################################
+    kind = 'vp'
+    leaf_size = 1024
+
+    ############################################################################
+    def __init__(self, bits, ids=None, hashes=None, seed=0, words=None):
+        super().__init__(bits)
+        if words is None:
+            words = ints_to_words(hashes or [], bits)
+        self.ids = np.asarray(ids if ids is not None else [], dtype=np.int64)
+        self.words = np.asarray(words, dtype=np.uint64)
+        self._lo = np.zeros((0,), dtype=np.int64)
+        self._hi = np.zeros((0,), dtype=np.int64)
+        self._mu = np.zeros((0,), dtype=np.int64)
+        self._inside = np.zeros((0,), dtype=np.int64)
+        self._outside = np.zeros((0,), dtype=np.int64)
+        if len(self.ids) > 0:
+            self._build(np.random.RandomState(seed))
+        return
+
+    ############################################################################
+    def _build(self, rnd):
+        order = np.arange(len(self.ids))
+        lo, hi, mu, inside, outside = [], [], [], [], []
+        # iterative so that degenerate splits cannot exhaust the stack
+        stack = [(0, len(order), None, None)]
+        while stack:
+            start, stop, parent, side = stack.pop()
+            node = len(lo)
+            if parent is not None:
+                side[parent] = node
+            lo.append(start)
+            hi.append(stop)
+            mu.append(-1)
+            inside.append(-1)
+            outside.append(-1)
+            if stop - start <= self.leaf_size:
+                continue
+
+            vp = start + rnd.randint(stop - start)
+            order[start], order[vp] = order[vp], order[start]
+            rest = order[start + 1:stop]
+            distances = popcount_words(self.words[rest]
+                                       ^ self.words[order[start]])
+            if distances.min() == distances.max() == 0:
+                continue
+            split = int(np.median(distances))
+            if not np.any(distances < split):
+                split = int(distances.min()) + 1
+            closer = distances < split
+            middle = start + 1 + int(np.count_nonzero(closer))
+            order[start + 1:stop] = np.concatenate([rest[closer],
+                                                    rest[~closer]])
+            mu[node] = split
+            if middle > start + 1:
+                stack.append((start + 1, middle, node, inside))
+            if stop > middle:
+                stack.append((middle, stop, node, outside))
+
+        self.ids = self.ids[order]
+        self.words = self.words[order]
+        self._lo = np.array(lo, dtype=np.int64)
+        self._hi = np.array(hi, dtype=np.int64)
+        self._mu = np.array(mu, dtype=np.int64)
+        self._inside = np.array(inside, dtype=np.int64)
+        self._outside = np.array(outside, dtype=np.int64)
+        return
+
+    ############################################################################
+    def _search(self, h, tau, found):
+        if len(self._lo) == 0:
+            return
+        h = ints_to_words([h], self.bits)[0]
+        stack = [0]
+        while stack:
+            node = stack.pop()
+            lo = int(self._lo[node])
+            mu = int(self._mu[node])
+            if mu < 0:
+                distances = popcount_words(self.words[lo:self._hi[node]] ^ h)
+                for n in np.flatnonzero(distances <= tau()):
+                    found(lo + int(n), int(distances[n]))
+                continue
+
+            d = int(popcount_words(self.words[lo] ^ h))
+            if d <= tau():
+                found(lo, d)
+            # visit the more promising side last so it is popped first
+            sides = [(int(self._outside[node]), d + tau() >= mu),
+                     (int(self._inside[node]), d - tau() < mu)]
+            if d >= mu:
+                sides.reverse()
+            for child, reachable in sides:
+                if child >= 0 and reachable:
+                    stack.append(child)
+        return
+
+    ############################################################################
+    def _arrays(self):
+        return {'words': self.words, 'lo': self._lo, 'hi': self._hi,
+                'mu': self._mu, 'inside': self._inside,
+                'outside': self._outside}
+
+    ############################################################################
+    def _load_arrays(self, data):
+        self.ids = data['ids']
+        self.words = data['words']
+        self._lo = data['lo']
+        self._hi = data['hi']
+        self._mu = data['mu']
+        self._inside = data['inside']
+        self._outside = data['outside']
+        return
+
+
+################################################################################
+def build_index(manager, methodcls, kind=None, snapshot=None,
+                catalog=None):
+    '''
+    bulk build an index over every stored hash of methodcls, read from the
+    packed words of a snapshot.HashSnapshot or catalog.VideoCatalog, or from
+    the database; a BK-tree for hashes of up to 64 bits, a VP-tree otherwise
+    '''
+    method = methodcls.hash_type()
+    bits = methodcls.hash_bits()
+    if snapshot is not None:
+        ids = snapshot.ids(method)
+        words = snapshot.words(method)
+    elif catalog is not None:
+        hashed = catalog.hashed(method)
+        ids = catalog.ids[hashed]
+        words = catalog.words(method)[hashed]
+    else:
+        hashes = manager.hash_dao.get_all_video_hashes([method])
+        ids = sorted(hashes)
+        words = ints_to_words([methodcls.hash_to_int(hashes[n][method])
+                               for n in ids], bits)
+    if kind is None:
+        kind = 'bk' if bits <= 64 else 'vp'
+    if kind == 'bk':
+        return BKTree(bits, np.asarray(ids).tolist(), words_to_ints(words))
+    if kind == 'vp':
+        return VPTree(bits, ids, words=words)
+    raise RuntimeError('Unknown index kind: {}'.format(kind))
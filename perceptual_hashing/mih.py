@@ -0,0 +1,204 @@
+#!/usr/bin/env python
+import itertools
+import sys
+from optparse import OptionParser
+
+from .data_manager import VideoDataManager
+from .video_hamming_distance import popcount
+
+
+################################################################################
+class MultiIndexHash:
+    '''
+    multi-index hashing over the stored hashes of one method
+
+    each hash_bits() bit hash is split into n_substrings substrings, and a
+    table in the VideoDataManager database maps (substring, value) to the
+    videos having it. two hashes within distance r agree within
+    r // n_substrings bits on at least one substring (pigeonhole), so a
+    radius query only looks up the neighbours of its own substrings and
+    verifies the candidates with the exact distance.
+    '''
+
+    ############################################################################
+    substring_bits = 16
+
+    ############################################################################
+    def __init__(self, manager, methodcls, n_substrings=None):
+        self._manager = manager
+        self._methodcls = methodcls
+        self.method = methodcls.hash_type()
+        self.bits = methodcls.hash_bits()
+        if n_substrings is None:
+            n_substrings = max(1, self.bits // self.substring_bits)
+        self.n_substrings = n_substrings
+        self._method_id = None
+
+        # widths differ by at most one bit when bits % n_substrings != 0
+        base, extra = divmod(self.bits, self.n_substrings)
+        self._widths = [base + (1 if n < extra else 0)
+                        for n in range(self.n_substrings)]
+        self._shifts = []
+        shift = self.bits
+        for width in self._widths:
+            shift -= width
+            self._shifts.append(shift)
+        return
+
+    ############################################################################
+    @property
+    def method_id(self):
+        if self._method_id is None:
+            hdao = self._manager.hash_dao
+            self._method_id = hdao.get_hash_method_by_name(self.method)
+        return self._method_id
+
+    ############################################################################
+    def substrings(self, h):
+        return [(h >> shift) & ((1 << width) - 1)
+                for shift, width in zip(self._shifts, self._widths)]
+
+    ############################################################################
+    @staticmethod
+    def neighbours(key, width, radius):
+        '''
+        every width-bit value within hamming distance radius of key
+        '''
+        found = [key]
+        for r in range(1, min(radius, width) + 1):
+            for bits in itertools.combinations(range(width), r):
+                flip = 0
+                for b in bits:
+                    flip |= 1 << b
+                found.append(key ^ flip)
+        return found
+
+    ############################################################################
+    def _rows(self, method_id, video_id, value):
+        h = self._methodcls.hash_to_int(value)
+        return [(method_id, n, key, video_id)
+                for n, key in enumerate(self.substrings(h))]
+
+    ############################################################################
+    def add(self, cursor, video_id, value, method_id=None):
+        '''
+        (re)index one stored hash; runs on the caller's cursor so it is part
+        of the transaction that wrote the hash
+        '''
+        self.add_many(cursor, [(video_id, value)], method_id)
+        return
+
+    ############################################################################
+    def add_many(self, cursor, hashes, method_id=None):
+        if method_id is None:
+            method_id = self.method_id
+        hashes = list(hashes)
+        cursor.executemany('''
+            DELETE FROM mih_substrings
+            WHERE method = ? AND video_id = ?
+            ''', [(method_id, video_id) for video_id, _ in hashes])
+        cursor.executemany('''
+            INSERT INTO mih_substrings (method, chunk, key, video_id)
+            VALUES (?,?,?,?)
+            ''', [row for video_id, value in hashes
+                  for row in self._rows(method_id, video_id, value)])
+        return
+
+    ############################################################################
+    def remove(self, video_id, commit=True):
+        c = self._manager.conn.cursor()
+        c.execute('''
+            DELETE FROM mih_substrings
+            WHERE method = ? AND video_id = ?
+            ''', [self.method_id, video_id])
+        if commit:
+            self._manager.conn.commit()
+        return
+
+    ############################################################################
+    def rebuild(self):
+        conn = self._manager.conn
+        hashes = self._manager.hash_dao.get_all_video_hashes([self.method])
+        c = conn.cursor()
+        try:
+            c.execute('''
+                DELETE FROM mih_substrings
+                WHERE method = ?
+                ''', [self.method_id])
+            c.executemany('''
+                INSERT INTO mih_substrings (method, chunk, key, video_id)
+                VALUES (?,?,?,?)
+                ''', [row for video_id, h in hashes.items()
+                      for row in self._rows(self.method_id, video_id,
+                                            h[self.method])])
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        return len(hashes)
+
+    ############################################################################
+    def candidates(self, h, radius):
+        sub_radius = radius // self.n_substrings
+        c = self._manager.conn.cursor()
+        found = set()
+        for n, key in enumerate(self.substrings(h)):
+            keys = self.neighbours(key, self._widths[n], sub_radius)
+            for k in range(0, len(keys), 500):
+                chunk = keys[k:k+500]
+                c.execute('''
+                    SELECT video_id
+                    FROM mih_substrings
+                    WHERE method = ? AND chunk = ? AND key IN ({})
+                    '''.format(','.join('?' * len(chunk))),
+                    [self.method_id, n] + chunk)
+                found.update(r[0] for r in c.fetchall())
+        return found
+
+    ############################################################################
+    def search(self, value, radius):
+        '''
+        (video_id, distance) of every stored hash within radius of value,
+        closest first
+        '''
+        h = self._methodcls.hash_to_int(value)
+        candidates = list(self.candidates(h, radius))
+        c = self._manager.conn.cursor()
+        matches = []
+        for k in range(0, len(candidates), 500):
+            chunk = candidates[k:k+500]
+            c.execute('''
+                SELECT video_id, hash_value
+                FROM computed_hashes
+                WHERE hash_method_id = ? AND video_id IN ({})
+                '''.format(','.join('?' * len(chunk))),
+                [self.method_id] + chunk)
+            for video_id, stored in c.fetchall():
+                distance = popcount(h ^ self._methodcls.hash_to_int(stored))
+                if distance <= radius:
+                    matches.append((video_id, distance))
+        return sorted(matches, key=lambda m: (m[1], m[0]))
+
+
+################################################################################
+def main(argv):
+    from . import llehash  # noqa: F401
+    from .video_hashing import VideoHasher
+
+    parser = OptionParser(usage='%prog [options] method [method ...]')
+    parser.add_option('--db',
+                      action='store',
+                      dest='db',
+                      default='videohash.db',
+                      help='Database to rebuild the index in')
+    (opts, args) = parser.parse_args(argv[1:])
+    if len(args) < 1:
+        sys.stderr.write("Must specify at least one hash method\n")
+        sys.exit(1)
+
+    manager = VideoDataManager(opts.db)
+    for method in args:
+        index = MultiIndexHash(manager,
+                               VideoHasher.get_hashmethod_class(method))
+        print('{}: indexed {} hashes'.format(method, index.rebuild()))
+    return
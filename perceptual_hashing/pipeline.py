@@ -0,0 +1,211 @@
+#!/usr/bin/env python
+import os
+import queue
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+from .accuracy import CalculateAccuracy
+from .data_manager import VideoDataManager
+from .util import ints_to_words, popcount_words, words_per_hash
+from .video_hashing import VIDEO_FORMATS
+from .video_preprocessing import VideoTranscoder
+
+_STOP = object()
+
+
+################################################################################
+class PipelineRunner:
+    '''
+    run_experiments as concurrent stages instead of phases
+
+    a transcoding thread hands every source and output to the hashing
+    thread as soon as its ffmpeg job is done, and the hashing thread hands
+    every stored hash to the distance thread, which computes its distances
+    to the videos of the same method seen before, as one popcount over the
+    packed hashes of those videos. the stages are linked by
+    queues of at most queue_size items, so a slow stage holds back the one
+    before it rather than letting work pile up. accuracy is evaluated on the
+    stored distances once all stages are done
+    '''
+
+    ############################################################################
+    queue_size = 16
+
+    ############################################################################
+    def __init__(self, path, hasher_classes, manager=None, force=False,
+                 transcode_jobs=None):
+        self.path = path
+        self.force = force
+        self.transcode_jobs = transcode_jobs
+        self._classes = list(hasher_classes)
+        self._manager = manager
+        if self._manager is None:
+            self._manager = VideoDataManager()
+        self.errors = []
+        self.timings = OrderedDict()
+        self._start = None
+        return
+
+    ############################################################################
+    def _mark(self, name):
+        if name not in self.timings:
+            self.timings[name] = time.perf_counter() - self._start
+        return
+
+    ############################################################################
+    def _registered_files(self):
+        vdao = self._manager.video_dao
+        for v in sorted(os.listdir(self.path)):
+            name, fmt = os.path.splitext(v)
+            fmt = fmt.replace('.', '')
+            if (fmt in VIDEO_FORMATS
+                    and vdao.video_by_name_and_format(name, fmt) is not None):
+                yield os.path.join(self.path, v)
+        return
+
+    ############################################################################
+    def _stage(self, name, work, inp, out):
+        '''
+        run work(inp, out) and close out with _STOP; after a failure the
+        rest of inp is drained so the stage before does not block
+        '''
+        try:
+            work(inp, out)
+        except Exception as err:
+            self.errors.append((name, err))
+            if inp is not None:
+                for _ in iter(inp.get, _STOP):
+                    pass
+        finally:
+            if out is not None:
+                out.put(_STOP)
+            self._mark(name)
+        return
+
+    ############################################################################
+    def _transcode(self, inp, out):
+        # files transcoded in an earlier run can be hashed right away
+        for path in self._registered_files():
+            out.put(path)
+        transcoder = VideoTranscoder(self.path, self._manager,
+                                     force=self.force,
+                                     processes=self.transcode_jobs)
+        transcoder.on_output = out.put
+        transcoder.run()
+        for path in self._registered_files():
+            out.put(path)
+        return
+
+    ############################################################################
+    def _hash(self, inp, out):
+        hashers = [cl(self.path, self._manager, force=self.force)
+                   for cl in self._classes]
+        seen = set()
+        for path in iter(inp.get, _STOP):
+            if path in seen:
+                continue
+            seen.add(path)
+            for hasher in hashers:
+                video = hasher.get_video(os.path.basename(path))
+                if not hasher.is_video_already_hashed(video):
+                    hasher.hash_or_reuse(path, video)
+                    self._mark('first hash')
+                out.put((hasher.hash_type(), video.id))
+        return
+
+    ############################################################################
+    def _add_video(self, method, video, seen):
+        '''
+        store the distances from video to the videos of seen[method], a
+        [videos, packed hashes] pair whose words grow by doubling
+        '''
+        methodcls = self._classes_by_method[method]
+        videos, words = seen[method]
+        h = video.hash_values[method]
+        row = ints_to_words([methodcls.hash_to_int(h)],
+                            methodcls.hash_bits())
+        n = len(videos)
+        if n:
+            self._manager.distance_dao.add_row(
+                h.id, video, videos, popcount_words(words[:n] ^ row))
+            self._mark('first distance')
+        if n == len(words):
+            words = np.concatenate([words, np.zeros_like(words)])
+            seen[method][1] = words
+        words[n] = row[0]
+        videos.append(video)
+        return
+
+    ############################################################################
+    def _distances(self, inp, out):
+        vdao = self._manager.video_dao
+        seen = {}
+        for method in self._pending:
+            bits = self._classes_by_method[method].hash_bits()
+            seen[method] = [[], np.zeros((1, words_per_hash(bits)),
+                                         dtype=np.uint64)]
+        ids = {method: set() for method in self._pending}
+        for method, video_id in iter(inp.get, _STOP):
+            if method not in seen or video_id in ids[method]:
+                continue
+            ids[method].add(video_id)
+            # the hash may be newer than this thread's copy of the video
+            self._manager.session.expire_video(video_id)
+            self._add_video(method, vdao.video_by_id(video_id), seen)
+
+        # hashed videos whose files are not in this directory
+        for method in self._pending:
+            for video in vdao.all_videos([method]):
+                if method in video.hash_values and video.id not in ids[method]:
+                    ids[method].add(video.id)
+                    self._add_video(method, video, seen)
+        return
+
+    ############################################################################
+    def run(self):
+        self._start = time.perf_counter()
+        self.errors = []
+        self.timings = OrderedDict()
+        self._classes_by_method = {cl.hash_type(): cl for cl in self._classes}
+
+        # methods evaluated before need no distances
+        hdao = self._manager.hash_dao
+        self._pending = []
+        for method in self._classes_by_method:
+            accuracy = hdao.get_method_accuracy(
+                hdao.get_hash_method_by_name(method))
+            if accuracy is None or accuracy['accuracy'] is None:
+                self._pending.append(method)
+
+        to_hash = queue.Queue(self.queue_size)
+        to_measure = queue.Queue(self.queue_size)
+        threads = [
+            threading.Thread(target=self._stage,
+                             args=('transcode', self._transcode, None,
+                                   to_hash)),
+            threading.Thread(target=self._stage,
+                             args=('hash', self._hash, to_hash, to_measure)),
+            threading.Thread(target=self._stage,
+                             args=('distances', self._distances, to_measure,
+                                   None)),
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        if self.errors:
+            name, err = self.errors[0]
+            raise RuntimeError('Pipeline {} stage failed: {}'.format(name,
+                                                                     err))
+
+        results = {}
+        for method in self._classes_by_method:
+            results[method] = CalculateAccuracy(method, self._manager).run(
+                calculate=False)
+        self._mark('accuracy')
+        for name, seconds in self.timings.items():
+            print('{}: {:.3f}s'.format(name, seconds))
+        return results
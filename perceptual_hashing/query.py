@@ -0,0 +1,205 @@
+#!/usr/bin/env python
+import collections
+import sys
+import time
+from optparse import OptionParser
+
+from .data_manager import VideoDataManager
+from .metric_index import MetricIndex, build_index
+from .util import threshold_radius
+
+
+################################################################################
+class QueryMatch:
+    ############################################################################
+    def __init__(self, video, distance, max_distance, threshold):
+        self.video = video
+        self.distance = distance
+        # distance on the same 0..1 scale as hash_methods.threshold
+        self.relative = distance / max_distance
+        self.threshold = threshold
+        return
+
+    ############################################################################
+    @property
+    def is_match(self):
+        if self.threshold is None:
+            return None
+        return self.relative < self.threshold
+
+    ############################################################################
+    def __repr__(self):
+        return 'QueryMatch({}, {}, {:.3f})'.format(self.video, self.distance,
+                                                   self.relative)
+
+
+################################################################################
+class QueryResult:
+    ############################################################################
+    def __init__(self, filepath, method, value, matches, timings):
+        self.filepath = filepath
+        self.method = method
+        self.value = value
+        self.matches = matches
+        # stage -> seconds, in the order the stages ran
+        self.timings = timings
+        return
+
+    ############################################################################
+    @property
+    def latency(self):
+        return sum(self.timings.values())
+
+
+################################################################################
+class VideoQuery:
+    '''
+    look up a video that is not in the catalog
+
+    the file is hashed with the method's VideoHasher without registering
+    it, the hash is looked up in an in-memory MetricIndex over the stored
+    hashes, and the nearest videos are ranked by distance relative to the
+    threshold learned for the method in hash_methods
+    '''
+
+    ############################################################################
+    def __init__(self, methodcls, manager=None, index=None):
+        self._methodcls = methodcls
+        self._manager = manager
+        if self._manager is None:
+            self._manager = VideoDataManager()
+        self.method = methodcls.hash_type()
+        self._hasher = methodcls('.', self._manager)
+        self._index = index
+        self._threshold = None
+        self.load_time = 0.0
+        return
+
+    ############################################################################
+    @property
+    def threshold(self):
+        if self._threshold is None:
+            hdao = self._manager.hash_dao
+            details = hdao.get_method_accuracy(
+                hdao.get_hash_method_by_name(self.method))
+            if details is not None:
+                self._threshold = details['threshold']
+        return self._threshold
+
+    ############################################################################
+    @property
+    def index(self):
+        if self._index is None:
+            start = time.perf_counter()
+            self._index = build_index(self._manager, self._methodcls)
+            self.load_time = time.perf_counter() - start
+        return self._index
+
+    ############################################################################
+    def load_index(self, path):
+        start = time.perf_counter()
+        self._index = MetricIndex.load(path)
+        self.load_time = time.perf_counter() - start
+        return self._index
+
+    ############################################################################
+    def query(self, filepath, k=10, within_threshold=False):
+        '''
+        the k catalog videos closest to filepath; only those under the
+        method's threshold when within_threshold is set
+        '''
+        timings = collections.OrderedDict()
+        if self._index is None:
+            self.index
+            timings['index'] = self.load_time
+
+        start = time.perf_counter()
+        value = self._hasher.hash_file(filepath)
+        timings['hash'] = time.perf_counter() - start
+        return self.lookup(value, k, within_threshold, filepath, timings)
+
+    ############################################################################
+    def lookup(self, value, k=10, within_threshold=False, filepath=None,
+               timings=None):
+        '''
+        query with a hash value computed already
+        '''
+        if timings is None:
+            timings = collections.OrderedDict()
+        index = self.index
+
+        start = time.perf_counter()
+        h = self._methodcls.hash_to_int(value)
+        threshold = self.threshold
+        max_distance = self._methodcls.max_threshold()
+        if within_threshold and threshold is not None:
+            # distances are integers, so relative < threshold is d <= this
+            radius = threshold_radius(threshold, max_distance)
+            found = index.radius(h, radius)[:k]
+        else:
+            found = index.knn(h, k)
+        timings['search'] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        videos = {v.id: v for v in self._manager.video_dao.videos_by_ids(
+            [video_id for video_id, _ in found], [self.method])}
+        matches = [QueryMatch(videos[video_id], distance, max_distance,
+                              threshold)
+                   for video_id, distance in found if video_id in videos]
+        timings['fetch'] = time.perf_counter() - start
+        return QueryResult(filepath, self.method, value, matches, timings)
+
+
+################################################################################
+def main(argv):
+    from . import llehash  # noqa: F401
+    from .video_hashing import VideoHasher
+
+    parser = OptionParser(usage='%prog [options] video [video ...]')
+    parser.add_option('--db',
+                      action='store',
+                      dest='db',
+                      default='videohash.db',
+                      help='Database holding the catalog')
+    parser.add_option('-m', '--method',
+                      action='store',
+                      dest='method',
+                      default='phash-summary',
+                      help='Hash method to query with')
+    parser.add_option('-k',
+                      action='store',
+                      type='int',
+                      dest='k',
+                      default=10,
+                      help='Number of matches to return')
+    parser.add_option('--index',
+                      action='store',
+                      dest='index',
+                      default=None,
+                      help='Saved index to load instead of building one')
+    parser.add_option('--within-threshold',
+                      action='store_true',
+                      dest='within_threshold',
+                      default=False,
+                      help="Only return matches under the method's threshold")
+    (opts, args) = parser.parse_args(argv[1:])
+    if len(args) < 1:
+        sys.stderr.write("Must specify at least one video to query\n")
+        sys.exit(1)
+
+    methodcls = VideoHasher.get_hashmethod_class(opts.method)
+    query = VideoQuery(methodcls, VideoDataManager(opts.db))
+    if opts.index is not None:
+        query.load_index(opts.index)
+
+    for filepath in args:
+        result = query.query(filepath, opts.k, opts.within_threshold)
+        print('{}: {}'.format(filepath, result.method))
+        for rank, match in enumerate(result.matches, 1):
+            print('  {:3d} {}.{} distance {} ({:.3f}{})'.format(
+                rank, match.video.name, match.video.format, match.distance,
+                match.relative, ' match' if match.is_match else ''))
+        print('  latency {:.3f}s: {}'.format(
+            result.latency, ', '.join('{} {:.3f}s'.format(stage, t)
+                                      for stage, t in result.timings.items())))
+    return
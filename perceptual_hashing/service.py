@@ -0,0 +1,397 @@
+#!/usr/bin/env python
+import collections
+import json
+import os
+import queue
+import socket
+import socketserver
+import sys
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from optparse import OptionParser
+
+from .cpu_budget import current_budget
+from .data_manager import VideoDataManager
+from .query import VideoQuery
+
+_STOP = object()
+
+
+################################################################################
+class HashService:
+    '''
+    hashing and lookups against a catalog kept warm in one process
+
+    the hashers, the metric index of every method and the database
+    connection are set up once, so a request only pays for hashing its
+    file. requests wait in a queue of at most max_pending; a dispatcher
+    thread takes up to batch_size of them at a time, waiting at most
+    batch_window seconds for a batch to fill, and hands them to a pool of
+    workers with the requests for the same (method, file) hashed only once.
+    a request that finds the queue full is answered at once with a 'busy'
+    error the client may retry, rather than queued without bound
+
+    a request is a dict with an op of 'hash', 'lookup', 'ping' or 'stats'.
+    hash and lookup take a path and a method (default: the first one
+    served), lookup also k and within_threshold as in VideoQuery.query.
+    the response carries the id of its request, if it had one, and ok;
+    an error response has error and retry instead of the results
+    '''
+
+    ############################################################################
+    max_pending = 64
+    batch_size = 8
+    batch_window = 0.01
+
+    ############################################################################
+    def __init__(self, methodclasses, manager=None, workers=None,
+                 max_pending=None, batch_size=None):
+        self._manager = manager
+        if self._manager is None:
+            self._manager = VideoDataManager()
+        self.workers = workers or current_budget().cores
+        if max_pending is not None:
+            self.max_pending = max_pending
+        if batch_size is not None:
+            self.batch_size = batch_size
+        self._queries = collections.OrderedDict(
+            (cl.hash_type(), VideoQuery(cl, self._manager))
+            for cl in methodclasses)
+        if len(self._queries) == 0:
+            raise RuntimeError('A hash service needs at least one method')
+        start = time.perf_counter()
+        for q in self._queries.values():
+            q.index
+        self.load_time = time.perf_counter() - start
+
+        self.stats = collections.Counter()
+        self._stats_lock = threading.Lock()
+        self._pending = queue.Queue(self.max_pending)
+        # batches handed to the pool but not finished, so the pool's own
+        # queue cannot grow past the workers
+        self._slots = threading.BoundedSemaphore(self.workers)
+        self._pool = ThreadPoolExecutor(self.workers)
+        self._dispatcher = threading.Thread(target=self._dispatch,
+                                            daemon=True)
+        self._dispatcher.start()
+        return
+
+    ############################################################################
+    def _count(self, name):
+        with self._stats_lock:
+            self.stats[name] += 1
+        return
+
+    ############################################################################
+    @property
+    def methods(self):
+        return list(self._queries)
+
+    ############################################################################
+    @staticmethod
+    def _error(request, message, retry=False):
+        response = {'ok': False, 'error': message, 'retry': retry}
+        if 'id' in request:
+            response['id'] = request['id']
+        return response
+
+    ############################################################################
+    @staticmethod
+    def _ok(request, **fields):
+        response = {'ok': True}
+        if 'id' in request:
+            response['id'] = request['id']
+        response.update(fields)
+        return response
+
+    ############################################################################
+    def submit(self, request):
+        '''
+        a Future of the response to request
+        '''
+        future = Future()
+        op = request.get('op')
+        if op == 'ping':
+            future.set_result(self._ok(request, methods=self.methods))
+            return future
+        if op == 'stats':
+            with self._stats_lock:
+                stats = dict(self.stats)
+            future.set_result(self._ok(request, pending=self._pending.qsize(),
+                                       **stats))
+            return future
+        if op not in ('hash', 'lookup'):
+            future.set_result(self._error(request,
+                                          'Unknown op: {}'.format(op)))
+            return future
+        method = request.setdefault('method', self.methods[0])
+        if method not in self._queries or 'path' not in request:
+            future.set_result(self._error(
+                request, 'Bad request: method {} path {}'.format(
+                    method, request.get('path'))))
+            return future
+
+        try:
+            self._pending.put_nowait((request, future))
+        except queue.Full:
+            self._count('rejected')
+            future.set_result(self._error(request, 'busy', retry=True))
+        return future
+
+    ############################################################################
+    def _dispatch(self):
+        stopping = False
+        while not stopping:
+            item = self._pending.get()
+            if item is _STOP:
+                break
+            batch = [item]
+            deadline = time.perf_counter() + self.batch_window
+            while len(batch) < self.batch_size:
+                try:
+                    item = self._pending.get(
+                        timeout=max(0, deadline - time.perf_counter()))
+                except queue.Empty:
+                    break
+                if item is _STOP:
+                    stopping = True
+                    break
+                batch.append(item)
+
+            groups = collections.OrderedDict()
+            for request, future in batch:
+                key = (request['method'], request['path'])
+                groups.setdefault(key, []).append((request, future))
+            self._count('batches')
+            for (method, path), items in groups.items():
+                self._slots.acquire()
+                self._pool.submit(self._run_group, method, path, items)
+        return
+
+    ############################################################################
+    def _run_group(self, method, path, items):
+        try:
+            query = self._queries[method]
+            methodcls = query._methodcls
+            start = time.perf_counter()
+            try:
+                value = query._hasher.hash_file(path)
+            except Exception as err:
+                for request, future in items:
+                    future.set_result(self._error(request, str(err)))
+                return
+            hashed = time.perf_counter() - start
+            self._count('hashed')
+            text = methodcls.int_to_hash(methodcls.hash_to_int(value))
+
+            for request, future in items:
+                self._count(request['op'])
+                if request['op'] == 'hash':
+                    future.set_result(self._ok(
+                        request, method=method, value=text,
+                        timings={'hash': hashed}))
+                    continue
+                try:
+                    result = query.lookup(
+                        value, int(request.get('k', 10)),
+                        bool(request.get('within_threshold', False)),
+                        path, collections.OrderedDict([('hash', hashed)]))
+                except Exception as err:
+                    future.set_result(self._error(request, str(err)))
+                    continue
+                matches = [{'name': m.video.name, 'format': m.video.format,
+                            'distance': m.distance, 'relative': m.relative,
+                            'match': m.is_match}
+                           for m in result.matches]
+                future.set_result(self._ok(
+                    request, method=method, value=text, matches=matches,
+                    timings=result.timings))
+        finally:
+            self._slots.release()
+        return
+
+    ############################################################################
+    def close(self):
+        '''
+        finish the queued requests and stop the workers
+        '''
+        self._pending.put(_STOP)
+        self._dispatcher.join()
+        self._pool.shutdown(wait=True)
+        return
+
+
+################################################################################
+class _Handler(socketserver.StreamRequestHandler):
+    '''
+    one json request per line in, one json response per line out; the
+    requests of a connection are served concurrently, so responses come
+    back as they are ready and are matched to requests by id
+    '''
+
+    ############################################################################
+    def handle(self):
+        service = self.server.service
+        done = threading.Condition()
+        counts = {'sent': 0}
+
+        def reply(future):
+            line = json.dumps(future.result()) + '\n'
+            with done:
+                try:
+                    self.wfile.write(line.encode('utf-8'))
+                    self.wfile.flush()
+                except OSError:
+                    # the client went away
+                    pass
+                counts['sent'] += 1
+                done.notify_all()
+            return
+
+        received = 0
+        for line in self.rfile:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                request = json.loads(line.decode('utf-8'))
+                if not isinstance(request, dict):
+                    raise ValueError('not an object')
+            except ValueError as err:
+                future = Future()
+                future.set_result(HashService._error(
+                    {}, 'Bad request: {}'.format(err)))
+            else:
+                future = service.submit(request)
+            received += 1
+            future.add_done_callback(reply)
+
+        with done:
+            done.wait_for(lambda: counts['sent'] == received)
+        return
+
+
+################################################################################
+class HashServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    ############################################################################
+    def __init__(self, path, service):
+        if os.path.exists(path):
+            # left over from a server that did not shut down cleanly
+            os.unlink(path)
+        self.service = service
+        super().__init__(path, _Handler)
+        return
+
+    ############################################################################
+    def server_close(self):
+        super().server_close()
+        if os.path.exists(self.server_address):
+            os.unlink(self.server_address)
+        return
+
+
+################################################################################
+class ServiceClient:
+    '''
+    a connection to a HashServer, one request at a time
+    '''
+
+    ############################################################################
+    def __init__(self, path, timeout=None):
+        self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._sock.settimeout(timeout)
+        self._sock.connect(path)
+        self._file = self._sock.makefile('rwb')
+        self._next_id = 0
+        return
+
+    ############################################################################
+    def send(self, request):
+        self._file.write((json.dumps(request) + '\n').encode('utf-8'))
+        self._file.flush()
+        return
+
+    ############################################################################
+    def receive(self):
+        line = self._file.readline()
+        if not line:
+            raise RuntimeError('Hash service closed the connection')
+        return json.loads(line.decode('utf-8'))
+
+    ############################################################################
+    def call(self, op, **fields):
+        self._next_id += 1
+        request = dict(fields, op=op, id=self._next_id)
+        self.send(request)
+        return self.receive()
+
+    ############################################################################
+    def close(self):
+        self._file.close()
+        self._sock.close()
+        return
+
+
+################################################################################
+def main(argv):
+    from . import llehash  # noqa: F401
+    from .video_hashing import VideoHasher
+
+    parser = OptionParser(usage='%prog [options]')
+    parser.add_option('--socket',
+                      action='store',
+                      dest='socket',
+                      default='videohash.sock',
+                      help='Unix socket to listen on')
+    parser.add_option('--db',
+                      action='store',
+                      dest='db',
+                      default='videohash.db',
+                      help='Database holding the catalog')
+    parser.add_option('-m', '--methods',
+                      action='store',
+                      dest='methods',
+                      default='phash-summary',
+                      help='Comma separated hash methods to serve')
+    parser.add_option('--workers',
+                      action='store',
+                      type='int',
+                      dest='workers',
+                      default=None,
+                      help='Requests hashed at once (default: cores)')
+    parser.add_option('--max-pending',
+                      action='store',
+                      type='int',
+                      dest='max_pending',
+                      default=HashService.max_pending,
+                      help='Requests queued before new ones are refused')
+    parser.add_option('--batch-size',
+                      action='store',
+                      type='int',
+                      dest='batch_size',
+                      default=HashService.batch_size,
+                      help='Requests handed to the workers at a time')
+    (opts, args) = parser.parse_args(argv[1:])
+    if len(args) > 0:
+        sys.stderr.write("Unexpected arguments: {}\n".format(' '.join(args)))
+        sys.exit(1)
+
+    classes = [VideoHasher.get_hashmethod_class(method)
+               for method in opts.methods.split(',')]
+    service = HashService(classes, VideoDataManager(opts.db), opts.workers,
+                          opts.max_pending, opts.batch_size)
+    server = HashServer(opts.socket, service)
+    print('{}: serving {} with {} workers (loaded in {:.3f}s)'.format(
+        opts.socket, ', '.join(service.methods), service.workers,
+        service.load_time))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.close()
+    return
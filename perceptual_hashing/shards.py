@@ -0,0 +1,211 @@
+#!/usr/bin/env python
+import os
+import sqlite3
+import sys
+from optparse import OptionParser
+
+from .data_manager import VideoDataManager, Video
+from .similarity_join import UnionFind
+
+
+################################################################################
+def _open_shard(path):
+    if not os.path.exists(path):
+        raise RuntimeError('No such shard: {}'.format(path))
+    conn = sqlite3.connect('file:{}?mode=ro'.format(path), uri=True)
+    c = conn.cursor()
+    c.execute('''
+    SELECT name FROM sqlite_master
+    WHERE type = 'table' AND name = 'video_info'
+    ''')
+    if c.fetchone() is None:
+        conn.close()
+        raise RuntimeError('Not a video database: {}'.format(path))
+    return conn
+
+
+################################################################################
+def _read_extras(c, table, keys):
+    # values stored next to the hashes of a method, in a table older
+    # shards may not have
+    extras = {}
+    c.execute('''
+    SELECT name FROM sqlite_master
+    WHERE type = 'table' AND name = ?
+    ''', (table,))
+    if c.fetchone() is None:
+        return extras
+    c.execute('''
+    SELECT x.video_id, h.name, x.hash_value
+    FROM {} x
+    INNER JOIN hash_methods h
+    ON h.id = x.method
+    ORDER BY x.video_id, h.name
+    '''.format(table))
+    for video_id, method, value in c.fetchall():
+        extras[keys[video_id] + (method,)] = value
+    return extras
+
+
+################################################################################
+def read_shard(path):
+    '''
+    (videos, hashes, coarse, sequences, sets) of a shard database by natural
+    key: videos is the (name, format) keys ordered by id, hashes, coarse and
+    sequences map (name, format, method name) to the stored hash, coarse
+    hash and keyframe sequence text and sets is a list of the member keys
+    of every video set
+    '''
+    conn = _open_shard(path)
+    try:
+        c = conn.cursor()
+        c.execute('''
+        SELECT id, video_name, format
+        FROM video_info
+        ORDER BY id
+        ''')
+        keys = {}
+        for video_id, name, fmt in c.fetchall():
+            keys[video_id] = (name, fmt)
+
+        c.execute('''
+        SELECT ch.video_id, h.name, ch.hash_value
+        FROM computed_hashes ch
+        INNER JOIN hash_methods h
+        ON h.id = ch.hash_method_id
+        ORDER BY ch.video_id, h.name
+        ''')
+        hashes = {}
+        for video_id, method, value in c.fetchall():
+            hashes[keys[video_id] + (method,)] = value
+
+        coarse = _read_extras(c, 'coarse_hashes', keys)
+        sequences = _read_extras(c, 'hash_sequences', keys)
+
+        c.execute('''
+        SELECT set_id, video_id
+        FROM video_set_memberships
+        ORDER BY set_id, video_id
+        ''')
+        sets = {}
+        for set_id, video_id in c.fetchall():
+            sets.setdefault(set_id, []).append(keys[video_id])
+    finally:
+        conn.close()
+    return (list(keys.values()), hashes, coarse, sequences,
+            list(sets.values()))
+
+
+################################################################################
+class ShardMerge:
+    '''
+    merge shard databases, written by workers that could not share one
+    database, into a target VideoDataManager
+
+    rows are matched on their natural keys: videos on (name, format), hash
+    methods on their name and video sets on their members, where sets of
+    different shards (or of the target) sharing a video become one set.
+    every row of every shard is buffered and written in a single WriteBatch
+    flush, so the merge is one transaction and a failed merge leaves the
+    target untouched. shards are read in the given order and their rows in
+    id order, so the same shards always give the same ids; a hash present
+    in several shards keeps the value of the last of them. distances,
+    clusters, accuracy figures and queued tasks are derived data and are not
+    merged
+    '''
+
+    ############################################################################
+    def __init__(self, manager=None):
+        self._manager = manager
+        if self._manager is None:
+            self._manager = VideoDataManager()
+        self.conflicts = 0
+        return
+
+    ############################################################################
+    def _target_set_members(self):
+        c = self._manager.conn.cursor()
+        c.execute('''
+        SELECT DISTINCT v.video_name, v.format
+        FROM video_info v
+        INNER JOIN video_set_memberships sm
+        ON sm.video_id = v.id
+        ''')
+        return set(c.fetchall())
+
+    ############################################################################
+    def merge(self, paths):
+        '''
+        merge the shards at paths; returns the number of videos merged
+        '''
+        shards = [read_shard(path) for path in paths]
+
+        videos = {}
+        hashes = {}
+        coarse = {}
+        sequences = {}
+        self.conflicts = 0
+        for keys, shard_hashes, shard_coarse, shard_sequences, _ in shards:
+            for key in keys:
+                videos.setdefault(key, len(videos))
+            for key, value in shard_hashes.items():
+                if key in hashes and hashes[key] != value:
+                    self.conflicts += 1
+                hashes[key] = value
+            coarse.update(shard_coarse)
+            sequences.update(shard_sequences)
+
+        # sets sharing a video, in any shard, are one set
+        uf = UnionFind(len(videos))
+        for _, _, _, _, sets in shards:
+            for members in sets:
+                for key in members[1:]:
+                    uf.union(videos[members[0]], videos[key])
+        in_sets = set(key for _, _, _, _, sets in shards
+                      for members in sets for key in members)
+        by_position = list(videos)
+        groups = [sorted(by_position[n] for n in group)
+                  for group in uf.groups()]
+        groups = sorted(g for g in groups if g[0] in in_sets)
+
+        # join an existing set of the target where there is one
+        target_members = self._target_set_members()
+        with self._manager.batch() as batch:
+            for name, fmt in videos:
+                batch.add_video(Video(name, fmt))
+            for (name, fmt, method), value in hashes.items():
+                batch.add_hash(Video(name, fmt), method, value)
+            for (name, fmt, method), value in coarse.items():
+                batch.add_coarse_hash(Video(name, fmt), method, value)
+            for (name, fmt, method), value in sequences.items():
+                batch.add_sequence(Video(name, fmt), method, value)
+            for group in groups:
+                anchor = next((key for key in group if key in target_members),
+                              group[0])
+                anchor = Video(*anchor)
+                for key in group:
+                    batch.add_to_set(Video(*key), anchor)
+        return len(videos)
+
+
+################################################################################
+def main(argv):
+    parser = OptionParser(usage='%prog [options] shard [shard ...]')
+    parser.add_option('--db',
+                      action='store',
+                      dest='db',
+                      default='videohash.db',
+                      help='Database to merge the shards into')
+    (opts, args) = parser.parse_args(argv[1:])
+    if len(args) < 1:
+        sys.stderr.write("Must specify at least one shard\n")
+        sys.exit(1)
+    if os.path.abspath(opts.db) in [os.path.abspath(p) for p in args]:
+        sys.stderr.write("Cannot merge a shard into itself\n")
+        sys.exit(1)
+
+    merge = ShardMerge(VideoDataManager(opts.db))
+    n = merge.merge(args)
+    print('{}: merged {} videos from {} shards ({} conflicting hashes)'
+          .format(opts.db, n, len(args), merge.conflicts))
+    return
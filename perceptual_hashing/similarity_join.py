@@ -0,0 +1,503 @@
+#!/usr/bin/env python
+import itertools
+import math
+import multiprocessing
+import sys
+import time
+from optparse import OptionParser
+
+import numpy as np
+
+from .cpu_budget import current_budget
+from .data_manager import VideoDataManager
+from .util import (ints_to_words, popcount_words, threshold_radius,
+                   words_per_hash)
+
+
+################################################################################
+class UnionFind:
+    ############################################################################
+    def __init__(self, n):
+        self._parent = list(range(n))
+        self._size = [1] * n
+        return
+
+    ############################################################################
+    def find(self, x):
+        parent = self._parent
+        while parent[x] != x:
+            parent[x] = parent[parent[x]]
+            x = parent[x]
+        return x
+
+    ############################################################################
+    def union(self, a, b):
+        a = self.find(a)
+        b = self.find(b)
+        if a == b:
+            return False
+        if self._size[a] < self._size[b]:
+            a, b = b, a
+        self._parent[b] = a
+        self._size[a] += self._size[b]
+        return True
+
+    ############################################################################
+    def groups(self):
+        found = {}
+        for x in range(len(self._parent)):
+            found.setdefault(self.find(x), []).append(x)
+        return list(found.values())
+
+
+################################################################################
+def partition_masks(bits, n_partitions):
+    '''
+    (n_partitions, words) uint64 masks splitting a bits-bit hash packed by
+    ints_to_words into contiguous substrings, most significant first
+    '''
+    base, extra = divmod(bits, n_partitions)
+    masks = []
+    shift = bits
+    for n in range(n_partitions):
+        width = base + (1 if n < extra else 0)
+        shift -= width
+        masks.append(((1 << width) - 1) << shift)
+    return ints_to_words(masks, bits)
+
+
+################################################################################
+# odd multipliers folding a masked substring into a single 64-bit sort key
+_KEY_MULTIPLIERS = (np.random.RandomState(0)
+                    .randint(0, 2**63, size=16, dtype=np.int64)
+                    .astype(np.uint64) * np.uint64(2) + np.uint64(1))
+
+
+################################################################################
+def partition_keys(words, mask):
+    multipliers = np.resize(_KEY_MULTIPLIERS, words.shape[1])
+    return ((words & mask) * multipliers).sum(axis=1, dtype=np.uint64)
+
+
+################################################################################
+def flip_masks(bits, n_partitions, p, radius):
+    '''
+    (n, words) masks of every way to flip 1 to radius bits of the p-th of
+    the partition_masks(bits, n_partitions) substrings
+    '''
+    base, extra = divmod(bits, n_partitions)
+    widths = [base + (1 if n < extra else 0) for n in range(n_partitions)]
+    shift = bits - sum(widths[:p + 1])
+    flips = []
+    for r in range(1, min(radius, widths[p]) + 1):
+        for positions in itertools.combinations(
+                range(shift, shift + widths[p]), r):
+            flips.append(sum(1 << b for b in positions))
+    return ints_to_words(flips, bits)
+
+
+################################################################################
+def _expand(order, starts_a, sizes_a, starts_b, sizes_b):
+    '''
+    positions of every pair between run starts_a[n] of sizes_a[n] and run
+    starts_b[n] of sizes_b[n] of order; a run paired with itself gives each
+    of its pairs once
+    '''
+    counts = sizes_a * sizes_b
+    group = np.repeat(np.arange(len(counts)), counts)
+    offset = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts,
+                                                 counts)
+    i = offset // sizes_b[group]
+    j = offset % sizes_b[group]
+    keep = (starts_a[group] != starts_b[group]) | (i < j)
+    return (order[(starts_a[group] + i)[keep]],
+            order[(starts_b[group] + j)[keep]])
+
+
+################################################################################
+_worker_state = None
+
+
+################################################################################
+def _init_worker(words, masks, radius, sub_radius, block_words):
+    global _worker_state
+    _worker_state = (words, masks, radius, sub_radius, block_words)
+    return
+
+
+################################################################################
+def _first_partition(xor, masks, p, sub_radius):
+    '''
+    mask of the pairs whose first substring within sub_radius is the p-th
+    '''
+    ok = popcount_words(xor & masks[p]) <= sub_radius
+    for q in range(p):
+        ok &= popcount_words(xor & masks[q]) > sub_radius
+    return ok
+
+
+################################################################################
+def _verify(task):
+    '''
+    exact distances of the candidate pairs of one task, either the arrays
+    of positions a and b or every pair of the rows a and b (of the rows a
+    alone when b is None); a pair is only reported by the first partition
+    its substrings are within sub_radius on, so no pair is reported twice
+    '''
+    p, a, b = task
+    words, masks, radius, sub_radius, block_words = _worker_state
+    found_a, found_b, found_d = [], [], []
+    if isinstance(a, tuple):
+        a, b = a
+        block = max(1, block_words // words.shape[1])
+        for s in range(0, len(a), block):
+            rows, others = a[s:s + block], b[s:s + block]
+            xor = words[rows] ^ words[others]
+            d = popcount_words(xor)
+            k = np.flatnonzero(d <= radius)
+            k = k[_first_partition(xor[k], masks, p, sub_radius)]
+            found_a.append(rows[k])
+            found_b.append(others[k])
+            found_d.append(d[k])
+    else:
+        same = b is None
+        if same:
+            b = a
+        block = max(1, block_words // (len(b) * words.shape[1]))
+        for s in range(0, len(a), block):
+            rows = a[s:s + block]
+            others = b[s + 1:] if same else b
+            xor = words[rows][:, None, :] ^ words[others][None, :, :]
+            d = popcount_words(xor)
+            ok = d <= radius
+            if same:
+                # column j of row i is b[s + 1 + j]; keep j >= i only
+                ok &= np.triu(np.ones(ok.shape, dtype=bool))
+            i, j = np.nonzero(ok)
+            keep = _first_partition(xor[i, j], masks, p, sub_radius)
+            i, j = i[keep], j[keep]
+            found_a.append(rows[i])
+            found_b.append(others[j])
+            found_d.append(d[i, j])
+    if len(found_a) == 0:
+        return (np.zeros(0, np.int64),) * 3
+    return (np.concatenate(found_a), np.concatenate(found_b),
+            np.concatenate(found_d))
+
+
+################################################################################
+def _verify_rows(task):
+    '''
+    exact distances of rows start..end-1 to every row after them, for the
+    join without substrings
+    '''
+    start, end = task
+    words, masks, radius, sub_radius, block_words = _worker_state
+    block = max(1, block_words // (len(words) * words.shape[1]))
+    found_a, found_b, found_d = [], [], []
+    for s in range(start, end, block):
+        rows = np.arange(s, min(s + block, end))
+        d = popcount_words(words[rows][:, None, :] ^ words[None, s + 1:, :])
+        # column j of row i is row s + 1 + j; keep j >= i only
+        ok = (d <= radius) & np.triu(np.ones(d.shape, dtype=bool))
+        i, j = np.nonzero(ok)
+        found_a.append(rows[i])
+        found_b.append(s + 1 + j)
+        found_d.append(d[i, j])
+    if len(found_a) == 0:
+        return (np.zeros(0, np.int64),) * 3
+    return (np.concatenate(found_a), np.concatenate(found_b),
+            np.concatenate(found_d))
+
+
+################################################################################
+class SimilarityJoin:
+    '''
+    every pair of a method's stored hashes within hamming distance radius,
+    without comparing all pairs
+
+    the hashes are cut into n_substrings substrings; two hashes within
+    radius are within sub_radius = radius // n_substrings of each other on
+    at least one of them (pigeonhole). for each substring the hashes are
+    sorted on it, and every run of equal substrings is paired with itself
+    and with the runs found by flipping up to sub_radius of its bits
+    (multi-probe, as in multi-index hashing); only those candidates are
+    compared exactly. the pairs are merged into clusters with union-find
+    and written back through the ClusterDAO. substrings are processed one
+    at a time, their candidates spread over worker processes in tasks of
+    at most task_pairs pairs, and comparisons are done in blocks of at most
+    block_words words, so memory stays bounded by the catalog size
+
+    n_substrings picks the number of substrings with the lowest expected
+    cost for uniformly spread hashes: radius + 1 exact substrings at small
+    radii, fewer and wider ones probed at larger radii. when even that is
+    expected to cost more than comparing all pairs once (e.g. the 480-bit
+    LLE hashes at radius 143, or a small catalog), every pair is compared
+    in blocks instead
+    '''
+
+    ############################################################################
+    task_pairs = 1 << 20
+    block_words = 1 << 22
+    # fixed cost of one vectorized probe pass, in word comparisons
+    pass_cost = 4096
+    # most bit flips probed per substring
+    max_probes = 1 << 16
+
+    ############################################################################
+    def __init__(self, methodcls, manager=None, radius=None, processes=None,
+                 catalog=None):
+        self._methodcls = methodcls
+        self._manager = manager
+        if self._manager is None:
+            self._manager = VideoDataManager()
+        self.method = methodcls.hash_type()
+        self.bits = methodcls.hash_bits()
+        self.processes = processes
+        self._radius = radius
+        self._catalog = catalog
+        self.n_pairs = 0
+        self.partitioned = None
+        return
+
+    ############################################################################
+    @property
+    def method_id(self):
+        return self._manager.hash_dao.get_hash_method_by_name(self.method)
+
+    ############################################################################
+    @property
+    def radius(self):
+        '''
+        the given radius, or the largest distance under the learned threshold
+        '''
+        if self._radius is None:
+            details = self._manager.hash_dao.get_method_accuracy(
+                self.method_id)
+            if details is None or details['threshold'] is None:
+                raise RuntimeError('No radius given and no threshold learned '
+                                   'for {}'.format(self.method))
+            max_distance = self._methodcls.max_threshold()
+            self._radius = threshold_radius(details['threshold'],
+                                            max_distance)
+        return self._radius
+
+    ############################################################################
+    def load(self):
+        if self._catalog is not None:
+            hashed = self._catalog.hashed(self.method)
+            return (self._catalog.ids[hashed],
+                    self._catalog.words(self.method)[hashed])
+        hashes = self._manager.hash_dao.get_all_video_hashes([self.method])
+        ids = np.array(sorted(hashes), dtype=np.int64)
+        words = ints_to_words([self._methodcls.hash_to_int(
+            hashes[n][self.method]) for n in ids.tolist()], self.bits)
+        return ids, words
+
+    ############################################################################
+    def _tasks(self, words, mask, flips, p):
+        keys = partition_keys(words, mask)
+        order = np.argsort(keys, kind='stable')
+        keys = keys[order]
+        starts = np.flatnonzero(np.concatenate(([True],
+                                                keys[1:] != keys[:-1])))
+        sizes = np.append(starts[1:], len(keys)) - starts
+        keys = keys[starts]
+
+        # every run with itself, then with the runs a flip away
+        runs = np.flatnonzero(sizes > 1)
+        probes = [(runs, runs)]
+        for flip in flips:
+            probe = partition_keys(words[order[starts]] ^ flip, mask)
+            found = np.minimum(np.searchsorted(keys, probe), len(keys) - 1)
+            # each pair of runs once, from the lower key
+            hit = np.flatnonzero((keys[found] == probe)
+                                 & (found > np.arange(len(keys))))
+            probes.append((hit, found[hit]))
+
+        for ra, rb in probes:
+            counts = sizes[ra] * sizes[rb]
+            # runs too large to list the pairs of are compared as blocks
+            large = counts > self.task_pairs
+            for x, y in zip(ra[large].tolist(), rb[large].tolist()):
+                rows = order[starts[x]:starts[x] + sizes[x]]
+                if x == y:
+                    yield (p, rows, None)
+                else:
+                    yield (p, rows, order[starts[y]:starts[y] + sizes[y]])
+            ra, rb, counts = ra[~large], rb[~large], counts[~large]
+            ends = np.searchsorted(np.cumsum(counts),
+                                   np.arange(self.task_pairs, counts.sum(),
+                                             self.task_pairs), 'right')
+            for chunk_a, chunk_b in zip(np.split(ra, ends),
+                                        np.split(rb, ends)):
+                if len(chunk_a) > 0:
+                    yield (p, _expand(order, starts[chunk_a], sizes[chunk_a],
+                                      starts[chunk_b], sizes[chunk_b]), None)
+        return
+
+    ############################################################################
+    def _row_tasks(self, n):
+        start = 0
+        while start < n - 1:
+            end, pairs = start, 0
+            while end < n - 1 and pairs < self.task_pairs:
+                pairs += n - 1 - end
+                end += 1
+            yield (start, end)
+            start = end
+        return
+
+    ############################################################################
+    def substring_cost(self, n, n_substrings):
+        '''
+        expected cost, in word comparisons, of joining n uniformly spread
+        hashes on n_substrings substrings; None when too many flips would be
+        probed
+        '''
+        sub_radius = self.radius // n_substrings
+        width = self.bits // n_substrings
+        probes = sum(math.comb(width, r)
+                     for r in range(min(sub_radius, width) + 1))
+        if probes > self.max_probes:
+            return None
+        words = words_per_hash(self.bits)
+        buckets = 2.0 ** width
+        candidates = min(n * n / 2, n * n / 2 * probes / buckets)
+        runs = min(n, buckets)
+        # a candidate pair is gathered from the hashes before it is compared
+        return n_substrings * (
+            probes * (self.pass_cost + runs * (words + math.log2(runs + 1)))
+            + candidates * (4 + 2 * words))
+
+    ############################################################################
+    def n_substrings(self, n):
+        '''
+        the number of substrings expected to join n hashes fastest
+        '''
+        best, cost = None, None
+        for m in range(1, min(self.radius + 1, self.bits) + 1):
+            c = self.substring_cost(n, m)
+            if c is not None and (cost is None or c < cost):
+                best, cost = m, c
+        return best
+
+    ############################################################################
+    def use_substrings(self, n):
+        '''
+        whether joining n hashes on substrings is expected to beat comparing
+        all pairs
+        '''
+        m = self.n_substrings(n)
+        if m is None:
+            return False
+        return (self.substring_cost(n, m)
+                < n * n / 2 * words_per_hash(self.bits))
+
+    ############################################################################
+    def pairs(self, ids=None, words=None):
+        '''
+        yield (video_id, video_id, distance) for every pair within radius
+        '''
+        if ids is None:
+            ids, words = self.load()
+        radius = self.radius
+        self.partitioned = self.use_substrings(len(words))
+        if self.partitioned:
+            m = self.n_substrings(len(words))
+            sub_radius = radius // m
+            masks = partition_masks(self.bits, m)
+            passes = ((_verify, self._tasks(
+                          words, masks[p],
+                          flip_masks(self.bits, m, p, sub_radius), p))
+                      for p in range(m))
+        else:
+            masks, sub_radius = None, None
+            passes = [(_verify_rows, self._row_tasks(len(words)))]
+        args = (words, masks, radius, sub_radius, self.block_words)
+
+        processes = self.processes or current_budget().cores
+        pool = None
+        if processes > 1:
+            pool = multiprocessing.Pool(processes, _init_worker, args)
+        else:
+            _init_worker(*args)
+        try:
+            for verify, tasks in passes:
+                if pool is None:
+                    results = map(verify, tasks)
+                else:
+                    results = pool.imap_unordered(verify, tasks)
+                for a, b, d in results:
+                    for pair in zip(ids[a].tolist(), ids[b].tolist(),
+                                    d.tolist()):
+                        yield pair
+        finally:
+            if pool is not None:
+                pool.terminate()
+        return
+
+    ############################################################################
+    def clusters(self):
+        '''
+        lists of video ids connected by pairs within radius
+        '''
+        ids, words = self.load()
+        position = {video_id: n for n, video_id in enumerate(ids.tolist())}
+        uf = UnionFind(len(ids))
+        self.n_pairs = 0
+        for a, b, d in self.pairs(ids, words):
+            uf.union(position[a], position[b])
+            self.n_pairs += 1
+        return [sorted(ids[g].tolist()) for g in uf.groups() if len(g) > 1]
+
+    ############################################################################
+    def run(self):
+        clusters = self.clusters()
+        self._manager.cluster_dao.replace_clusters(self.method_id,
+                                                   self.radius, clusters)
+        return clusters
+
+
+################################################################################
+def main(argv):
+    from . import llehash  # noqa: F401
+    from .video_hashing import VideoHasher
+
+    parser = OptionParser(usage='%prog [options] method [method ...]')
+    parser.add_option('--db',
+                      action='store',
+                      dest='db',
+                      default='videohash.db',
+                      help='Database holding the catalog')
+    parser.add_option('-r', '--radius',
+                      action='store',
+                      type='int',
+                      dest='radius',
+                      default=None,
+                      help="Distance to join on (default: the method's "
+                           "learned threshold)")
+    parser.add_option('--processes',
+                      action='store',
+                      type='int',
+                      dest='processes',
+                      default=None,
+                      help='Worker processes (default: one per core)')
+    (opts, args) = parser.parse_args(argv[1:])
+    if len(args) < 1:
+        sys.stderr.write("Must specify at least one hash method\n")
+        sys.exit(1)
+
+    manager = VideoDataManager(opts.db)
+    for method in args:
+        start = time.perf_counter()
+        join = SimilarityJoin(VideoHasher.get_hashmethod_class(method),
+                              manager, opts.radius, opts.processes)
+        clusters = join.run()
+        print('{}: radius {} ({}): {} pairs, {} clusters of {} videos '
+              '({:.3f}s)'.format(
+                  method, join.radius,
+                  'substrings' if join.partitioned else 'all pairs',
+                  join.n_pairs, len(clusters), sum(len(c) for c in clusters),
+                  time.perf_counter() - start))
+    return
@@ -0,0 +1,370 @@
+#!/usr/bin/env python
+import json
+import struct
+import sys
+import zlib
+from optparse import OptionParser
+
+import numpy as np
+
+from .data_manager import VideoDataManager, Video
+from .util import ints_to_words, words_to_ints, words_per_hash
+from .video_hashing import VideoHasher
+
+ENCODINGS = ('decimal', 'bitstring')
+
+
+################################################################################
+def method_format(name):
+    '''
+    (bits, encoding) of the hashes stored under method name
+    '''
+    try:
+        cls = VideoHasher.get_hashmethod_class(name)
+        return (cls.hash_bits(), cls.hash_encoding)
+    except KeyError:
+        raise RuntimeError('Unknown hash method: {}'.format(name))
+
+
+################################################################################
+def parse_hash(value, encoding):
+    if encoding == 'bitstring':
+        return int(str(value), 2)
+    return int(str(value))
+
+
+################################################################################
+def format_hash(h, bits, encoding):
+    if encoding == 'bitstring':
+        return format(h, '0{}b'.format(bits))
+    return str(h)
+
+
+################################################################################
+class _SnapshotWriter:
+    ############################################################################
+    def __init__(self, fd):
+        self._fd = fd
+        self._crc = 0
+        self.offset = HashSnapshot.header.size
+        fd.write(b'\0' * self.offset)
+        return
+
+    ############################################################################
+    def write(self, data):
+        '''
+        append data at the next 8-byte boundary, returns its offset
+        '''
+        pad = -self.offset % 8
+        if pad:
+            self._write(b'\0' * pad)
+        offset = self.offset
+        self._write(data)
+        return offset
+
+    ############################################################################
+    def _write(self, data):
+        if isinstance(data, np.ndarray):
+            # sections are little-endian whatever the machine
+            data = np.ascontiguousarray(data, data.dtype.newbyteorder('<'))
+        data = bytes(data)
+        self._fd.write(data)
+        self._crc = zlib.crc32(data, self._crc)
+        self.offset += len(data)
+        return
+
+    ############################################################################
+    def finish(self, meta):
+        meta = json.dumps(meta, sort_keys=True).encode('utf-8')
+        meta_offset = self.write(meta)
+        self._fd.seek(0)
+        self._fd.write(HashSnapshot.header.pack(
+            HashSnapshot.magic, HashSnapshot.version, self._crc,
+            meta_offset, len(meta)))
+        return
+
+
+################################################################################
+class HashSnapshot:
+    '''
+    read-only view of a snapshot file
+
+    the file is a fixed header (magic, version, crc32 of everything after
+    the header, offset and size of a json table of contents) followed by
+    8-byte aligned sections: the video table (int64 ids, int64 set ids,
+    uint64 offsets into a utf-8 blob of "name\\0format" entries) and, per
+    method, an int64 video id array and an (n, words) uint64 matrix of the
+    hashes packed by util.ints_to_words, plus the same two sections for
+    the coarse hashes of the method if it has any. the sections are numpy
+    views on a memory map, so opening a snapshot reads nothing but the
+    header and the table of contents
+    '''
+
+    ############################################################################
+    magic = b'PVHSNAP\0'
+    # 2: coarse hashes are part of their method, not a method of their own
+    version = 2
+    header = struct.Struct('<8sIIQQ')
+
+    ############################################################################
+    def __init__(self, path, verify=False):
+        self.path = path
+        with open(path, 'rb') as fd:
+            raw = fd.read(self.header.size)
+            if len(raw) != self.header.size:
+                raise RuntimeError('Not a hash snapshot: {}'.format(path))
+            magic, version, crc, meta_offset, meta_size = \
+                self.header.unpack(raw)
+            if magic != self.magic:
+                raise RuntimeError('Not a hash snapshot: {}'.format(path))
+            if version != self.version:
+                raise RuntimeError('Unsupported snapshot version {}: {}'
+                                   .format(version, path))
+            fd.seek(meta_offset)
+            self.meta = json.loads(fd.read(meta_size).decode('utf-8'))
+        self.crc = crc
+        self._mm = np.memmap(path, dtype=np.uint8, mode='r')
+        self._methods = {m['name']: m for m in self.meta['methods']}
+        if verify:
+            self.verify()
+        return
+
+    ############################################################################
+    def verify(self):
+        crc = 0
+        step = 1 << 24
+        for n in range(self.header.size, len(self._mm), step):
+            crc = zlib.crc32(self._mm[n:n + step], crc)
+        if crc != self.crc:
+            raise RuntimeError('Snapshot checksum mismatch: {}'.format(
+                self.path))
+        return
+
+    ############################################################################
+    def _array(self, offset, dtype, shape):
+        size = int(np.prod(shape)) * np.dtype(dtype).itemsize
+        return self._mm[offset:offset + size].view(dtype).reshape(shape)
+
+    ############################################################################
+    @property
+    def methods(self):
+        return [m['name'] for m in self.meta['methods']]
+
+    ############################################################################
+    def method(self, name):
+        if name not in self._methods:
+            raise RuntimeError('Method not in snapshot: {}'.format(name))
+        return self._methods[name]
+
+    ############################################################################
+    def __len__(self):
+        return self.meta['videos']['n']
+
+    ############################################################################
+    @property
+    def video_ids(self):
+        v = self.meta['videos']
+        return self._array(v['ids'], '<i8', (v['n'],))
+
+    ############################################################################
+    @property
+    def set_ids(self):
+        '''
+        video set of every video in video_ids, -1 for none
+        '''
+        v = self.meta['videos']
+        return self._array(v['set_ids'], '<i8', (v['n'],))
+
+    ############################################################################
+    def video_name(self, n):
+        '''
+        (name, format) of the n-th video
+        '''
+        v = self.meta['videos']
+        offsets = self._array(v['name_offsets'], '<u8', (v['n'] + 1,))
+        start = v['names'] + int(offsets[n])
+        end = v['names'] + int(offsets[n + 1])
+        name, fmt = bytes(self._mm[start:end]).decode('utf-8').split('\0')
+        return (name, fmt)
+
+    ############################################################################
+    def ids(self, method):
+        m = self.method(method)
+        return self._array(m['ids'], '<i8', (m['n'],))
+
+    ############################################################################
+    def words(self, method):
+        '''
+        (n, words) uint64 hash matrix of method, rows in ids(method) order
+        '''
+        m = self.method(method)
+        return self._array(m['hashes'], '<u8', (m['n'], m['words']))
+
+    ############################################################################
+    def hashes(self, method):
+        '''
+        {video_id: integer hash} of method
+        '''
+        return dict(zip(self.ids(method).tolist(),
+                        words_to_ints(self.words(method))))
+
+    ############################################################################
+    def coarse_hashes(self, method):
+        '''
+        {video_id: integer coarse hash} of method, empty if it has none
+        '''
+        c = self.method(method).get('coarse')
+        if c is None:
+            return {}
+        ids = self._array(c['ids'], '<i8', (c['n'],))
+        words = self._array(c['hashes'], '<u8', (c['n'], c['words']))
+        return dict(zip(ids.tolist(), words_to_ints(words)))
+
+    ############################################################################
+    def close(self):
+        self._mm = None
+        return
+
+
+################################################################################
+def export_snapshot(manager, path, methods=None):
+    '''
+    write the videos, set memberships and hashes of methods (default: every
+    method with stored fixed width hashes) of manager to a snapshot file
+    '''
+    c = manager.conn.cursor()
+    if methods is None:
+        c.execute('''
+        SELECT DISTINCT h.name
+        FROM hash_methods h
+        INNER JOIN computed_hashes ch
+        ON ch.hash_method_id = h.id
+        ORDER BY h.id
+        ''')
+        methods = [r[0] for r in c.fetchall()]
+
+    videos = manager.video_dao.video_table()
+
+    hdao = manager.hash_dao
+    with open(path, 'wb') as fd:
+        w = _SnapshotWriter(fd)
+        names = [('{}\0{}'.format(name, fmt)).encode('utf-8')
+                 for _, name, fmt, _ in videos]
+        name_offsets = np.zeros(len(names) + 1, dtype=np.uint64)
+        name_offsets[1:] = np.cumsum([len(n) for n in names])
+        meta = {
+            'videos': {
+                'n': len(videos),
+                'ids': w.write(np.array([v[0] for v in videos],
+                                        dtype=np.int64)),
+                'set_ids': w.write(np.array(
+                    [-1 if v[3] is None else v[3] for v in videos],
+                    dtype=np.int64)),
+                'name_offsets': w.write(name_offsets),
+                'names': w.write(b''.join(names)),
+            },
+            'methods': [],
+        }
+
+        for method in methods:
+            bits, encoding = method_format(method)
+            hashes = hdao.get_all_video_hashes([method])
+            ids = sorted(hashes)
+            values = [parse_hash(hashes[n][method].value, encoding)
+                      for n in ids]
+            accuracy = hdao.get_method_accuracy(
+                hdao.get_hash_method_by_name(method))
+            entry = {
+                'name': method,
+                'bits': bits,
+                'encoding': encoding,
+                'words': words_per_hash(bits),
+                'n': len(ids),
+                'ids': w.write(np.array(ids, dtype=np.int64)),
+                'hashes': w.write(ints_to_words(values, bits)),
+                'accuracy': accuracy,
+            }
+            coarse = hdao.get_coarse_hashes(method)
+            if coarse:
+                cbits = VideoHasher.get_hashmethod_class(method).coarse_bits
+                ids = sorted(coarse)
+                entry['coarse'] = {
+                    'bits': cbits,
+                    'words': words_per_hash(cbits),
+                    'n': len(ids),
+                    'ids': w.write(np.array(ids, dtype=np.int64)),
+                    'hashes': w.write(ints_to_words(
+                        [int(coarse[n]) for n in ids], cbits)),
+                }
+            meta['methods'].append(entry)
+        w.finish(meta)
+    return len(videos)
+
+
+################################################################################
+def import_snapshot(manager, path, methods=None, flush_every=10000):
+    '''
+    bulk load a snapshot into manager; videos are matched on (name, format)
+    and every video set of the snapshot becomes one video set
+    '''
+    snapshot = HashSnapshot(path, verify=True)
+    if methods is None:
+        methods = snapshot.methods
+
+    videos = {}
+    anchors = {}
+    with manager.batch(flush_every) as batch:
+        for n, (video_id, set_id) in enumerate(zip(
+                snapshot.video_ids.tolist(), snapshot.set_ids.tolist())):
+            video = Video(*snapshot.video_name(n))
+            videos[video_id] = video
+            batch.add_video(video)
+            if set_id >= 0:
+                batch.add_to_set(video, anchors.setdefault(set_id, video))
+
+        for method in methods:
+            m = snapshot.method(method)
+            if m['encoding'] not in ENCODINGS:
+                raise RuntimeError('Unknown hash encoding: {}'.format(
+                    m['encoding']))
+            for video_id, h in snapshot.hashes(method).items():
+                batch.add_hash(videos[video_id], method,
+                               format_hash(h, m['bits'], m['encoding']))
+            for video_id, h in snapshot.coarse_hashes(method).items():
+                batch.add_coarse_hash(videos[video_id], method, h)
+
+    hdao = manager.hash_dao
+    for method in methods:
+        accuracy = snapshot.method(method)['accuracy']
+        if accuracy is not None and accuracy['accuracy'] is not None:
+            hdao.set_method_accuracy(hdao.get_hash_method_by_name(method),
+                                     accuracy)
+    snapshot.close()
+    return len(videos)
+
+
+################################################################################
+def main(argv):
+    from . import llehash  # noqa: F401
+
+    parser = OptionParser(usage='%prog [options] export|import snapshot '
+                                '[method ...]')
+    parser.add_option('--db',
+                      action='store',
+                      dest='db',
+                      default='videohash.db',
+                      help='Database to export from or import into')
+    (opts, args) = parser.parse_args(argv[1:])
+    if len(args) < 2 or args[0] not in ('export', 'import'):
+        sys.stderr.write("Must specify export or import and a snapshot\n")
+        sys.exit(1)
+
+    manager = VideoDataManager(opts.db)
+    methods = args[2:] or None
+    if args[0] == 'export':
+        n = export_snapshot(manager, args[1], methods)
+        print('{}: exported {} videos'.format(args[1], n))
+    else:
+        n = import_snapshot(manager, args[1], methods)
+        print('{}: imported {} videos'.format(args[1], n))
+    return
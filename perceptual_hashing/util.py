@@ -1,9 +1,13 @@
 #!/usr/bin/env python
 
+import hashlib
 import math
+import os
 import decimal
 from decimal import Decimal
 
+import numpy as np
+
 
 ################################################################################
 def vector_to_integer(vec, radix=10):
@@ -35,3 +39,103 @@ def convert_to_hash(vec, radix, bitsize=480):
     b = Decimal(max_int)
     scaled = (a/b) * Decimal(2 ** bitsize)
     return int(math.floor(scaled))
+
+
+################################################################################
+def threshold_radius(threshold, max_distance):
+    '''
+    the largest integer distance whose relative distance is under threshold;
+    rounded first, so that e.g. 0.35 * 20 = 7.000000000000001 gives 6
+    '''
+    return math.ceil(round(threshold * max_distance, 9)) - 1
+
+
+################################################################################
+def words_per_hash(bitsize):
+    return max(1, (bitsize + 63) // 64)
+
+
+################################################################################
+def ints_to_words(values, bitsize):
+    '''
+    pack integer hashes into an (n, words_per_hash(bitsize)) uint64 matrix,
+    most significant word first
+    '''
+    n_words = words_per_hash(bitsize)
+    data = b''.join(int(v).to_bytes(8 * n_words, 'big') for v in values)
+    words = np.frombuffer(data, dtype='>u8').astype(np.uint64)
+    return words.reshape(len(values), n_words)
+
+
+################################################################################
+def words_to_ints(words):
+    words = np.ascontiguousarray(words, dtype='>u8')
+    row_bytes = words.shape[1] * 8
+    data = words.tobytes()
+    return [int.from_bytes(data[n:n + row_bytes], 'big')
+            for n in range(0, len(data), row_bytes)]
+
+
+################################################################################
+_BYTE_POPCOUNT = np.array([bin(n).count('1') for n in range(256)],
+                          dtype=np.uint8)
+
+
+################################################################################
+def popcount_words(words):
+    '''
+    number of set bits along the last axis of a uint64 word array, e.g. the
+    hamming distances of two ints_to_words matrices xor-ed together
+    '''
+    if hasattr(np, 'bitwise_count'):
+        return np.bitwise_count(words).sum(axis=-1, dtype=np.int64)
+    words = np.ascontiguousarray(words, dtype=np.uint64)
+    octets = words.view(np.uint8).reshape(words.shape[:-1] + (-1,))
+    return _BYTE_POPCOUNT[octets].sum(axis=-1, dtype=np.int64)
+
+
+################################################################################
+def block_mean_hash(frames, size=8):
+    '''
+    size * size bit block-mean hash of a sequence of frames: the frames are
+    averaged over time and colour, cut into a size x size grid and each
+    block is one bit, set when its mean is above the median block
+    '''
+    frames = np.asarray(frames, dtype=np.float64)
+    if frames.ndim == 4:
+        frames = frames.mean(axis=3)
+    img = frames.mean(axis=0)
+    bh = img.shape[0] // size
+    bw = img.shape[1] // size
+    if bh == 0 or bw == 0:
+        raise RuntimeError('Frames too small for a {0}x{0} block hash'
+                           .format(size))
+    blocks = img[:bh * size, :bw * size].reshape(size, bh, size, bw)
+    blocks = blocks.mean(axis=(1, 3)).flatten()
+    h = 0
+    for bit in blocks > np.median(blocks):
+        h = (h << 1) | int(bit)
+    return h
+
+
+################################################################################
+def content_digest(filepath, chunk_size=1 << 16, n_chunks=16):
+    '''
+    digest of a file's size and of a sample of its bytes: the first and
+    last chunk_size bytes and n_chunks chunks at even strides in between.
+    files smaller than the sample are digested whole. byte-identical files
+    always get the same digest, whatever their name
+    '''
+    size = os.path.getsize(filepath)
+    digest = hashlib.blake2b(digest_size=20)
+    digest.update(size.to_bytes(8, 'little'))
+    with open(filepath, 'rb') as fd:
+        if size <= (n_chunks + 2) * chunk_size:
+            digest.update(fd.read())
+        else:
+            stride = (size - chunk_size) // (n_chunks + 1)
+            offsets = [n * stride for n in range(n_chunks + 1)]
+            for offset in offsets + [size - chunk_size]:
+                fd.seek(offset)
+                digest.update(fd.read(chunk_size))
+    return digest.hexdigest()
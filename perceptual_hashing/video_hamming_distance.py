@@ -2,6 +2,11 @@
 from BitVector import BitVector
 
 
+################################################################################
+def popcount(v):
+    return bin(v).count('1')
+
+
 ################################################################################
 def hamming_distance(v1, v2, size=64, hashtype='intval'):
     '''
@@ -1,9 +1,15 @@
 #!/usr/bin/env python
+import io
+import itertools
 import os
-import subprocess
 
 from .data_manager import VideoDataManager, Hash, VideoDistance
 from .video_hamming_distance import hamming_distance
+from .util import content_digest
+from .async_exec import run_all, probe
+from . import dct_hash
+from .video_preprocessing import (decode_cmd, decode_frames, probe_video,
+                                  read_ppm_frames, read_ppm_frame_async)
 
 VIDEO_FORMATS = set(['avi', 'mpg', 'mov', 'mp4', 'mkv', 'wmv', 'flv', 'ogv',
                      'webm', 'vob', 'qt', 'm4v', 'mpv', '3gp', 'f4v'])
@@ -21,15 +27,50 @@ class VideoHasher:
     ############################################################################
     __found_hashmethod_classes = None
 
+    # hashes buffered before they are written to the database in one go
+    flush_every = 32
+
+    # have the VideoDataManager keep a MultiIndexHash of this method's hashes
+    # up to date
+    maintain_index = True
+
+    # how hash_value is kept in computed_hashes: 'decimal' or 'bitstring'
+    hash_encoding = 'decimal'
+
+    # copy the hashes of a byte-identical file instead of decoding again
+    reuse_by_digest = True
+
+    # whether hash_video_frames is implemented
+    supports_frames = False
+
+    # whether hash_file_async is implemented
+    supports_async = False
+
+    # external processes run() keeps going at once, and the seconds each
+    # may take; above 1 a hasher that supports_async hashes that many files
+    # concurrently
+    concurrency = 1
+    subprocess_timeout = None
+
     ############################################################################
     def __init__(self, path, manager=None, force=False):
         self.path = path
         self.force = force
-        self._manager = manager
-        if self._manager is None:
-            self._manager = VideoDataManager()
+        # opened on first use, so a hasher that only computes hashes never
+        # touches a database
+        self.__manager = manager
+        # content digest -> hashes of the files hashed by this hasher
+        self._digest_hashes = {}
+        self.failed = []
         return
 
+    ############################################################################
+    @property
+    def _manager(self):
+        if self.__manager is None:
+            self.__manager = VideoDataManager()
+        return self.__manager
+
     ############################################################################
     @classmethod
     def find_all_subclasses(klass, cls=None):
@@ -55,14 +96,244 @@ class VideoHasher:
         raise NotImplementedError('hash_type')
 
     ############################################################################
-    def hash_video(self, path, video):
-        raise NotImplementedError('hash_video')
+    @classmethod
+    def stored_types(cls):
+        '''
+        methods whose hashes hash_video stores
+        '''
+        return [cls.hash_type()]
+
+    ############################################################################
+    @classmethod
+    def hash_bits(cls):
+        return cls.max_threshold()
+
+    ############################################################################
+    @classmethod
+    def hash_to_int(cls, value):
+        '''
+        stored hash value (a Hash, or its text as kept in the database) as
+        an integer of hash_bits() bits
+        '''
+        if isinstance(value, Hash):
+            value = value.value
+        if isinstance(value, int):
+            return value
+        return int(str(value))
+
+    ############################################################################
+    @classmethod
+    def int_to_hash(cls, h):
+        '''
+        integer hash as the text stored in the database
+        '''
+        if cls.hash_encoding == 'bitstring':
+            return format(h, '0{}b'.format(cls.hash_bits()))
+        return str(h)
+
+    ############################################################################
+    def hash_file(self, filepath):
+        '''
+        compute the hash of a video file without registering or storing it
+        '''
+        raise NotImplementedError('hash_file')
+
+    ############################################################################
+    def compute(self, frames, total=None):
+        '''
+        integer hash of a video given as all of its decoded frames, in
+        order, as (height, width, 3) rgb arrays; nothing is read from disk
+        or stored. frames may be an iterator straight from a decoder;
+        methods that pick frames by number then need the number of frames
+        of the video as total
+        '''
+        raise NotImplementedError('compute')
+
+    ############################################################################
+    def compute_from_bytes(self, buf):
+        '''
+        integer hash of the contents of a video file held in memory; the
+        container must be readable from a pipe (see PIPE_FORMATS)
+        '''
+        raise NotImplementedError('compute_from_bytes')
+
+    ############################################################################
+    def compute_many(self, videos, totals=None):
+        '''
+        compute() of every frame sequence of videos, with the frame count
+        of each from totals if given, yielded as each is hashed so videos
+        can be produced by a decoder as they are consumed
+        '''
+        if totals is None:
+            totals = itertools.repeat(None)
+        for frames, total in zip(videos, totals):
+            yield self.compute(frames, total)
+        return
+
+    ############################################################################
+    def compute_many_from_bytes(self, bufs):
+        '''
+        compute_from_bytes() of every buffer of bufs, yielded in order
+        '''
+        for buf in bufs:
+            yield self.compute_from_bytes(buf)
+        return
+
+    ############################################################################
+    async def hash_file_async(self, runner, filepath):
+        '''
+        hash filepath on the event loop of runner, an async_exec.AsyncRunner;
+        returns what store_result takes
+        '''
+        raise NotImplementedError('hash_file_async')
+
+    ############################################################################
+    def hash_video(self, filepath, video):
+        self.store_hash(video, self.hash_file(filepath))
+        return
+
+    ############################################################################
+    def wanted(self, filepath):
+        '''
+        numbers of the frames of filepath that hash_video_frames needs
+        '''
+        raise NotImplementedError('wanted')
+
+    ############################################################################
+    def hash_video_frames(self, filepath, frames, video):
+        '''
+        hash and store the wanted frames of video, decoded by the caller as
+        (height, width, 3) rgb arrays in frame order; filepath only names
+        the video
+        '''
+        raise NotImplementedError('hash_video_frames')
+
+    ############################################################################
+    def store_hash(self, video, hash_number, method=None, coarse=None,
+                   sequence=None):
+        if method is None:
+            method = self.hash_type()
+        h = Hash(method, hash_number, coarse=coarse, sequence=sequence)
+        video.hash_values.update({method: h})
+        batch = self._manager.current_batch
+        if batch is not None:
+            batch.add_hash(video, method, hash_number, coarse, sequence)
+        else:
+            self._manager.video_dao.add_video_hashes(video)
+        return
+
+    ############################################################################
+    def store_result(self, video, result):
+        '''
+        store what hash_file_async returned for video
+        '''
+        self.store_hash(video, result)
+        return
+
+    ############################################################################
+    def store_digest(self, video, digest):
+        batch = self._manager.current_batch
+        if batch is not None:
+            batch.add_digest(video, digest)
+        else:
+            self._manager.video_dao.set_digest(video, digest)
+        return
+
+    ############################################################################
+    def _reuse(self, filepath, video):
+        '''
+        store the content digest of filepath and, unless forced, copy the
+        hashes of a file with the same digest; returns (copied, digest)
+        '''
+        digest = content_digest(filepath)
+        self.store_digest(video, digest)
+        if not self.force:
+            hashes = self._digest_hashes.get(digest)
+            if hashes is None:
+                hashes = self._manager.video_dao.hashes_by_digest(
+                    digest, self.stored_types())
+            if hashes is not None:
+                self._copy(video, hashes)
+                return (True, digest)
+        return (False, digest)
+
+    ############################################################################
+    def _remember(self, digest, video):
+        self._digest_hashes[digest] = {m: video.hash_values[m]
+                                       for m in self.stored_types()}
+        return
+
+    ############################################################################
+    def _copy(self, video, hashes):
+        '''
+        store the {method: Hash} of a file with the same content for video
+        '''
+        for method, h in hashes.items():
+            self.store_hash(video, h.value, method, h.coarse, h.sequence)
+        return
+
+    ############################################################################
+    def hash_or_reuse(self, filepath, video):
+        '''
+        hash_video, unless a file with the same content digest has been
+        hashed already: then its hashes are copied without decoding the
+        file. returns True when the hashes were copied
+        '''
+        if not self.reuse_by_digest:
+            self.hash_video(filepath, video)
+            return False
+        copied, digest = self._reuse(filepath, video)
+        if copied:
+            return True
+        self.hash_video(filepath, video)
+        self._remember(digest, video)
+        return False
 
     ############################################################################
-    def store_hash(self, video, hash_number):
-        h = Hash(self.hash_type(), hash_number)
-        video.hash_values.update({self.hash_type(): h})
-        self._manager.video_dao.add_video_hashes(video)
+    def _hash_concurrently(self, pending):
+        '''
+        hash the (filepath, video) pairs of pending with up to concurrency
+        hash_file_async calls at once. files with a digest seen before are
+        copied as in hash_or_reuse, and of several files sharing a digest
+        only the first is hashed. a file that fails is left unhashed and
+        added to failed, as are the files sharing its digest
+        '''
+        first = {}
+        copies = []
+        for filepath, video in pending:
+            key = filepath
+            digest = None
+            if self.reuse_by_digest:
+                copied, digest = self._reuse(filepath, video)
+                if copied:
+                    continue
+                if not self.force:
+                    if digest in first:
+                        copies.append((digest, filepath, video))
+                        continue
+                    key = digest
+            first[key] = (filepath, video, digest)
+
+        jobs = [lambda runner, f=filepath: self.hash_file_async(runner, f)
+                for filepath, _, _ in first.values()]
+        results = run_all(jobs, self.concurrency, self.subprocess_timeout)
+        for (filepath, video, digest), value in zip(first.values(), results):
+            if isinstance(value, BaseException):
+                print('Hashing failed: {}: {}'.format(filepath, value))
+                self.failed.append(filepath)
+                continue
+            self.store_result(video, value)
+            if digest is not None:
+                self._remember(digest, video)
+
+        for digest, filepath, video in copies:
+            if digest not in self._digest_hashes:
+                # the file hashed for this content failed
+                print('Hashing failed: {}: same content as {}'.format(
+                    filepath, first[digest][0]))
+                self.failed.append(filepath)
+                continue
+            self._copy(video, self._digest_hashes[digest])
         return
 
     ############################################################################
@@ -88,22 +359,51 @@ class VideoHasher:
             return True
         return False
 
+    ############################################################################
+    def prepare(self, filepaths):
+        '''
+        called by run() with the files it is about to hash
+        '''
+        return
+
     ############################################################################
     def run(self):
         video_list = list(os.listdir(self.path))
-        for v in video_list:
-            if os.path.splitext(v)[1].replace('.', '') not in VIDEO_FORMATS:
-                continue
-            video = self.get_video(v)
-            if self.is_video_already_hashed(video):
-                continue
-            filepath = os.path.join(self.path, v)
-            self.hash_video(filepath, video)
+        with self._manager.batch(flush_every=self.flush_every):
+            pending = []
+            for v in video_list:
+                if (os.path.splitext(v)[1].replace('.', '')
+                        not in VIDEO_FORMATS):
+                    continue
+                video = self.get_video(v)
+                if self.is_video_already_hashed(video):
+                    continue
+                pending.append((os.path.join(self.path, v), video))
+            self.prepare([filepath for filepath, _ in pending])
+
+            if self.supports_async and self.concurrency > 1:
+                self._hash_concurrently(pending)
+                return
+            for filepath, video in pending:
+                self.hash_or_reuse(filepath, video)
         return
 
 
 ################################################################################
 class PHash(VideoHasher):
+    '''
+    the pHash DCT video hash, computed in process (see dct_hash)
+
+    ph_dct_videohash is the keyframe hash sequence of a video, stored with
+    its hash (HashDAO.get_sequences) and compared by sequence_similarity.
+    the hash itself, which calculate_distance and the indexes compare, is
+    the bitwise majority of the sequence (dct_hash.summary_hash): a lossy
+    fixed width summary that pHash does not have, hence 'phash-summary'
+    '''
+
+    ############################################################################
+    supports_async = True
+
     ############################################################################
     @classmethod
     def calculate_distance(cls, video1, video2):
@@ -116,7 +416,7 @@ class PHash(VideoHasher):
     ############################################################################
     @classmethod
     def hash_type(cls):
-        return 'phash-video'
+        return 'phash-summary'
 
     ############################################################################
     @classmethod
@@ -124,22 +424,214 @@ class PHash(VideoHasher):
         return 64
 
     ############################################################################
-    def _run_phash(self, filepath):
-        process = subprocess.Popen(["./phash", filepath],
-                                   stderr=subprocess.PIPE,
-                                   stdout=subprocess.PIPE)
+    @staticmethod
+    def sample_filter(step):
+        '''
+        ffmpeg filter passing every step-th frame, the samples of pHash
+        '''
+        return r'select=not(mod(n\,{}))'.format(step)
 
-        output, errs = process.communicate()
-        if len(errs) > 0:
-            raise RuntimeError(errs)
+    ############################################################################
+    @staticmethod
+    def keyframe_filter(numbers):
+        '''
+        ffmpeg filter passing the frames numbered numbers, scaled to 32x32
+        '''
+        return 'select={},scale={}:{}:flags=bicubic'.format(
+            '+'.join(r'eq(n\,{})'.format(n) for n in numbers),
+            dct_hash.SIZE, dct_hash.SIZE)
 
-        if len(output) == 0:
-            raise RuntimeError('No output from phash: on {}'.format(filepath))
+    ############################################################################
+    @staticmethod
+    def frame_count(vinfo):
+        '''
+        the frames of a video stream from its ffprobe information, or None
+        '''
+        for key in ['nb_frames', 'nb_read_frames']:
+            count = str(vinfo.get(key, ''))
+            if count.isdigit() and int(count) > 0:
+                return int(count)
+        return None
+
+    ############################################################################
+    @classmethod
+    def sampling(cls, vinfo, filepath):
+        '''
+        (step, number of samples) of a video from its ffprobe information;
+        pHash steps by half the integer frame rate, rounded
+        '''
+        num, den = [int(n) for n in
+                    str(vinfo.get('r_frame_rate', '0/0')).split('/')]
+        if num <= 0 or den <= 0:
+            raise RuntimeError('Unknown frame rate: {}'.format(filepath))
+        step = dct_hash.frame_step(num // den)
+        return step, (cls.frame_count(vinfo) or 0) // step
 
-        return int(output)
+    ############################################################################
+    def sequences(self, videos):
+        '''
+        the keyframe hash sequences of videos, from their hashes when they
+        carry them and from the database otherwise
+        '''
+        found = {}
+        for v in videos:
+            h = v.hash_values.get(self.hash_type())
+            if h is not None and h.sequence is not None:
+                found[v.id] = h.sequence
+        missing = [v.id for v in videos if v.id not in found]
+        if missing:
+            found.update(self._manager.hash_dao.get_sequences(
+                self.hash_type(), missing))
+        for v in videos:
+            if v.id not in found:
+                raise RuntimeError('No keyframe sequence stored for {}'
+                                   .format(v))
+        return [dct_hash.parse_sequence(found[v.id]) for v in videos]
+
+    ############################################################################
+    def sequence(self, video):
+        '''
+        the stored keyframe hash sequence of video
+        '''
+        return self.sequences([video])[0]
+
+    ############################################################################
+    def sequence_similarity(self, video1, video2):
+        '''
+        ph_dct_videohash_dist of two videos: the share of their keyframes
+        that match in order, 0..1
+        '''
+        a, b = self.sequences([video1, video2])
+        return dct_hash.sequence_similarity(a, b)
+
+    ############################################################################
+    def match_sequences(self, video, candidates):
+        '''
+        sequence_similarity of video to every video of candidates
+        '''
+        sequences = self.sequences([video] + list(candidates))
+        return dct_hash.match_sequences(sequences[0], sequences[1:])
+
+    ############################################################################
+    @staticmethod
+    def _summarize(sequence, filepath):
+        if len(sequence) == 0:
+            raise RuntimeError('No frames decoded: {}'.format(filepath))
+        return (dct_hash.summary_hash(sequence), sequence)
+
+    ############################################################################
+    @staticmethod
+    def _hash_keyframes(frames, selected, filepath):
+        # the 32x32 keyframes decoded in the second pass
+        try:
+            keyframes = list(frames)
+        finally:
+            frames.close()
+        if len(keyframes) != len(selected):
+            raise RuntimeError('Decoded {} of {} keyframes: {}'.format(
+                len(keyframes), len(selected), filepath))
+        return dct_hash.frame_hashes(keyframes)
+
+    ############################################################################
+    def keyframe_hashes(self, filepath, buf=None):
+        '''
+        keyframe hash sequence of a video file, or of the video file held in
+        memory in buf when filepath is 'pipe:0'. the samples are decoded in
+        full to find the keyframes, which are decoded again at 32x32
+        '''
+        vinfo = probe_video(filepath, buf)
+        if self.frame_count(vinfo) is None:
+            vinfo = probe_video(filepath, buf, count_frames=True)
+        step, n_samples = self.sampling(vinfo, filepath)
+
+        frames = decode_frames(filepath, buf, self.sample_filter(step),
+                               gray=True)
+        try:
+            dist = dct_hash.histogram_distances(
+                dct_hash.histogram(frame)
+                for frame in itertools.islice(frames, n_samples))
+        finally:
+            frames.close()
+        selected = dct_hash.keyframes(dist)
+        if len(selected) == 0:
+            return []
+        frames = decode_frames(filepath, buf, self.keyframe_filter(
+            [k * step for k in selected]), gray=True)
+        return self._hash_keyframes(frames, selected, filepath)
+
+    ############################################################################
+    def _hash_file(self, filepath):
+        return self._summarize(self.keyframe_hashes(filepath), filepath)
+
+    ############################################################################
+    def hash_file(self, filepath):
+        return self._hash_file(filepath)[0]
+
+    ############################################################################
+    def store_result(self, video, result):
+        summary, sequence = result
+        self.store_hash(video, summary,
+                        sequence=dct_hash.format_sequence(sequence))
+        return
 
     ############################################################################
     def hash_video(self, filepath, video):
-        hash_number = self._run_phash(filepath)
-        self.store_hash(video, hash_number)
+        self.store_result(video, self._hash_file(filepath))
         return
+
+    ############################################################################
+    def compute_sequence(self, frames):
+        '''
+        keyframe hash sequence of frames, which should be sampled as
+        sample_filter does; hash_file decodes every keyframe again at
+        32x32 with ffmpeg, here they are scaled in process
+        '''
+        return dct_hash.video_hash(frames)
+
+    ############################################################################
+    def compute(self, frames, total=None):
+        return self._summarize(self.compute_sequence(frames), '<frames>')[0]
+
+    ############################################################################
+    def compute_from_bytes(self, buf):
+        return self._summarize(self.keyframe_hashes('pipe:0', buf),
+                               '<buffer>')[0]
+
+    ############################################################################
+    async def _decode_async(self, runner, filepath, vf):
+        # the ppm frames of the whole output of ffmpeg
+        result = await runner.run(decode_cmd(filepath, vf, gray=True))
+        if result.returncode != 0:
+            raise RuntimeError('ffmpeg failed on {}: {}'.format(
+                filepath, result.stderr.decode('utf-8', 'replace').strip()))
+        return read_ppm_frames(io.BytesIO(result.stdout))
+
+    ############################################################################
+    async def hash_file_async(self, runner, filepath):
+        vinfo = await probe(runner, filepath)
+        if self.frame_count(vinfo) is None:
+            vinfo = await probe(runner, filepath, count_frames=True)
+        step, n_samples = self.sampling(vinfo, filepath)
+
+        # the samples are read as they are decoded, not held at once
+        histograms = []
+        frames = runner.records(
+            decode_cmd(filepath, self.sample_filter(step), gray=True),
+            read_ppm_frame_async)
+        try:
+            async for frame in frames:
+                if len(histograms) == n_samples:
+                    break
+                histograms.append(dct_hash.histogram(frame))
+        finally:
+            await frames.aclose()
+        selected = dct_hash.keyframes(
+            dct_hash.histogram_distances(histograms))
+        sequence = []
+        if len(selected) > 0:
+            frames = await self._decode_async(runner, filepath,
+                                              self.keyframe_filter(
+                                                  [k * step
+                                                   for k in selected]))
+            sequence = self._hash_keyframes(frames, selected, filepath)
+        return self._summarize(sequence, filepath)
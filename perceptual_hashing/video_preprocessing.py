@@ -1,14 +1,221 @@
 #!/usr/bin/env python
+import asyncio
 import ffmpy
+import json
 import os
+import subprocess
+import threading
 import pymediainfo
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
+import numpy as np
+
+from .cpu_budget import current_budget
 from .data_manager import VideoDataManager, Video
 
 
 # video preprocessing step, will take a video and convert the video into
 # different file formats (mp4 -> avi, mpeg)
 
+# ffmpeg muxer options of every target format when written to a pipe
+PIPE_FORMATS = {
+    'avi': ['-f', 'avi'],
+    'mpg': ['-f', 'mpeg'],
+    'mp4': ['-f', 'mp4', '-movflags', 'frag_keyframe+empty_moov'],
+}
+
+
+################################################################################
+def _ppm_token(stream):
+    token = b''
+    while True:
+        c = stream.read(1)
+        if c == b'#' and token == b'':
+            stream.readline()
+            continue
+        if c == b'' or c.isspace():
+            if token or c == b'':
+                # the single whitespace after a token is consumed with it
+                return token or None
+            continue
+        token += c
+
+
+################################################################################
+async def _ppm_token_async(stream):
+    token = b''
+    while True:
+        c = await stream.read(1)
+        if c == b'#' and token == b'':
+            await stream.readline()
+            continue
+        if c == b'' or c.isspace():
+            if token or c == b'':
+                return token or None
+            continue
+        token += c
+
+
+################################################################################
+def _ppm_shape(magic, header):
+    # frame shape of a ppm (rgb) or pgm (grayscale) image header
+    if magic not in (b'P6', b'P5') or None in header:
+        raise RuntimeError('Invalid ppm frame header')
+    width, height, maxval = [int(t) for t in header]
+    if maxval != 255:
+        raise RuntimeError('Unsupported ppm maxval: {}'.format(maxval))
+    if magic == b'P5':
+        return (height, width)
+    return (height, width, 3)
+
+
+################################################################################
+def read_ppm_frames(stream):
+    '''
+    uint8 frames of a stream of binary ppm images, e.g. the output of
+    ffmpeg -f image2pipe -vcodec ppm: (height, width, 3) rgb frames, or
+    (height, width) grayscale frames of pgm images
+    '''
+    while True:
+        magic = _ppm_token(stream)
+        if magic is None:
+            return
+        shape = _ppm_shape(magic, [_ppm_token(stream) for _ in range(3)])
+        size = int(np.prod(shape))
+        data = stream.read(size)
+        if len(data) != size:
+            raise RuntimeError('Truncated ppm frame')
+        yield np.frombuffer(data, dtype=np.uint8).reshape(shape)
+
+
+################################################################################
+async def read_ppm_frame_async(stream):
+    '''
+    the next frame of read_ppm_frames from an asyncio stream, or None at
+    its end
+    '''
+    magic = await _ppm_token_async(stream)
+    if magic is None:
+        return None
+    shape = _ppm_shape(magic, [await _ppm_token_async(stream)
+                               for _ in range(3)])
+    try:
+        data = await stream.readexactly(int(np.prod(shape)))
+    except asyncio.IncompleteReadError:
+        raise RuntimeError('Truncated ppm frame')
+    return np.frombuffer(data, dtype=np.uint8).reshape(shape)
+
+
+################################################################################
+def _feed(proc, buf):
+    try:
+        proc.stdin.write(buf)
+    except (BrokenPipeError, ValueError):
+        # the reader stopped early
+        pass
+    finally:
+        try:
+            proc.stdin.close()
+        except BrokenPipeError:
+            pass
+    return
+
+
+################################################################################
+def decode_cmd(video_input, vf=None, gray=False):
+    '''
+    ffmpeg command writing the frames of video_input, filtered by vf, as
+    ppm images to stdout, or as 8 bit grayscale pgm images with gray
+    '''
+    cmd = ['ffmpeg', '-v', 'error', '-i', video_input]
+    if vf is not None:
+        # exactly the frames the filter passes, none duplicated or dropped
+        cmd += ['-vf', vf, '-vsync', '0']
+    if gray:
+        return cmd + ['-pix_fmt', 'gray', '-f', 'image2pipe',
+                      '-vcodec', 'pgm', 'pipe:1']
+    return cmd + ['-f', 'image2pipe', '-vcodec', 'ppm', 'pipe:1']
+
+
+################################################################################
+def decode_frames(video_input, buf=None, vf=None, gray=False):
+    '''
+    uint8 frames of video_input, filtered by the ffmpeg video filter vf:
+    (height, width, 3) rgb, or (height, width) grayscale with gray. with a
+    buf, video_input is 'pipe:0' and buf is written to the decoder.
+    closing the generator stops the decoder
+    '''
+    stdin = None
+    if buf is not None:
+        stdin = subprocess.PIPE
+    proc = subprocess.Popen(decode_cmd(video_input, vf, gray), stdin=stdin,
+                            stdout=subprocess.PIPE,
+                            stderr=subprocess.DEVNULL)
+    feeder = None
+    if buf is not None:
+        feeder = threading.Thread(target=_feed, args=(proc, buf), daemon=True)
+        feeder.start()
+    try:
+        for frame in read_ppm_frames(proc.stdout):
+            yield frame
+    finally:
+        proc.stdout.close()
+        if proc.poll() is None:
+            proc.kill()
+        proc.wait()
+        if feeder is not None:
+            feeder.join()
+    return
+
+
+################################################################################
+def decode_bytes(buf, vf=None, gray=False):
+    '''
+    decode_frames of a video file held in memory
+    '''
+    return decode_frames('pipe:0', buf, vf, gray)
+
+
+################################################################################
+def probe_video(video_input, buf=None, count_frames=False):
+    '''
+    ffprobe information of the first video stream of video_input, or of a
+    video file held in memory in buf when video_input is 'pipe:0';
+    without a stream duration the container's is used. count_frames
+    decodes the stream to count its frames into nb_read_frames
+    '''
+    cmd = ['ffprobe', '-v', 'error', '-print_format', 'json',
+           '-show_streams', '-show_format', '-select_streams', 'v:0']
+    if count_frames:
+        cmd.append('-count_frames')
+    where = video_input
+    if buf is not None:
+        where = 'buffer'
+    process = subprocess.run(cmd + [video_input], input=buf,
+                             stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    if process.returncode != 0:
+        raise RuntimeError('ffprobe failed: {}'.format(
+            process.stderr.decode('utf-8', 'replace').strip()))
+    info = json.loads(process.stdout.decode('utf-8'))
+    if len(info.get('streams', [])) == 0:
+        raise RuntimeError('No video stream in {}'.format(where))
+    vinfo = dict(info['streams'][0])
+    if 'duration' not in vinfo:
+        vinfo['duration'] = info.get('format', {}).get('duration')
+    return vinfo
+
+
+################################################################################
+def probe_bytes(buf):
+    '''
+    probe_video of a video file held in memory, which must have a duration
+    '''
+    vinfo = probe_video('pipe:0', buf)
+    if vinfo['duration'] is None:
+        raise RuntimeError('Unknown duration of the video in buffer')
+    return vinfo
+
+
 # ffmpeg -i input.avi -b:v 8192k -bufsize 64k output.avi
 # to check to see what ff will do, ff.cmd
 # to run, ff.run()
@@ -17,16 +224,34 @@ class VideoTranscoder:
     ############################################################################
     target_formats = ['avi', 'mpg', 'mp4']
 
+    # registrations buffered before they are written to the database
+    flush_every = 32
+
     ############################################################################
-    def __init__(self, path, manager=None, force=False):
+    def __init__(self, path, manager=None, force=False, processes=None,
+                 cores=None):
         self._path = path
         self._manager = manager
         if self._manager is None:
             self._manager = VideoDataManager()
         self.force = force
+        # ffmpeg jobs run at once, and the cores they share
+        self.cores = cores or current_budget().cores
+        self.processes = processes or self.cores
+        self.failed = []
+        # called with the path of every source and output of a finished job
+        self.on_output = None
 
         return
 
+    ############################################################################
+    @property
+    def threads_per_job(self):
+        '''
+        ffmpeg -threads of every job, so the jobs together fit the cores
+        '''
+        return max(1, self.cores // self.processes)
+
     ############################################################################
     def is_video(self, path):
         file_info = pymediainfo.MediaInfo.parse(path)
@@ -39,66 +264,195 @@ class VideoTranscoder:
     def run(self):
         video_list = list(os.listdir(self._path))
 
-        for v in video_list:
-            filepath = os.path.join(self._path, v)
-            if os.path.isfile(filepath) and self.is_video(filepath):
-                if (not filepath.endswith('smaller.mp4')
-                        and not filepath.endswith('bigger.mp4')):
-                    for fmt in self.target_formats:
-                        self.transcode_video(filepath, fmt)
-
-                    self.transcode_video(filepath, 'mp4',
-                                         opts='-vf scale=iw*0.9375:ih*0.9375',
-                                         output_suffix='_smaller')
-                    self.transcode_video(filepath, 'mp4',
-                                         opts='-vf scale=iw*1.0625:ih*1.0625',
-                                         output_suffix='_bigger')
+        with self._manager.batch(flush_every=self.flush_every):
+            cmds = []
+            for v in video_list:
+                filepath = os.path.join(self._path, v)
+                if os.path.isfile(filepath) and self.is_video(filepath):
+                    if (not filepath.endswith('smaller.mp4')
+                            and not filepath.endswith('bigger.mp4')):
+                        cmds.extend(self._transcode_all(filepath))
+            self.run_jobs(cmds)
 
         return
 
     ############################################################################
-    def _video_encoding_cmd(self, video_input, fmt, opts='', output_suffix=''):
-        video_name, inputfmt = os.path.splitext(video_input)
-        inputfmt = inputfmt.replace('.', '')
-        video_basename = os.path.basename(video_name)
-        video_dirname = os.path.dirname(video_name)
-        setdao = self._manager.videoset_dao
-        vdao = self._manager.video_dao
-        output_name = video_basename + output_suffix
+    def variants(self):
+        '''
+        (format, video filter or None, output suffix) of every transcode of a
+        source
+        '''
+        return ([(fmt, None, '') for fmt in self.target_formats] +
+                [('mp4', 'scale=iw*0.9375:ih*0.9375', '_smaller'),
+                 ('mp4', 'scale=iw*1.0625:ih*1.0625', '_bigger')])
+
+    ############################################################################
+    def _transcode_all(self, filepath):
+        cmd = self._multi_output_cmd(filepath, threads=self.threads_per_job)
+        if cmd is None:
+            return []
+        return [cmd]
+
+    ############################################################################
+    def _run_job(self, cmd):
+        print(cmd.cmd)
+        cmd.run()
+        return
+
+    ############################################################################
+    def run_jobs(self, cmds):
+        '''
+        run the ffmpeg commands, at most self.processes at once, and register
+        the outputs of those that succeed as they finish; a failed command
+        is reported, its partial outputs removed and the others go on
+        '''
+        if len(cmds) == 0:
+            return 0
+        done = 0
+        with ThreadPoolExecutor(self.processes) as pool:
+            futures = {}
+            for cmd in cmds:
+                cmd.add_input_video()
+                futures[pool.submit(self._run_job, cmd)] = cmd
+            # the database is only written from this thread
+            for future in as_completed(futures):
+                cmd = futures[future]
+                try:
+                    future.result()
+                except Exception as err:
+                    print('Transcoding failed: {}: {}'.format(
+                        ', '.join(cmd.output_paths), err))
+                    for path in cmd.output_paths:
+                        if os.path.exists(path):
+                            os.unlink(path)
+                    self.failed.append(cmd)
+                    continue
+                cmd.add_output_video()
+                done += 1
+                if self.on_output is not None:
+                    # the videos must be visible to whoever is called
+                    batch = self._manager.current_batch
+                    if batch is not None:
+                        batch.flush()
+                    for path in [cmd.input_path] + cmd.output_paths:
+                        self.on_output(path)
+        return done
 
+    ############################################################################
+    def _needs_output(self, inputfmt, output_name, fmt, output_suffix):
         if inputfmt == fmt and output_suffix == '':
-            return None
+            return False
 
         if not self.force:
-            video = vdao.video_by_name_and_format(output_name, fmt)
+            batch = self._manager.current_batch
+            if batch is not None and batch.contains(output_name, fmt):
+                return False
+            video = self._manager.video_dao.video_by_name_and_format(
+                output_name, fmt)
             if video is not None:
-                return None
+                return False
+        return True
 
+    ############################################################################
+    def _command(self, input_video, video_input, outputs,
+                 global_options=None):
+        '''
+        ffmpy command with outputs {path: options}, and the callbacks
+        registering the input and the (name, format) outputs it writes
+        '''
+        setdao = self._manager.videoset_dao
+        vdao = self._manager.video_dao
         video_set_r = []
 
         def add_input_video():
-            video = vdao.add_video_if_new(Video(video_basename, inputfmt))
+            batch = self._manager.current_batch
+            if batch is not None:
+                batch.add_to_set(input_video, input_video)
+                video_set_r.append(input_video)
+                return
+            video = vdao.add_video_if_new(input_video)
             video_set_r.append(setdao.add_video_to_set(video))
 
         def add_output_video():
             if len(video_set_r) == 0:
                 raise RuntimeError('must call add_input_video before ' +
                                    'add_output_video')
-            video_set = video_set_r[0]
-            video = vdao.add_video_if_new(Video(output_name, fmt))
-            setdao.add_video_to_set(video, video_set)
-
-        cmd = ffmpy.FFmpeg(
-                inputs={video_input: None},
-                outputs={os.path.join(video_dirname, output_name) +
-                         '.' + fmt: opts +
-                         ' -b:v 8M -maxrate 10M -bufsize 8M -an'}
-                )
+            batch = self._manager.current_batch
+            for output_name, fmt in cmd.output_videos:
+                if batch is not None:
+                    batch.add_to_set(Video(output_name, fmt), input_video)
+                    continue
+                video = vdao.add_video_if_new(Video(output_name, fmt))
+                video_set_r[0] = setdao.add_video_to_set(video, video_set_r[0])
 
+        cmd = ffmpy.FFmpeg(global_options=global_options,
+                           inputs={video_input: None},
+                           outputs={path: opts for path, opts, _ in outputs})
+        cmd.input_path = video_input
+        cmd.output_paths = [path for path, _, _ in outputs]
+        cmd.output_videos = [video for _, _, video in outputs]
         cmd.add_input_video = add_input_video
         cmd.add_output_video = add_output_video
         return cmd
 
+    ############################################################################
+    def _split(self, video_input):
+        video_name, inputfmt = os.path.splitext(video_input)
+        return (os.path.dirname(video_name), os.path.basename(video_name),
+                inputfmt.replace('.', ''))
+
+    ############################################################################
+    def _multi_output_cmd(self, video_input, threads=None):
+        '''
+        one ffmpeg command decoding video_input once and writing every
+        variant not in the database yet: the decoded video is split into
+        one stream per output, each scaled as needed
+        '''
+        video_dirname, video_basename, inputfmt = self._split(video_input)
+        wanted = [(fmt, vf, output_suffix)
+                  for fmt, vf, output_suffix in self.variants()
+                  if self._needs_output(inputfmt, video_basename +
+                                        output_suffix, fmt, output_suffix)]
+        if len(wanted) == 0:
+            return None
+
+        graph = ['[0:v]split={}{}'.format(
+            len(wanted), ''.join('[s{}]'.format(n)
+                                 for n in range(len(wanted))))]
+        outputs = []
+        for n, (fmt, vf, output_suffix) in enumerate(wanted):
+            label = '[s{}]'.format(n)
+            if vf is not None:
+                graph.append('{}{}[o{}]'.format(label, vf, n))
+                label = '[o{}]'.format(n)
+            opts = '-map {}'.format(label)
+            if threads is not None:
+                # the encoders of one command share its threads
+                opts += ' -threads {}'.format(max(1, threads // len(wanted)))
+            opts += ' -b:v 8M -maxrate 10M -bufsize 8M -an'
+            output_name = video_basename + output_suffix
+            outputs.append((os.path.join(video_dirname, output_name) + '.' +
+                            fmt, opts, (output_name, fmt)))
+
+        return self._command(Video(video_basename, inputfmt), video_input,
+                             outputs, ['-filter_complex', ';'.join(graph)])
+
+    ############################################################################
+    def _video_encoding_cmd(self, video_input, fmt, opts='', output_suffix='',
+                            threads=None):
+        video_dirname, video_basename, inputfmt = self._split(video_input)
+        output_name = video_basename + output_suffix
+        if not self._needs_output(inputfmt, output_name, fmt, output_suffix):
+            return None
+
+        if threads is not None:
+            opts += ' -threads {}'.format(threads)
+        output_path = os.path.join(video_dirname, output_name) + '.' + fmt
+        return self._command(Video(video_basename, inputfmt), video_input,
+                             [(output_path,
+                               opts + ' -b:v 8M -maxrate 10M -bufsize 8M -an',
+                               (output_name, fmt))])
+
     ############################################################################
     def transcode_video(self, video_input, fmt, opts='', output_suffix=''):
         cmd = self._video_encoding_cmd(video_input, fmt, opts, output_suffix)
@@ -109,3 +463,154 @@ class VideoTranscoder:
             cmd.run()
             cmd.add_output_video()
         return
+
+
+################################################################################
+class StreamingTranscoder(VideoTranscoder):
+    '''
+    the variants of VideoTranscoder without writing them to disk
+
+    every variant is re-encoded to its target format into a pipe, decoded
+    again straight from that pipe, and the frames the hashers want are
+    handed to their hash_video_frames. the source is decoded once for its
+    own hashes. variants are registered in the set of their source just as
+    VideoTranscoder registers the files it writes, so accuracy evaluation
+    works unchanged; only hashers that support frames can take part
+    '''
+
+    ############################################################################
+    def __init__(self, path, manager=None, hashers=(), force=False,
+                 cores=None):
+        super().__init__(path, manager, force, processes=1, cores=cores)
+        self.hashers = list(hashers)
+        for hasher in self.hashers:
+            if not hasher.supports_frames:
+                raise RuntimeError('{} cannot hash streamed frames'.format(
+                    hasher.hash_type()))
+        return
+
+    ############################################################################
+    def run(self):
+        video_list = list(os.listdir(self._path))
+
+        with self._manager.batch(flush_every=self.flush_every):
+            for v in video_list:
+                filepath = os.path.join(self._path, v)
+                if os.path.isfile(filepath) and self.is_video(filepath):
+                    if (not filepath.endswith('smaller.mp4')
+                            and not filepath.endswith('bigger.mp4')):
+                        self.stream_all(filepath)
+
+        return
+
+    ############################################################################
+    def _needs_hashing(self, output_name, fmt):
+        if self.force:
+            return True
+        batch = self._manager.current_batch
+        if batch is not None and batch.contains(output_name, fmt):
+            return False
+        video = self._manager.video_dao.video_by_name_and_format(output_name,
+                                                                 fmt)
+        return video is None or any(h.hash_type() not in video.hash_values
+                                    for h in self.hashers)
+
+    ############################################################################
+    def encode_cmd(self, video_input, fmt, vf=None):
+        cmd = ['ffmpeg', '-v', 'error', '-i', video_input]
+        if vf is not None:
+            cmd += ['-vf', vf]
+        cmd += ['-threads', str(self.threads_per_job),
+                '-b:v', '8M', '-maxrate', '10M', '-bufsize', '8M', '-an']
+        return cmd + PIPE_FORMATS[fmt] + ['pipe:1']
+
+    ############################################################################
+    def decode_cmd(self, video_input='pipe:0'):
+        return ['ffmpeg', '-v', 'error', '-i', video_input,
+                '-f', 'image2pipe', '-vcodec', 'ppm', 'pipe:1']
+
+    ############################################################################
+    def stream_frames(self, video_input, fmt, vf, wanted):
+        '''
+        {frame number: frame} of the wanted frames of video_input encoded to
+        fmt with video filter vf, or of video_input itself when fmt is None;
+        the pipeline is stopped once the last wanted frame is decoded
+        '''
+        procs = []
+        frames = {}
+        try:
+            if fmt is None:
+                decoder = subprocess.Popen(self.decode_cmd(video_input),
+                                           stdout=subprocess.PIPE,
+                                           stderr=subprocess.DEVNULL)
+            else:
+                encoder = subprocess.Popen(
+                    self.encode_cmd(video_input, fmt, vf),
+                    stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+                procs.append(encoder)
+                decoder = subprocess.Popen(self.decode_cmd(),
+                                           stdin=encoder.stdout,
+                                           stdout=subprocess.PIPE,
+                                           stderr=subprocess.DEVNULL)
+                encoder.stdout.close()
+            procs.append(decoder)
+            last = max(wanted)
+            for n, frame in enumerate(read_ppm_frames(decoder.stdout)):
+                if n in wanted:
+                    frames[n] = frame
+                if n >= last:
+                    break
+        finally:
+            for proc in procs:
+                if proc.stdout is not None:
+                    proc.stdout.close()
+                if proc.poll() is None:
+                    proc.kill()
+                proc.wait()
+
+        missing = set(wanted) - set(frames)
+        if missing:
+            raise RuntimeError('Stream ended before frame {}: {}'.format(
+                min(missing), video_input))
+        return frames
+
+    ############################################################################
+    def stream_all(self, video_input):
+        video_dirname, video_basename, inputfmt = self._split(video_input)
+        source = Video(video_basename, inputfmt)
+        outputs = [(video_basename, inputfmt, None, None)]
+        for fmt, vf, output_suffix in self.variants():
+            if inputfmt == fmt and output_suffix == '':
+                continue
+            outputs.append((video_basename + output_suffix, fmt, fmt, vf))
+
+        batch = self._manager.current_batch
+        if len(self.hashers) == 0:
+            # register the source for the hashers that read files
+            batch.add_to_set(source, source)
+            return
+
+        wanted = None
+        for output_name, fmt, target, vf in outputs:
+            if not self._needs_hashing(output_name, fmt):
+                continue
+            if wanted is None:
+                wanted = [sorted(h.wanted(video_input)) for h in self.hashers]
+            label = os.path.join(video_dirname, output_name) + '.' + fmt
+            video = Video(output_name, fmt)
+            print('Streaming: ' + label)
+            try:
+                frames = self.stream_frames(
+                    video_input, target, vf,
+                    set(n for numbers in wanted for n in numbers))
+                for hasher, numbers in zip(self.hashers, wanted):
+                    hasher.hash_video_frames(label,
+                                             [frames[n] for n in numbers],
+                                             video)
+            except Exception as err:
+                print('Streaming failed: {}: {}'.format(label, err))
+                self.failed.append((output_name, fmt))
+                continue
+            batch.add_to_set(video, source)
+        return
+
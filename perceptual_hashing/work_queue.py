@@ -0,0 +1,363 @@
+#!/usr/bin/env python
+import os
+import socket
+import threading
+import time
+from optparse import OptionParser
+
+from .data_manager import VideoDataManager
+
+TASK_STATES = ('pending', 'leased', 'done', 'failed')
+
+
+################################################################################
+class Task:
+    ############################################################################
+    def __init__(self, task_id, video_id, method, lease_expires, attempts):
+        self.id = task_id
+        self.video_id = video_id
+        self.method = method
+        self.lease_expires = lease_expires
+        self.attempts = attempts
+        return
+
+    ############################################################################
+    def __repr__(self):
+        return 'Task({}, {}, {})'.format(self.id, self.video_id, self.method)
+
+
+################################################################################
+class WorkQueue:
+    '''
+    (video, method) hashing tasks in the hash_tasks table of a shared
+    database
+
+    a worker claims tasks by taking a lease on them for lease_seconds and
+    keeps the lease alive with heartbeat(); a task whose lease expires, e.g.
+    because its worker died, goes back to whoever claims next. a task is
+    tried at most max_attempts times before it is marked failed
+    '''
+
+    ############################################################################
+    clock = staticmethod(time.time)
+
+    # expired leases of tasks that have used up their attempts
+    reap_sql = '''
+    UPDATE hash_tasks
+    SET state = 'failed', worker = NULL, lease_expires = NULL,
+        error = COALESCE(error, 'lease expired'),
+        date_updated = CURRENT_TIMESTAMP
+    WHERE state = 'leased' AND lease_expires < ? AND attempts >= ?
+    '''
+
+    ############################################################################
+    def __init__(self, manager=None, worker=None, lease_seconds=300,
+                 max_attempts=3):
+        self._manager = manager
+        if self._manager is None:
+            self._manager = VideoDataManager()
+        if worker is None:
+            worker = '{}:{}'.format(socket.gethostname(), os.getpid())
+        self.worker = worker
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        return
+
+    ############################################################################
+    def _write(self, sql, params=(), many=False, reap_at=None):
+        '''
+        run sql in a transaction of its own, after reaping the leases
+        expired at reap_at if given
+        '''
+        conn = self._manager.conn
+        try:
+            c = conn.cursor()
+            if reap_at is not None:
+                c.execute(self.reap_sql, [reap_at, self.max_attempts])
+            if many:
+                c.executemany(sql, params)
+            else:
+                c.execute(sql, params)
+            rows = c.fetchall()
+            count = c.rowcount
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        return (rows, count)
+
+    ############################################################################
+    def enqueue(self, methods, video_ids=None, force=False):
+        '''
+        add a task for every video (default: all) and method that is not
+        hashed yet, or for every one when forced; returns the number added
+        '''
+        hdao = self._manager.hash_dao
+        method_ids = [hdao.get_hash_method_by_name(m) for m in methods]
+        sql = '''
+        INSERT INTO hash_tasks (video_id, method)
+        SELECT v.id, h.id
+        FROM video_info v, hash_methods h
+        WHERE h.id IN ({})
+        '''.format(','.join('?' * len(method_ids)))
+        params = list(method_ids)
+        if not force:
+            sql += '''
+            AND NOT EXISTS (SELECT 1 FROM computed_hashes ch
+                            WHERE ch.video_id = v.id
+                            AND ch.hash_method_id = h.id)
+            '''
+        if force:
+            # a forced task is run again even when it was done before
+            upsert = '''
+            ON CONFLICT (video_id, method) DO UPDATE
+            SET state = 'pending', worker = NULL, lease_expires = NULL,
+                attempts = 0, error = NULL
+            WHERE state != 'leased'
+            '''
+        else:
+            upsert = 'ON CONFLICT (video_id, method) DO NOTHING'
+
+        if video_ids is None:
+            _, count = self._write(sql + upsert, params)
+            return count
+        count = 0
+        video_ids = list(video_ids)
+        for n in range(0, len(video_ids), 500):
+            chunk = video_ids[n:n+500]
+            _, added = self._write(
+                sql + ' AND v.id IN ({}) '.format(','.join('?' * len(chunk)))
+                + upsert, params + chunk)
+            count += added
+        return count
+
+    ############################################################################
+    def claim(self, n=1, methods=None):
+        '''
+        lease up to n pending or expired tasks, of methods (default: any),
+        to this worker; the expired tasks that are out of attempts are
+        marked failed first, so a queue with nothing left to claim ends
+        '''
+        now = self.clock()
+        params = [self.worker, now + self.lease_seconds, now,
+                  self.max_attempts]
+        only = ''
+        if methods is not None:
+            hdao = self._manager.hash_dao
+            params += [hdao.get_hash_method_by_name(m) for m in methods]
+            only = 'AND method IN ({})'.format(','.join('?' * len(methods)))
+        rows, _ = self._write('''
+        UPDATE hash_tasks
+        SET state = 'leased', worker = ?, lease_expires = ?,
+            attempts = attempts + 1, date_updated = CURRENT_TIMESTAMP
+        WHERE id IN (SELECT id
+                     FROM hash_tasks
+                     WHERE (state = 'pending'
+                            OR (state = 'leased' AND lease_expires < ?))
+                     AND attempts < ?
+                     {}
+                     ORDER BY id
+                     LIMIT ?)
+        RETURNING id, video_id, method, lease_expires, attempts
+        '''.format(only), params + [n], reap_at=now)
+        names = self._method_names()
+        return sorted((Task(task_id, video_id, names[method], expires,
+                            attempts)
+                       for task_id, video_id, method, expires, attempts
+                       in rows), key=lambda t: t.id)
+
+    ############################################################################
+    def _method_names(self):
+        c = self._manager.conn.cursor()
+        c.execute('SELECT id, name FROM hash_methods')
+        return dict(c.fetchall())
+
+    ############################################################################
+    def heartbeat(self, tasks):
+        '''
+        extend the leases of tasks; returns the ids of those still held
+        '''
+        if len(tasks) == 0:
+            return set()
+        expires = self.clock() + self.lease_seconds
+        ids = [t.id for t in tasks]
+        rows, _ = self._write('''
+        UPDATE hash_tasks
+        SET lease_expires = ?
+        WHERE id IN ({})
+        AND state = 'leased' AND worker = ?
+        RETURNING id
+        '''.format(','.join('?' * len(ids))), [expires] + ids + [self.worker])
+        for t in tasks:
+            t.lease_expires = expires
+        return set(r[0] for r in rows)
+
+    ############################################################################
+    def complete(self, task):
+        '''
+        mark task done; False when this worker no longer holds its lease
+        '''
+        _, count = self._write('''
+        UPDATE hash_tasks
+        SET state = 'done', lease_expires = NULL, error = NULL,
+            date_updated = CURRENT_TIMESTAMP
+        WHERE id = ? AND state = 'leased' AND worker = ?
+        ''', [task.id, self.worker])
+        return count == 1
+
+    ############################################################################
+    def fail(self, task, error):
+        '''
+        give task back to the queue, or mark it failed after max_attempts
+        '''
+        _, count = self._write('''
+        UPDATE hash_tasks
+        SET state = CASE WHEN attempts < ? THEN 'pending' ELSE 'failed' END,
+            worker = NULL, lease_expires = NULL, error = ?,
+            date_updated = CURRENT_TIMESTAMP
+        WHERE id = ? AND state = 'leased' AND worker = ?
+        ''', [self.max_attempts, str(error), task.id, self.worker])
+        return count == 1
+
+    ############################################################################
+    def reap(self):
+        '''
+        mark the expired tasks that have used up their attempts as failed
+        '''
+        _, count = self._write(self.reap_sql,
+                               [self.clock(), self.max_attempts])
+        return count
+
+    ############################################################################
+    def progress(self):
+        '''
+        {method: {state: count}}; leases that have run out are counted as
+        'expired' rather than 'leased', or as 'failed' when the task has no
+        attempt left, as the next claim() or reap() will mark it
+        '''
+        c = self._manager.conn.cursor()
+        c.execute('''
+        SELECT h.name,
+               CASE WHEN t.state = 'leased' AND t.lease_expires < ?
+                    THEN CASE WHEN t.attempts >= ? THEN 'failed'
+                              ELSE 'expired' END
+                    ELSE t.state END,
+               COUNT(*)
+        FROM hash_tasks t
+        INNER JOIN hash_methods h
+        ON h.id = t.method
+        GROUP BY 1, 2
+        ''', [self.clock(), self.max_attempts])
+        progress = {}
+        for method, state, count in c.fetchall():
+            counts = progress.setdefault(
+                method, dict.fromkeys(TASK_STATES + ('expired',), 0))
+            counts[state] = count
+        return progress
+
+    ############################################################################
+    def is_finished(self):
+        return all(counts['pending'] + counts['leased'] + counts['expired']
+                   == 0 for counts in self.progress().values())
+
+
+################################################################################
+class QueueWorker:
+    '''
+    claims tasks from a WorkQueue and hashes the videos from path with the
+    hashers of their method until the queue has no claimable task left;
+    the leases of the claimed tasks are renewed by a heartbeat thread
+    '''
+
+    ############################################################################
+    def __init__(self, queue, path, hashers, batch_size=4):
+        self._queue = queue
+        self.path = path
+        # method name -> VideoHasher instance
+        self._hashers = hashers
+        self.batch_size = batch_size
+        self._held = []
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self.done = 0
+        self.failed = 0
+        return
+
+    ############################################################################
+    def _heartbeat(self):
+        interval = max(0.01, self._queue.lease_seconds / 3.0)
+        while not self._stop.wait(interval):
+            with self._lock:
+                held = list(self._held)
+            self._queue.heartbeat(held)
+        return
+
+    ############################################################################
+    def run_task(self, task, manager):
+        hasher = self._hashers.get(task.method)
+        if hasher is None:
+            raise RuntimeError('No hasher for {}'.format(task.method))
+        video = manager.video_dao.video_by_id(task.video_id)
+        if video is None:
+            raise RuntimeError('Unknown video: {}'.format(task.video_id))
+        filepath = os.path.join(self.path,
+                                '{}.{}'.format(video.name, video.format))
+        if not os.path.exists(filepath):
+            raise RuntimeError('Missing video file: {}'.format(filepath))
+        hasher.hash_or_reuse(filepath, video)
+        return
+
+    ############################################################################
+    def run(self):
+        manager = self._queue._manager
+        thread = threading.Thread(target=self._heartbeat, daemon=True)
+        thread.start()
+        try:
+            while True:
+                tasks = self._queue.claim(self.batch_size,
+                                          list(self._hashers))
+                if len(tasks) == 0:
+                    break
+                with self._lock:
+                    self._held = list(tasks)
+                for task in tasks:
+                    try:
+                        self.run_task(task, manager)
+                    except Exception as err:
+                        self._queue.fail(task, err)
+                        self.failed += 1
+                    else:
+                        if self._queue.complete(task):
+                            self.done += 1
+                    with self._lock:
+                        self._held.remove(task)
+        finally:
+            self._stop.set()
+            thread.join()
+        return (self.done, self.failed)
+
+
+################################################################################
+def main(argv):
+    parser = OptionParser(usage='%prog [options]')
+    parser.add_option('--db',
+                      action='store',
+                      dest='db',
+                      default='videohash.db',
+                      help='Database holding the task queue')
+    parser.add_option('--reap',
+                      action='store_true',
+                      dest='reap',
+                      default=False,
+                      help='Mark expired tasks without attempts left failed')
+    (opts, args) = parser.parse_args(argv[1:])
+
+    queue = WorkQueue(VideoDataManager(opts.db))
+    if opts.reap:
+        print('reaped {} tasks'.format(queue.reap()))
+    for method, counts in sorted(queue.progress().items()):
+        total = sum(counts.values())
+        print('{}: {}/{} done, {} leased, {} expired, {} pending, {} failed'
+              .format(method, counts['done'], total, counts['leased'],
+                      counts['expired'], counts['pending'], counts['failed']))
+    return
@@ -4,8 +4,12 @@ setup(
     name="perceptual_hashing",
     version="0.1",
     packages=['perceptual_hashing'],
-    scripts=['bin/run_experiments'],
-    install_requires=['docutils>=0.3'],
+    scripts=['bin/run_experiments', 'bin/rebuild_index',
+             'bin/query_video', 'bin/similarity_join',
+             'bin/cascade_report', 'bin/hash_snapshot',
+             'bin/queue_status', 'bin/merge_shards',
+             'bin/cpu_benchmark', 'bin/hash_service'],
+    install_requires=['docutils>=0.3', 'threadpoolctl'],
     package_data={'': ['*.txt', '*.rst', '*.md']},
     test_suite='nose.collector',
     tests_require=['nose', 'mock'],
@@ -1,8 +1,14 @@
 import unittest
 import tempfile
+import shutil
 import os
 from perceptual_hashing.video_hashing import PHash
+from perceptual_hashing.llehash import LLE16x16PointHash
 from perceptual_hashing.data_manager import VideoDataManager, Video, VideoSet
+from perceptual_hashing.data_manager import Hash
+from perceptual_hashing.accuracy import CalculateAccuracy, MultiMethodAccuracy
+from perceptual_hashing.accuracy import CatalogAccuracy
+from perceptual_hashing.snapshot import method_format, format_hash
 
 
 ################################################################################
@@ -14,14 +20,124 @@ class testcase(unittest.TestCase):
 
     ############################################################################
     def tearDown(self):
-        for f in os.listdir(self.tempdir):
-            os.unlink('{}/{}'.format(self.tempdir, f))
-        os.rmdir(self.tempdir)
+        shutil.rmtree(self.tempdir)
         return
 
     ############################################################################
-    #def test_
+    def make_catalog(self, distance_store='sqlite', methods=None):
+        m = VideoDataManager(os.path.join(self.tempdir, 'test.db'),
+                             distance_store=distance_store)
+        vdao = m.video_dao
+        setdao = m.videoset_dao
+        if methods is None:
+            methods = [PHash.hash_type()]
+        hashes = [[0, 1, 3], [0xffffffff00000000, 0xffffffff00000001],
+                  [0xffff0000]]
+        for n, values in enumerate(hashes):
+            video_set = None
+            for k, value in enumerate(values):
+                v = vdao.add_video(Video('file{}'.format(n), 'f{}'.format(k)))
+                for i, method in enumerate(methods):
+                    # every method sees the catalog a little differently
+                    bits, encoding = method_format(method)
+                    v.hash_values[method] = Hash(method, format_hash(
+                        value ^ (k * i), bits, encoding))
+                v = vdao.add_video_hashes(v)
+                video_set = setdao.add_video_to_set(v, video_set)
+        return m
 
+    ############################################################################
+    def test_multi_method_accuracy(self):
+        m = self.make_catalog()
+        method = PHash.hash_type()
+        results = MultiMethodAccuracy([method], m, processes=1).run()
+        self.assertEqual(results[method], 1.0)
+
+        methodid = m.hash_dao.get_hash_method_by_name(method)
+        stored = m.hash_dao.get_method_accuracy(methodid)
+        self.assertEqual(stored['accuracy'], 1.0)
+        self.assertEqual(stored['true_positives'], 4)
+        self.assertEqual(stored['true_negatives'], 11)
+
+        videos = m.video_dao.all_videos()
+        vd = m.distance_dao.get_distance(methodid, videos[0], videos[2])
+        self.assertEqual(vd.distance, 2)
+
+    ############################################################################
+    def test_matches_single_method_accuracy(self):
+        methods = [PHash.hash_type(), LLE16x16PointHash.hash_type()]
+        stored = []
+        for processes in [1, 2]:
+            m = self.make_catalog(methods=methods)
+            expected = {}
+            for method in methods:
+                calc = CalculateAccuracy(method, m, verbose=False)
+                calc.calculate_distances()
+                expected[method] = calc.best_accuracy()
+            m.close()
+            os.unlink(os.path.join(self.tempdir, 'test.db'))
 
+            # the methods are evaluated on a pool of two processes
+            m = self.make_catalog(methods=methods)
+            MultiMethodAccuracy(methods, m, processes=processes).run()
+            results = {}
+            videos = m.video_dao.all_videos(methods)
+            for method in methods:
+                methodid = m.hash_dao.get_hash_method_by_name(method)
+                accuracy = m.hash_dao.get_method_accuracy(methodid)
+                self.assertEqual(accuracy, expected[method])
+                distances = [m.distance_dao.get_distance(methodid, a, b)
+                             for n, a in enumerate(videos)
+                             for b in videos[n + 1:]]
+                results[method] = (accuracy, [d.distance for d in distances])
+            stored.append(results)
+            m.close()
+            os.unlink(os.path.join(self.tempdir, 'test.db'))
+        self.assertNotEqual(stored[0][methods[0]], stored[0][methods[1]])
+        self.assertEqual(stored[0], stored[1])
 
+    ############################################################################
+    def test_distances_by_row(self):
+        for store in ['sqlite', 'matrix']:
+            m = self.make_catalog(store)
+            method = PHash.hash_type()
+            calc = CalculateAccuracy(method, m, verbose=False)
+            calc.commit_every = 2
+            calc.calculate_distances()
+            videos = m.video_dao.all_videos([method])
+            for n, a in enumerate(videos):
+                for b in videos[n + 1:]:
+                    self.assertEqual(
+                        m.distance_dao.get_distance(calc._methodid, a, b),
+                        PHash.calculate_distance(a, b))
+            m.close()
+            shutil.rmtree(self.tempdir)
+            os.mkdir(self.tempdir)
+
+    ############################################################################
+    def test_accuracy_with_matrix_store(self):
+        m = self.make_catalog('matrix')
+        method = PHash.hash_type()
+        self.assertEqual(CalculateAccuracy(method, m, verbose=False).run(),
+                         1.0)
+        results = MultiMethodAccuracy([method], m, processes=1).run()
+        self.assertEqual(results[method], 1.0)
+
+    ############################################################################
+    def test_accuracy_without_distances(self):
+        m = self.make_catalog()
+        method = PHash.hash_type()
+        expected = CatalogAccuracy(
+            PHash, m.video_dao.all_videos([method]),
+            m.videoset_dao.get_video_all_sets([method]))
+        expected.calculate_distances()
+        expected = expected.best_accuracy()
 
+        results = MultiMethodAccuracy([method], m,
+                                      store_distances=False).run()
+        self.assertEqual(results[method], 1.0)
+        methodid = m.hash_dao.get_hash_method_by_name(method)
+        self.assertEqual(m.hash_dao.get_method_accuracy(methodid), expected)
+        c = m.conn.cursor()
+        c.execute('SELECT COUNT(*) FROM video_distances')
+        self.assertEqual(c.fetchone()[0], 0)
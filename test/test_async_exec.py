@@ -0,0 +1,183 @@
+import unittest
+import tempfile
+import shutil
+import asyncio
+import os
+import sys
+import time
+from perceptual_hashing.async_exec import AsyncRunner, run_all
+from perceptual_hashing.video_hashing import PHash
+from perceptual_hashing.video_preprocessing import read_ppm_frame_async
+from perceptual_hashing.data_manager import VideoDataManager, Video
+
+
+################################################################################
+def python(code):
+    return [sys.executable, '-c', code]
+
+
+################################################################################
+class testcase(unittest.TestCase):
+    ############################################################################
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        return
+
+    ############################################################################
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+        return
+
+    ############################################################################
+    def test_run(self):
+        async def job(runner):
+            return await runner.run(
+                python('import sys; print(sys.stdin.read().upper())'),
+                stdin=b'frames')
+
+        result, = run_all([job])
+        self.assertEqual(result.returncode, 0)
+        self.assertEqual(result.stdout.strip(), b'FRAMES')
+        return
+
+    ############################################################################
+    def test_limit(self):
+        # four 0.3s processes two at a time take at least two rounds
+        sleep = python('import time; time.sleep(0.3)')
+        jobs = [lambda runner: runner.run(sleep) for _ in range(4)]
+        start = time.perf_counter()
+        results = run_all(jobs, limit=2)
+        self.assertGreaterEqual(time.perf_counter() - start, 0.6)
+        self.assertEqual([r.returncode for r in results], [0, 0, 0, 0])
+        return
+
+    ############################################################################
+    def test_timeout(self):
+        jobs = [lambda runner: runner.run(python('import time; '
+                                                 'time.sleep(30)')),
+                lambda runner: runner.run(python('print(1)'))]
+        start = time.perf_counter()
+        timed_out, done = run_all(jobs, timeout=0.5)
+        self.assertLess(time.perf_counter() - start, 10)
+        self.assertIsInstance(timed_out, RuntimeError)
+        self.assertEqual(done.stdout.strip(), b'1')
+        return
+
+    ############################################################################
+    def test_cancel(self):
+        async def main():
+            runner = AsyncRunner()
+            task = asyncio.ensure_future(
+                runner.run(python('import time; time.sleep(30)')))
+            await asyncio.sleep(0.3)
+            task.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                await task
+            return
+
+        start = time.perf_counter()
+        asyncio.run(main())
+        self.assertLess(time.perf_counter() - start, 10)
+        return
+
+    ############################################################################
+    def test_lines(self):
+        count = python('import time\n'
+                       'for n in range(1000):\n'
+                       '    print(n, flush=True)\n'
+                       '    time.sleep(0.01)\n')
+
+        async def first_three(runner):
+            seen = []
+            lines = runner.lines(count)
+            async for line in lines:
+                seen.append(int(line))
+                if len(seen) == 3:
+                    break
+            await lines.aclose()
+            return seen
+
+        async def all_lines(runner):
+            return [line async for line in runner.lines(
+                python('print("a"); print("b")'))]
+
+        async def failing(runner):
+            return [line async for line in runner.lines(
+                python('print("a"); raise SystemExit(3)'))]
+
+        start = time.perf_counter()
+        first, lines, failed = run_all([first_three, all_lines, failing])
+        self.assertLess(time.perf_counter() - start, 5)
+        self.assertEqual(first, [0, 1, 2])
+        self.assertEqual(lines, ['a', 'b'])
+        self.assertIsInstance(failed, RuntimeError)
+        return
+
+    ############################################################################
+    def test_records(self):
+        frames = python('import sys\n'
+                        'for n in range(3):\n'
+                        '    sys.stdout.buffer.write(b"P5\\n2 1\\n255\\n" +'
+                        ' bytes([n, n]))\n')
+
+        async def read_all(runner):
+            return [frame.tolist() async for frame in runner.records(
+                frames, read_ppm_frame_async)]
+
+        async def truncated(runner):
+            return [frame async for frame in runner.records(
+                python('import sys; sys.stdout.write("P5 2 1 255 x")'),
+                read_ppm_frame_async)]
+
+        decoded, failed = run_all([read_all, truncated])
+        self.assertEqual(decoded, [[[0, 0]], [[1, 1]], [[2, 2]]])
+        self.assertIsInstance(failed, RuntimeError)
+        return
+
+    ############################################################################
+    def test_phash_concurrently(self):
+        m = VideoDataManager(os.path.join(self.tempdir, 'test.db'))
+        runs = []
+
+        async def fake_phash(runner, filepath):
+            runs.append(os.path.basename(filepath))
+            if 'bad' in filepath:
+                result = await runner.run(python('raise SystemExit(1)'))
+                raise RuntimeError(result.returncode)
+            result = await runner.run(python('print(len({!r}))'
+                                             .format(filepath)))
+            value = int(result.stdout)
+            return (value, [value])
+
+        contents = {'a': 'one', 'b': 'one', 'c': 'three', 'bad': 'four',
+                    'bad2': 'four'}
+        for name, content in contents.items():
+            with open(os.path.join(self.tempdir, name + '.mp4'), 'w') as fd:
+                fd.write(content)
+            m.video_dao.add_video(Video(name, 'mp4'))
+
+        ph = PHash(self.tempdir, m)
+        ph.concurrency = 4
+        ph.hash_file_async = fake_phash
+        ph.run()
+
+        # a.mp4 and b.mp4 have the same content: one of them is hashed, and
+        # so is one of bad.mp4 and bad2.mp4, which both fail
+        self.assertEqual(len(runs), 3)
+        self.assertEqual(sorted(ph.failed),
+                         [os.path.join(self.tempdir, name + '.mp4')
+                          for name in ['bad', 'bad2']])
+        vdao = m.video_dao
+        a = vdao.video_by_name_and_format('a', 'mp4')
+        b = vdao.video_by_name_and_format('b', 'mp4')
+        c = vdao.video_by_name_and_format('c', 'mp4')
+        bad = vdao.video_by_name_and_format('bad', 'mp4')
+        self.assertEqual(a.hash_values['phash-summary'].value,
+                         b.hash_values['phash-summary'].value)
+        self.assertEqual(int(c.hash_values['phash-summary'].value),
+                         len(os.path.join(self.tempdir, 'c.mp4')))
+        self.assertNotIn('phash-summary', bad.hash_values)
+        bad2 = vdao.video_by_name_and_format('bad2', 'mp4')
+        self.assertNotIn('phash-summary', bad2.hash_values)
+        m.close()
+        return
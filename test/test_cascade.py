@@ -0,0 +1,183 @@
+import unittest
+import tempfile
+import shutil
+import os
+import random
+import numpy as np
+from perceptual_hashing.cascade import CascadeSearch
+from perceptual_hashing.llehash import LLE16x16PointHash
+from perceptual_hashing.data_manager import (VideoDataManager, Video, Hash,
+                                             SCHEMA_MIGRATIONS)
+from perceptual_hashing.util import block_mean_hash
+from perceptual_hashing.video_hamming_distance import popcount
+
+
+################################################################################
+def noisy(rnd, h, bits, noise):
+    for k in range(rnd.randrange(noise)):
+        h ^= 1 << rnd.randrange(bits)
+    return h
+
+
+################################################################################
+class testcase(unittest.TestCase):
+    ############################################################################
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.m = VideoDataManager(os.path.join(self.tempdir, 'test.db'))
+        self.lle = LLE16x16PointHash(self.tempdir, self.m)
+        return
+
+    ############################################################################
+    def tearDown(self):
+        self.m.close()
+        shutil.rmtree(self.tempdir)
+        return
+
+    ############################################################################
+    def make_catalog(self, n_sets=15, per_set=4):
+        rnd = random.Random(3)
+        hashes = {}
+        for s in range(n_sets):
+            fine = rnd.getrandbits(480)
+            coarse = rnd.getrandbits(64)
+            anchor = None
+            for n in range(per_set):
+                v = self.m.video_dao.add_video(
+                    Video('set{}_{}'.format(s, n), 'mp4'))
+                h = noisy(rnd, fine, 480, 40)
+                c = noisy(rnd, coarse, 64, 8)
+                self.lle.store_hash(v, format(h, '0480b'), coarse=c)
+                if anchor is None:
+                    anchor = v
+                self.m.videoset_dao.add_video_to_set(
+                    v, self.m.videoset_dao.get_video_set(anchor))
+                hashes[v.id] = (h, c)
+        return hashes
+
+    ############################################################################
+    def test_block_mean_hash(self):
+        frames = np.zeros((8, 64, 48, 3))
+        frames[:, :32] = 255
+        h = block_mean_hash(frames)
+        self.assertEqual(h, int('1' * 32 + '0' * 32, 2))
+        self.assertEqual(LLE16x16PointHash.coarse_hash(frames), h)
+        self.assertRaises(RuntimeError, block_mean_hash,
+                          np.zeros((2, 4, 4)))
+        return
+
+    ############################################################################
+    def test_coarse_stored_with_lle(self):
+        v = self.m.video_dao.add_video(Video('file', 'mp4'))
+        self.lle._hash_file = lambda f: ('01' * 240, 12345)
+        self.lle.hash_video('file.mp4', v)
+        v = self.m.video_dao.video_by_id(v.id)
+        self.assertEqual(list(v.hash_values), [self.lle.hash_type()])
+        self.assertEqual(v.hash_values[self.lle.hash_type()].value, '01' * 240)
+        self.assertEqual(self.m.hash_dao.get_coarse_hashes(
+            self.lle.hash_type()), {v.id: '12345'})
+
+        # copied with the hash to a file with the same content, and stored
+        # through a batch
+        self.m.video_dao.set_digest(v, 'digest')
+        hashes = self.m.video_dao.hashes_by_digest('digest',
+                                                   self.lle.stored_types())
+        self.assertEqual(hashes[self.lle.hash_type()].coarse, '12345')
+        with self.m.batch():
+            self.lle._copy(Video('copy', 'mp4'), hashes)
+            self.lle._hash_file = lambda f: ('10' * 240, 678)
+            self.lle.hash_video('other.mp4', Video('other', 'mp4'))
+        coarse = self.m.hash_dao.get_coarse_hashes(self.lle.hash_type())
+        vdao = self.m.video_dao
+        self.assertEqual(coarse[vdao.video_by_name_and_format(
+            'copy', 'mp4').id], '12345')
+        self.assertEqual(coarse[vdao.video_by_name_and_format(
+            'other', 'mp4').id], '678')
+        return
+
+    ############################################################################
+    def test_coarse_method_migrated(self):
+        # a database from before the coarse_hashes table, which kept the
+        # coarse hashes as a method of their own
+        v = self.m.video_dao.add_video(Video('file', 'mp4'))
+        self.lle.store_hash(v, '01' * 240)
+        c = self.m.conn
+        c.execute('DROP TABLE coarse_hashes')
+        c.execute('DROP TABLE hash_sequences')
+        c.execute('PRAGMA user_version = {}'.format(
+            len(SCHEMA_MIGRATIONS) - 2))
+        v.hash_values['LLE16x16PointHash-coarse'] = Hash(
+            'LLE16x16PointHash-coarse', 12345)
+        self.m.video_dao.add_video_hashes(v)
+        self.m.close()
+
+        self.m = VideoDataManager(os.path.join(self.tempdir, 'test.db'))
+        hdao = self.m.hash_dao
+        self.assertEqual(hdao.get_coarse_hashes('LLE16x16PointHash'),
+                         {v.id: '12345'})
+        self.assertEqual(list(hdao.get_video_hashes(v.id)),
+                         ['LLE16x16PointHash'])
+        self.assertIsNone(self.m.conn.execute('''
+            SELECT id FROM hash_methods
+            WHERE name = 'LLE16x16PointHash-coarse'
+            ''').fetchone())
+        return
+
+    ############################################################################
+    def test_search_matches_exhaustive(self):
+        hashes = self.make_catalog()
+        cascade = CascadeSearch(LLE16x16PointHash, self.m, radius=60,
+                                coarse_radius=64)
+        self.assertEqual(cascade.load(), len(hashes))
+        for video_id, (h, c) in list(hashes.items())[:10]:
+            exhaustive = cascade.exhaustive(h)
+            self.assertEqual(cascade.search(h, c), exhaustive)
+            self.assertIn((video_id, 0), exhaustive)
+            self.assertEqual(exhaustive,
+                             sorted(((n, popcount(h ^ o[0]))
+                                     for n, o in hashes.items()
+                                     if popcount(h ^ o[0]) <= 60),
+                                    key=lambda m: (m[1], m[0])))
+
+        # a tight coarse radius only ever drops matches
+        cascade.coarse_radius = 2
+        for video_id, (h, c) in hashes.items():
+            found = cascade.search(h, c)
+            self.assertTrue(set(found) <= set(cascade.exhaustive(h)))
+            self.assertEqual(len(cascade.survivors(c)),
+                             sum(1 for o in hashes.values()
+                                 if popcount(c ^ o[1]) <= 2))
+        return
+
+    ############################################################################
+    def test_recall_report(self):
+        self.make_catalog()
+        cascade = CascadeSearch(LLE16x16PointHash, self.m, radius=80)
+        self.assertEqual(cascade.calibrate(1.0), cascade.coarse_radius)
+        # every pair of the calibration sets is kept
+        coarse, fine, _ = cascade._set_pairs(True)
+        self.assertEqual(len(fine), 7 * 6)
+        self.assertTrue(np.all(coarse <= cascade.coarse_radius))
+
+        # the report only counts the 8 sets with an odd id
+        report = cascade.recall_report()
+        self.assertTrue(report['held_out'])
+        self.assertEqual(report['set_pairs'], 8 * 6)
+        self.assertEqual(report['exhaustive_pairs'], 8 * 6)
+        self.assertLess(report['candidate_fraction'], 0.5)
+
+        # a radius given rather than calibrated is measured on every set
+        cascade = CascadeSearch(LLE16x16PointHash, self.m, radius=80,
+                                coarse_radius=64)
+        report = cascade.recall_report()
+        self.assertFalse(report['held_out'])
+        self.assertEqual(report['set_pairs'], 15 * 6)
+        self.assertEqual(report['recall_loss'], 0.0)
+
+        cascade.coarse_radius = 0
+        report = cascade.recall_report()
+        self.assertLess(report['recall'], 1.0)
+        self.assertAlmostEqual(report['recall_loss'], 1 - report['recall'])
+        self.assertEqual(report['cascade_pairs'],
+                         round(report['recall'] * report['exhaustive_pairs']))
+        return
@@ -0,0 +1,145 @@
+import unittest
+import tempfile
+import shutil
+import os
+import random
+import numpy as np
+from perceptual_hashing.catalog import VideoCatalog
+from perceptual_hashing.accuracy import CatalogAccuracy, VectorAccuracy
+from perceptual_hashing.snapshot import HashSnapshot, export_snapshot
+from perceptual_hashing.video_hashing import PHash
+from perceptual_hashing.llehash import LLE16x16PointHash
+from perceptual_hashing.data_manager import (VideoDataManager, Video,
+                                             VideoSet, Hash)
+from perceptual_hashing.video_hamming_distance import popcount
+
+
+################################################################################
+class testcase(unittest.TestCase):
+    ############################################################################
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.m = VideoDataManager(os.path.join(self.tempdir, 'test.db'))
+        return
+
+    ############################################################################
+    def tearDown(self):
+        self.m.close()
+        shutil.rmtree(self.tempdir)
+        return
+
+    ############################################################################
+    def make_catalog(self, n_sets=6, per_set=4, loose=3):
+        rnd = random.Random(11)
+        ph = PHash(self.tempdir, self.m)
+        lle = LLE16x16PointHash(self.tempdir, self.m)
+        self.phashes = {}
+        with self.m.batch() as batch:
+            for s in range(n_sets):
+                anchor = Video('set{}_0'.format(s), 'mp4')
+                for n in range(per_set):
+                    batch.add_to_set(Video('set{}_{}'.format(s, n), 'mp4'),
+                                     anchor)
+            for n in range(loose):
+                batch.add_video(Video('loose{}'.format(n), 'mkv'))
+        for v in self.m.video_dao.all_videos():
+            center = hash(v.name.split('_')[0]) & (2**64 - 1)
+            h = center ^ rnd.getrandbits(64) & rnd.getrandbits(64) \
+                & rnd.getrandbits(64)
+            ph.store_hash(v, h)
+            self.phashes[v.id] = h
+            # only some videos have the LLE hash
+            if v.id % 2 == 0:
+                lle.store_hash(v, format(rnd.getrandbits(480), '0480b'))
+        return
+
+    ############################################################################
+    def test_video_hash_and_set_videos(self):
+        v = Video('a', 'mp4', video_id=1)
+        s = set([v])
+        h = hash(v)
+        v.hash_values['phash-summary'] = Hash('phash-summary', 1)
+        self.assertEqual(hash(v), h)
+        self.assertIn(v, s)
+        hash(Video('b', 'mp4'))
+
+        video_set = VideoSet(1, set([v]))
+        self.assertIs(video_set.videos, video_set.videos)
+        self.assertIsInstance(video_set.videos, frozenset)
+        self.assertEqual(VideoSet(2).videos, frozenset())
+        return
+
+    ############################################################################
+    def test_catalog_from_manager(self):
+        self.make_catalog()
+        catalog = VideoCatalog.from_manager(
+            self.m, ['phash-summary', 'LLE16x16PointHash'])
+        videos = self.m.video_dao.all_videos()
+        self.assertEqual(len(catalog), len(videos))
+        self.assertEqual(catalog.ids.tolist(), sorted(v.id for v in videos))
+        self.assertEqual(catalog.n_sets, 6)
+        sets = self.m.videoset_dao.get_video_all_sets()
+        self.assertEqual(
+            sorted(sorted(catalog.ids[catalog.members(n)].tolist())
+                   for n in range(catalog.n_sets)),
+            sorted(sorted(v.id for v in s.videos) for s in sets))
+        self.assertEqual(int(np.count_nonzero(catalog.set_labels < 0)), 3)
+
+        self.assertTrue(catalog.hashed('phash-summary').all())
+        hashed = catalog.hashed('LLE16x16PointHash')
+        self.assertEqual(catalog.ids[hashed].tolist(),
+                         [n for n in catalog.ids.tolist() if n % 2 == 0])
+        self.assertEqual(catalog.words('LLE16x16PointHash').shape,
+                         (len(catalog), 8))
+
+        ordinals = catalog.ordinals([videos[3].id, videos[0].id])
+        self.assertEqual(catalog.video(ordinals[0]).name, videos[3].name)
+        d = catalog.distances('phash-summary', ordinals[:1], ordinals[1:])
+        self.assertEqual(d.tolist(), [popcount(self.phashes[videos[3].id] ^
+                                               self.phashes[videos[0].id])])
+        d = catalog.distances_from('phash-summary', self.phashes[videos[0].id])
+        self.assertEqual(d[ordinals[1]], 0)
+        d = catalog.distances_from('LLE16x16PointHash', 0)
+        self.assertTrue((d[~hashed] == -1).all())
+        self.assertRaises(RuntimeError, catalog.ordinals, [10**6])
+        self.assertRaises(RuntimeError, catalog.words, 'nope')
+        return
+
+    ############################################################################
+    def test_catalog_from_snapshot(self):
+        self.make_catalog()
+        path = os.path.join(self.tempdir, 'catalog.snap')
+        export_snapshot(self.m, path)
+        a = VideoCatalog.from_snapshot(HashSnapshot(path))
+        b = VideoCatalog.from_manager(
+            self.m, ['phash-summary', 'LLE16x16PointHash'])
+        self.assertEqual(a.ids.tolist(), b.ids.tolist())
+        self.assertEqual(a.names, b.names)
+        self.assertEqual(a.set_members.tolist(), b.set_members.tolist())
+        for method in b.methods:
+            self.assertEqual(a.hashed(method).tolist(),
+                             b.hashed(method).tolist())
+            self.assertTrue(np.array_equal(a.words(method), b.words(method)))
+        # a method every video has is used straight from the memory map
+        self.assertIsInstance(a.words('phash-summary'), np.memmap)
+        return
+
+    ############################################################################
+    def test_vector_accuracy(self):
+        self.make_catalog()
+        videos = self.m.video_dao.all_videos(['phash-summary'])
+        sets = self.m.videoset_dao.get_video_all_sets(['phash-summary'])
+        calc = CatalogAccuracy(PHash, videos, sets)
+        calc.calculate_distances()
+
+        catalog = VideoCatalog.from_manager(self.m, ['phash-summary'])
+        vector = VectorAccuracy(PHash, catalog)
+        vector.block_words = 5
+        self.assertEqual(vector.best_accuracy(), calc.best_accuracy())
+        for threshold in (1, 10, 30, 63):
+            self.assertEqual(vector.accuracy(threshold),
+                             calc.accuracy(threshold))
+        tp, tn, fp, fn = vector.accuracy(64)[1:]
+        self.assertEqual(tp + fn, 6 * 6)
+        self.assertEqual(tn + fp, 15 * 16)
+        return
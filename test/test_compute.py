@@ -0,0 +1,148 @@
+import unittest
+import tempfile
+import shutil
+import os
+from unittest import mock
+import numpy as np
+from perceptual_hashing.llehash import LLE16x16PointHash
+from perceptual_hashing.video_hashing import PHash
+from perceptual_hashing import dct_hash
+
+
+################################################################################
+def shaded_frames(n):
+    # frame k is a uniform frame of shade 20 + k
+    for k in range(n):
+        yield np.full((16, 16, 3), 20 + k, dtype=np.uint8)
+    return
+
+
+################################################################################
+class testcase(unittest.TestCase):
+    ############################################################################
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.cwd = os.getcwd()
+        os.chdir(self.tempdir)
+        self.selected = []
+        return
+
+    ############################################################################
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.tempdir)
+        return
+
+    ############################################################################
+    def make_lle(self):
+        lle = LLE16x16PointHash(None)
+
+        def hash_decoded(filepath, decoded, n_wanted):
+            self.assertIsNone(filepath)
+            shades = [int(frame.mean()) for frame in decoded]
+            self.selected.append(shades)
+            return format(sum(shades), '0480b')
+
+        lle._lle_hash_decoded = hash_decoded
+        # the coarse hash is not computed for frames that are not stored
+        lle.coarse_hash = None
+        return lle
+
+    ############################################################################
+    def test_compute(self):
+        lle = self.make_lle()
+        self.assertEqual(lle.wanted_frames(40),
+                         {2, 6, 10, 14, 18, 22, 26, 30})
+        self.assertEqual(lle.compute(list(shaded_frames(40))),
+                         sum(20 + n for n in range(2, 31, 4)))
+        self.assertEqual(self.selected, [[22, 26, 30, 34, 38, 42, 46, 50]])
+
+        # a stream of frames is read up to the last wanted frame only
+        frames = shaded_frames(40)
+        self.assertEqual(lle.compute(frames, 40), 288)
+        self.assertEqual(next(frames).mean(), 20 + 31)
+        with self.assertRaises(RuntimeError):
+            lle.compute(shaded_frames(40))
+
+        # videos are hashed one at a time as they are produced
+        videos = (shaded_frames(n) for n in [40, 80])
+        results = lle.compute_many(videos, [40, 80])
+        self.assertEqual(next(results), 288)
+        self.assertEqual(len(self.selected), 3)
+        self.assertEqual(next(results), sum(20 + n for n in range(4, 68, 9)))
+
+        with self.assertRaises(RuntimeError):
+            lle.compute(list(shaded_frames(5)))
+
+        # no database and no debug images were written
+        self.assertEqual(os.listdir(self.tempdir), [])
+        return
+
+    ############################################################################
+    def test_compute_from_bytes(self):
+        lle = self.make_lle()
+        closed = []
+
+        def decode_bytes(buf):
+            self.assertEqual(buf, b'video')
+            try:
+                yield from shaded_frames(1000)
+            finally:
+                closed.append(True)
+            return
+
+        info = {'r_frame_rate': '10/1', 'duration': '4.0'}
+        with mock.patch('perceptual_hashing.llehash.probe_bytes',
+                        return_value=info), \
+                mock.patch('perceptual_hashing.llehash.decode_bytes',
+                           decode_bytes):
+            self.assertEqual(list(lle.compute_many_from_bytes([b'video'])),
+                             [288])
+        # the decoder is stopped after the last wanted frame
+        self.assertEqual(closed, [True])
+        self.assertEqual(os.listdir(self.tempdir), [])
+        return
+
+    ############################################################################
+    def test_phash_from_bytes(self):
+        ph = PHash(None)
+        # three ten second shots of a dark, a mid and a bright texture,
+        # sampled twice a second
+        rng = np.random.RandomState(0)
+        shots = [rng.randint(low, low + 50, (48, 64)).astype(np.uint8)
+                 for low in (0, 100, 200)]
+        frames = [shot for shot in shots for _ in range(20)]
+        summary = ph.compute(iter(frames))
+        self.assertEqual(len(ph.compute_sequence(frames)), 3)
+        filters = []
+
+        def probe_video(filepath, buf, count_frames=False):
+            self.assertEqual((filepath, buf), ('pipe:0', b'video'))
+            # no frame count in the header, so the frames are counted
+            if not count_frames:
+                return {'r_frame_rate': '25/1'}
+            return {'r_frame_rate': '25/1', 'nb_read_frames': '780'}
+
+        def decode_frames(filepath, buf, vf, gray):
+            self.assertEqual((filepath, buf, gray), ('pipe:0', b'video', True))
+            filters.append(vf)
+            if len(filters) == 1:
+                # a sample more than the 780 frames hold
+                yield from frames + frames[:1]
+                return
+            for k in [1, 21, 41]:
+                yield dct_hash.shrink(frames[k])
+            return
+
+        with mock.patch('perceptual_hashing.video_hashing.probe_video',
+                        probe_video), \
+                mock.patch('perceptual_hashing.video_hashing.decode_frames',
+                           decode_frames):
+            self.assertEqual(ph.compute_from_bytes(b'video'), summary)
+        self.assertEqual(filters, [r'select=not(mod(n\,13))',
+                                   r'select=eq(n\,13)+eq(n\,273)+eq(n\,533),'
+                                   'scale=32:32:flags=bicubic'])
+        with self.assertRaises(RuntimeError):
+            ph.compute([])
+        self.assertEqual(os.listdir(self.tempdir), [])
+        return
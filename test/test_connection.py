@@ -0,0 +1,108 @@
+import unittest
+import tempfile
+import shutil
+import os
+import threading
+import multiprocessing
+from perceptual_hashing.connection import ConnectionManager
+from perceptual_hashing.data_manager import VideoDataManager, Video, Hash
+from perceptual_hashing.data_manager import SCHEMA_MIGRATIONS
+
+
+################################################################################
+def add_videos_with(m, worker, n):
+    for k in range(n):
+        v = Video('video{}_{}'.format(worker, k), 'mp4')
+        v.hash_values['FOOMETHOD'] = Hash('FOOMETHOD', k)
+        m.video_dao.add_video(v)
+    return
+
+
+################################################################################
+def add_videos(path, worker, n):
+    m = VideoDataManager(path, timeout=0.01, retries=50)
+    add_videos_with(m, worker, n)
+    m.close()
+    return
+
+
+################################################################################
+class testcase(unittest.TestCase):
+    ############################################################################
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tempdir, 'test.db')
+        return
+
+    ############################################################################
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+        return
+
+    ############################################################################
+    def test_pragmas(self):
+        cm = ConnectionManager(self.path, pragmas=[('journal_mode', 'WAL'),
+                                                   ('synchronous', 'OFF'),
+                                                   ('cache_size', -1024)])
+        self.assertEqual(cm.pragma('journal_mode'), 'wal')
+        self.assertEqual(cm.pragma('synchronous'), 0)
+        self.assertEqual(cm.pragma('cache_size'), -1024)
+        cm.close_all()
+
+    ############################################################################
+    def test_migrations(self):
+        m = VideoDataManager(self.path)
+        self.assertEqual(m.conn.pragma('user_version'),
+                         len(SCHEMA_MIGRATIONS))
+        indexes = set(r[0] for r in m.conn.execute('''
+            SELECT name FROM sqlite_master WHERE type = 'index'
+            ''').fetchall())
+        self.assertIn('video_set_memberships_video', indexes)
+        self.assertIn('computed_hashes_method_video', indexes)
+        self.assertIn('video_distances_method', indexes)
+
+        self.assertEqual(m.conn.migrate(SCHEMA_MIGRATIONS + [[
+            'CREATE TABLE extra (id INTEGER)']]), len(SCHEMA_MIGRATIONS) + 1)
+        m.close()
+
+    ############################################################################
+    def test_connection_per_thread(self):
+        cm = ConnectionManager(self.path)
+        connections = []
+        t = threading.Thread(target=lambda: connections.append(cm.connection))
+        t.start()
+        t.join()
+        self.assertIs(cm.connection, cm.connection)
+        self.assertIsNot(cm.connection, connections[0])
+        cm.close_all()
+
+    ############################################################################
+    def test_concurrent_threads(self):
+        m = VideoDataManager(self.path)
+        threads = [threading.Thread(target=add_videos_with,
+                                    args=(m, n, 25))
+                   for n in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(len(m.video_dao.all_videos()), 100)
+        m.close()
+
+    ############################################################################
+    def test_concurrent_processes(self):
+        VideoDataManager(self.path).close()
+        workers = [multiprocessing.Process(target=add_videos,
+                                           args=(self.path, n, 25))
+                   for n in range(4)]
+        for w in workers:
+            w.start()
+        for w in workers:
+            w.join()
+            self.assertEqual(w.exitcode, 0)
+
+        m = VideoDataManager(self.path)
+        videos = m.video_dao.all_videos()
+        self.assertEqual(len(videos), 100)
+        self.assertTrue(all('FOOMETHOD' in v.hash_values for v in videos))
+        m.close()
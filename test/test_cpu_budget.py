@@ -0,0 +1,87 @@
+import unittest
+import tempfile
+import shutil
+import os
+import io
+from unittest import mock
+from perceptual_hashing import cpu_budget
+from perceptual_hashing.cpu_budget import (CpuBudget, current_budget, splits,
+                                           benchmark)
+from perceptual_hashing.video_preprocessing import VideoTranscoder
+from perceptual_hashing.data_manager import VideoDataManager
+
+
+################################################################################
+class testcase(unittest.TestCase):
+    ############################################################################
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.environ = dict(os.environ)
+        return
+
+    ############################################################################
+    def tearDown(self):
+        os.environ.clear()
+        os.environ.update(self.environ)
+        # the BLAS pools of the process outlive the test
+        if (cpu_budget._current is not None
+                and cpu_budget._current.thread_limits is not None):
+            cpu_budget._current.thread_limits.restore_original_limits()
+        cpu_budget._current = None
+        shutil.rmtree(self.tempdir)
+        return
+
+    ############################################################################
+    def test_share(self):
+        budget = CpuBudget(8, range(8))
+        shares = [budget.share(n, 3) for n in range(1, 4)]
+        self.assertEqual([s.cores for s in shares], [3, 3, 2])
+        self.assertEqual([s.cpus for s in shares],
+                         [[0, 1, 2], [3, 4, 5], [6, 7]])
+
+        # more workers than cores get one core each, on shared cpus
+        shares = [CpuBudget(2, [4, 5]).share(n, 3) for n in range(1, 4)]
+        self.assertEqual([s.cores for s in shares], [1, 1, 1])
+        self.assertEqual([s.cpus for s in shares], [[4], [5], [4]])
+
+        with self.assertRaises(RuntimeError):
+            budget.share(4, 3)
+        self.assertEqual(budget.threads_for(3), 2)
+        self.assertEqual(budget.threads_for(16), 1)
+        self.assertEqual(splits(12), [(1, 12), (2, 6), (3, 4), (4, 3),
+                                      (6, 2), (12, 1)])
+        return
+
+    ############################################################################
+    def test_apply(self):
+        self.assertEqual(current_budget().cpus, cpu_budget.available_cpus())
+        budget = CpuBudget(3).apply()
+        self.assertIs(current_budget(), budget)
+        if cpu_budget.threadpool_limits is not None:
+            self.assertIsNotNone(budget.thread_limits)
+        self.assertEqual(os.environ['OMP_NUM_THREADS'], '3')
+        self.assertEqual(os.environ['OPENBLAS_NUM_THREADS'], '3')
+
+        m = VideoDataManager(os.path.join(self.tempdir, 'test.db'))
+        transcoder = VideoTranscoder(self.tempdir, m, processes=2)
+        self.assertEqual(transcoder.cores, 3)
+        self.assertEqual(transcoder.threads_per_job, 1)
+        m.close()
+
+        # without threadpoolctl the pools numpy started are left as they are
+        stream = io.StringIO()
+        with mock.patch.object(cpu_budget, 'threadpool_limits', None):
+            self.assertTrue(cpu_budget.warn_if_uncapped(stream))
+        self.assertIn('threadpoolctl', stream.getvalue())
+        if cpu_budget.threadpool_limits is not None:
+            self.assertFalse(cpu_budget.warn_if_uncapped(stream))
+        return
+
+    ############################################################################
+    def test_benchmark(self):
+        results = benchmark(CpuBudget(2), tasks=2, points=40,
+                            candidates=[(1, 2), (2, 1)])
+        self.assertEqual(sorted((w, t) for w, t, _ in results),
+                         [(1, 2), (2, 1)])
+        self.assertLessEqual(results[0][2], results[1][2])
+        return
@@ -1,8 +1,9 @@
 import unittest
 import tempfile
 import os
+from unittest import mock
 from perceptual_hashing.data_manager import VideoDataManager, Video, Hash
-from perceptual_hashing.data_manager import VideoDistance
+from perceptual_hashing.data_manager import VideoDistance, WriteBatch
 
 
 class testcase(unittest.TestCase):
@@ -135,3 +136,163 @@ class testcase(unittest.TestCase):
 
         self.assertEqual(q1, vd1)
         self.assertEqual(q2, vd2)
+
+    def count_queries(self, m, fn):
+        queries = []
+        m.conn.set_trace_callback(queries.append)
+        try:
+            result = fn()
+        finally:
+            m.conn.set_trace_callback(None)
+        return (result, len(queries))
+
+    def test_bulk_loaders(self):
+        m = VideoDataManager(self.tempdir + '/testdata.db')
+        vdao = m.video_dao
+        setdao = m.videoset_dao
+        for n in range(20):
+            v = vdao.add_video(Video('video{}'.format(n), 'mp4'))
+            v.hash_values['FOOMETHOD'] = Hash('FOOMETHOD', n)
+            v.hash_values['BARMETHOD'] = Hash('BARMETHOD', n * 2)
+            v = vdao.add_video_hashes(v)
+            if n % 4 != 3:
+                s = setdao.add_video_to_set(v, None if n % 4 == 0 else s)
+        setdao.create_video_set()
+
+        videos, n_queries = self.count_queries(m, vdao.all_videos)
+        self.assertEqual(n_queries, 1)
+        self.assertEqual(len(videos), 20)
+        self.assertListEqual(videos, [vdao.video_by_id(v.id) for v in videos])
+
+        sets, n_queries = self.count_queries(m, setdao.get_video_all_sets)
+        self.assertLessEqual(n_queries, 2)
+        self.assertEqual(len(sets), 6)
+        self.assertListEqual([len(s.videos) for s in sets],
+                             [3, 3, 3, 3, 3, 0])
+        for s in sets:
+            self.assertEqual(s, setdao.get_video_set_by_id(s.id))
+
+        videos = vdao.all_videos(['FOOMETHOD'])
+        self.assertEqual(len(videos), 20)
+        for v in videos:
+            self.assertListEqual(list(v.hash_values), ['FOOMETHOD'])
+
+        sets = setdao.get_video_all_sets(['BARMETHOD'])
+        for s in sets:
+            for v in s.videos:
+                self.assertListEqual(list(v.hash_values), ['BARMETHOD'])
+
+    def test_session_identity_map(self):
+        m = VideoDataManager(self.tempdir + '/testdata.db')
+        vdao = m.video_dao
+        self.assertIs(m.video_dao, vdao)
+
+        v = vdao.add_video(Video('foobar', 'baz'))
+        self.assertIs(vdao.video_by_id(v.id), v)
+        self.assertIs(vdao.video_by_name_and_format('foobar', 'baz'), v)
+        self.assertIs(vdao.all_videos()[0], v)
+
+        _, n_queries = self.count_queries(m, lambda: vdao.video_by_id(v.id))
+        self.assertEqual(n_queries, 0)
+        _, n_queries = self.count_queries(
+            m, lambda: m.hash_dao.get_hash_method_by_name('FOOMETHOD'))
+        self.assertGreater(n_queries, 0)
+        _, n_queries = self.count_queries(
+            m, lambda: m.hash_dao.get_hash_method_by_name('FOOMETHOD'))
+        self.assertEqual(n_queries, 0)
+
+    def test_session_write_through(self):
+        m = VideoDataManager(self.tempdir + '/testdata.db')
+        vdao = m.video_dao
+        v = vdao.add_video(Video('foobar', 'baz'))
+        m.hash_dao.get_hash_method_by_name('FOOMETHOD')
+
+        def store(value):
+            v.hash_values['FOOMETHOD'] = Hash('FOOMETHOD', value)
+            return vdao.add_video_hashes(v)
+
+        _, n_queries = self.count_queries(m, lambda: store(1))
+        self.assertLessEqual(n_queries, 3)
+        self.assertEqual(vdao.video_by_id(v.id).hash_values['FOOMETHOD'],
+                         Hash('FOOMETHOD', '1'))
+
+        store(2)
+        m.expire_all()
+        fresh = vdao.video_by_id(v.id)
+        self.assertIsNot(fresh, v)
+        self.assertEqual(fresh.hash_values['FOOMETHOD'],
+                         Hash('FOOMETHOD', '2'))
+
+        s = m.videoset_dao.add_video_to_set(fresh)
+        _, n_queries = self.count_queries(
+            m, lambda: m.videoset_dao.get_video_set(fresh))
+        self.assertEqual(n_queries, 0)
+        self.assertEqual(m.videoset_dao.get_video_set(fresh), s)
+
+    def test_write_batch(self):
+        m = VideoDataManager(self.tempdir + '/testdata.db')
+        vdao = m.video_dao
+        existing = vdao.add_video(Video('existing', 'mp4'))
+
+        with m.batch() as batch:
+            self.assertIs(m.current_batch, batch)
+            with m.batch() as inner:
+                self.assertIs(inner, batch)
+            for n in range(10):
+                v = Video('video{}'.format(n), 'mp4')
+                batch.add_hash(v, 'FOOMETHOD', n)
+                batch.add_to_set(v, existing)
+            batch.add_hash(existing, 'FOOMETHOD', 99)
+            self.assertIsNone(vdao.video_by_name_and_format('video0', 'mp4'))
+            statements = []
+            m.conn.set_trace_callback(statements.append)
+            batch.flush()
+            m.conn.set_trace_callback(None)
+            self.assertEqual(statements.count('COMMIT'), 1)
+
+            batch.add_hash(existing, 'FOOMETHOD', 100)
+            batch.add_to_set(Video('other', 'avi'), Video('other', 'mp4'))
+        self.assertIsNone(m.current_batch)
+
+        videos = vdao.all_videos()
+        self.assertEqual(len(videos), 13)
+        v = vdao.video_by_name_and_format('video3', 'mp4')
+        self.assertEqual(v.hash_values['FOOMETHOD'], Hash('FOOMETHOD', '3'))
+        self.assertEqual(vdao.video_by_id(existing.id)
+                         .hash_values['FOOMETHOD'], Hash('FOOMETHOD', '100'))
+
+        s = m.videoset_dao.get_video_set(existing)
+        self.assertEqual(len(s.videos), 11)
+        s = m.videoset_dao.get_video_set(
+            vdao.video_by_name_and_format('other', 'avi'))
+        self.assertEqual(sorted(v.format for v in s.videos), ['avi', 'mp4'])
+
+    def test_write_batch_failure(self):
+        m = VideoDataManager(self.tempdir + '/testdata.db')
+        v = Video('video', 'mp4')
+        batch = m.batch()
+        batch.add_hash(v, 'NEWMETHOD', 1)
+        batch.add_to_set(v, Video('other', 'mp4'))
+        with mock.patch.object(WriteBatch, '_write_memberships',
+                               side_effect=RuntimeError('disk full')):
+            with self.assertRaises(RuntimeError):
+                batch.flush()
+        self.assertEqual(m.video_dao.all_videos(), [])
+
+        # the method id inserted by the failed flush was rolled back too
+        with m.batch() as batch:
+            batch.add_hash(v, 'NEWMETHOD', 2)
+        v = m.video_dao.video_by_name_and_format('video', 'mp4')
+        self.assertEqual(v.hash_values['NEWMETHOD'].value, '2')
+
+    def test_rollback_expires_method_ids(self):
+        m = VideoDataManager(self.tempdir + '/testdata.db')
+        hdao = m.hash_dao
+        hdao.get_hash_method_by_name('NEWMETHOD', commit=False)
+        m.conn.rollback()
+        hdao.get_hash_method_by_name('OTHERMETHOD')
+        # the id was not handed out again from the session after the rollback
+        method_id = hdao.get_hash_method_by_name('NEWMETHOD')
+        c = m.conn.cursor()
+        c.execute('SELECT name FROM hash_methods WHERE id = ?', [method_id])
+        self.assertEqual(c.fetchone()[0], 'NEWMETHOD')
@@ -0,0 +1,386 @@
+import unittest
+import tempfile
+import shutil
+import subprocess
+import os
+import numpy as np
+from perceptual_hashing import dct_hash
+from perceptual_hashing.video_hashing import PHash
+from perceptual_hashing.data_manager import (VideoDataManager, Video, Hash,
+                                             SCHEMA_MIGRATIONS)
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PHASH = os.path.join(ROOT, 'phash')
+CLIP = os.path.join(ROOT, 'test', 'data', 'shots.mp4')
+
+
+################################################################################
+def shot_frames(lows, length=20, seed=0, shape=(48, 64)):
+    # one shot of length frames for each texture of shades low..low + 50
+    rng = np.random.RandomState(seed)
+    shots = [rng.randint(low, low + 50, shape).astype(np.uint8)
+             for low in lows]
+    return [shot for shot in shots for _ in range(length)]
+
+
+################################################################################
+def phash_runs():
+    # ./phash, ffmpeg and ffprobe are all there to compare with
+    for tool in ['ffmpeg', 'ffprobe']:
+        if shutil.which(tool) is None:
+            return False
+    try:
+        process = subprocess.run([PHASH], stdout=subprocess.PIPE,
+                                 stderr=subprocess.PIPE)
+    except OSError:
+        return False
+    return b'Must specify' in process.stderr
+
+
+# the C of ph_getKeyframesFromVideo, ph_dct_videohash and the CImg they
+# use, line by line with float32 scalars, to check the numpy port against
+
+################################################################################
+def c_histogram(frame):
+    hist = [0] * 64
+    for val in frame.ravel().tolist():
+        hist[63 if val == 255 else val * 64 // 255] += 1
+    return hist
+
+
+################################################################################
+def c_keyframes(frames):
+    f = np.float32
+    nbframes = len(frames)
+    dist = [f(0)] * nbframes
+    prev = [f(0)] * 64
+    for k, frame in enumerate(frames):
+        hist = c_histogram(frame)
+        for x in range(64):
+            d = f(hist[x]) - prev[x]
+            d = d if d >= 0 else -d
+            dist[k] += d
+            prev[x] = f(hist[x])
+
+    bnds = [0] * nbframes
+    bnds[0] = 1
+    k = 1
+    while True:
+        s_begin = k - 10 if k - 10 >= 0 else 0
+        s_end = k + 10 if k + 10 < nbframes else nbframes - 1
+        l_begin = k - 50 if k - 50 >= 0 else 0
+        l_end = k + 50 if k + 50 < nbframes else nbframes - 1
+        sum_global = f(0)
+        for i in range(l_begin, l_end + 1):
+            sum_global += dist[i]
+        ave_global = sum_global / f(l_end - l_begin + 1)
+        dev_global = f(0)
+        for i in range(l_begin, l_end + 1):
+            dev = ave_global - dist[i]
+            dev = dev if dev >= 0 else -1 * dev
+            dev_global += dev
+        dev_global = dev_global / f(l_end - l_begin + 1)
+        t_global = ave_global + 3 * dev_global
+        localmaxpos = s_begin
+        for i in range(s_begin, s_end + 1):
+            localmaxpos = i if dist[i] > dist[localmaxpos] else localmaxpos
+        localmaxpos2 = s_begin
+        localmax2 = f(0)
+        for i in range(s_begin, s_end + 1):
+            if i != localmaxpos:
+                localmaxpos2 = i if dist[i] > localmax2 else localmaxpos2
+                localmax2 = dist[i] if dist[i] > localmax2 else localmax2
+        t_local = 2 * dist[localmaxpos2]
+        thresh = t_global if t_global >= t_local else t_local
+        if dist[k] == dist[localmaxpos] and dist[k] > thresh:
+            bnds[k] = 1
+        else:
+            bnds[k] = 0
+        k += 1
+        if not k < nbframes - 1:
+            break
+    bnds[nbframes - 1] = 1
+
+    start = end = 0
+    while True:
+        while True:
+            end += 1
+            if not (bnds[end] != 1 and end < nbframes):
+                break
+        minpos = start + 1
+        for i in range(start + 1, end):
+            minpos = i if dist[i] < dist[minpos] else minpos
+        bnds[minpos] = 2
+        start = end
+        if not start < nbframes - 1:
+            break
+    return [k for k in range(nbframes) if bnds[k] == 2]
+
+
+################################################################################
+def c_deriche(line):
+    # _cimg_deriche2_apply of one row or column, boundary conditions on
+    a0, a1, a2, a3, b1, b2, coefp, coefn = dct_hash._deriche_coefficients(
+        1.0)
+    f = np.float32
+    N = len(line)
+    Y = [f(0)] * N
+    xp = f(line[0])
+    yb = yp = coefp * xp
+    for m in range(N):
+        xc = f(line[m])
+        yc = Y[m] = a0 * xc + a1 * xp - b1 * yp - b2 * yb
+        xp, yb, yp = xc, yp, yc
+    xn = xa = f(line[N - 1])
+    yn = ya = coefn * xn
+    out = list(line)
+    for n in range(N - 1, -1, -1):
+        xc = f(line[n])
+        yc = a2 * xn + a3 * xa - b1 * yn - b2 * ya
+        xa, xn, ya, yn = xn, xc, yn, yc
+        out[n] = int(Y[n] + yc) & 0xFF
+    return out
+
+
+################################################################################
+def c_frame_hash(frame):
+    f = np.float32
+    img = [list(row) for row in frame.tolist()]
+    img = [c_deriche(row) for row in img]
+    columns = [c_deriche([img[y][x] for y in range(32)]) for x in range(32)]
+    img = [[columns[x][y] for x in range(32)] for y in range(32)]
+
+    c = dct_hash.dct_matrix()
+
+    def product(a, b):
+        res = [[f(0)] * 32 for _ in range(32)]
+        for j in range(32):
+            for i in range(32):
+                val = 0.0
+                for k in range(32):
+                    val += float(f(a[j][k]) * f(b[k][i]))
+                res[j][i] = f(val)
+        return res
+
+    dct = product(product(c.tolist(), img), c.T.tolist())
+    subsec = [dct[y][x] for y in range(1, 9) for x in range(1, 9)]
+    s = sorted(subsec)
+    med = (s[32] + s[31]) / f(2)
+    hash_value = 0
+    for j in range(64):
+        if subsec[j] > med:
+            hash_value |= 1 << j
+    return hash_value
+
+
+################################################################################
+def c_videohash_dist(hash_a, hash_b, threshold):
+    # ph_dct_videohash_dist
+    n1, n2 = len(hash_a), len(hash_b)
+    den = n1 if n1 <= n2 else n2
+    c = [[0] * (n2 + 1) for _ in range(n1 + 1)]
+    for i in range(1, n1 + 1):
+        for j in range(1, n2 + 1):
+            d = bin(hash_a[i - 1] ^ hash_b[j - 1]).count('1')
+            if d <= threshold:
+                c[i][j] = c[i - 1][j - 1] + 1
+            else:
+                c[i][j] = (c[i - 1][j] if c[i - 1][j] >= c[i][j - 1]
+                           else c[i][j - 1])
+    return c[n1][n2] / den
+
+
+################################################################################
+class testcase(unittest.TestCase):
+    ############################################################################
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        return
+
+    ############################################################################
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+        return
+
+    ############################################################################
+    def test_frame_hashes(self):
+        c = dct_hash.dct_matrix()
+        self.assertTrue(np.allclose(c.astype(float) @ c.T,
+                                    np.eye(dct_hash.SIZE), atol=1e-6))
+
+        frames = np.stack([dct_hash.shrink(f) for f in
+                           shot_frames([0, 100, 200], length=1)])
+        self.assertEqual(frames.shape, (3, 32, 32))
+        self.assertEqual(frames.dtype, np.uint8)
+        hashes = dct_hash.frame_hashes(frames)
+        self.assertEqual(len(set(hashes)), 3)
+        self.assertTrue(all(0 <= h < 2 ** 64 for h in hashes))
+
+        # a little noise moves a hash by a few bits at most
+        rng = np.random.RandomState(1)
+        noisy = dct_hash.frame_hashes(np.clip(
+            frames + rng.normal(0, 2, frames.shape), 0, 255).astype(np.uint8))
+        self.assertTrue(all(bin(a ^ b).count('1') < dct_hash.MATCH_THRESHOLD
+                            for a, b in zip(hashes, noisy)))
+
+        self.assertEqual(dct_hash.summary_hash([0b011, 0b110, 0b010]), 0b010)
+        self.assertEqual(dct_hash.parse_sequence(
+            dct_hash.format_sequence(hashes)), hashes)
+        with self.assertRaises(RuntimeError):
+            dct_hash.summary_hash([])
+        return
+
+    ############################################################################
+    def test_histogram(self):
+        # CImg bins value * 64 / 255, with 255 alone in the top bin
+        frame = np.array([[0, 3, 4, 251, 252, 254, 255]], dtype=np.uint8)
+        hist = dct_hash.histogram(frame)
+        self.assertEqual(list(np.nonzero(hist)[0]), [0, 1, 62, 63])
+        self.assertEqual(list(hist[[0, 1, 62, 63]]), [2, 1, 1, 3])
+        self.assertEqual(list(hist), c_histogram(frame))
+        self.assertEqual(list(dct_hash.histogram_distances([hist, hist])),
+                         [7, 0])
+        return
+
+    ############################################################################
+    def test_keyframes(self):
+        frames = shot_frames([0, 100, 200])
+        dist = dct_hash.histogram_distances(
+            [dct_hash.histogram(f) for f in frames])
+        self.assertEqual(dist.dtype, np.float32)
+        self.assertEqual(dct_hash.keyframes(dist), [1, 21, 41])
+        self.assertEqual(dct_hash.keyframes(dist[:2]), [1])
+        self.assertEqual(dct_hash.keyframes(dist[:1]), [])
+        self.assertEqual(dct_hash.keyframes([]), [])
+        return
+
+    ############################################################################
+    def test_same_as_phash_source(self):
+        rng = np.random.RandomState(2)
+        for n in [2, 3, 12, 70, 150, 300]:
+            # shots of a flickering texture, cut to other shades
+            frames = []
+            while len(frames) < n:
+                low = rng.randint(0, 200)
+                shot = rng.randint(low, low + rng.randint(1, 56), (12, 16))
+                for _ in range(rng.randint(1, 40)):
+                    flicker = rng.randint(-1, 2, shot.shape)
+                    frames.append(np.clip(shot + flicker, 0, 255).astype(
+                        np.uint8))
+            frames = frames[:n]
+            dist = dct_hash.histogram_distances(
+                [dct_hash.histogram(f) for f in frames])
+            self.assertEqual(dct_hash.keyframes(dist), c_keyframes(frames))
+
+        frames = [rng.randint(0, 256, (32, 32)),
+                  np.full((32, 32), 255),
+                  np.tile(np.arange(0, 256, 8), (32, 1)),
+                  np.kron(rng.randint(0, 2, (4, 4)) * 255, np.ones((8, 8))),
+                  rng.randint(100, 110, (32, 32))]
+        frames = np.array(frames, dtype=np.uint8)
+        self.assertEqual(dct_hash.frame_hashes(frames),
+                         [c_frame_hash(f) for f in frames])
+        blurred = dct_hash.blur(frames[:1])[0]
+        rows = [c_deriche(row) for row in frames[0].tolist()]
+        self.assertEqual(blurred.tolist(),
+                         np.array([c_deriche(col) for col in
+                                   np.array(rows).T.tolist()]).T.tolist())
+
+        # keyframe hashes near each other, so that some match and some not
+        center = int(rng.randint(0, 2**63))
+        for n in range(20):
+            a, b = [[center ^ sum(1 << int(k) for k in
+                                  rng.permutation(64)[:rng.randint(0, 40)])
+                     for _ in range(rng.randint(1, 8))] for _ in range(2)]
+            for threshold in [dct_hash.MATCH_THRESHOLD, 10]:
+                self.assertEqual(
+                    dct_hash.sequence_similarity(a, b, threshold),
+                    c_videohash_dist(a, b, threshold))
+        return
+
+    ############################################################################
+    @unittest.skipUnless(phash_runs(), './phash, libpHash, ffmpeg or ffprobe '
+                         'missing; the port is checked against the C source '
+                         'by test_same_as_phash_source')
+    def test_same_as_phash(self):
+        # the clip is three shots of ffmpeg test sources; ./phash prints
+        # ph_dct_videohash, the keyframe hash sequence
+        process = subprocess.run([PHASH, CLIP], stdout=subprocess.PIPE,
+                                 check=True)
+        expected = [int(h) for h in process.stdout.split()]
+        self.assertGreater(len(expected), 1)
+        self.assertEqual(PHash(None).keyframe_hashes(CLIP), expected)
+        return
+
+    ############################################################################
+    def test_sequence_similarity(self):
+        a = dct_hash.video_hash(shot_frames([0, 100, 200]))
+        b = dct_hash.video_hash(shot_frames([0, 100, 200], seed=1))
+        self.assertEqual(len(a), 3)
+        self.assertEqual(dct_hash.sequence_similarity(a, a), 1.0)
+        # a clip of the video matches all its own keyframes
+        self.assertEqual(dct_hash.sequence_similarity(a[1:], a), 1.0)
+        # and the order of keyframes counts
+        self.assertLess(dct_hash.sequence_similarity(a[::-1], a), 1.0)
+        self.assertEqual(dct_hash.sequence_similarity([], a), 0.0)
+
+        candidates = [a, b, a[::-1], [], a[:1]]
+        self.assertEqual(dct_hash.match_sequences(a, candidates),
+                         [dct_hash.sequence_similarity(a, c)
+                          for c in candidates])
+        return
+
+    ############################################################################
+    def test_phash_stores_sequence(self):
+        m = VideoDataManager(os.path.join(self.tempdir, 'test.db'))
+        ph = PHash(self.tempdir, m)
+        sequences = {'a.mp4': [0b1111, 0b1110, 0b0111],
+                     'b.mp4': [0b0111, 0b1111]}
+        for name, sequence in sequences.items():
+            ph.keyframe_hashes = lambda f, s=sequence: s
+            v = m.video_dao.add_video(Video(name, 'mp4'))
+            ph.hash_video(name, v)
+
+        a, b = [m.video_dao.video_by_name_and_format(n, 'mp4')
+                for n in ['a.mp4', 'b.mp4']]
+        self.assertEqual(a.hash_values['phash-summary'].value, '15')
+        self.assertEqual(m.hash_dao.get_sequences('phash-summary'),
+                         {v.id: dct_hash.format_sequence(sequences[v.name])
+                          for v in [a, b]})
+        self.assertEqual(ph.sequence(a), sequences['a.mp4'])
+        self.assertEqual(PHash.calculate_distance(a, b).distance, 1)
+        self.assertEqual(ph.sequence_similarity(a, b), 1.0)
+        self.assertEqual(ph.match_sequences(a, [a, b]), [1.0, 1.0])
+
+        # no other method is stored next to the summary
+        self.assertEqual(m.conn.execute('SELECT name FROM hash_methods')
+                         .fetchall(), [('phash-summary',)])
+        c = m.video_dao.add_video(Video('c.mp4', 'mp4'))
+        self.assertRaises(RuntimeError, ph.sequence, c)
+        m.close()
+        return
+
+    ############################################################################
+    def test_old_phash_dropped(self):
+        # a database from before hash_sequences, whose 'phash-video' held
+        # the output of ./phash or the keyframe majority
+        path = os.path.join(self.tempdir, 'test.db')
+        m = VideoDataManager(path)
+        v = m.video_dao.add_video(Video('file', 'mp4'))
+        c = m.conn
+        c.execute('DROP TABLE hash_sequences')
+        c.execute('PRAGMA user_version = {}'.format(
+            len(SCHEMA_MIGRATIONS) - 1))
+        v.hash_values['phash-video'] = Hash('phash-video', 15)
+        v.hash_values['phash-video-sequence'] = Hash('phash-video-sequence',
+                                                     '15,14')
+        m.video_dao.add_video_hashes(v)
+        m.close()
+
+        m = VideoDataManager(path)
+        self.assertEqual(m.hash_dao.get_video_hashes(v.id), {})
+        self.assertEqual(m.conn.execute('SELECT name FROM hash_methods')
+                         .fetchall(), [])
+        self.assertEqual(m.hash_dao.get_sequences('phash-summary'), {})
+        m.close()
+        return
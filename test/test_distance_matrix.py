@@ -0,0 +1,175 @@
+import unittest
+import tempfile
+import shutil
+import os
+import threading
+from perceptual_hashing.distance_matrix import DistanceMatrix
+from perceptual_hashing.data_manager import VideoDataManager, Video
+from perceptual_hashing.data_manager import VideoDistance
+
+
+################################################################################
+class testcase(unittest.TestCase):
+    ############################################################################
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        return
+
+    ############################################################################
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+        return
+
+    ############################################################################
+    def test_offsets_are_condensed(self):
+        offsets = sorted(DistanceMatrix.offset(i, j)
+                         for i in range(10) for j in range(i))
+        self.assertListEqual(offsets, list(range(DistanceMatrix.entries(10))))
+        self.assertEqual(DistanceMatrix.offset(3, 7),
+                         DistanceMatrix.offset(7, 3))
+
+    ############################################################################
+    def test_capacity_for(self):
+        for n in range(2, 200):
+            entries = DistanceMatrix.entries(n)
+            self.assertEqual(DistanceMatrix.capacity_for(entries), n)
+
+    ############################################################################
+    def test_set_get_and_grow(self):
+        path = os.path.join(self.tempdir, 'm.u16')
+        m = DistanceMatrix(path)
+        self.assertIsNone(m[1, 0])
+        m[5, 2] = 17
+        m[2, 0] = 3
+        capacity = m.capacity
+        m[capacity + 10, 1] = 480
+        self.assertGreater(m.capacity, capacity)
+        self.assertEqual(m[2, 5], 17)
+        self.assertEqual(m[0, 2], 3)
+        self.assertEqual(m[1, capacity + 10], 480)
+        self.assertEqual(m[4, 4], 0)
+        self.assertIsNone(m[4, 3])
+        m.flush()
+
+        reopened = DistanceMatrix(path)
+        self.assertEqual(reopened.capacity, m.capacity)
+        self.assertEqual(reopened[5, 2], 17)
+        self.assertListEqual(reopened.row(2).tolist(),
+                             [3, DistanceMatrix.unknown])
+
+    ############################################################################
+    def test_growth(self):
+        m = DistanceMatrix(os.path.join(self.tempdir, 'm.u16'))
+        sizes = []
+        for n in range(1, 2000):
+            m.reserve(n)
+            if m.capacity not in sizes:
+                sizes.append(m.capacity)
+        # the file roughly doubles, the capacity grows by about sqrt(2)
+        for a, b in zip(sizes[1:], sizes[2:]):
+            self.assertLess(DistanceMatrix.entries(b),
+                            2.1 * DistanceMatrix.entries(a))
+        self.assertLess(len(sizes), 12)
+
+    ############################################################################
+    def test_set_row(self):
+        m = DistanceMatrix(os.path.join(self.tempdir, 'm.u16'))
+        m.set_row(3, [0, 2, 5, 100], [7, 8, 9, 10])
+        self.assertEqual([m[3, 0], m[2, 3], m[5, 3], m[3, 100]],
+                         [7, 8, 9, 10])
+        self.assertIsNone(m[3, 1])
+        with self.assertRaises(RuntimeError):
+            m.set_row(3, [1, 3], [1, 1])
+        with self.assertRaises(RuntimeError):
+            m.set_row(3, [1], [DistanceMatrix.unknown])
+
+    ############################################################################
+    def test_row_is_a_view(self):
+        m = DistanceMatrix(os.path.join(self.tempdir, 'm.u16'), 8)
+        row = m.row(4)
+        m[4, 1] = 9
+        self.assertEqual(row[1], 9)
+
+    ############################################################################
+    def test_matrix_distance_store(self):
+        m = VideoDataManager(os.path.join(self.tempdir, 'test.db'),
+                             distance_store='matrix')
+        vdao = m.video_dao
+        ddao = m.distance_dao
+        method_id = m.hash_dao.get_hash_method_by_name('foobar-method')
+
+        v1 = vdao.add_video(Video("foobar", "baz"))
+        v2 = vdao.add_video(Video("foobar", "quux"))
+        v3 = vdao.add_video(Video("baz", "quux"))
+
+        self.assertIsNone(ddao.get_distance(method_id, v1, v2))
+        ddao.ordinal(v1)
+        ddao.ordinal(v2)
+        # reading a method without distances does not create its matrix
+        self.assertIsNone(ddao.get_distance(method_id, v1, v2))
+        self.assertFalse(os.path.exists(os.path.join(self.tempdir,
+                                                     'test.db.distances')))
+        c = m.conn.cursor()
+        c.execute('SELECT COUNT(*) FROM distance_matrices')
+        self.assertEqual(c.fetchone()[0], 0)
+        ddao.add_distances([VideoDistance(v1, v2, method_id, 12),
+                            VideoDistance(v3, v2, method_id, 54)])
+
+        self.assertEqual(ddao.get_distance(method_id, v1, v2),
+                         VideoDistance(v1, v2, method_id, 12))
+        self.assertEqual(ddao.get_distance(method_id, v2, v3).distance, 54)
+        self.assertIsNone(ddao.get_distance(method_id, v1, v3))
+
+        m2 = VideoDataManager(os.path.join(self.tempdir, 'test.db'),
+                              distance_store='matrix')
+        self.assertEqual(m2.distance_dao.get_distance(method_id, v3, v2),
+                         VideoDistance(v3, v2, method_id, 54))
+
+    ############################################################################
+    def test_rollback_forgets_ordinals(self):
+        m = VideoDataManager(os.path.join(self.tempdir, 'test.db'),
+                             distance_store='matrix')
+        v1 = m.video_dao.add_video(Video("foobar", "baz"))
+        v2 = m.video_dao.add_video(Video("foobar", "quux"))
+        ddao = m.distance_dao
+        self.assertEqual(ddao.ordinal(v1), 0)
+        m.conn.rollback()
+        # v1 got no ordinal after all: the next video takes 0
+        self.assertIsNone(ddao.ordinal(v1, create=False))
+        self.assertEqual(ddao.ordinal(v2), 0)
+        self.assertEqual(ddao.ordinal(v1), 1)
+        m.close()
+
+    ############################################################################
+    def test_concurrent_rows(self):
+        m = VideoDataManager(os.path.join(self.tempdir, 'test.db'),
+                             distance_store='matrix')
+        method_id = m.hash_dao.get_hash_method_by_name('foobar-method')
+        videos = [m.video_dao.add_video(Video('v{}'.format(i), 'mp4'))
+                  for i in range(40)]
+        errors = []
+
+        def worker(n):
+            try:
+                ddao = m.distance_dao
+                for i in range(n, len(videos), 4):
+                    ddao.add_row(method_id, videos[i], videos[:i],
+                                 [i] * i)
+            except Exception as err:
+                errors.append(err)
+
+        threads = [threading.Thread(target=worker, args=(n,))
+                   for n in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(errors, [])
+        ddao = m.distance_dao
+        self.assertEqual(len(set(ddao.ordinal(v) for v in videos)), 40)
+        for i in range(1, len(videos)):
+            self.assertEqual(
+                ddao.get_distance(method_id, videos[i], videos[0]).distance,
+                i)
+        self.assertEqual(len(m._matrices), 1)
+        m.close()
@@ -0,0 +1,126 @@
+import unittest
+import tempfile
+import shutil
+import os
+import random
+from unittest import mock
+import numpy as np
+from perceptual_hashing.metric_index import (BKTree, VPTree, MetricIndex,
+                                             build_index)
+from perceptual_hashing.video_hashing import PHash
+from perceptual_hashing.llehash import LLE16x16PointHash
+from perceptual_hashing.data_manager import VideoDataManager, Video
+from perceptual_hashing.video_hamming_distance import popcount
+
+
+################################################################################
+def clustered_hashes(rnd, bits, n_clusters, per_cluster, noise):
+    hashes = []
+    for c in range(n_clusters):
+        center = rnd.getrandbits(bits)
+        for n in range(per_cluster):
+            h = center
+            for k in range(rnd.randrange(noise)):
+                h ^= 1 << rnd.randrange(bits)
+            hashes.append(h)
+    return hashes
+
+
+################################################################################
+class testcase(unittest.TestCase):
+    ############################################################################
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        return
+
+    ############################################################################
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+        return
+
+    ############################################################################
+    def brute_force(self, hashes, h):
+        return sorted(((popcount(h ^ x), n) for n, x in enumerate(hashes)))
+
+    ############################################################################
+    def check_index(self, cls, bits):
+        rnd = random.Random(bits)
+        hashes = clustered_hashes(rnd, bits, 20, 15, bits // 8)
+        index = cls(bits, list(range(len(hashes))), hashes)
+        self.assertEqual(len(index), len(hashes))
+
+        for query in [hashes[5], hashes[100], rnd.getrandbits(bits)]:
+            expected = self.brute_force(hashes, query)
+            for r in [0, bits // 16, bits // 4]:
+                self.assertListEqual(index.radius(query, r),
+                                     [(n, d) for d, n in expected if d <= r])
+            knn = index.knn(query, 10)
+            self.assertListEqual([d for n, d in knn],
+                                 [d for d, n in expected[:10]])
+
+        path = os.path.join(self.tempdir, 'index.npz')
+        index.save(path)
+        loaded = MetricIndex.load(path)
+        self.assertIsInstance(loaded, cls)
+        self.assertEqual(loaded.bits, bits)
+        self.assertListEqual(loaded.knn(hashes[7], 5), index.knn(hashes[7], 5))
+        self.assertListEqual(loaded.radius(hashes[7], bits // 8),
+                             index.radius(hashes[7], bits // 8))
+
+    ############################################################################
+    def test_bktree(self):
+        self.check_index(BKTree, 64)
+
+    ############################################################################
+    def test_vptree(self):
+        self.check_index(VPTree, 480)
+        self.check_index(VPTree, 64)
+        # with small leaves, so the queries walk the tree
+        with mock.patch.object(VPTree, 'leaf_size', 4):
+            self.check_index(VPTree, 480)
+            self.check_index(VPTree, 64)
+
+    ############################################################################
+    def test_vptree_loads_arrays(self):
+        rnd = random.Random(5)
+        hashes = clustered_hashes(rnd, 480, 10, 10, 40)
+        with mock.patch.object(VPTree, 'leaf_size', 4):
+            index = VPTree(480, list(range(100, 200)), hashes)
+        path = os.path.join(self.tempdir, 'index.npz')
+        index.save(path)
+        loaded = MetricIndex.load(path)
+        self.assertIsInstance(loaded.ids, np.ndarray)
+        self.assertIsInstance(loaded.words, np.ndarray)
+        self.assertEqual(loaded.knn(hashes[3], 4), index.knn(hashes[3], 4))
+        self.assertEqual(loaded.knn(hashes[3], 1), [(103, 0)])
+
+    ############################################################################
+    def test_vptree_duplicates(self):
+        for cls in [VPTree, BKTree]:
+            with mock.patch.object(VPTree, 'leaf_size', 4):
+                index = cls(64, list(range(5000)), [7] * 4000 + [6] * 1000)
+            self.assertEqual(len(index.radius(7, 0)), 4000)
+            self.assertEqual(len(index.radius(7, 1)), 5000)
+            self.assertListEqual(index.knn(6, 3), [(4000, 0), (4001, 0),
+                                                   (4002, 0)])
+            path = os.path.join(self.tempdir, 'index.npz')
+            index.save(path)
+            self.assertEqual(len(MetricIndex.load(path).radius(6, 0)), 1000)
+
+    ############################################################################
+    def test_build_index(self):
+        m = VideoDataManager(os.path.join(self.tempdir, 'test.db'))
+        ph = PHash(self.tempdir, m)
+        lle = LLE16x16PointHash(self.tempdir, m)
+        for n in range(10):
+            v = m.video_dao.add_video(Video('file{}'.format(n), 'mp4'))
+            ph.store_hash(v, n)
+            lle.store_hash(v, format(n, '0480b'))
+
+        index = build_index(m, PHash)
+        self.assertIsInstance(index, BKTree)
+        self.assertEqual([d for n, d in index.knn(0, 3)], [0, 1, 1])
+
+        index = build_index(m, LLE16x16PointHash)
+        self.assertIsInstance(index, VPTree)
+        self.assertEqual(len(index.radius(3, 1)), 4)
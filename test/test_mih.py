@@ -0,0 +1,132 @@
+import unittest
+import tempfile
+import os
+import random
+from perceptual_hashing.video_hashing import PHash
+from perceptual_hashing.llehash import LLE16x16PointHash
+from perceptual_hashing.data_manager import VideoDataManager, Video
+from perceptual_hashing.mih import MultiIndexHash
+from perceptual_hashing.snapshot import export_snapshot, import_snapshot
+from perceptual_hashing.video_hamming_distance import popcount
+
+
+################################################################################
+class testcase(unittest.TestCase):
+    ############################################################################
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.m = VideoDataManager(os.path.join(self.tempdir, 'test.db'))
+        return
+
+    ############################################################################
+    def tearDown(self):
+        self.m.close()
+        for f in os.listdir(self.tempdir):
+            os.unlink('{}/{}'.format(self.tempdir, f))
+        os.rmdir(self.tempdir)
+        return
+
+    ############################################################################
+    def store(self, hasher, hashes):
+        videos = []
+        for n, h in enumerate(hashes):
+            v = self.m.video_dao.add_video(Video('file{}'.format(n), 'mp4'))
+            hasher.store_hash(v, h)
+            videos.append(v)
+        return videos
+
+    ############################################################################
+    def brute_force(self, hashes, videos, h, radius):
+        found = [(v.id, popcount(h ^ x)) for v, x in zip(videos, hashes)]
+        return sorted([f for f in found if f[1] <= radius],
+                      key=lambda m: (m[1], m[0]))
+
+    ############################################################################
+    def test_substrings(self):
+        index = MultiIndexHash(self.m, PHash, n_substrings=3)
+        self.assertEqual(index._widths, [22, 21, 21])
+        h = random.Random(1).getrandbits(64)
+        parts = index.substrings(h)
+        joined = (parts[0] << 42) | (parts[1] << 21) | parts[2]
+        self.assertEqual(joined, h)
+        self.assertEqual(len(MultiIndexHash.neighbours(0, 16, 2)),
+                         1 + 16 + 120)
+
+    ############################################################################
+    def test_radius_search_phash(self):
+        rnd = random.Random(7)
+        base = rnd.getrandbits(64)
+        hashes = [base ^ (1 << rnd.randrange(64)) ^ (1 << rnd.randrange(64))
+                  for n in range(20)]
+        hashes += [rnd.getrandbits(64) for n in range(40)]
+        ph = PHash(self.tempdir, self.m)
+        videos = self.store(ph, hashes)
+
+        index = self.m.hash_index(PHash.hash_type())
+        for radius in [0, 3, 7, 12, 20]:
+            self.assertListEqual(index.search(base, radius),
+                                 self.brute_force(hashes, videos, base,
+                                                  radius))
+
+    ############################################################################
+    def test_radius_search_lle_batched(self):
+        rnd = random.Random(3)
+        base = rnd.getrandbits(480)
+        hashes = [base ^ rnd.getrandbits(480) & rnd.getrandbits(480)
+                  & rnd.getrandbits(480) & rnd.getrandbits(480)
+                  for n in range(30)]
+        lle = LLE16x16PointHash(self.tempdir, self.m)
+        videos = [self.m.video_dao.add_video(Video('f{}'.format(n), 'mp4'))
+                  for n in range(len(hashes))]
+        with self.m.batch():
+            for v, h in zip(videos, hashes):
+                lle.store_hash(v, format(h, '0480b'))
+
+        index = self.m.hash_index(LLE16x16PointHash.hash_type())
+        self.assertEqual(index.search(base, 60),
+                         self.brute_force(hashes, videos, base, 60))
+
+    ############################################################################
+    def test_delete_and_rebuild(self):
+        ph = PHash(self.tempdir, self.m)
+        videos = self.store(ph, [1, 3, 7, 2 ** 64 - 1])
+        index = self.m.hash_index(PHash.hash_type())
+        self.assertEqual([v for v, d in index.search(1, 2)],
+                         [videos[0].id, videos[1].id, videos[2].id])
+
+        self.m.video_dao.delete_video(videos[1])
+        self.assertEqual([v for v, d in index.search(1, 2)],
+                         [videos[0].id, videos[2].id])
+        n_rows = self.m.conn.execute(
+            'SELECT COUNT(*) FROM mih_substrings').fetchone()[0]
+        self.assertEqual(n_rows, 3 * index.n_substrings)
+
+        self.m.conn.execute('DELETE FROM mih_substrings')
+        self.m.conn.commit()
+        self.assertEqual(index.search(1, 2), [])
+        self.assertEqual(index.rebuild(), 3)
+        self.assertEqual(len(index.search(1, 2)), 2)
+
+    ############################################################################
+    def test_indexed_without_hasher(self):
+        # written by a batch and a snapshot import, no hasher constructed
+        hashes = [1, 3, 7, 2 ** 64 - 1]
+        videos = [self.m.video_dao.add_video(Video('f{}'.format(n), 'mp4'))
+                  for n in range(len(hashes))]
+        with self.m.batch() as batch:
+            for v, h in zip(videos, hashes):
+                batch.add_hash(v, PHash.hash_type(), h)
+            batch.add_hash(videos[0], 'some-method', 5)
+        index = self.m.hash_index(PHash.hash_type())
+        self.assertEqual(index.search(1, 2),
+                         self.brute_force(hashes, videos, 1, 2))
+        self.assertIsNone(self.m.hash_index('some-method'))
+
+        path = os.path.join(self.tempdir, 'hashes.snap')
+        export_snapshot(self.m, path, [PHash.hash_type()])
+        m2 = VideoDataManager(os.path.join(self.tempdir, 'imported.db'))
+        import_snapshot(m2, path)
+        found = m2.hash_index(PHash.hash_type()).search(1, 2)
+        self.assertEqual(sorted(m2.video_dao.video_by_id(v).name
+                                for v, d in found), ['f0', 'f1', 'f2'])
+        m2.close()
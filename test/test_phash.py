@@ -3,6 +3,7 @@ import tempfile
 import os
 from perceptual_hashing.video_hashing import PHash, VideoHasher
 from perceptual_hashing.data_manager import VideoDataManager, Video, Hash
+from perceptual_hashing.util import content_digest
 
 
 ################################################################################
@@ -28,7 +29,7 @@ class testcase(unittest.TestCase):
     def test_video_hasher(self):
         m = VideoDataManager(os.path.join(self.tempdir, 'test.db'))
         ph = PHash(self.tempdir, m)
-        ph._run_phash = lambda f: 123456789
+        ph.keyframe_hashes = lambda f: [123456789]
 
         for n in range(10):
             filename = 'file{}'.format(n)
@@ -48,6 +49,71 @@ class testcase(unittest.TestCase):
             self.assertEqual(len(v.hash_values), 1)
             self.assertIn(ph.hash_type(), v.hash_values)
             self.assertEqual(v.hash_values[ph.hash_type()],
-                             Hash('phash-video', '123456789', 1))
+                             Hash('phash-summary', '123456789', 1))
+            self.assertEqual(ph.sequence(v), [123456789])
 
         return
+
+    ############################################################################
+    def test_content_digest(self):
+        def write(name, data):
+            path = os.path.join(self.tempdir, name)
+            with open(path, 'wb') as fd:
+                fd.write(data)
+            return content_digest(path, chunk_size=16, n_chunks=4)
+
+        data = bytes(range(256)) * 4
+        self.assertEqual(write('a.mp4', data), write('b.mkv', data))
+        self.assertNotEqual(write('c.mp4', data[:-1] + b'x'),
+                            write('a.mp4', data))
+        self.assertNotEqual(write('c.mp4', b'x' + data[1:]),
+                            write('a.mp4', data))
+        self.assertNotEqual(write('c.mp4', data + b'\0'),
+                            write('a.mp4', data))
+        # small files are digested whole
+        self.assertNotEqual(write('d.mp4', b'ab'), write('e.mp4', b'ac'))
+        return
+
+    ############################################################################
+    def test_reuse_by_digest(self):
+        m = VideoDataManager(os.path.join(self.tempdir, 'test.db'))
+        hashed = []
+
+        def make_hasher(force=False):
+            ph = PHash(self.tempdir, m, force)
+            ph.keyframe_hashes = lambda f: (hashed.append(f) or
+                                            [1000 + len(hashed)])
+            return ph
+
+        def add_file(n, content):
+            with open(os.path.join(self.tempdir, 'file{}.mp4'.format(n)),
+                      'w') as fd:
+                fd.write(content)
+            m.video_dao.add_video(Video('file{}'.format(n), 'mp4'))
+            return
+
+        for n in range(4):
+            add_file(n, 'same bytes' if n < 3 else 'other bytes')
+        make_hasher().run()
+        self.assertEqual(len(hashed), 2)
+        values = {v.name: v.hash_values['phash-summary'].value
+                  for v in m.video_dao.all_videos()}
+        self.assertEqual(values['file0'], values['file1'])
+        self.assertEqual(values['file0'], values['file2'])
+        self.assertNotEqual(values['file0'], values['file3'])
+
+        # a renamed copy is found through the database
+        add_file(4, 'other bytes')
+        make_hasher().run()
+        self.assertEqual(len(hashed), 2)
+        v = m.video_dao.video_by_name_and_format('file4', 'mp4')
+        self.assertEqual(v.hash_values['phash-summary'].value, values['file3'])
+        self.assertEqual(m.video_dao.get_digest(v),
+                         content_digest(os.path.join(self.tempdir,
+                                                     'file4.mp4')))
+
+        make_hasher(force=True).run()
+        self.assertEqual(len(hashed), 2 + 5)
+        m.close()
+        return
+
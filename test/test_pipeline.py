@@ -0,0 +1,97 @@
+import unittest
+import tempfile
+import shutil
+import os
+from unittest import mock
+from perceptual_hashing.pipeline import PipelineRunner
+from perceptual_hashing.video_hashing import PHash
+from perceptual_hashing.video_preprocessing import VideoTranscoder
+from perceptual_hashing.data_manager import VideoDataManager
+
+
+################################################################################
+def fake_transcode(self, cmd):
+    for path in cmd.output_paths:
+        with open(path, 'w') as fd:
+            fd.write(os.path.basename(path))
+    return
+
+
+################################################################################
+def fake_phash(self, filepath):
+    # variants of one source are close, different sources are far apart
+    name = os.path.basename(filepath)
+    source = int(name[len('clip')])
+    return [(0xff << (8 * source)) ^ (1 if '_' in name else 0)]
+
+
+################################################################################
+class testcase(unittest.TestCase):
+    ############################################################################
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.m = VideoDataManager(os.path.join(self.tempdir, 'test.db'))
+        self.path = os.path.join(self.tempdir, 'videos')
+        os.mkdir(self.path)
+        for n in range(3):
+            with open(os.path.join(self.path, 'clip{}.mp4'.format(n)),
+                      'w') as fd:
+                fd.write('source {}'.format(n))
+        patches = [
+            mock.patch.object(VideoTranscoder, 'is_video',
+                              lambda self, path: path.endswith('.mp4')),
+            mock.patch.object(VideoTranscoder, '_run_job', fake_transcode),
+            mock.patch.object(PHash, 'keyframe_hashes', fake_phash),
+        ]
+        for p in patches:
+            p.start()
+            self.addCleanup(p.stop)
+        return
+
+    ############################################################################
+    def tearDown(self):
+        self.m.close()
+        shutil.rmtree(self.tempdir)
+        return
+
+    ############################################################################
+    def test_pipeline(self):
+        runner = PipelineRunner(self.path, [PHash], self.m, transcode_jobs=2)
+        results = runner.run()
+        self.assertEqual(results, {'phash-summary': 1.0})
+        self.assertEqual(sorted(runner.timings),
+                         ['accuracy', 'distances', 'first distance',
+                          'first hash', 'hash', 'transcode'])
+        self.assertLess(runner.timings['first hash'],
+                        runner.timings['transcode'])
+        self.assertLess(runner.timings['first distance'],
+                        runner.timings['distances'])
+
+        videos = self.m.video_dao.all_videos()
+        self.assertEqual(len(videos), 15)
+        for v in videos:
+            self.assertIn('phash-summary', v.hash_values)
+        ddao = self.m.distance_dao
+        method = self.m.hash_dao.get_hash_method_by_name('phash-summary')
+        for n, a in enumerate(videos):
+            for b in videos[n + 1:]:
+                self.assertEqual(ddao.get_distance(method, a, b).distance,
+                                 PHash.calculate_distance(a, b).distance)
+
+        # a second run has nothing left to do
+        with mock.patch.object(PHash, 'keyframe_hashes') as run_phash:
+            self.assertEqual(runner.run(), {'phash-summary': mock.ANY})
+            run_phash.assert_not_called()
+        return
+
+    ############################################################################
+    def test_stage_failure(self):
+        def fail(self, filepath):
+            raise RuntimeError('phash crashed')
+
+        with mock.patch.object(PHash, 'keyframe_hashes', fail):
+            runner = PipelineRunner(self.path, [PHash], self.m)
+            with self.assertRaises(RuntimeError):
+                runner.run()
+        self.assertEqual([name for name, err in runner.errors], ['hash'])
+        return
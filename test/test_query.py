@@ -0,0 +1,96 @@
+import unittest
+import tempfile
+import shutil
+import os
+from perceptual_hashing.query import VideoQuery
+from perceptual_hashing.metric_index import BKTree
+from perceptual_hashing.video_hashing import PHash
+from perceptual_hashing.data_manager import VideoDataManager, Video
+from perceptual_hashing.util import threshold_radius
+
+
+################################################################################
+class testcase(unittest.TestCase):
+    ############################################################################
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.m = VideoDataManager(os.path.join(self.tempdir, 'test.db'))
+        for n, h in enumerate([0, 0b1, 0b111, 0xffff, 2**64 - 1]):
+            v = self.m.video_dao.add_video(Video('file{}'.format(n), 'mp4'))
+            PHash(self.tempdir, self.m).store_hash(v, h)
+        return
+
+    ############################################################################
+    def tearDown(self):
+        self.m.close()
+        shutil.rmtree(self.tempdir)
+        return
+
+    ############################################################################
+    def make_query(self, h, index=None):
+        query = VideoQuery(PHash, self.m, index)
+        query._hasher.keyframe_hashes = lambda f: [h]
+        return query
+
+    ############################################################################
+    def test_query_ranked(self):
+        query = self.make_query(0b11)
+        result = query.query(os.path.join(self.tempdir, 'new.mp4'), k=3)
+        self.assertEqual([(m.video.name, m.distance) for m in result.matches],
+                         [('file1', 1), ('file2', 1), ('file0', 2)])
+        self.assertEqual(result.matches[0].relative, 1 / 64)
+        # no threshold has been learned yet
+        self.assertIsNone(result.matches[0].is_match)
+        self.assertEqual(list(result.timings),
+                         ['index', 'hash', 'search', 'fetch'])
+        self.assertAlmostEqual(result.latency, sum(result.timings.values()))
+
+        # the query file is not registered
+        self.assertIsNone(self.m.video_dao.video_by_name_and_format('new',
+                                                                    'mp4'))
+        self.assertEqual(len(self.m.video_dao.all_videos()), 5)
+
+        # the index is built once
+        result = query.query(os.path.join(self.tempdir, 'new.mp4'), k=3)
+        self.assertNotIn('index', result.timings)
+        return
+
+    ############################################################################
+    def test_query_threshold(self):
+        hdao = self.m.hash_dao
+        hdao.set_method_accuracy(hdao.get_hash_method_by_name('phash-summary'),
+                                 {'accuracy': 0.9, 'threshold': 2 / 64,
+                                  'true_positives': 1, 'true_negatives': 1,
+                                  'false_positives': 0,
+                                  'false_negatives': 0})
+        query = self.make_query(0b11)
+        result = query.query('new.mp4', k=5)
+        self.assertEqual([m.is_match for m in result.matches],
+                         [True, True, False, False, False])
+
+        result = query.query('new.mp4', k=5, within_threshold=True)
+        self.assertEqual(sorted(m.video.name for m in result.matches),
+                         ['file1', 'file2'])
+        return
+
+    ############################################################################
+    def test_threshold_radius(self):
+        # relative distances under the threshold, despite float error
+        self.assertEqual(threshold_radius(0.35, 20), 6)
+        self.assertEqual(threshold_radius(0.1 * 3, 10), 2)
+        self.assertEqual(threshold_radius(0.3, 480), 143)
+        self.assertEqual(threshold_radius(2 / 64, 64), 1)
+        self.assertEqual(threshold_radius(0.301, 10), 3)
+        return
+
+    ############################################################################
+    def test_query_saved_index(self):
+        path = os.path.join(self.tempdir, 'phash.idx')
+        BKTree(64, [1, 2], [0, 2**64 - 1]).save(path)
+        query = self.make_query(2**64 - 2)
+        query.load_index(path)
+        result = query.query('new.mp4', k=1)
+        self.assertEqual([(m.video.id, m.distance) for m in result.matches],
+                         [(2, 1)])
+        self.assertNotIn('index', result.timings)
+        return
@@ -0,0 +1,130 @@
+import unittest
+import tempfile
+import shutil
+import threading
+import time
+import os
+from perceptual_hashing.service import HashService, HashServer, ServiceClient
+from perceptual_hashing.video_hashing import PHash
+from perceptual_hashing.data_manager import VideoDataManager, Video
+
+
+################################################################################
+class testcase(unittest.TestCase):
+    ############################################################################
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.m = VideoDataManager(os.path.join(self.tempdir, 'test.db'))
+        for n, h in enumerate([0, 0b1, 0b111, 0xffff]):
+            v = self.m.video_dao.add_video(Video('file{}'.format(n), 'mp4'))
+            PHash(self.tempdir, self.m).store_hash(v, h)
+        self.hashed = []
+        self.gate = threading.Event()
+        self.gate.set()
+        self.services = []
+        return
+
+    ############################################################################
+    def tearDown(self):
+        self.gate.set()
+        for service in self.services:
+            service.close()
+        self.m.close()
+        shutil.rmtree(self.tempdir)
+        return
+
+    ############################################################################
+    def fake_phash(self, filepath):
+        self.gate.wait()
+        self.hashed.append(filepath)
+        if 'missing' in filepath:
+            raise RuntimeError('No output from phash: on {}'.format(filepath))
+        return [0b11]
+
+    ############################################################################
+    def make_service(self, **kwargs):
+        service = HashService([PHash], self.m, **kwargs)
+        hasher = service._queries['phash-summary']._hasher
+        hasher.keyframe_hashes = self.fake_phash
+        self.services.append(service)
+        return service
+
+    ############################################################################
+    def test_socket(self):
+        service = self.make_service(workers=2)
+        path = os.path.join(self.tempdir, 'hash.sock')
+        server = HashServer(path, service)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.start()
+        try:
+            client = ServiceClient(path, timeout=10)
+            self.assertEqual(client.call('ping'),
+                             {'ok': True, 'id': 1,
+                              'methods': ['phash-summary']})
+
+            response = client.call('hash', path='new.mp4')
+            self.assertTrue(response['ok'])
+            self.assertEqual(response['value'], '3')
+
+            response = client.call('lookup', path='new.mp4', k=2)
+            self.assertEqual(response['id'], 3)
+            self.assertEqual([(m['name'], m['distance'])
+                              for m in response['matches']],
+                             [('file1', 1), ('file2', 1)])
+            self.assertEqual(list(response['timings']),
+                             ['hash', 'search', 'fetch'])
+
+            response = client.call('hash', path='missing.mp4')
+            self.assertFalse(response['ok'])
+            self.assertFalse(response['retry'])
+            self.assertFalse(client.call('hash', path='x.mp4',
+                                         method='nope')['ok'])
+            self.assertFalse(client.call('transcode', path='x.mp4')['ok'])
+
+            client.send(['not', 'a', 'request'])
+            self.assertFalse(client.receive()['ok'])
+            client.close()
+
+            # nothing was registered
+            self.assertEqual(len(self.m.video_dao.all_videos()), 4)
+        finally:
+            server.shutdown()
+            server.server_close()
+            thread.join()
+        self.assertFalse(os.path.exists(path))
+        return
+
+    ############################################################################
+    def test_batching(self):
+        service = self.make_service(workers=2)
+        service.batch_window = 0.5
+        futures = [service.submit({'op': op, 'path': 'same.mp4', 'id': n})
+                   for n, op in enumerate(['hash', 'lookup', 'hash'])]
+        responses = [f.result(10) for f in futures]
+        self.assertEqual([r['id'] for r in responses], [0, 1, 2])
+        self.assertTrue(all(r['ok'] for r in responses))
+        # the three requests for one file were hashed once
+        self.assertEqual(self.hashed, ['same.mp4'])
+        self.assertEqual(service.stats['batches'], 1)
+        return
+
+    ############################################################################
+    def test_back_pressure(self):
+        service = self.make_service(workers=1, max_pending=2, batch_size=1)
+        self.gate.clear()
+        futures = [service.submit({'op': 'hash', 'path': '{}.mp4'.format(n)})
+                   for n in range(8)]
+        # the worker is blocked: two requests are in hand at most, two queued
+        time.sleep(0.2)
+        futures += [service.submit({'op': 'hash', 'path': 'late.mp4'})]
+        busy = [f.result(0) for f in futures if f.done()]
+        self.assertGreaterEqual(len(busy), 4)
+        self.assertTrue(all(r['error'] == 'busy' and r['retry']
+                            for r in busy))
+
+        self.gate.set()
+        responses = [f.result(10) for f in futures]
+        served = [r for r in responses if r['ok']]
+        self.assertEqual(len(served) + service.stats['rejected'], 9)
+        self.assertLessEqual(len(served), 5)
+        return
@@ -0,0 +1,110 @@
+import unittest
+import tempfile
+import shutil
+import os
+from perceptual_hashing.shards import ShardMerge, read_shard
+from perceptual_hashing.data_manager import VideoDataManager, Video
+
+
+################################################################################
+class testcase(unittest.TestCase):
+    ############################################################################
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.managers = []
+        self.shards = []
+        # shard 0 knows a.mp4 -> a_1, shard 1 knows a.mp4 -> a_2 and its
+        # own set b, in a different id order
+        self.make_shard([('a', 'mp4', 'a'), ('a_1', 'mkv', 'a'),
+                         ('loose', 'avi', None)],
+                        {('a', 'mp4'): '11', ('a_1', 'mkv'): '12',
+                         ('loose', 'avi'): '13'})
+        self.make_shard([('b', 'mp4', 'b'), ('a_2', 'wmv', 'a'),
+                         ('b_1', 'mkv', 'b'), ('a', 'mp4', 'a')],
+                        {('a_2', 'wmv'): '21', ('b', 'mp4'): '22',
+                         ('loose', 'avi'): '23'})
+        return
+
+    ############################################################################
+    def tearDown(self):
+        for m in self.managers:
+            m.close()
+        shutil.rmtree(self.tempdir)
+        return
+
+    ############################################################################
+    def manager(self, name):
+        m = VideoDataManager(os.path.join(self.tempdir, name))
+        self.managers.append(m)
+        return m
+
+    ############################################################################
+    def make_shard(self, videos, hashes):
+        name = 'shard{}.db'.format(len(self.shards))
+        m = self.manager(name)
+        with m.batch() as batch:
+            for video, fmt, anchor in videos:
+                if anchor is None:
+                    batch.add_video(Video(video, fmt))
+                else:
+                    batch.add_to_set(Video(video, fmt), Video(anchor, 'mp4'))
+            for (video, fmt), value in hashes.items():
+                batch.add_hash(Video(video, fmt), 'phash-summary', value,
+                               sequence='{0},{0}'.format(value))
+        self.shards.append(os.path.join(self.tempdir, name))
+        return
+
+    ############################################################################
+    def contents(self, path):
+        videos, hashes, _, _, sets = read_shard(path)
+        return (sorted(videos), hashes, sorted(sorted(s) for s in sets))
+
+    ############################################################################
+    def test_merge(self):
+        target = self.manager('merged.db')
+        merge = ShardMerge(target)
+        self.assertEqual(merge.merge(self.shards), 6)
+        # loose.avi was hashed in both shards with different values
+        self.assertEqual(merge.conflicts, 1)
+
+        videos, hashes, sets = self.contents(target.path)
+        self.assertEqual(videos, [('a', 'mp4'), ('a_1', 'mkv'),
+                                  ('a_2', 'wmv'), ('b', 'mp4'),
+                                  ('b_1', 'mkv'), ('loose', 'avi')])
+        self.assertEqual(hashes[('a', 'mp4', 'phash-summary')], '11')
+        self.assertEqual(hashes[('a_2', 'wmv', 'phash-summary')], '21')
+        self.assertEqual(hashes[('loose', 'avi', 'phash-summary')], '23')
+        self.assertEqual(sets, [[('a', 'mp4'), ('a_1', 'mkv'), ('a_2', 'wmv')],
+                                [('b', 'mp4'), ('b_1', 'mkv')]])
+        a = target.video_dao.video_by_name_and_format('a_2', 'wmv')
+        self.assertEqual(a.hash_values['phash-summary'].value, '21')
+        self.assertEqual(target.hash_dao.get_sequences('phash-summary',
+                                                       [a.id]),
+                         {a.id: '21,21'})
+        return
+
+    ############################################################################
+    def test_deterministic(self):
+        first = self.manager('first.db')
+        second = self.manager('second.db')
+        ShardMerge(first).merge(self.shards)
+        ShardMerge(second).merge(self.shards)
+        self.assertEqual(first.video_dao.video_table(),
+                         second.video_dao.video_table())
+
+        # merging again, or into a target that has the rows, changes nothing
+        ShardMerge(first).merge(self.shards)
+        self.assertEqual(first.video_dao.video_table(),
+                         second.video_dao.video_table())
+        return
+
+    ############################################################################
+    def test_bad_shard(self):
+        target = self.manager('merged.db')
+        with open(os.path.join(self.tempdir, 'junk.db'), 'w') as fd:
+            fd.write('')
+        with self.assertRaises(RuntimeError):
+            ShardMerge(target).merge(self.shards +
+                                     [os.path.join(self.tempdir, 'junk.db')])
+        self.assertEqual(target.video_dao.video_table(), [])
+        return
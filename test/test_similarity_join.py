@@ -0,0 +1,223 @@
+import unittest
+import tempfile
+import shutil
+import os
+import random
+from perceptual_hashing.similarity_join import (SimilarityJoin, UnionFind,
+                                                partition_masks)
+from perceptual_hashing.video_hashing import PHash
+from perceptual_hashing.llehash import LLE16x16PointHash
+from perceptual_hashing.data_manager import VideoDataManager, Video
+from perceptual_hashing.video_hamming_distance import popcount
+from perceptual_hashing.util import words_to_ints
+from perceptual_hashing.catalog import VideoCatalog
+
+
+################################################################################
+def clustered_hashes(rnd, bits, n_clusters, per_cluster, noise):
+    hashes = []
+    for c in range(n_clusters):
+        center = rnd.getrandbits(bits)
+        for n in range(per_cluster):
+            h = center
+            for k in range(rnd.randrange(noise)):
+                h ^= 1 << rnd.randrange(bits)
+            hashes.append(h)
+    return hashes
+
+
+################################################################################
+class testcase(unittest.TestCase):
+    ############################################################################
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.m = VideoDataManager(os.path.join(self.tempdir, 'test.db'))
+        return
+
+    ############################################################################
+    def tearDown(self):
+        self.m.close()
+        shutil.rmtree(self.tempdir)
+        return
+
+    ############################################################################
+    def store(self, methodcls, hashes):
+        hasher = methodcls(self.tempdir, self.m)
+        ids = []
+        with self.m.batch():
+            for n, h in enumerate(hashes):
+                v = Video('file{}'.format(n), 'mp4')
+                if methodcls is LLE16x16PointHash:
+                    h = format(h, '0480b')
+                hasher.store_hash(v, h)
+        for n in range(len(hashes)):
+            ids.append(self.m.video_dao.video_by_name_and_format(
+                'file{}'.format(n), 'mp4').id)
+        return ids
+
+    ############################################################################
+    def brute_force(self, ids, hashes, radius):
+        found = set()
+        for n in range(len(hashes)):
+            for k in range(n + 1, len(hashes)):
+                d = popcount(hashes[n] ^ hashes[k])
+                if d <= radius:
+                    found.add((min(ids[n], ids[k]), max(ids[n], ids[k]), d))
+        return found
+
+    ############################################################################
+    def test_union_find(self):
+        uf = UnionFind(6)
+        self.assertTrue(uf.union(0, 1))
+        self.assertTrue(uf.union(3, 4))
+        self.assertTrue(uf.union(1, 4))
+        self.assertFalse(uf.union(0, 3))
+        self.assertEqual(sorted(sorted(g) for g in uf.groups()),
+                         [[0, 1, 3, 4], [2], [5]])
+        return
+
+    ############################################################################
+    def test_partition_masks(self):
+        masks = words_to_ints(partition_masks(480, 7))
+        self.assertEqual(sum(masks), 2**480 - 1)
+        self.assertEqual([popcount(m) for m in masks],
+                         [69, 69, 69, 69, 68, 68, 68])
+        return
+
+    ############################################################################
+    def check_pairs(self, methodcls, bits, radius, processes=1,
+                    n_substrings=()):
+        rnd = random.Random(bits + radius)
+        hashes = clustered_hashes(rnd, bits, 20, 6, radius + 4)
+        # exact duplicates must be joined too
+        hashes.extend(hashes[:5])
+        ids = self.store(methodcls, hashes)
+
+        expected = self.brute_force(ids, hashes, radius)
+        for m in list(n_substrings) + [0]:
+            join = SimilarityJoin(methodcls, self.m, radius, processes)
+            join.task_pairs = 7
+            join.block_words = 40
+            join.use_substrings = lambda n, m=m: m != 0
+            if m:
+                join.n_substrings = lambda n, m=m: m
+            pairs = list(join.pairs())
+            self.assertEqual(join.partitioned, m != 0)
+            self.assertEqual(len(pairs), len(set(pairs)))
+            found = set((min(a, b), max(a, b), d) for a, b, d in pairs)
+            self.assertEqual(found, expected)
+        return
+
+    ############################################################################
+    def test_use_substrings(self):
+        join = SimilarityJoin(PHash, self.m, 3)
+        self.assertTrue(join.use_substrings(100000))
+        self.assertEqual(join.n_substrings(100000), 4)
+        # fewer, wider substrings than radius + 1, probed within 2 bits
+        join = SimilarityJoin(PHash, self.m, 9)
+        self.assertEqual(join.n_substrings(1000000), 4)
+        self.assertTrue(join.use_substrings(1000000))
+        join = SimilarityJoin(PHash, self.m, 19)
+        self.assertFalse(join.use_substrings(1000))
+        join = SimilarityJoin(LLE16x16PointHash, self.m, 12)
+        self.assertTrue(join.use_substrings(100000))
+        join = SimilarityJoin(LLE16x16PointHash, self.m, 143)
+        self.assertFalse(join.use_substrings(100000))
+        return
+
+    ############################################################################
+    def test_pairs_phash(self):
+        self.check_pairs(PHash, 64, 5, n_substrings=(6, 3, 2))
+        return
+
+    ############################################################################
+    def test_pairs_lle(self):
+        self.check_pairs(LLE16x16PointHash, 480, 12, n_substrings=(13, 6))
+        return
+
+    ############################################################################
+    def test_pairs_processes(self):
+        self.check_pairs(PHash, 64, 3, processes=2, n_substrings=(4, 2))
+        return
+
+    ############################################################################
+    def test_default_radius(self):
+        hdao = self.m.hash_dao
+        hdao.set_method_accuracy(hdao.get_hash_method_by_name('phash-summary'),
+                                 {'accuracy': 0.9, 'threshold': 20 / 64,
+                                  'true_positives': 1, 'true_negatives': 1,
+                                  'false_positives': 0,
+                                  'false_negatives': 0})
+        join = SimilarityJoin(PHash, self.m)
+        self.assertEqual(join.radius, 19)
+        # a large catalog is joined on 4 substrings of 16 bits, probed
+        # within 4 bits, instead of 20 of 3 bits
+        self.assertEqual(join.n_substrings(1000000), 4)
+        self.assertTrue(join.use_substrings(1000000))
+
+        rnd = random.Random(19)
+        hashes = clustered_hashes(rnd, 64, 10, 6, 20)
+        ids = self.store(PHash, hashes)
+        # joined as a large catalog would be
+        join.use_substrings = lambda n: True
+        join.n_substrings = lambda n: 4
+        pairs = list(join.pairs())
+        self.assertTrue(join.partitioned)
+        self.assertEqual(len(pairs), len(set(pairs)))
+        self.assertEqual(set((min(a, b), max(a, b), d) for a, b, d in pairs),
+                         self.brute_force(ids, hashes, 19))
+        return
+
+    ############################################################################
+    def test_clusters_written_back(self):
+        hashes = [0, 0b1, 0b11, 0xff00, 0xff01, 2**64 - 1]
+        ids = self.store(PHash, hashes)
+        join = SimilarityJoin(PHash, self.m, 1, processes=1)
+        clusters = join.run()
+        self.assertEqual(sorted(clusters), [ids[0:3], ids[3:5]])
+        self.assertEqual(join.n_pairs, 3)
+
+        cdao = self.m.cluster_dao
+        method_id = self.m.hash_dao.get_hash_method_by_name('phash-summary')
+        stored = cdao.get_clusters(method_id)
+        self.assertEqual(sorted(sorted(v.id for v in c.videos)
+                                for c in stored), [ids[0:3], ids[3:5]])
+        video = self.m.video_dao.video_by_id(ids[4])
+        self.assertEqual(set(v.id for v in
+                             cdao.get_cluster_by_video_id(method_id,
+                                                          video).videos),
+                         set(ids[3:5]))
+        self.assertIsNone(cdao.get_cluster_by_video_id(
+            method_id, self.m.video_dao.video_by_id(ids[5])))
+
+        # a new join replaces the previous clusters
+        SimilarityJoin(PHash, self.m, 2, processes=1).run()
+        self.assertEqual(sorted(cdao.get_cluster_members(method_id).values(),
+                                key=min),
+                         [set(ids[0:3]), set(ids[3:5])])
+        return
+
+    ############################################################################
+    def test_radius_from_threshold(self):
+        hdao = self.m.hash_dao
+        join = SimilarityJoin(PHash, self.m)
+        self.assertRaises(RuntimeError, lambda: join.radius)
+        hdao.set_method_accuracy(hdao.get_hash_method_by_name('phash-summary'),
+                                 {'accuracy': 0.9, 'threshold': 4 / 64,
+                                  'true_positives': 1, 'true_negatives': 1,
+                                  'false_positives': 0,
+                                  'false_negatives': 0})
+        self.assertEqual(SimilarityJoin(PHash, self.m).radius, 3)
+        return
+
+    ############################################################################
+    def test_pairs_from_catalog(self):
+        rnd = random.Random(9)
+        hashes = clustered_hashes(rnd, 64, 10, 5, 6)
+        ids = self.store(PHash, hashes)
+        catalog = VideoCatalog.from_manager(self.m, ['phash-summary'])
+        join = SimilarityJoin(PHash, self.m, 4, 1, catalog)
+        self.assertEqual(set((min(a, b), max(a, b), d)
+                             for a, b, d in join.pairs()),
+                         self.brute_force(ids, hashes, 4))
+        return
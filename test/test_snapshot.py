@@ -0,0 +1,175 @@
+import unittest
+import tempfile
+import shutil
+import os
+import random
+import numpy as np
+from perceptual_hashing.snapshot import (HashSnapshot, export_snapshot,
+                                         import_snapshot, method_format)
+from perceptual_hashing.metric_index import build_index
+from perceptual_hashing.catalog import VideoCatalog
+from perceptual_hashing.video_hashing import PHash
+from perceptual_hashing.llehash import LLE16x16PointHash
+from perceptual_hashing.data_manager import VideoDataManager, Video
+
+
+################################################################################
+class testcase(unittest.TestCase):
+    ############################################################################
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.m = VideoDataManager(os.path.join(self.tempdir, 'test.db'))
+        self.path = os.path.join(self.tempdir, 'catalog.snap')
+        return
+
+    ############################################################################
+    def tearDown(self):
+        self.m.close()
+        shutil.rmtree(self.tempdir)
+        return
+
+    ############################################################################
+    def make_catalog(self):
+        rnd = random.Random(5)
+        ph = PHash(self.tempdir, self.m)
+        lle = LLE16x16PointHash(self.tempdir, self.m)
+        self.phashes = {}
+        self.lhashes = {}
+        self.coarse = {}
+        with self.m.batch() as batch:
+            for s in range(4):
+                anchor = Video('set{}_0'.format(s), 'mp4')
+                for n in range(3):
+                    v = Video('set{}_{}'.format(s, n), 'mp4')
+                    batch.add_to_set(v, anchor)
+            for n in range(3):
+                batch.add_video(Video('loose{}'.format(n), 'mkv'))
+        for v in self.m.video_dao.all_videos():
+            h = rnd.getrandbits(64)
+            ph.store_hash(v, h)
+            self.phashes[(v.name, v.format)] = h
+            if v.format == 'mp4':
+                h = rnd.getrandbits(480)
+                c = rnd.getrandbits(64)
+                lle.store_hash(v, format(h, '0480b'), coarse=c)
+                self.lhashes[(v.name, v.format)] = h
+                self.coarse[(v.name, v.format)] = c
+        hdao = self.m.hash_dao
+        hdao.set_method_accuracy(hdao.get_hash_method_by_name('phash-summary'),
+                                 {'accuracy': 0.75, 'threshold': 0.125,
+                                  'true_positives': 3, 'true_negatives': 3,
+                                  'false_positives': 1,
+                                  'false_negatives': 1})
+        return
+
+    ############################################################################
+    def test_method_format(self):
+        self.assertEqual(method_format('phash-summary'), (64, 'decimal'))
+        self.assertEqual(method_format('LLE16x16PointHash'),
+                         (480, 'bitstring'))
+        self.assertRaises(RuntimeError, method_format, 'nope')
+        return
+
+    ############################################################################
+    def test_export_read(self):
+        self.make_catalog()
+        self.assertEqual(export_snapshot(self.m, self.path), 15)
+
+        snap = HashSnapshot(self.path, verify=True)
+        self.assertEqual(snap.methods, ['phash-summary', 'LLE16x16PointHash'])
+        self.assertEqual(len(snap), 15)
+        names = [snap.video_name(n) for n in range(len(snap))]
+        by_id = {v.id: v for v in self.m.video_dao.all_videos()}
+        self.assertEqual(names, [(by_id[n].name, by_id[n].format)
+                                 for n in snap.video_ids.tolist()])
+        self.assertEqual(int(np.count_nonzero(snap.set_ids >= 0)), 12)
+        self.assertEqual(len(set(snap.set_ids.tolist()) - {-1}), 4)
+
+        self.assertIsInstance(snap.words('phash-summary'), np.memmap)
+        self.assertEqual(snap.words('LLE16x16PointHash').shape, (12, 8))
+        # the coarse hashes travel with their method
+        by_key = {(by_id[n].name, by_id[n].format): c for n, c in
+                  snap.coarse_hashes('LLE16x16PointHash').items()}
+        self.assertEqual(by_key, self.coarse)
+        self.assertEqual(snap.coarse_hashes('phash-summary'), {})
+        for name, expected in (('phash-summary', self.phashes),
+                               ('LLE16x16PointHash', self.lhashes)):
+            found = {(by_id[n].name, by_id[n].format): h
+                     for n, h in snap.hashes(name).items()}
+            self.assertEqual(found, expected)
+        self.assertEqual(snap.method('phash-summary')['accuracy']['accuracy'],
+                         0.75)
+        self.assertRaises(RuntimeError, snap.method, 'nope')
+        return
+
+    ############################################################################
+    def test_checksum_and_header(self):
+        self.make_catalog()
+        export_snapshot(self.m, self.path, ['phash-summary'])
+        with open(self.path, 'r+b') as fd:
+            fd.seek(HashSnapshot.header.size + 3)
+            b = fd.read(1)
+            fd.seek(HashSnapshot.header.size + 3)
+            fd.write(bytes([b[0] ^ 1]))
+        # opening does not read the sections, verifying does
+        snap = HashSnapshot(self.path)
+        self.assertRaises(RuntimeError, snap.verify)
+        self.assertRaises(RuntimeError, HashSnapshot, self.path, True)
+
+        with open(self.path, 'r+b') as fd:
+            fd.write(b'garbage!')
+        self.assertRaises(RuntimeError, HashSnapshot, self.path)
+        return
+
+    ############################################################################
+    def test_import(self):
+        self.make_catalog()
+        export_snapshot(self.m, self.path)
+
+        m2 = VideoDataManager(os.path.join(self.tempdir, 'fresh.db'))
+        self.assertEqual(import_snapshot(m2, self.path), 15)
+        videos = {(v.name, v.format): v for v in m2.video_dao.all_videos()}
+        self.assertEqual(len(videos), 15)
+        for key, h in self.phashes.items():
+            self.assertEqual(videos[key].hash_values['phash-summary'].value,
+                             str(h))
+        for key, h in self.lhashes.items():
+            self.assertEqual(
+                videos[key].hash_values['LLE16x16PointHash'].value,
+                format(h, '0480b'))
+        coarse = m2.hash_dao.get_coarse_hashes('LLE16x16PointHash')
+        self.assertEqual({(videos[key].name, videos[key].format):
+                          int(coarse[videos[key].id]) for key in self.coarse},
+                         self.coarse)
+
+        sets = sorted(sorted(v.name for v in s.videos)
+                      for s in m2.videoset_dao.get_video_all_sets())
+        self.assertEqual(sets, [['set{}_{}'.format(s, n) for n in range(3)]
+                                for s in range(4)])
+        hdao = m2.hash_dao
+        self.assertEqual(hdao.get_method_accuracy(
+            hdao.get_hash_method_by_name('phash-summary'))['threshold'], 0.125)
+
+        # importing again changes nothing
+        import_snapshot(m2, self.path)
+        self.assertEqual(len(m2.video_dao.all_videos()), 15)
+        self.assertEqual(len(m2.videoset_dao.get_video_all_sets()), 4)
+        m2.close()
+        return
+
+    ############################################################################
+    def test_index_from_snapshot(self):
+        self.make_catalog()
+        export_snapshot(self.m, self.path)
+        snap = HashSnapshot(self.path)
+        a = build_index(self.m, PHash, snapshot=snap)
+        b = build_index(self.m, PHash)
+        self.assertEqual(a.ids, b.ids)
+        self.assertEqual(a.hashes, b.hashes)
+
+        catalog = VideoCatalog.from_snapshot(snap)
+        a = build_index(None, PHash, 'vp', catalog=catalog)
+        b = build_index(self.m, PHash, 'vp')
+        self.assertEqual(a.ids.tolist(), b.ids.tolist())
+        self.assertEqual(a.knn(0, 3), b.knn(0, 3))
+        return
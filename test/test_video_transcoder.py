@@ -1,10 +1,30 @@
 import unittest
 import tempfile
 import os
-from perceptual_hashing.video_preprocessing import VideoTranscoder
+import io
+import threading
+import inspect
+import time
+import numpy as np
+from unittest import mock
+from BitVector import BitVector
+from skimage import filters
+from perceptual_hashing.video_preprocessing import (VideoTranscoder,
+                                                    StreamingTranscoder,
+                                                    read_ppm_frames)
+from perceptual_hashing.llehash import LLE16x16PointHash
 from perceptual_hashing.data_manager import VideoDataManager
 
 
+def gaussian(image, sigma, multichannel=False):
+    # the pinned scikit-image takes multichannel, later ones channel_axis
+    if 'multichannel' in inspect.signature(filters.gaussian).parameters:
+        return filters.gaussian(image, sigma=sigma,
+                                multichannel=multichannel)
+    return filters.gaussian(image, sigma=sigma,
+                            channel_axis=-1 if multichannel else None)
+
+
 class testcase(unittest.TestCase):
     def setUp(self):
         self.tempdir = tempfile.mkdtemp()
@@ -65,3 +85,200 @@ class testcase(unittest.TestCase):
         s = m.videoset_dao.get_video_set(v)
         self.assertIsNotNone(s)
         self.assertEqual(len(s.videos), 4)
+
+    def test_video_set_batched(self):
+        m = VideoDataManager(os.path.join(self.tempdir, 'test.db'))
+        vt = VideoTranscoder(self.tempdir, m)
+
+        with m.batch():
+            for fmt in ['avi', 'mpg', 'mov', 'mp4']:
+                cmd = vt._video_encoding_cmd('/some/path/to/foobar.mp4', fmt)
+                if cmd is not None:
+                    cmd.add_input_video()
+                    cmd.add_output_video()
+            self.assertIsNone(
+                vt._video_encoding_cmd('/some/path/to/foobar.mp4', 'avi'))
+            self.assertIsNone(
+                m.video_dao.video_by_name_and_format('foobar', 'mp4'))
+
+        v = m.video_dao.video_by_name_and_format('foobar', 'mp4')
+        self.assertIsNotNone(v)
+
+        s = m.videoset_dao.get_video_set(v)
+        self.assertIsNotNone(s)
+        self.assertEqual(len(s.videos), 4)
+
+    def test_multi_output_cmd(self):
+        m = VideoDataManager(os.path.join(self.tempdir, 'test.db'))
+        vt = VideoTranscoder(self.tempdir, m)
+        cmd = vt._multi_output_cmd('/some/path/to/foobar.mp4', threads=8)
+        self.assertEqual(cmd.cmd,
+                         'ffmpeg -filter_complex ' +
+                         '[0:v]split=4[s0][s1][s2][s3];' +
+                         '[s2]scale=iw*0.9375:ih*0.9375[o2];' +
+                         '[s3]scale=iw*1.0625:ih*1.0625[o3] ' +
+                         '-i /some/path/to/foobar.mp4 ' +
+                         '-map [s0] -threads 2 ' +
+                         '-b:v 8M -maxrate 10M -bufsize 8M -an ' +
+                         '/some/path/to/foobar.avi ' +
+                         '-map [s1] -threads 2 ' +
+                         '-b:v 8M -maxrate 10M -bufsize 8M -an ' +
+                         '/some/path/to/foobar.mpg ' +
+                         '-map [o2] -threads 2 ' +
+                         '-b:v 8M -maxrate 10M -bufsize 8M -an ' +
+                         '/some/path/to/foobar_smaller.mp4 ' +
+                         '-map [o3] -threads 2 ' +
+                         '-b:v 8M -maxrate 10M -bufsize 8M -an ' +
+                         '/some/path/to/foobar_bigger.mp4')
+        cmd.add_input_video()
+        cmd.add_output_video()
+        v = m.video_dao.video_by_name_and_format('foobar', 'mp4')
+        self.assertEqual(len(m.videoset_dao.get_video_set(v).videos), 5)
+        self.assertIsNone(
+            vt._multi_output_cmd('/some/path/to/foobar.mp4', threads=8))
+
+        # only the outputs missing from the database are written
+        m.video_dao.delete_video(
+            m.video_dao.video_by_name_and_format('foobar_smaller', 'mp4'))
+        cmd = vt._multi_output_cmd('/some/path/to/foobar.avi')
+        self.assertEqual(cmd.output_videos, [('foobar_smaller', 'mp4')])
+        self.assertEqual(cmd.cmd,
+                         'ffmpeg -filter_complex [0:v]split=1[s0];' +
+                         '[s0]scale=iw*0.9375:ih*0.9375[o0] ' +
+                         '-i /some/path/to/foobar.avi ' +
+                         '-map [o0] -b:v 8M -maxrate 10M -bufsize 8M -an ' +
+                         '/some/path/to/foobar_smaller.mp4')
+        m.close()
+
+    def test_parallel_jobs(self):
+        m = VideoDataManager(os.path.join(self.tempdir, 'test.db'))
+        vt = VideoTranscoder(self.tempdir, m, processes=2, cores=16)
+        self.assertEqual(vt.threads_per_job, 8)
+        for name in ['one', 'two', 'three']:
+            with open(os.path.join(self.tempdir, name + '.mp4'), 'w') as fd:
+                fd.write('source')
+        vt.is_video = lambda path: path.endswith('.mp4')
+
+        lock = threading.Lock()
+        running = [0, 0]
+
+        def run_job(cmd):
+            # one command per source, its four encoders share 8 threads
+            self.assertEqual(cmd.cmd.count(' -threads 2 '), 4)
+            with lock:
+                running[0] += 1
+                running[1] = max(running)
+            time.sleep(0.01)
+            for path in cmd.output_paths:
+                with open(path, 'w') as fd:
+                    fd.write('partial')
+            with lock:
+                running[0] -= 1
+            if 'two.mp4' in cmd.cmd:
+                raise RuntimeError('ffmpeg failed')
+            return
+
+        vt._run_job = run_job
+        vt.run()
+        self.assertEqual(running[1], 2)
+        self.assertEqual(len(vt.failed), 1)
+        for name in ['two.avi', 'two.mpg', 'two_smaller.mp4',
+                     'two_bigger.mp4']:
+            self.assertFalse(os.path.exists(os.path.join(self.tempdir, name)))
+
+        for name in ['one', 'three']:
+            v = m.video_dao.video_by_name_and_format(name, 'mp4')
+            self.assertEqual(len(m.videoset_dao.get_video_set(v).videos), 5)
+        two = m.video_dao.video_by_name_and_format('two', 'mp4')
+        self.assertEqual(len(m.videoset_dao.get_video_set(two).videos), 1)
+        self.assertIsNone(m.video_dao.video_by_name_and_format('two', 'avi'))
+
+        # a second run only retries the failed source
+        vt = VideoTranscoder(self.tempdir, m, processes=2, cores=16)
+        vt.is_video = lambda path: path.endswith('.mp4')
+        jobs = []
+        vt._run_job = lambda cmd: jobs.append(cmd.output_paths)
+        vt.run()
+        self.assertEqual(jobs, [[os.path.join(self.tempdir, name) for name in
+                                 ['two.avi', 'two.mpg', 'two_smaller.mp4',
+                                  'two_bigger.mp4']]])
+        m.close()
+
+    def test_read_ppm_frames(self):
+        a = np.arange(2 * 3 * 3, dtype=np.uint8).reshape(2, 3, 3)
+        b = np.full((1, 2, 3), 7, dtype=np.uint8)
+        gray = np.arange(6, dtype=np.uint8).reshape(2, 3)
+        stream = io.BytesIO(b'P6\n3 2\n255\n' + a.tobytes() +
+                            b'P6 # comment\n2\n1 255\n' + b.tobytes() +
+                            b'P5\n3 2\n255\n' + gray.tobytes())
+        frames = list(read_ppm_frames(stream))
+        self.assertEqual(len(frames), 3)
+        self.assertTrue(np.array_equal(frames[0], a))
+        self.assertTrue(np.array_equal(frames[1], b))
+        self.assertTrue(np.array_equal(frames[2], gray))
+        with self.assertRaises(RuntimeError):
+            list(read_ppm_frames(io.BytesIO(b'P6\n3 2\n255\n' +
+                                            a.tobytes()[:-1])))
+
+    def test_streaming(self):
+        m = VideoDataManager(os.path.join(self.tempdir, 'test.db'))
+        with open(os.path.join(self.tempdir, 'clip.mp4'), 'w') as fd:
+            fd.write('source')
+        lle = LLE16x16PointHash(self.tempdir, m)
+        lle.grab_n_frames = 2
+        lle.wanted = lambda path: {1, 3}
+        hashed = []
+
+        def lle_hash(points):
+            hashed.append(np.mean(points))
+            return BitVector(size=480, intVal=len(hashed))
+
+        lle.lle_hash = lle_hash
+        st = StreamingTranscoder(self.tempdir, m, [lle])
+        st.is_video = lambda path: path.endswith('.mp4')
+        streamed = []
+        shades = {None: 100, 'avi': 120, 'mpg': 140, 'mp4': 160}
+
+        def stream_frames(video_input, fmt, vf, wanted):
+            streamed.append((fmt, vf))
+            if vf is not None and '1.0625' in vf:
+                raise RuntimeError('encoder failed')
+            shade = shades[fmt] + (1 if vf is not None else 0)
+            return {n: np.full((16, 16, 3), shade, dtype=np.uint8)
+                    for n in wanted}
+
+        st.stream_frames = stream_frames
+        # recent scipy no longer has imsave
+        with mock.patch('perceptual_hashing.llehash.misc.imsave',
+                        create=True) as imsave, \
+                mock.patch('perceptual_hashing.llehash.gaussian', gaussian):
+            st.run()
+        imsave.assert_not_called()
+        self.assertEqual(streamed, [(None, None), ('avi', None),
+                                    ('mpg', None),
+                                    ('mp4', 'scale=iw*0.9375:ih*0.9375'),
+                                    ('mp4', 'scale=iw*1.0625:ih*1.0625')])
+        self.assertEqual(st.failed, [('clip_bigger', 'mp4')])
+        # every variant was hashed from its own frames
+        self.assertEqual(len(set(hashed)), 4)
+        # nothing but the source was written to disk
+        self.assertEqual([f for f in os.listdir(self.tempdir)
+                          if not f.startswith('test.db')], ['clip.mp4'])
+
+        v = m.video_dao.video_by_name_and_format('clip', 'mp4')
+        videos = m.videoset_dao.get_video_set(v).videos
+        self.assertEqual(sorted((x.name, x.format) for x in videos),
+                         [('clip', 'avi'), ('clip', 'mp4'), ('clip', 'mpg'),
+                          ('clip_smaller', 'mp4')])
+        values = {(x.name, x.format): int(x.hash_values[lle.hash_type()]
+                                          .value, 2) for x in videos}
+        self.assertEqual(values, {('clip', 'mp4'): 1, ('clip', 'avi'): 2,
+                                  ('clip', 'mpg'): 3,
+                                  ('clip_smaller', 'mp4'): 4})
+
+        # a second run only retries what failed
+        del streamed[:]
+        st.run()
+        self.assertEqual(streamed, [('mp4', 'scale=iw*1.0625:ih*1.0625')])
+        m.close()
+
@@ -0,0 +1,174 @@
+import unittest
+import tempfile
+import shutil
+import os
+import multiprocessing
+from perceptual_hashing.work_queue import WorkQueue, QueueWorker
+from perceptual_hashing.video_hashing import PHash
+from perceptual_hashing.data_manager import VideoDataManager, Video
+
+
+################################################################################
+class Clock:
+    ############################################################################
+    def __init__(self):
+        self.now = 1000.0
+        return
+
+    ############################################################################
+    def __call__(self):
+        return self.now
+
+
+################################################################################
+def run_worker(db, path, worker):
+    m = VideoDataManager(db)
+    queue = WorkQueue(m, worker=worker, lease_seconds=30)
+    ph = PHash(path, m)
+    ph.keyframe_hashes = lambda f: [int(os.path.basename(f)[4:]
+                                         .split('.')[0]) + 1]
+    return QueueWorker(queue, path, {'phash-summary': ph}, 2).run()
+
+
+################################################################################
+class testcase(unittest.TestCase):
+    ############################################################################
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.db = os.path.join(self.tempdir, 'test.db')
+        self.m = VideoDataManager(self.db)
+        for n in range(10):
+            with open(os.path.join(self.tempdir, 'file{}.mp4'.format(n)),
+                      'w') as fd:
+                fd.write('Dummy file {}'.format(n))
+            self.m.video_dao.add_video(Video('file{}'.format(n), 'mp4'))
+        return
+
+    ############################################################################
+    def tearDown(self):
+        self.m.close()
+        shutil.rmtree(self.tempdir)
+        return
+
+    ############################################################################
+    def make_queue(self, worker, clock=None, **kwargs):
+        queue = WorkQueue(self.m, worker=worker, **kwargs)
+        if clock is not None:
+            queue.clock = clock
+        return queue
+
+    ############################################################################
+    def test_enqueue(self):
+        queue = self.make_queue('a')
+        v = self.m.video_dao.video_by_name_and_format('file0', 'mp4')
+        PHash(self.tempdir, self.m).store_hash(v, 1)
+        self.assertEqual(queue.enqueue(['phash-summary']), 9)
+        # already queued
+        self.assertEqual(queue.enqueue(['phash-summary']), 0)
+        self.assertEqual(queue.enqueue(['phash-summary', 'other'],
+                                       video_ids=[v.id, v.id + 1]), 2)
+        self.assertEqual(queue.progress()['phash-summary']['pending'], 9)
+        self.assertEqual(queue.progress()['other']['pending'], 2)
+        self.assertEqual(queue.enqueue(['phash-summary'], force=True), 10)
+        self.assertEqual(queue.progress()['phash-summary']['pending'], 10)
+        return
+
+    ############################################################################
+    def test_lease_heartbeat_and_reclaim(self):
+        clock = Clock()
+        a = self.make_queue('a', clock, lease_seconds=10, max_attempts=2)
+        b = self.make_queue('b', clock, lease_seconds=10, max_attempts=2)
+        a.enqueue(['phash-summary'])
+
+        tasks = a.claim(3)
+        self.assertEqual([t.attempts for t in tasks], [1, 1, 1])
+        self.assertEqual(len(b.claim(10)), 7)
+        self.assertEqual(b.claim(10), [])
+        self.assertEqual(a.progress()['phash-summary']['leased'], 10)
+
+        clock.now += 8
+        self.assertEqual(a.heartbeat(tasks[:2]), set(t.id for t in tasks[:2]))
+        clock.now += 5
+        # tasks[2] and all of b's leases ran out, a's renewed ones did not
+        self.assertEqual(a.progress()['phash-summary']['expired'], 8)
+        reclaimed = b.claim(10)
+        self.assertEqual(len(reclaimed), 8)
+        self.assertIn(tasks[2].id, [t.id for t in reclaimed])
+        # a lost tasks[2]
+        self.assertEqual(a.heartbeat(tasks), set(t.id for t in tasks[:2]))
+        self.assertFalse(a.complete(tasks[2]))
+        self.assertTrue(a.complete(tasks[0]))
+
+        # b fails one task for good, gives another back
+        by_id = {t.id: t for t in reclaimed}
+        self.assertTrue(b.fail(by_id[tasks[2].id], 'broken'))
+        self.assertTrue(b.fail(reclaimed[-1], 'broken'))
+        progress = b.progress()['phash-summary']
+        self.assertEqual(progress['failed'], 2)
+        self.assertEqual(progress['done'], 1)
+
+        # expired leases out of attempts are reaped
+        clock.now += 100
+        self.assertEqual(b.reap(), 6)
+        self.assertEqual(b.claim(10)[0].id, tasks[1].id)
+        self.assertFalse(b.is_finished())
+        return
+
+    ############################################################################
+    def test_last_attempt_expires(self):
+        clock = Clock()
+        dead = self.make_queue('dead', clock, lease_seconds=10,
+                               max_attempts=1)
+        alive = self.make_queue('alive', clock, lease_seconds=10,
+                                max_attempts=1)
+        dead.enqueue(['phash-summary'])
+        self.assertEqual(len(dead.claim(10)), 10)
+        self.assertFalse(alive.is_finished())
+
+        # the worker died holding its leases, which was their last attempt
+        clock.now += 11
+        self.assertEqual(alive.progress()['phash-summary']['failed'], 10)
+        self.assertTrue(alive.is_finished())
+        self.assertEqual(alive.claim(10), [])
+        self.assertEqual(alive.reap(), 0)
+        progress = alive.progress()['phash-summary']
+        self.assertEqual(progress['failed'], 10)
+        self.assertEqual(progress['expired'] + progress['leased'], 0)
+        self.assertTrue(alive.is_finished())
+        return
+
+    ############################################################################
+    def test_worker(self):
+        queue = self.make_queue('a')
+        queue.enqueue(['phash-summary', 'missing-method'])
+        os.unlink(os.path.join(self.tempdir, 'file9.mp4'))
+        ph = PHash(self.tempdir, self.m)
+        ph.keyframe_hashes = lambda f: [42]
+        worker = QueueWorker(queue, self.tempdir, {'phash-summary': ph}, 3)
+        # the missing file is tried max_attempts times
+        self.assertEqual(worker.run(), (9, 3))
+
+        progress = queue.progress()
+        self.assertEqual(progress['phash-summary']['done'], 9)
+        self.assertEqual(progress['phash-summary']['failed'], 1)
+        self.assertEqual(progress['missing-method']['pending'], 10)
+        v = self.m.video_dao.video_by_name_and_format('file3', 'mp4')
+        hashes = self.m.hash_dao.get_all_video_hashes(['phash-summary'])
+        self.assertEqual(hashes[v.id]['phash-summary'].value, '42')
+        return
+
+    ############################################################################
+    def test_concurrent_workers(self):
+        self.make_queue('a').enqueue(['phash-summary'])
+        with multiprocessing.Pool(3) as pool:
+            results = pool.starmap(run_worker,
+                                   [(self.db, self.tempdir, 'w{}'.format(n))
+                                    for n in range(3)])
+        self.assertEqual(sum(r[0] for r in results), 10)
+        self.assertEqual(sum(r[1] for r in results), 0)
+        self.assertTrue(self.make_queue('a').is_finished())
+        hashes = self.m.hash_dao.get_all_video_hashes(['phash-summary'])
+        for v in self.m.video_dao.all_videos():
+            self.assertEqual(hashes[v.id]['phash-summary'].value,
+                             str(int(v.name[4:]) + 1))
+        return